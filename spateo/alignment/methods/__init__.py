@@ -1,3 +1,4 @@
+from .dissimilarity import ExpFactors, fit_exp_basis, get_exp_factors
 from .morpho import BA_align
 from .morpho_sparse import BA_align_sparse
 from .paste import (
@@ -6,6 +7,7 @@ from .paste import (
     paste_pairwise_align,
 )
 from .utils import (
+    ChunkPlan,
     PCA_project,
     PCA_recover,
     PCA_reduction,
@@ -17,4 +19,5 @@ from .utils import (
     calc_exp_dissimilarity,
     coarse_rigid_alignment,
     empty_cache,
+    plan_chunks,
 )
@@ -0,0 +1,311 @@
+"""Precomputed factors of the expression dissimilarity between the spots of two samples.
+
+Both expression dissimilarities decompose into a term that only depends on each expression profile and inner products
+of (transformed) expression profiles::
+
+    kl(a, b) = (sum(a log a) + sum(b log b) - a . log b - b . log a) / 2
+    euclidean(a, b) = |a|^2 + |b|^2 - 2 a . b
+
+Hence, after each sample has been transformed once into :class:`ExpFactors`, any block of the dissimilarity matrix is
+given by matrix products. Optionally, the (log-normalized) expression is projected onto a low-rank basis shared by the
+samples, which makes these products much cheaper. Factors and bases can be cached on disk, keyed by a hash of the
+expression matrices and the gene set, such that repeated alignments of the same samples skip this preprocessing.
+"""
+import hashlib
+import os
+import tempfile
+from typing import List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import ot
+import torch
+from sklearn.utils.extmath import randomized_svd
+
+from spateo.logging import logger_manager as lm
+
+from .utils import _dot
+
+CACHE_VERSION = 1
+# Maximum number of spots used to fit the low-rank basis.
+BASIS_MAX_SAMPLES = 50000
+
+
+class ExpFactors(NamedTuple):
+    """Factors of the expression dissimilarity of the spots of a sample, as computed by :func:`exp_factors`.
+
+    Attributes:
+        norm: The term of the dissimilarity that only depends on each spot. Shape: N.
+        X: The (normalized and possibly projected) expression of each spot. Shape: N x G.
+        log_X: The (possibly projected) log-normalized expression of each spot for the ``'kl'`` dissimilarity, None
+            for the ``'euclidean'`` dissimilarity. Shape: N x G.
+    """
+
+    norm: Union[np.ndarray, torch.Tensor]
+    X: Union[np.ndarray, torch.Tensor]
+    log_X: Optional[Union[np.ndarray, torch.Tensor]]
+
+    @property
+    def dissimilarity(self) -> str:
+        return "euclidean" if self.log_X is None else "kl"
+
+    def take(self, idx) -> "ExpFactors":
+        """The factors of a subset of spots."""
+        return ExpFactors(self.norm[idx], self.X[idx], None if self.log_X is None else self.log_X[idx])
+
+
+def _check_dissimilarity(dissimilarity: str) -> str:
+    assert dissimilarity.lower() in [
+        "kl",
+        "euclidean",
+        "euc",
+    ], "``dissimilarity`` value is wrong. Available ``dissimilarity`` are: ``'kl'``, ``'euclidean'`` and ``'euc'``."
+    return "kl" if dissimilarity.lower() == "kl" else "euclidean"
+
+
+def _normalize_exp(X: Union[np.ndarray, torch.Tensor], dissimilarity: str):
+    """The normalized and log-normalized expression used by the KL dissimilarity, or the expression itself for the
+    euclidean dissimilarity."""
+    if dissimilarity == "euclidean":
+        return X, None
+    nx = ot.backend.get_backend(X)
+    X = X + 0.01
+    X = X / nx.sum(X, axis=1, keepdims=True)
+    return X, nx.log(X)
+
+
+def fit_exp_basis(
+    matrices: Sequence[Union[np.ndarray, torch.Tensor]],
+    dissimilarity: str = "kl",
+    n_components: int = 50,
+    seed: int = 0,
+) -> np.ndarray:
+    """Fit a low-rank basis shared by the expression matrices of several samples, which is the span of the top
+    (uncentered) principal components of the log-normalized expression for the ``'kl'`` dissimilarity, or of the
+    expression for the ``'euclidean'`` dissimilarity. At most ``BASIS_MAX_SAMPLES`` randomly selected spots are used.
+
+    Args:
+        matrices: Gene expression matrices of the samples, with the same genes.
+        dissimilarity: Expression dissimilarity measure: ``'kl'`` or ``'euclidean'``.
+        n_components: The rank of the basis.
+        seed: Random seed used to select spots and by the randomized SVD.
+
+    Returns:
+        The orthonormal basis with shape G x n_components.
+    """
+    dissimilarity = _check_dissimilarity(dissimilarity)
+    rng = np.random.default_rng(seed)
+    n_total = sum(X.shape[0] for X in matrices)
+    data = []
+    for X in matrices:
+        X = ot.backend.get_backend(X).to_numpy(X)
+        n = max(1, int(round(BASIS_MAX_SAMPLES * X.shape[0] / n_total))) if n_total > BASIS_MAX_SAMPLES else X.shape[0]
+        if n < X.shape[0]:
+            X = X[np.sort(rng.choice(X.shape[0], n, replace=False))]
+        X, log_X = _normalize_exp(X, dissimilarity)
+        data.append(X if log_X is None else log_X)
+    data = np.concatenate(data, axis=0)
+    n_components = min(n_components, *data.shape)
+    _, _, Vt = randomized_svd(data, n_components, random_state=seed)
+    return Vt.T
+
+
+def exp_factors(
+    X: Union[np.ndarray, torch.Tensor],
+    dissimilarity: str = "kl",
+    basis: Optional[Union[np.ndarray, torch.Tensor]] = None,
+) -> ExpFactors:
+    """Transform an expression matrix into the factors of its expression dissimilarity.
+
+    Args:
+        X: Gene expression matrix of the sample.
+        dissimilarity: Expression dissimilarity measure: ``'kl'`` or ``'euclidean'``.
+        basis: Optional low-rank basis, as returned by :func:`fit_exp_basis`, onto which the expression is projected.
+
+    Returns:
+        The factors of the sample.
+    """
+    nx = ot.backend.get_backend(X)
+    dissimilarity = _check_dissimilarity(dissimilarity)
+    X, log_X = _normalize_exp(X, dissimilarity)
+    norm = nx.sum(X**2, 1) if log_X is None else nx.sum(X * log_X, 1) / 2
+    if basis is not None:
+        basis = nx.from_numpy(basis, type_as=X) if isinstance(basis, np.ndarray) else basis
+        X = _dot(nx)(X, basis)
+        log_X = None if log_X is None else _dot(nx)(log_X, basis)
+    return ExpFactors(norm, X, log_X)
+
+
+def factors_dissimilarity(factors_A: ExpFactors, factors_B: ExpFactors) -> Union[np.ndarray, torch.Tensor]:
+    """Calculate the expression dissimilarity matrix between two samples from their factors.
+
+    Args:
+        factors_A: Factors of sample A.
+        factors_B: Factors of sample B.
+
+    Returns:
+        The dissimilarity matrix with shape N x M.
+    """
+    nx = ot.backend.get_backend(factors_A.X, factors_B.X)
+    if factors_A.log_X is None:
+        cross = 2 * _dot(nx)(factors_A.X, factors_B.X.T)
+    else:
+        cross = (_dot(nx)(factors_A.X, factors_B.log_X.T) + _dot(nx)(factors_A.log_X, factors_B.X.T)) / 2
+    return factors_A.norm[:, None] + factors_B.norm[None, :] - cross
+
+
+def factors_paired_dissimilarity(
+    factors_A: ExpFactors,
+    factors_B: ExpFactors,
+    rows: Union[np.ndarray, torch.Tensor],
+    cols: Union[np.ndarray, torch.Tensor],
+    chunk_size: int = 10000000,
+) -> Union[np.ndarray, torch.Tensor]:
+    """Calculate the expression dissimilarity only between the given pairs of spots, i.e. the entries ``(rows, cols)``
+    of the matrix returned by :func:`factors_dissimilarity`.
+
+    Args:
+        factors_A: Factors of sample A.
+        factors_B: Factors of sample B.
+        rows: Indices of the spots of sample A in each pair.
+        cols: Indices of the spots of sample B in each pair.
+        chunk_size: Maximum number of expression values that are gathered at once.
+
+    Returns:
+        The dissimilarity of each pair.
+    """
+    nx = ot.backend.get_backend(factors_A.X, factors_B.X)
+    step = max(1, chunk_size // max(1, factors_A.X.shape[1]))
+    arr = []  # array for temporary storage of results
+    for start in range(0, rows.shape[0], step):
+        r, c = rows[start : start + step], cols[start : start + step]
+        if factors_A.log_X is None:
+            cross = 2 * nx.sum(factors_A.X[r] * factors_B.X[c], 1)
+        else:
+            cross = (
+                nx.sum(factors_A.X[r] * factors_B.log_X[c], 1) + nx.sum(factors_A.log_X[r] * factors_B.X[c], 1)
+            ) / 2
+        arr.append(factors_A.norm[r] + factors_B.norm[c] - cross)
+    return nx.concatenate(arr, axis=0) if len(arr) > 0 else nx.zeros((0,), type_as=factors_A.norm)
+
+
+def calc_paired_exp_dissimilarity(
+    X_A: Union[np.ndarray, torch.Tensor],
+    X_B: Union[np.ndarray, torch.Tensor],
+    rows: Union[np.ndarray, torch.Tensor],
+    cols: Union[np.ndarray, torch.Tensor],
+    dissimilarity: str = "kl",
+    chunk_size: int = 10000000,
+) -> Union[np.ndarray, torch.Tensor]:
+    """
+    Calculate expression dissimilarity only between the given pairs of spots, i.e. the entries ``(rows, cols)`` of the
+    matrix returned by :func:`~spateo.alignment.methods.utils.calc_exp_dissimilarity`.
+    Args:
+        X_A: Gene expression matrix of sample A.
+        X_B: Gene expression matrix of sample B.
+        rows: Indices of the spots of sample A in each pair.
+        cols: Indices of the spots of sample B in each pair.
+        dissimilarity: Expression dissimilarity measure: ``'kl'`` or ``'euclidean'``.
+        chunk_size: Maximum number of expression values that are gathered at once.
+
+    Returns:
+        Union[np.ndarray, torch.Tensor]: The dissimilarity of each pair of feature samples.
+    """
+    return factors_paired_dissimilarity(
+        exp_factors(X_A, dissimilarity), exp_factors(X_B, dissimilarity), rows, cols, chunk_size=chunk_size
+    )
+
+
+def _hash_matrix(X: Union[np.ndarray, torch.Tensor], genes: Optional[Sequence[str]] = None) -> str:
+    """Hash of the content of an expression matrix and of its gene names."""
+    X = np.ascontiguousarray(ot.backend.get_backend(X).to_numpy(X))
+    sha = hashlib.sha256(f"{X.shape}:{X.dtype.str}".encode())
+    sha.update(X.data)
+    if genes is not None:
+        sha.update("\0".join(map(str, genes)).encode())
+    return sha.hexdigest()
+
+
+def _load_cache(path: str) -> Optional[dict]:
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as f:
+        if int(f["version"]) != CACHE_VERSION:
+            return None
+        return {key: f[key] for key in f.files}
+
+
+def _write_cache(path: str, **arrays):
+    """Write arrays to an .npz file. Arrays are first written to a temporary file, such that incomplete caches are
+    never read."""
+    cache_dir = os.path.dirname(path) or "."
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp.", suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, version=CACHE_VERSION, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_exp_factors(
+    matrices: Sequence[Union[np.ndarray, torch.Tensor]],
+    genes: Optional[Sequence[str]] = None,
+    dissimilarity: str = "kl",
+    n_components: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    verbose: bool = True,
+) -> List[ExpFactors]:
+    """Compute the factors of the expression dissimilarity of several samples, projected onto a shared low-rank basis
+    if ``n_components`` is given.
+
+    Args:
+        matrices: Gene expression matrices of the samples, with the same genes.
+        genes: The genes corresponding to the columns of the expression matrices.
+        dissimilarity: Expression dissimilarity measure: ``'kl'`` or ``'euclidean'``.
+        n_components: The rank of the shared basis. If None, the factors are not projected, such that the
+            dissimilarity is exact.
+        cache_dir: If provided, the basis and factors are loaded from (or saved to) this directory. Caches are keyed
+            by the content of the expression matrices and the gene set.
+        verbose: If ``True``, print progress updates.
+
+    Returns:
+        The factors of each sample.
+    """
+    dissimilarity = _check_dissimilarity(dissimilarity)
+    if cache_dir is None:
+        basis = None if n_components is None else fit_exp_basis(matrices, dissimilarity, n_components)
+        return [exp_factors(X, dissimilarity, basis) for X in matrices]
+
+    hashes = [_hash_matrix(X, genes) for X in matrices]
+    basis, basis_key = None, "full"
+    if n_components is not None:
+        basis_key = hashlib.sha256(f"{dissimilarity}:{n_components}:{':'.join(sorted(hashes))}".encode()).hexdigest()
+        basis_path = os.path.join(cache_dir, f"exp_basis.{basis_key[:32]}.npz")
+        cached = _load_cache(basis_path)
+        if cached is None:
+            basis = fit_exp_basis(matrices, dissimilarity, n_components)
+            _write_cache(basis_path, basis=basis)
+        else:
+            basis = cached["basis"]
+
+    factors = []
+    for X, X_hash in zip(matrices, hashes):
+        nx = ot.backend.get_backend(X)
+        key = hashlib.sha256(f"{dissimilarity}:{basis_key}:{X_hash}".encode()).hexdigest()
+        path = os.path.join(cache_dir, f"exp_factors.{key[:32]}.npz")
+        cached = _load_cache(path)
+        if cached is None:
+            factor = exp_factors(X, dissimilarity, basis)
+            _write_cache(
+                path, **{name: nx.to_numpy(value) for name, value in factor._asdict().items() if value is not None}
+            )
+        else:
+            if verbose:
+                lm.main_debug(f"Using cached expression dissimilarity factors {path}.")
+            factor = ExpFactors(
+                *(nx.from_numpy(cached[name], type_as=X) if name in cached else None for name in ExpFactors._fields)
+            )
+        factors.append(factor)
+    return factors
@@ -4,6 +4,8 @@ import numpy as np
 import ot
 import torch
 from anndata import AnnData
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
 try:
     from typing import Any, Dict, List, Literal, Optional, Tuple, Union
@@ -14,11 +16,19 @@ from typing import List, Optional, Tuple, Union
 
 from spateo.logging import logger_manager as lm
 
+from .dissimilarity import (
+    ExpFactors,
+    factors_dissimilarity,
+    factors_paired_dissimilarity,
+    get_exp_factors,
+)
 from .utils import (
+    P_TEMPORARIES,
     _chunk,
     _data,
     _dot,
     _identity,
+    _itemsize,
     _linalg,
     _mul,
     _pi,
@@ -35,7 +45,11 @@ from .utils import (
     calc_exp_dissimilarity,
     coarse_rigid_alignment,
     empty_cache,
+    get_device,
     get_optimal_R,
+    nx_torch,
+    plan_chunks,
+    scatter_sum,
 )
 
 
@@ -144,8 +158,8 @@ def get_P(
 def get_P_chunk(
     XnAHat: Union[np.ndarray, torch.Tensor],
     XnB: Union[np.ndarray, torch.Tensor],
-    X_A: Union[np.ndarray, torch.Tensor],
-    X_B: Union[np.ndarray, torch.Tensor],
+    X_A: Union[np.ndarray, torch.Tensor, ExpFactors],
+    X_B: Union[np.ndarray, torch.Tensor, ExpFactors],
     sigma2: Union[int, float, np.ndarray, torch.Tensor],
     beta2: Union[int, float, np.ndarray, torch.Tensor],
     alpha: Union[np.ndarray, torch.Tensor],
@@ -153,21 +167,35 @@ def get_P_chunk(
     Sigma: Union[np.ndarray, torch.Tensor],
     samples_s: Optional[List[float]] = None,
     outlier_variance: float = None,
-    chunk_size: int = 1000,
+    chunk_size: Optional[int] = None,
     dissimilarity: str = "kl",
+    memory_budget: Optional[int] = None,
 ) -> Union[np.ndarray, torch.Tensor]:
     """Calculating the generating probability matrix P.
 
     Args:
         XAHat: Current spatial coordinate of sample A. Shape
+        chunk_size: Sample B is split into ``ceil(NA / chunk_size)`` chunks. If None, the number of chunks is planned
+            from ``memory_budget``.
+        memory_budget: The memory budget in bytes. If None, half of the available memory of the device is used.
+        X_A: Gene expression matrix of sample A, or its precomputed dissimilarity factors, in which case
+            ``dissimilarity`` is ignored.
+        X_B: Gene expression matrix of sample B, or its precomputed dissimilarity factors.
     """
     # Get the number of cells in each sample
     NA, NB = XnAHat.shape[0], XnB.shape[0]
-    # Get the number of genes
-    G = X_A.shape[1]
     # Get the number of spatial dimensions
     D = XnAHat.shape[1]
-    chunk_num = int(np.ceil(NA / chunk_size))
+    if chunk_size is None:
+        chunk_num = plan_chunks(
+            n_rows=NB,
+            bytes_per_row=NA * P_TEMPORARIES * _itemsize(XnAHat),
+            memory_budget=memory_budget,
+            device=get_device(XnAHat),
+            name="Probability matrix",
+        ).n_chunks
+    else:
+        chunk_num = int(np.ceil(NA / chunk_size))
 
     assert XnAHat.shape[1] == XnB.shape[1], "XnAHat and XnB do not have the same number of features."
     assert XnAHat.shape[0] == alpha.shape[0], "XnAHat and alpha do not have the same length."
@@ -181,13 +209,20 @@ def get_P_chunk(
         )
     outlier_s = samples_s * NA
     # chunk
-    X_Bs = _chunk(nx, X_B, chunk_num, dim=0)
     XnBs = _chunk(nx, XnB, chunk_num, dim=0)
+    if isinstance(X_B, ExpFactors):
+        bounds = np.cumsum([0] + [xnBs.shape[0] for xnBs in XnBs])
+        X_Bs = [X_B.take(slice(start, end)) for start, end in zip(bounds[:-1], bounds[1:])]
+    else:
+        X_Bs = _chunk(nx, X_B, chunk_num, dim=0)
 
     Ps = []
     for x_Bs, xnBs in zip(X_Bs, XnBs):
-        SpatialDistMat = cal_dist(XnAHat, xnBs)
-        GeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=x_Bs, dissimilarity=dissimilarity)
+        SpatialDistMat = cal_dist(XnAHat, xnBs, chunk_num=1)
+        if isinstance(X_A, ExpFactors):
+            GeneDistMat = factors_dissimilarity(X_A, x_Bs)
+        else:
+            GeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=x_Bs, dissimilarity=dissimilarity, chunk_num=1)
         if outlier_variance is None:
             exp_SpatialMat = nx.exp(-SpatialDistMat / (2 * sigma2))
         else:
@@ -213,6 +248,150 @@ def get_P_chunk(
     return P
 
 
+def get_topk_candidates(
+    XnAHat: Union[np.ndarray, torch.Tensor],
+    XnB: Union[np.ndarray, torch.Tensor],
+    top_k: int,
+) -> Tuple[Any, Any, Any]:
+    """Find, for each spot of sample B, the ``top_k`` spatially nearest spots of sample A with a KD-tree.
+
+    Args:
+        XnAHat: Current spatial coordinate of sample A. Shape: N x D.
+        XnB: Spatial coordinate of sample B (reference sample). Shape: M x D.
+        top_k: The number of candidates kept for each spot of sample B.
+
+    Returns:
+        rows: Index of the spot of sample A of each candidate pair. Shape: M * top_k.
+        cols: Index of the spot of sample B of each candidate pair. Shape: M * top_k.
+        SpatialDist: The squared spatial distance of each candidate pair. Shape: M * top_k.
+    """
+    nx = ot.backend.get_backend(XnAHat, XnB)
+    NA, NB = XnAHat.shape[0], XnB.shape[0]
+    top_k = min(top_k, NA)
+    _, idx = cKDTree(nx.to_numpy(XnAHat)).query(nx.to_numpy(XnB), k=top_k, workers=-1)
+    rows = idx.reshape(NB * top_k).astype(np.int64)
+    cols = np.repeat(np.arange(NB, dtype=np.int64), top_k)
+    if nx_torch(nx):
+        rows = torch.from_numpy(rows).to(XnB.device)
+        cols = torch.from_numpy(cols).to(XnB.device)
+    SpatialDist = nx.sum((XnAHat[rows] - XnB[cols]) ** 2, 1)
+    return rows, cols, SpatialDist
+
+
+def get_P_topk(
+    XnAHat: Union[np.ndarray, torch.Tensor],
+    XnB: Union[np.ndarray, torch.Tensor],
+    sigma2: Union[int, float, np.ndarray, torch.Tensor],
+    beta2: Union[int, float, np.ndarray, torch.Tensor],
+    alpha: Union[np.ndarray, torch.Tensor],
+    gamma: Union[float, np.ndarray, torch.Tensor],
+    Sigma: Union[np.ndarray, torch.Tensor],
+    GeneDist: Union[np.ndarray, torch.Tensor],
+    SpatialDist: Union[np.ndarray, torch.Tensor],
+    rows: Union[np.ndarray, torch.Tensor],
+    cols: Union[np.ndarray, torch.Tensor],
+    samples_s: Optional[List[float]] = None,
+    outlier_variance: float = None,
+) -> Tuple[Any, Any, Any]:
+    """Calculating the generating probability matrix P only on the candidate pairs ``(rows, cols)``, which are
+    usually found with :func:`get_topk_candidates`. The probabilities of all other pairs are assumed to be zero, such
+    that the result equals that of :func:`get_P` when the candidates hold (almost) all of the probability mass.
+
+    Args:
+        XnAHat: Current spatial coordinate of sample A. Shape: N x D.
+        XnB : spatial coordinate of sample B (reference sample). Shape: M x D.
+        sigma2: The spatial coordinate noise.
+        beta2: The gene expression noise.
+        alpha: A vector that encoding each probability generated by the spots of sample A. Shape: N x 1.
+        gamma: Inlier proportion of sample A.
+        Sigma: The posterior covariance matrix of Gaussian process. Shape: N x N or N x 1.
+        GeneDist: The gene expression distance of each candidate pair.
+        SpatialDist: The spatial coordinate distance of each candidate pair.
+        rows: Index of the spot of sample A of each candidate pair.
+        cols: Index of the spot of sample B of each candidate pair.
+        samples_s: The space size of each sample. Area size for 2D samples and volume size for 3D samples.
+        outlier_variance: If provided, the spatial noise used for ``spatial_P`` and for the spatial inlier probability
+            of each spot of sample B is ``sigma2`` divided by ``outlier_variance``.
+    Returns:
+        P: Values of the generating probability matrix P at the candidate pairs.
+        spatial_P: Values of the generating probability matrix at the candidate pairs, from the spatial coordinates
+            only.
+        sigma2_P: Values of the generating probability matrix at the candidate pairs used to update ``sigma2``, from
+            the spatial coordinates only, weighted by the spatial inlier probability.
+    """
+
+    assert XnAHat.shape[1] == XnB.shape[1], "XnAHat and XnB do not have the same number of features."
+    assert XnAHat.shape[0] == alpha.shape[0], "XnAHat and alpha do not have the same length."
+    assert XnAHat.shape[0] == Sigma.shape[0], "XnAHat and Sigma do not have the same length."
+
+    nx = ot.backend.get_backend(XnAHat, XnB)
+    NA, NB, D = XnAHat.shape[0], XnB.shape[0], XnAHat.shape[1]
+    if samples_s is None:
+        samples_s = nx.maximum(
+            _prod(nx)(nx.max(XnAHat, axis=0) - nx.min(XnAHat, axis=0)),
+            _prod(nx)(nx.max(XnB, axis=0) - nx.min(XnB, axis=0)),
+        )
+    outlier_s = samples_s * NA
+    if outlier_variance is None:
+        exp_Spatial = nx.exp(-SpatialDist / (2 * sigma2))
+    else:
+        exp_Spatial = nx.exp(-SpatialDist / (2 * sigma2 / outlier_variance))
+    alpha_term = _mul(nx)(alpha, nx.exp(-Sigma / sigma2))[rows]
+    spatial_term1 = exp_Spatial * alpha_term
+    spatial_outlier = _power(nx)((2 * _pi(nx) * sigma2), _data(nx, D / 2, XnAHat)) * (1 - gamma) / (gamma * outlier_s)
+    spatial_term2 = spatial_outlier + scatter_sum(nx, spatial_term1, cols, NB)
+    spatial_P = spatial_term1 / spatial_term2[cols]
+    spatial_inlier = 1 - spatial_outlier / (spatial_outlier + scatter_sum(nx, exp_Spatial, cols, NB))
+
+    term1 = _mul(nx)(nx.exp(-SpatialDist / (2 * sigma2)), nx.exp(-GeneDist / (2 * beta2))) * alpha_term
+    P = term1 / (scatter_sum(nx, term1, cols, NB)[cols] + 1e-8)
+    P = spatial_inlier[cols] * P
+
+    term1 = nx.exp(-SpatialDist / (2 * sigma2)) * alpha_term
+    sigma2_P = term1 / (scatter_sum(nx, term1, cols, NB)[cols] + 1e-8)
+    sigma2_P = spatial_inlier[cols] * sigma2_P
+    return P, spatial_P, sigma2_P
+
+
+def get_optimal_R_topk(
+    coordsA: Union[np.ndarray, torch.Tensor],
+    coordsB: Union[np.ndarray, torch.Tensor],
+    P: Union[np.ndarray, torch.Tensor],
+    rows: Union[np.ndarray, torch.Tensor],
+    cols: Union[np.ndarray, torch.Tensor],
+    R_init: Union[np.ndarray, torch.Tensor],
+):
+    """Get the optimal rotation matrix R from the values of P at the candidate pairs ``(rows, cols)``.
+
+    Args:
+        coordsA (Union[np.ndarray, torch.Tensor]): The first input matrix with shape n x d
+        coordsB (Union[np.ndarray, torch.Tensor]): The second input matrix with shape m x d
+        P (Union[np.ndarray, torch.Tensor]): Values of the optimal transport matrix at the candidate pairs.
+        rows (Union[np.ndarray, torch.Tensor]): Index of the spot of coordsA of each candidate pair.
+        cols (Union[np.ndarray, torch.Tensor]): Index of the spot of coordsB of each candidate pair.
+
+    Returns:
+        Union[np.ndarray, torch.Tensor]: The optimal rotation matrix R with shape d x d
+    """
+    nx = ot.backend.get_backend(coordsA, coordsB, P, R_init)
+    NA, NB, D = coordsA.shape[0], coordsB.shape[0], coordsA.shape[1]
+    Sp = nx.sum(P)
+    K_NA = scatter_sum(nx, P, rows, NA)
+    K_NB = scatter_sum(nx, P, cols, NB)
+    mu_XnA, mu_XnB = _dot(nx)(K_NA, coordsA) / Sp, _dot(nx)(K_NB, coordsB) / Sp
+    XnABar, XnBBar = coordsA - mu_XnA, coordsB - mu_XnB
+    A = _dot(nx)(scatter_sum(nx, P[:, None] * XnBBar[cols], rows, NA).T, XnABar)
+
+    # get the optimal rotation matrix R
+    svdU, svdS, svdV = _linalg(nx).svd(A)
+    C = _identity(nx, D, type_as=coordsA[0, 0])
+    C[-1, -1] = _linalg(nx).det(_dot(nx)(svdU, svdV))
+    R = _dot(nx)(_dot(nx)(svdU, C), svdV)
+    t = mu_XnB - _dot(nx)(mu_XnA, R.T)
+    optimal_RnA = _dot(nx)(coordsA, R.T) + t
+    return optimal_RnA, R, t
+
+
 def BA_align(
     sampleA: AnnData,
     sampleB: AnnData,
@@ -239,7 +418,10 @@ def BA_align(
     SVI_mode: bool = True,
     batch_size: int = 1000,
     partial_robust_level: float = 25,
-) -> Tuple[Optional[Tuple[AnnData, AnnData]], np.ndarray, np.ndarray]:
+    sparse_top_k: Optional[int] = None,
+    dissimilarity_n_components: Optional[int] = None,
+    dissimilarity_cache_dir: Optional[str] = None,
+) -> Tuple[Optional[Tuple[AnnData, AnnData]], Union[np.ndarray, csr_matrix], np.ndarray]:
     """_summary_
 
     Args:
@@ -269,6 +451,9 @@ def BA_align(
         SVI_mode: Whether to use stochastic variational inferential (SVI) optimization strategy.
         batch_size: The size of the mini-batch of SVI. If set smaller, the calculation will be faster, but it will affect the accuracy, and vice versa. If not set, it is automatically set to one-tenth of the data size.
         partial_robust_level: The robust level of partial alignment. The larger the value, the more robust the alignment to partial cases is. Recommended setting from 1 to 50.
+        sparse_top_k: If set, each spot of sample B only keeps the ``sparse_top_k`` spatially nearest spots of sample A as candidate correspondences, which are found with a KD-tree over the current aligned coordinates of sample A in each iteration. The probability matrix is then only computed on these candidates and returned as a sparse matrix, such that memory scales with the number of spots rather than with the product of the numbers of spots of both samples.
+        dissimilarity_n_components: If set, the expression dissimilarity is approximated by projecting the (log-normalized) expression of both samples onto a shared basis of this rank, which makes computing it much cheaper.
+        dissimilarity_cache_dir: If provided, the precomputed factors of the expression dissimilarity of both samples are cached in this directory, such that repeated alignments of the same samples skip computing them.
     """
     empty_cache(device=device)
     # Preprocessing
@@ -300,28 +485,40 @@ def BA_align(
     del spatial_coords, exp_matrices
 
     NA, NB, D, G = coordsA.shape[0], coordsB.shape[0], coordsA.shape[1], X_A.shape[1]
+    exp_factors_A, exp_factors_B = get_exp_factors(
+        [X_A, X_B],
+        genes=new_samples[0].var_names,
+        dissimilarity=dissimilarity,
+        n_components=dissimilarity_n_components,
+        cache_dir=dissimilarity_cache_dir,
+        verbose=verbose,
+    )
     sub_sample = False
     sub_sample_num = 15000
-    if SVI_mode and (NA > sub_sample_num or NB > sub_sample_num):
+    if (SVI_mode or sparse_top_k is not None) and (NA > sub_sample_num or NB > sub_sample_num):
         if NA > sub_sample_num:
             sub_idx_A = np.random.choice(NA, sub_sample_num, replace=False)
             sub_coordsA = coordsA[sub_idx_A, :]
             sub_X_A = X_A[sub_idx_A, :]
+            sub_exp_factors_A = exp_factors_A.take(sub_idx_A)
         else:
             sub_coordsA = coordsA
             sub_X_A = X_A
+            sub_exp_factors_A = exp_factors_A
         if NB > sub_sample_num:
             sub_idx_B = np.random.choice(NB, sub_sample_num, replace=False)
             sub_coordsB = coordsB[sub_idx_B, :]
             sub_X_B = X_B[sub_idx_B, :]
+            sub_exp_factors_B = exp_factors_B.take(sub_idx_B)
         else:
             sub_coordsB = coordsB
             sub_X_B = X_B
+            sub_exp_factors_B = exp_factors_B
 
-        GeneDistMat = calc_exp_dissimilarity(X_A=sub_X_A, X_B=sub_X_B, dissimilarity=dissimilarity)
+        GeneDistMat = factors_dissimilarity(sub_exp_factors_A, sub_exp_factors_B)
         sub_sample = True
     else:
-        GeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=X_B, dissimilarity=dissimilarity)
+        GeneDistMat = factors_dissimilarity(exp_factors_A, exp_factors_B)
     area = _prod(nx)(nx.max(coordsA, axis=0) - nx.min(coordsA, axis=0))
 
     if nn_init:
@@ -393,7 +590,11 @@ def BA_align(
     beta2_end = nx.max(minGeneDistMat) / 5
     del minGeneDistMat
     if sub_sample:
-        del sub_X_A, sub_X_B, GeneDistMat
+        del sub_X_A, sub_X_B, sub_exp_factors_A, sub_exp_factors_B, GeneDistMat
+    elif sparse_top_k is not None:
+        del GeneDistMat
+    if sparse_top_k is not None:
+        del SpatialDistMat
     # The value of beta2 becomes progressively larger
     beta2 = nx.maximum(beta2, _data(nx, 1e-2, type_as))
     beta2_decrease = _power(nx)(beta2_end / beta2, 1 / (50))
@@ -411,12 +612,13 @@ def BA_align(
         randIdx = randomidx[:batch_size]
         randomIdx = _roll(nx)(randomidx, batch_size)
         randcoordsB = coordsB[randIdx, :]  # batch_size x D
-        if sub_sample:
-            randGeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=X_B[randIdx, :], dissimilarity=dissimilarity)
-            SpatialDistMat = cal_dist(coordsA, randcoordsB)
-        else:
-            randGeneDistMat = GeneDistMat[:, randIdx]  # NA x batch_size
-            SpatialDistMat = SpatialDistMat[:, randIdx]  # NA x batch_size
+        if sparse_top_k is None:
+            if sub_sample:
+                randGeneDistMat = factors_dissimilarity(exp_factors_A, exp_factors_B.take(randIdx))
+                SpatialDistMat = cal_dist(coordsA, randcoordsB)
+            else:
+                randGeneDistMat = GeneDistMat[:, randIdx]  # NA x batch_size
+                SpatialDistMat = SpatialDistMat[:, randIdx]  # NA x batch_size
         Sp, Sp_spatial, Sp_sigma2 = 0, 0, 0
         SigmaInv = nx.zeros((K, K), type_as=type_as)  # K x K
         PXB_term = nx.zeros((NA, D), type_as=type_as)  # NA x D
@@ -440,6 +642,26 @@ def BA_align(
             sampleB.uns[iter_key_added]["scale"][iter] = nx.to_numpy(s)
         if SVI_mode:
             step_size = nx.minimum(_data(nx, 1.0, type_as), SVI_deacy / (iter + 1.0))
+        if sparse_top_k is not None:
+            batch_coordsB, batch_exp_factors_B = (
+                (randcoordsB, exp_factors_B.take(randIdx)) if SVI_mode else (coordsB, exp_factors_B)
+            )
+            rows, cols, SpatialDistMat = get_topk_candidates(XAHat, batch_coordsB, sparse_top_k)
+            P, spatial_P, sigma2_P = get_P_topk(
+                XnAHat=XAHat,
+                XnB=batch_coordsB,
+                sigma2=sigma2,
+                beta2=beta2,
+                alpha=alpha,
+                gamma=gamma,
+                Sigma=SigmaDiag,
+                GeneDist=factors_paired_dissimilarity(exp_factors_A, batch_exp_factors_B, rows, cols),
+                SpatialDist=SpatialDistMat,
+                rows=rows,
+                cols=cols,
+                outlier_variance=outlier_variance,
+            )
+        elif SVI_mode:
             P, spatial_P, sigma2_P = get_P(
                 XnAHat=XAHat,
                 XnB=randcoordsB,
@@ -474,23 +696,35 @@ def BA_align(
             )
             outlier_variance = nx.minimum(outlier_variance * outlier_variance_decrease, max_outlier_variance)
 
-        K_NA = nx.einsum("ij->i", P)
-        K_NB = nx.einsum("ij->j", P)
-        K_NA_spatial = nx.einsum("ij->i", spatial_P)
-        K_NB_spatial = nx.einsum("ij->j", spatial_P)
-        K_NA_sigma2 = nx.einsum("ij->i", sigma2_P)
-        K_NB_sigma2 = nx.einsum("ij->j", sigma2_P)
+        if sparse_top_k is None:
+            K_NA = nx.einsum("ij->i", P)
+            K_NB = nx.einsum("ij->j", P)
+            K_NA_spatial = nx.einsum("ij->i", spatial_P)
+            K_NA_sigma2 = nx.einsum("ij->i", sigma2_P)
+            P_sum, spatial_P_sum, sigma2_P_sum = (
+                nx.einsum("ij->", P),
+                nx.einsum("ij->", spatial_P),
+                nx.einsum("ij->", sigma2_P),
+            )
+            P_XB = _dot(nx)(P, randcoordsB if SVI_mode else coordsB)
+        else:
+            K_NA = scatter_sum(nx, P, rows, NA)
+            K_NB = scatter_sum(nx, P, cols, batch_coordsB.shape[0])
+            K_NA_spatial = scatter_sum(nx, spatial_P, rows, NA)
+            K_NA_sigma2 = scatter_sum(nx, sigma2_P, rows, NA)
+            P_sum, spatial_P_sum, sigma2_P_sum = nx.sum(P), nx.sum(spatial_P), nx.sum(sigma2_P)
+            P_XB = scatter_sum(nx, P[:, None] * batch_coordsB[cols], rows, NA)
 
         # Update gamma
         if SVI_mode:
-            Sp = step_size * nx.einsum("ij->", P) + (1 - step_size) * Sp
-            Sp_spatial = step_size * nx.einsum("ij->", spatial_P) + (1 - step_size) * Sp_spatial
-            Sp_sigma2 = step_size * nx.einsum("ij->", sigma2_P) + (1 - step_size) * Sp_sigma2
+            Sp = step_size * P_sum + (1 - step_size) * Sp
+            Sp_spatial = step_size * spatial_P_sum + (1 - step_size) * Sp_spatial
+            Sp_sigma2 = step_size * sigma2_P_sum + (1 - step_size) * Sp_sigma2
             gamma = nx.exp(_psi(nx)(gamma_a + Sp_spatial) - _psi(nx)(gamma_a + gamma_b + batch_size))
         else:
-            Sp = nx.einsum("ij->", P)
-            Sp_spatial = nx.einsum("ij->", spatial_P)
-            Sp_sigma2 = nx.einsum("ij->", sigma2_P)
+            Sp = P_sum
+            Sp_spatial = spatial_P_sum
+            Sp_sigma2 = sigma2_P_sum
             gamma = nx.exp(_psi(nx)(gamma_a + Sp_spatial) - _psi(nx)(gamma_a + gamma_b + NB))
         gamma = _data(nx, 0.99, type_as) if gamma > 0.99 else gamma
         gamma = _data(nx, 0.01, type_as) if gamma < 0.01 else gamma
@@ -506,10 +740,7 @@ def BA_align(
                     + (1 - step_size) * SigmaInv
                 )
                 term1 = _dot(nx)(_pinv(nx)(SigmaInv), U.T)
-                PXB_term = (
-                    step_size * (_dot(nx)(P, randcoordsB) - nx.einsum("ij,i->ij", RnA, K_NA))
-                    + (1 - step_size) * PXB_term
-                )
+                PXB_term = step_size * (P_XB - nx.einsum("ij,i->ij", RnA, K_NA)) + (1 - step_size) * PXB_term
                 Coff = _dot(nx)(term1, PXB_term)
                 VnA = _dot(nx)(
                     U,
@@ -522,7 +753,7 @@ def BA_align(
                     U.T,
                 )
                 SigmaDiag = sigma2 * nx.einsum("ij->i", nx.einsum("ij,ji->ij", U, term1))
-                Coff = _dot(nx)(term1, (_dot(nx)(P, coordsB) - nx.einsum("ij,i->ij", RnA, K_NA)))
+                Coff = _dot(nx)(term1, (P_XB - nx.einsum("ij,i->ij", RnA, K_NA)))
                 VnA = _dot(nx)(
                     U,
                     Coff,
@@ -559,7 +790,7 @@ def BA_align(
         if SVI_mode:
             A = -(
                 _dot(nx)(PXA.T, t)
-                + _dot(nx)(coordsA.T, nx.einsum("ij,i->ij", VnA, K_NA) - _dot(nx)(P, randcoordsB))
+                + _dot(nx)(coordsA.T, nx.einsum("ij,i->ij", VnA, K_NA) - P_XB)
                 + 2
                 * lambdaReg
                 * sigma2
@@ -568,7 +799,7 @@ def BA_align(
         else:
             A = -(
                 _dot(nx)(PXA.T, t)
-                + _dot(nx)(coordsA.T, nx.einsum("ij,i->ij", VnA, K_NA) - _dot(nx)(P, coordsB))
+                + _dot(nx)(coordsA.T, nx.einsum("ij,i->ij", VnA, K_NA) - P_XB)
                 + 2
                 * lambdaReg
                 * sigma2
@@ -586,16 +817,18 @@ def BA_align(
         XAHat = RnA + VnA
 
         # Update sigma2 and beta2
-        if SVI_mode:
-            SpatialDistMat = cal_dist(XAHat, randcoordsB)
+        if sparse_top_k is not None:
+            SpatialDistMat = nx.sum((XAHat[rows] - batch_coordsB[cols]) ** 2, 1)
+            sigma2_P_dist = nx.sum(sigma2_P * SpatialDistMat)
         else:
-            SpatialDistMat = cal_dist(XAHat, coordsB)
+            if SVI_mode:
+                SpatialDistMat = cal_dist(XAHat, randcoordsB)
+            else:
+                SpatialDistMat = cal_dist(XAHat, coordsB)
+            sigma2_P_dist = nx.einsum("ij,ij", sigma2_P, SpatialDistMat)
         sigma2_old = sigma2
         sigma2 = nx.maximum(
-            (
-                nx.einsum("ij,ij", sigma2_P, SpatialDistMat) / (D * Sp_sigma2)
-                + nx.einsum("i,i", K_NA_sigma2, SigmaDiag) / Sp_sigma2
-            ),
+            (sigma2_P_dist / (D * Sp_sigma2) + nx.einsum("i,i", K_NA_sigma2, SigmaDiag) / Sp_sigma2),
             _data(nx, 1e-3, type_as),
         )
         sigma2_terc = nx.abs((sigma2 - sigma2_old) / sigma2)
@@ -605,20 +838,38 @@ def BA_align(
             randIdx = randomidx[:batch_size]
             randomidx = _roll(nx)(randomidx, batch_size)
             randcoordsB = coordsB[randIdx, :]
-            if sub_sample:
-                randGeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=X_B[randIdx, :], dissimilarity=dissimilarity)
-            else:
-                randGeneDistMat = GeneDistMat[:, randIdx]  # NA x batch_size
-            SpatialDistMat = cal_dist(XAHat, randcoordsB)
+            if sparse_top_k is None:
+                if sub_sample:
+                    randGeneDistMat = factors_dissimilarity(exp_factors_A, exp_factors_B.take(randIdx))
+                else:
+                    randGeneDistMat = GeneDistMat[:, randIdx]  # NA x batch_size
+                SpatialDistMat = cal_dist(XAHat, randcoordsB)
         empty_cache(device=device)
 
     # full data
-    if SVI_mode:
+    if sparse_top_k is not None:
+        if SVI_mode:
+            rows, cols, SpatialDistMat = get_topk_candidates(XAHat, coordsB, sparse_top_k)
+            P, _, _ = get_P_topk(
+                XnAHat=XAHat,
+                XnB=coordsB,
+                sigma2=sigma2,
+                beta2=beta2,
+                alpha=alpha,
+                gamma=gamma,
+                Sigma=SigmaDiag,
+                GeneDist=factors_paired_dissimilarity(exp_factors_A, exp_factors_B, rows, cols),
+                SpatialDist=SpatialDistMat,
+                rows=rows,
+                cols=cols,
+                outlier_variance=outlier_variance,
+            )
+    elif SVI_mode:
         P = get_P_chunk(
             XnAHat=XAHat,
             XnB=coordsB,
-            X_A=X_A,
-            X_B=X_B,
+            X_A=exp_factors_A,
+            X_B=exp_factors_B,
             sigma2=sigma2,
             beta2=beta2,
             alpha=alpha,
@@ -627,12 +878,23 @@ def BA_align(
             outlier_variance=outlier_variance,
         )
     # Get optimal Rigid transformation
-    optimal_RnA, optimal_R, optimal_t = get_optimal_R(
-        coordsA=coordsA,
-        coordsB=coordsB,
-        P=P,
-        R_init=R,
-    )
+    if sparse_top_k is not None:
+        optimal_RnA, optimal_R, optimal_t = get_optimal_R_topk(
+            coordsA=coordsA,
+            coordsB=coordsB,
+            P=P,
+            rows=rows,
+            cols=cols,
+            R_init=R,
+        )
+        P = csr_matrix((nx.to_numpy(P), (nx.to_numpy(rows), nx.to_numpy(cols))), shape=(NA, NB))
+    else:
+        optimal_RnA, optimal_R, optimal_t = get_optimal_R(
+            coordsA=coordsA,
+            coordsB=coordsB,
+            P=P,
+            R_init=R,
+        )
 
     if verbose:
         lm.main_info(f"Key Parameters: gamma: {gamma}; beta2: {beta2}; sigma2: {sigma2}")
@@ -679,6 +941,6 @@ def BA_align(
     empty_cache(device=device)
     return (
         None if inplace else (sampleA, sampleB),
-        nx.to_numpy(P.T),
+        P.T.tocsr() if sparse_top_k is not None else nx.to_numpy(P.T),
         nx.to_numpy(sigma2),
     )
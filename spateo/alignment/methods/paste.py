@@ -8,6 +8,7 @@ from sklearn.decomposition import NMF
 
 from spateo.logging import logger_manager as lm
 
+from .dissimilarity import factors_dissimilarity, get_exp_factors
 from .utils import (
     align_preprocess,
     calc_exp_dissimilarity,
@@ -40,6 +41,8 @@ def paste_pairwise_align(
     dtype: str = "float32",
     device: str = "cpu",
     verbose: bool = True,
+    dissimilarity_n_components: Optional[int] = None,
+    dissimilarity_cache_dir: Optional[str] = None,
 ) -> Tuple[np.ndarray, Optional[int]]:
     """
     Calculates and returns optimal alignment of two slices.
@@ -63,6 +66,8 @@ def paste_pairwise_align(
         dtype: The floating-point number type. Only float32 and float64.
         device: Equipment used to run the program. You can also set the specified GPU for running. E.g.: '0'.
         verbose: If ``True``, print progress updates.
+        dissimilarity_n_components: If set, the expression dissimilarity is approximated by projecting the (log-normalized) expression of both samples onto a shared basis of this rank.
+        dissimilarity_cache_dir: If provided, the precomputed factors of the expression dissimilarity of both samples are cached in this directory, such that repeated alignments of the same samples skip computing them.
 
     Returns:
         pi: Alignment of spots.
@@ -90,7 +95,19 @@ def paste_pairwise_align(
 
     # Calculate expression dissimilarity
     X_A, X_B = exp_matrices[0], exp_matrices[1]
-    M = calc_exp_dissimilarity(X_A=X_A, X_B=X_B, dissimilarity=dissimilarity)
+    if dissimilarity_n_components is None and dissimilarity_cache_dir is None:
+        M = calc_exp_dissimilarity(X_A=X_A, X_B=X_B, dissimilarity=dissimilarity)
+    else:
+        M = factors_dissimilarity(
+            *get_exp_factors(
+                [X_A, X_B],
+                genes=new_samples[0].var_names,
+                dissimilarity=dissimilarity,
+                n_components=dissimilarity_n_components,
+                cache_dir=dissimilarity_cache_dir,
+                verbose=verbose,
+            )
+        )
 
     # init distributions
     a = np.ones((sampleA.shape[0],)) / sampleA.shape[0] if a_distribution is None else np.asarray(a_distribution)
@@ -1,9 +1,10 @@
 import os
-from typing import Any, List, Optional, Tuple, Union
+from typing import Any, List, NamedTuple, Optional, Tuple, Union
 
 import numpy as np
 import ot
 import pandas as pd
+import psutil
 import torch
 from anndata import AnnData
 from numpy import ndarray
@@ -340,6 +341,112 @@ def _mask_from_label_prior(
     return label_mask
 
 
+##################
+# Chunk planning #
+##################
+
+# Estimated number of (chunk rows x columns) temporaries alive at once in ``_dist`` and ``get_P_chunk``.
+DIST_TEMPORARIES = 4
+P_TEMPORARIES = 8
+
+
+class ChunkPlan(NamedTuple):
+    """Plan for processing the rows of a matrix in chunks.
+
+    Attributes:
+        n_rows: The number of rows to process.
+        chunk_size: The number of rows processed at once.
+        n_chunks: The number of chunks.
+        bytes_per_row: The estimated working memory that each row needs, in bytes.
+        memory_budget: The memory budget the plan was derived from, in bytes.
+    """
+
+    n_rows: int
+    chunk_size: int
+    n_chunks: int
+    bytes_per_row: int
+    memory_budget: int
+
+
+def get_device(x: Union[np.ndarray, torch.Tensor]) -> str:
+    """The device of an array, in the form used by ``check_backend``: ``'cpu'`` or the index of the GPU."""
+    if isinstance(x, torch.Tensor) and x.is_cuda:
+        return str(x.device.index or 0)
+    return "cpu"
+
+
+def get_memory_budget(device: str = "cpu", fraction: float = 0.5) -> int:
+    """Get a memory budget from the currently available memory of a device.
+
+    Args:
+        device: ``'cpu'`` or the index of the GPU.
+        fraction: The fraction of the available memory to use.
+
+    Returns:
+        The memory budget in bytes.
+    """
+    if device != "cpu" and torch.cuda.is_available():
+        available, _ = torch.cuda.mem_get_info(int(device))
+    else:
+        available = psutil.virtual_memory().available
+    return int(available * fraction)
+
+
+def plan_chunks(
+    n_rows: int,
+    bytes_per_row: int,
+    memory_budget: Optional[int] = None,
+    device: str = "cpu",
+    name: Optional[str] = None,
+) -> ChunkPlan:
+    """Derive the largest chunk size whose working memory fits in a memory budget.
+
+    Args:
+        n_rows: The number of rows to process.
+        bytes_per_row: The estimated working memory that each row needs, in bytes.
+        memory_budget: The memory budget in bytes. If None, half of the memory currently available on ``device`` is
+            used.
+        device: The device the chunks are processed on, used to detect the available memory.
+        name: Name of the calculation, used for logging the plan.
+
+    Returns:
+        The chunk plan.
+    """
+    if memory_budget is None:
+        memory_budget = get_memory_budget(device)
+    chunk_size = int(min(max(memory_budget // max(bytes_per_row, 1), 1), max(n_rows, 1)))
+    plan = ChunkPlan(
+        n_rows=n_rows,
+        chunk_size=chunk_size,
+        n_chunks=int(np.ceil(n_rows / chunk_size)),
+        bytes_per_row=bytes_per_row,
+        memory_budget=memory_budget,
+    )
+    if name is not None:
+        lm.main_debug(f"{name}: {plan}")
+    return plan
+
+
+def _itemsize(*arrays: Union[np.ndarray, torch.Tensor]) -> int:
+    return max(x.element_size() if isinstance(x, torch.Tensor) else x.dtype.itemsize for x in arrays)
+
+
+def plan_dist_chunks(
+    X_A: Union[np.ndarray, torch.Tensor],
+    X_B: Union[np.ndarray, torch.Tensor],
+    memory_budget: Optional[int] = None,
+    name: Optional[str] = None,
+) -> ChunkPlan:
+    """Plan the chunks of the rows of ``X_A`` for calculating a distance matrix between ``X_A`` and ``X_B``."""
+    return plan_chunks(
+        n_rows=X_A.shape[0],
+        bytes_per_row=X_B.shape[0] * DIST_TEMPORARIES * _itemsize(X_A, X_B),
+        memory_budget=memory_budget,
+        device=get_device(X_A),
+        name=name,
+    )
+
+
 ######################################
 # Calculate expression dissimilarity #
 ######################################
@@ -485,7 +592,8 @@ def calc_exp_dissimilarity(
     X_A: Union[np.ndarray, torch.Tensor],
     X_B: Union[np.ndarray, torch.Tensor],
     dissimilarity: str = "kl",
-    chunk_num: int = 1,
+    chunk_num: Optional[int] = None,
+    memory_budget: Optional[int] = None,
 ) -> Union[np.ndarray, torch.Tensor]:
     """
     Calculate expression dissimilarity.
@@ -493,6 +601,8 @@ def calc_exp_dissimilarity(
         X_A: Gene expression matrix of sample A.
         X_B: Gene expression matrix of sample B.
         dissimilarity: Expression dissimilarity measure: ``'kl'`` or ``'euclidean'``.
+        chunk_num: The number of chunks of the rows of ``X_A``. If None, it is planned from ``memory_budget``.
+        memory_budget: The memory budget in bytes. If None, half of the available memory is used.
 
     Returns:
         Union[np.ndarray, torch.Tensor]: The dissimilarity matrix of two feature samples.
@@ -509,34 +619,50 @@ def calc_exp_dissimilarity(
         X_B = X_B + 0.01
         X_A = X_A / nx.sum(X_A, axis=1, keepdims=True)
         X_B = X_B / nx.sum(X_B, axis=1, keepdims=True)
-    while True:
-        try:
-            if chunk_num == 1:
-                DistMat = _dist(X_A, X_B, dissimilarity)
-                break
-            else:
-                X_As = _chunk(nx, X_A, chunk_num, 0)
-                X_Bs = _chunk(nx, X_B, chunk_num, 0)
-                arr = []  # array for temporary storage of results
-                for x_As in X_As:
-                    arr2 = []
-                    for x_Bs in X_Bs:
-                        arr2.append(_dist(x_As, x_Bs, dissimilarity))
-                    arr.append(nx.concatenate(arr2, axis=1))
-                DistMat = nx.concatenate(arr, axis=0)
-                break
-        except:
-            chunk_num = chunk_num * 2
-            print("chunk more")
+    if chunk_num is None:
+        chunk_num = plan_dist_chunks(X_A, X_B, memory_budget, name="Expression dissimilarity").n_chunks
+    if chunk_num == 1:
+        return _dist(X_A, X_B, dissimilarity)
+    X_As = _chunk(nx, X_A, chunk_num, 0)
+    DistMat = nx.concatenate([_dist(x_As, X_B, dissimilarity) for x_As in X_As], axis=0)
     return DistMat
 
 
+def scatter_sum(
+    nx: Union[ot.backend.TorchBackend, ot.backend.NumpyBackend],
+    values: Union[np.ndarray, torch.Tensor],
+    index: Union[np.ndarray, torch.Tensor],
+    n: int,
+) -> Union[np.ndarray, torch.Tensor]:
+    """Sum the rows of ``values`` that share the same ``index``, i.e. the row (or column) sums of a sparse matrix in
+    coordinate format.
+
+    Args:
+        nx: The backend.
+        values: The values to sum, with shape m or m x d.
+        index: The output row of each of the m values.
+        n: The number of output rows.
+
+    Returns:
+        Union[np.ndarray, torch.Tensor]: The sums with shape n or n x d.
+    """
+    if nx_torch(nx):
+        out = torch.zeros((n,) + tuple(values.shape[1:]), dtype=values.dtype, device=values.device)
+        return out.index_add_(0, index, values)
+    if values.ndim == 1:
+        return np.bincount(index, weights=values, minlength=n).astype(values.dtype, copy=False)
+    return np.stack(
+        [np.bincount(index, weights=values[:, i], minlength=n) for i in range(values.shape[1])], axis=1
+    ).astype(values.dtype, copy=False)
+
+
 def cal_dist(
     X_A: Union[np.ndarray, torch.Tensor],
     X_B: Union[np.ndarray, torch.Tensor],
     use_gpu: bool = True,
-    chunk_num: int = 1,
+    chunk_num: Optional[int] = None,
     return_gpu: bool = True,
+    memory_budget: Optional[int] = None,
 ) -> Union[np.ndarray, torch.Tensor]:
     """Calculate the distance between two vectors
 
@@ -544,7 +670,9 @@ def cal_dist(
         X_A (Union[np.ndarray, torch.Tensor]): The first input vector with shape n x d
         X_B (Union[np.ndarray, torch.Tensor]): The second input vector with shape m x d
         use_gpu (bool, optional): Whether to use GPU for chunk. Defaults to True.
-        chunk_num (int, optional): The number of chunks. The larger the number, the smaller the GPU memory usage, but the slower the calculation speed. Defaults to 1.
+        chunk_num (int, optional): The number of chunks. The larger the number, the smaller the GPU memory usage, but the slower the calculation speed. If None, it is planned from ``memory_budget``. Defaults to None.
+        return_gpu (bool, optional): Whether to move a chunked result back to the GPU. Defaults to True.
+        memory_budget (int, optional): The memory budget in bytes. If None, half of the available memory of the device of ``X_A`` is used. Defaults to None.
 
     Returns:
         Union[np.ndarray, torch.Tensor]: Distance matrix of two vectors with shape n x m.
@@ -556,45 +684,24 @@ def cal_dist(
             data_on_gpu = True
     type_as = X_A[0, 0].cpu() if nx_torch(nx) else X_A[0, 0]
     use_gpu = True if use_gpu and nx_torch(nx) and torch.cuda.is_available() else False
-    chunk_flag = False
-    while True:
-        try:
-            if chunk_num == 1:
-                DistMat = _dist(X_A, X_B, "euc")
-                break
-            else:
-                # convert to numpy to save the GPU memory
-                if chunk_flag == False:
-                    X_A, X_B = nx.to_numpy(X_A), nx.to_numpy(X_B)
-                chunk_flag = True
-                # chunk
-                X_As = np.array_split(X_A, chunk_num, axis=0)
-                X_Bs = np.array_split(X_B, chunk_num, axis=0)
-                arr = []  # array for temporary storage of results
-                for x_As in X_As:
-                    arr2 = []  # array for temporary storage of results
-                    for x_Bs in X_Bs:
-                        if use_gpu:
-                            arr2.append(
-                                ot.dist(
-                                    nx.from_numpy(x_As, type_as=type_as).cuda(),
-                                    nx.from_numpy(x_Bs, type_as=type_as).cuda(),
-                                ).cpu()
-                            )
-                        else:
-                            arr2.append(
-                                ot.dist(
-                                    nx.from_numpy(x_As, type_as=type_as),
-                                    nx.from_numpy(x_Bs, type_as=type_as),
-                                )
-                            )
-                    arr.append(nx.concatenate(arr2, axis=1))
-                DistMat = nx.concatenate(arr, axis=0)  # not convert to GPU
-                break
-        except:
-            chunk_num = chunk_num * 2
-            print("dist chunk more")
-    if data_on_gpu and chunk_num != 1 and return_gpu:
+    if chunk_num is None:
+        chunk_num = plan_dist_chunks(X_A, X_B, memory_budget, name="Spatial distance").n_chunks
+    if chunk_num == 1:
+        return _dist(X_A, X_B, "euc")
+
+    # convert to numpy to save the GPU memory
+    X_A, X_B = nx.to_numpy(X_A), nx.to_numpy(X_B)
+    x_B = nx.from_numpy(X_B, type_as=type_as)
+    if use_gpu:
+        x_B = x_B.cuda()
+    arr = []  # array for temporary storage of results
+    for x_As in np.array_split(X_A, chunk_num, axis=0):
+        if use_gpu:
+            arr.append(ot.dist(nx.from_numpy(x_As, type_as=type_as).cuda(), x_B).cpu())
+        else:
+            arr.append(ot.dist(nx.from_numpy(x_As, type_as=type_as), x_B))
+    DistMat = nx.concatenate(arr, axis=0)  # not convert to GPU
+    if data_on_gpu and return_gpu:
         DistMat = DistMat.cuda()
     return DistMat
 
@@ -604,7 +711,8 @@ def cal_dot(
     mat2: Union[np.ndarray, torch.Tensor],
     use_chunk: bool = False,
     use_gpu: bool = True,
-    chunk_num: int = 20,
+    chunk_num: Optional[int] = None,
+    memory_budget: Optional[int] = None,
 ) -> Union[np.ndarray, torch.Tensor]:
     """Calculate the matrix multiplication of two matrices
 
@@ -613,7 +721,8 @@ def cal_dot(
         mat2 (Union[np.ndarray, torch.Tensor]): The second input matrix with shape d x m. We suppose m << n and does not require chunk.
         use_chunk (bool, optional): Whether to use chunk to reduce the GPU memory usage. Note that if set to ``True'' it will slow down the calculation. Defaults to False.
         use_gpu (bool, optional): Whether to use GPU for chunk. Defaults to True.
-        chunk_num (int, optional): The number of chunks. The larger the number, the smaller the GPU memory usage, but the slower the calculation speed. Defaults to 20.
+        chunk_num (int, optional): The number of chunks. The larger the number, the smaller the GPU memory usage, but the slower the calculation speed. If None, it is planned from ``memory_budget``. Defaults to None.
+        memory_budget (int, optional): The memory budget in bytes. If None, half of the available memory of the device is used. Defaults to None.
 
     Returns:
         Union[np.ndarray, torch.Tensor]: Matrix multiplication result with shape n x m
@@ -629,6 +738,14 @@ def cal_dot(
         mat1 = nx.to_numpy(mat1)
         if use_gpu:
             mat2 = mat2.cuda()
+        if chunk_num is None:
+            chunk_num = plan_chunks(
+                n_rows=mat1.shape[0],
+                bytes_per_row=(mat1.shape[1] + mat2.shape[1]) * _itemsize(mat1, mat2),
+                memory_budget=memory_budget,
+                device=get_device(mat2),
+                name="Matrix multiplication",
+            ).n_chunks
         # chunk
         mat1s = np.array_split(mat1, chunk_num, axis=0)
         arr = []  # array for temporary storage of results
@@ -12,7 +12,34 @@ from spateo.logging import logger_manager as lm
 
 from .methods import BA_align, empty_cache
 from .transform import BA_transform, BA_transform_and_assignment
-from .utils import _iteration, downsampling
+from .utils import (
+    _apply_affine,
+    _compose_affine,
+    _fit_affine,
+    _iteration,
+    downsampling,
+    run_pairwise,
+)
+
+
+def _morpho_pair(
+    sampleA: AnnData,
+    sampleB: AnnData,
+    iter_key_added: Optional[str] = None,
+    vecfld_key_added: Optional[str] = None,
+    **kwargs,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, dict]:
+    """Align a pair of models with ``BA_align`` and return the results that ``morpho_align`` stores in sampleB."""
+    _, P, sigma2 = BA_align(
+        sampleA=sampleA,
+        sampleB=sampleB,
+        iter_key_added=iter_key_added,
+        vecfld_key_added=vecfld_key_added,
+        inplace=True,
+        **kwargs,
+    )
+    uns = {key: sampleB.uns[key] for key in (iter_key_added, vecfld_key_added) if key is not None}
+    return P, sigma2, sampleB.obsm["Rigid_align_spatial"], sampleB.obsm["Nonrigid_align_spatial"], uns
 
 
 def morpho_align(
@@ -30,6 +57,7 @@ def morpho_align(
     dtype: str = "float32",
     device: str = "cpu",
     verbose: bool = True,
+    n_jobs: int = 1,
     **kwargs,
 ) -> Tuple[List[AnnData], List[np.ndarray], List[np.ndarray]]:
     """
@@ -53,6 +81,10 @@ def morpho_align(
         dtype: The floating-point number type. Only ``float32`` and ``float64``.
         device: Equipment used to run the program. You can also set the specified GPU for running. ``E.g.: '0'``.
         verbose: If ``True``, print progress updates.
+        n_jobs: Number of worker processes used to align consecutive pairs of models concurrently. If not 1, each
+            model is aligned to the unaligned previous model, and the resulting transformations are then composed
+            along the series. In ``'SN-N'`` mode, the previous model is then only aligned by the affine transformation
+            that best fits its non-rigid alignment. -1 means using all processors.
         **kwargs: Additional parameters that will be passed to ``BA_align`` function.
 
     Returns:
@@ -70,6 +102,42 @@ def morpho_align(
         m.obsm["Nonrigid_align_spatial"] = m.obsm[spatial_key]
 
     pis, sigma2s = [], []
+    if n_jobs != 1:
+        results = run_pairwise(
+            _morpho_pair,
+            align_models,
+            layer=layer,
+            spatial_key=spatial_key,
+            n_jobs=n_jobs,
+            genes=genes,
+            key_added=key_added,
+            iter_key_added=iter_key_added,
+            vecfld_key_added=vecfld_key_added,
+            dissimilarity=dissimilarity,
+            max_iter=max_iter,
+            dtype=dtype,
+            device=device,
+            verbose=False,
+            SVI_mode=SVI_mode,
+            **kwargs,
+        )
+        # Compose the transformations of the pairs along the series.
+        D = align_models[0].obsm[spatial_key].shape[1]
+        transform = np.vstack([np.eye(D), np.zeros((1, D))])
+        for modelB, (P, sigma2, rigid, nonrigid, uns) in zip(align_models[1:], results):
+            modelB.obsm["Rigid_align_spatial"] = _apply_affine(transform, rigid)
+            modelB.obsm["Nonrigid_align_spatial"] = _apply_affine(transform, nonrigid)
+            modelB.uns.update(uns)
+            aligned = rigid if mode == "SN-S" else nonrigid
+            transform = _compose_affine(transform, _fit_affine(modelB.obsm[spatial_key], aligned))
+            if mode == "SN-S":
+                modelB.obsm[key_added] = modelB.obsm["Rigid_align_spatial"]
+            elif mode == "SN-N":
+                modelB.obsm[key_added] = modelB.obsm["Nonrigid_align_spatial"]
+            pis.append(P)
+            sigma2s.append(sigma2)
+        return align_models, pis, sigma2s
+
     progress_name = f"Models alignment based on morpho, mode: {mode}."
     for i in _iteration(n=len(align_models) - 1, progress_name=progress_name, verbose=True):
         modelA = align_models[i]
@@ -7,7 +7,13 @@ from spateo.configuration import SKM
 
 from .methods import generalized_procrustes_analysis, paste_pairwise_align
 from .transform import paste_transform
-from .utils import _iteration, downsampling
+from .utils import _iteration, downsampling, run_pairwise
+
+
+def _paste_pair(sampleA: AnnData, sampleB: AnnData, **kwargs) -> np.ndarray:
+    """Calculate the optimal alignment of a pair of models with ``paste_pairwise_align`` and return its pi matrix."""
+    pi, _ = paste_pairwise_align(sampleA=sampleA, sampleB=sampleB, **kwargs)
+    return pi
 
 
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE, "models")
@@ -24,6 +30,7 @@ def paste_align(
     dtype: str = "float64",
     device: str = "cpu",
     verbose: bool = True,
+    n_jobs: int = 1,
     **kwargs,
 ) -> Tuple[List[AnnData], List[Union[np.ndarray, np.ndarray]]]:
     """
@@ -45,6 +52,9 @@ def paste_align(
         dtype: The floating-point number type. Only ``float32`` and ``float64``.
         device: Equipment used to run the program. You can also set the specified GPU for running. ``E.g.: '0'``.
         verbose: If ``True``, print progress updates.
+        n_jobs: Number of worker processes used to calculate the pi matrices of consecutive pairs of models
+            concurrently. Since FGW-OT only depends on the distances within each model, the pi matrices do not depend
+            on the previous alignments. -1 means using all processors.
         **kwargs: Additional parameters that will be passed to ``pairwise_align`` function.
 
     Returns:
@@ -56,26 +66,46 @@ def paste_align(
 
     pis = []
     align_models = [model.copy() for model in models]
-    for i in _iteration(n=len(align_models) - 1, progress_name="Models alignment", verbose=verbose):
-        modelA = align_models[i]
-        modelB = align_models[i + 1]
-
-        # Calculate and returns optimal alignment of two models.
-        pi, _ = paste_pairwise_align(
-            sampleA=modelA.copy(),
-            sampleB=modelB.copy(),
+    if n_jobs != 1:
+        pis = run_pairwise(
+            _paste_pair,
+            align_models,
             layer=layer,
-            genes=genes,
             spatial_key=key_added,
+            n_jobs=n_jobs,
+            genes=genes,
             alpha=alpha,
             numItermax=numItermax,
             numItermaxEmd=numItermaxEmd,
             dtype=dtype,
             device=device,
-            verbose=verbose,
+            verbose=False,
             **kwargs,
         )
-        pis.append(pi)
+
+    for i in _iteration(n=len(align_models) - 1, progress_name="Models alignment", verbose=verbose):
+        modelA = align_models[i]
+        modelB = align_models[i + 1]
+
+        if n_jobs == 1:
+            # Calculate and returns optimal alignment of two models.
+            pi, _ = paste_pairwise_align(
+                sampleA=modelA.copy(),
+                sampleB=modelB.copy(),
+                layer=layer,
+                genes=genes,
+                spatial_key=key_added,
+                alpha=alpha,
+                numItermax=numItermax,
+                numItermaxEmd=numItermaxEmd,
+                dtype=dtype,
+                device=device,
+                verbose=verbose,
+                **kwargs,
+            )
+            pis.append(pi)
+        else:
+            pi = pis[i]
 
         # Calculate new coordinates of two models
         modelA_coords, modelB_coords, mapping_dict = generalized_procrustes_analysis(
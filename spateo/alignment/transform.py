@@ -8,9 +8,11 @@ from anndata import AnnData
 from .methods import cal_dist, cal_dot
 from .methods.morpho import con_K
 from .methods.utils import (
+    P_TEMPORARIES,
     _chunk,
     _data,
     _dot,
+    _itemsize,
     _mul,
     _pi,
     _power,
@@ -20,7 +22,9 @@ from .methods.utils import (
     check_backend,
     check_exp,
     filter_common_genes,
+    get_device,
     intersect_lsts,
+    plan_chunks,
 )
 
 
@@ -210,13 +214,17 @@ def get_P_chunk(
     Sigma: Union[np.ndarray, torch.Tensor],
     samples_s: Optional[List[float]] = None,
     outlier_variance: float = None,
-    chunk_size: int = 1000,
+    chunk_size: Optional[int] = None,
     dissimilarity: str = "kl",
+    memory_budget: Optional[int] = None,
 ) -> Union[np.ndarray, torch.Tensor]:
     """Calculating the generating probability matrix P.
 
     Args:
         XAHat: Current spatial coordinate of sample A. Shape
+        chunk_size: Sample B is split into ``ceil(NA / chunk_size)`` chunks. If None, the number of chunks is planned
+            from ``memory_budget``.
+        memory_budget: The memory budget in bytes. If None, half of the available memory of the device is used.
     """
     # Get the number of cells in each sample
     NA, NB = XnAHat.shape[0], XnB.shape[0]
@@ -224,7 +232,16 @@ def get_P_chunk(
     G = X_A.shape[1]
     # Get the number of spatial dimensions
     D = XnAHat.shape[1]
-    chunk_num = int(np.ceil(NA / chunk_size))
+    if chunk_size is None:
+        chunk_num = plan_chunks(
+            n_rows=NB,
+            bytes_per_row=NA * P_TEMPORARIES * _itemsize(XnAHat),
+            memory_budget=memory_budget,
+            device=get_device(XnAHat),
+            name="Probability matrix",
+        ).n_chunks
+    else:
+        chunk_num = int(np.ceil(NA / chunk_size))
 
     assert XnAHat.shape[1] == XnB.shape[1], "XnAHat and XnB do not have the same number of features."
     assert XnAHat.shape[0] == alpha.shape[0], "XnAHat and alpha do not have the same length."
@@ -243,8 +260,8 @@ def get_P_chunk(
 
     Ps = []
     for x_Bs, xnBs in zip(X_Bs, XnBs):
-        SpatialDistMat = cal_dist(XnAHat, xnBs)
-        GeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=x_Bs, dissimilarity=dissimilarity)
+        SpatialDistMat = cal_dist(XnAHat, xnBs, chunk_num=1)
+        GeneDistMat = calc_exp_dissimilarity(X_A=X_A, X_B=x_Bs, dissimilarity=dissimilarity, chunk_num=1)
         if outlier_variance is None:
             exp_SpatialMat = nx.exp(-SpatialDistMat / (2 * sigma2))
         else:
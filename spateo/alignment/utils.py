@@ -1,9 +1,12 @@
+import os
 from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
 from anndata import AnnData
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy.spatial import cKDTree
+from threadpoolctl import threadpool_limits
 
 from spateo.logging import logger_manager as lm
 
@@ -42,6 +45,86 @@ def downsampling(
     return sampling_models
 
 
+######################
+# Parallel Alignment #
+######################
+
+
+def _model_arrays(model: AnnData, layer: str, spatial_key: str) -> dict:
+    """The expression, gene names and coordinates of a model. These are passed to worker processes instead of the
+    model itself, such that joblib memory-maps the large arrays and workers share rather than copy them."""
+    return dict(
+        X=model.X if layer == "X" else model.layers[layer],
+        var_names=np.asarray(model.var_names),
+        coords=np.asarray(model.obsm[spatial_key]),
+    )
+
+
+def _arrays_model(X, var_names: np.ndarray, coords: np.ndarray, spatial_key: str) -> AnnData:
+    """Reconstruct a minimal model from the arrays returned by :func:`_model_arrays`."""
+    model = AnnData(X=X, var=pd.DataFrame(index=var_names))
+    model.obsm[spatial_key] = coords
+    return model
+
+
+def _run_pair(func, arrays_A: dict, arrays_B: dict, spatial_key: str, blas_threads: int, **kwargs):
+    with threadpool_limits(limits=blas_threads):
+        return func(
+            _arrays_model(spatial_key=spatial_key, **arrays_A),
+            _arrays_model(spatial_key=spatial_key, **arrays_B),
+            spatial_key=spatial_key,
+            **kwargs,
+        )
+
+
+def run_pairwise(
+    func,
+    models: List[AnnData],
+    layer: str = "X",
+    spatial_key: str = "spatial",
+    n_jobs: int = -1,
+    **kwargs,
+) -> list:
+    """Run a pairwise alignment function on all pairs of consecutive models in a pool of worker processes. Only the
+    expression (of ``.X`` or the given layer) and the spatial coordinates of the models are shared with the workers.
+    The BLAS threads are split among the workers, such that the workers do not oversubscribe the CPUs.
+
+    Args:
+        func: Function that is called as ``func(modelA, modelB, spatial_key=spatial_key, **kwargs)`` for each pair of
+            consecutive models. It must be picklable, i.e. defined at the top level of a module.
+        models: List of models (AnnData Object).
+        layer: If ``'X'``, shares ``.X`` with the workers, otherwise shares ``.layers[layer]`` as ``.X``.
+        spatial_key: The key in ``.obsm`` that corresponds to the spatial coordinate.
+        n_jobs: Number of worker processes. -1 means using all processors.
+        **kwargs: Additional parameters that will be passed to ``func``.
+
+    Returns:
+        The results of ``func`` for each pair of consecutive models.
+    """
+    n_jobs = min(effective_n_jobs(n_jobs), max(1, len(models) - 1))
+    blas_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+    arrays = [_model_arrays(model, layer, spatial_key) for model in models]
+    return Parallel(n_jobs=n_jobs)(
+        delayed(_run_pair)(func, arrays[i], arrays[i + 1], spatial_key, blas_threads, **kwargs)
+        for i in range(len(models) - 1)
+    )
+
+
+def _fit_affine(X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+    """Least-squares affine transformation ``M`` with ``Y ~ X @ M[:-1] + M[-1]``."""
+    M, _, _, _ = np.linalg.lstsq(np.hstack([X, np.ones((X.shape[0], 1))]), Y, rcond=None)
+    return M
+
+
+def _apply_affine(M: np.ndarray, X: np.ndarray) -> np.ndarray:
+    return X @ M[:-1] + M[-1]
+
+
+def _compose_affine(M1: np.ndarray, M2: np.ndarray) -> np.ndarray:
+    """The affine transformation that applies ``M2`` and then ``M1``."""
+    return np.vstack([M2[:-1] @ M1[:-1], _apply_affine(M1, M2[-1:])])
+
+
 ###################
 # After Alignment #
 ###################
@@ -3,7 +3,7 @@
 import gzip
 import math
 import warnings
-from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -19,6 +19,7 @@ from typing_extensions import Literal
 
 from ..configuration import SKM
 from ..logging import logger_manager as lm
+from .cache import get_cache_path, has_cache, iter_cache, read_cache, write_cache
 from .utils import (
     bin_indices,
     centroids,
@@ -50,19 +51,17 @@ COUNT_COLUMN_MAPPING = {
 }
 
 
-def read_bgi_as_dataframe(path: str, label_column: Optional[str] = None) -> pd.DataFrame:
-    """Read a BGI read file as a pandas DataFrame.
+def _bgi_read_options(path: str, label_column: Optional[str] = None) -> Tuple[Dict[str, type], Dict[str, str]]:
+    """Validate the header of a BGI read file and obtain the dtypes and column
+    renames used to read it.
 
     Args:
         path: Path to read file.
         label_column: Column name containing positive cell labels.
 
     Returns:
-        Pandas Dataframe with the following standardized column names.
-            * `gene`: Gene name/ID (whatever was used in the original file)
-            * `x`, `y`: X and Y coordinates
-            * `total`, `spliced`, `unspliced`: Counts for each RNA species.
-                The latter two is only present if they are in the original file.
+        Tuple of dictionaries containing the dtype of each column and the
+        standardized name of each column.
     """
     dtype = {
         "geneID": "category",  # geneID
@@ -101,7 +100,57 @@ def read_bgi_as_dataframe(path: str, label_column: Optional[str] = None) -> pd.D
     for _to, _cols in rename_inverse.items():
         if sum(_from in df.columns for _from in _cols) > 1:
             raise IOError(f"Found multiple columns mapping to `{_to}`.")
+    return dtype, rename
+
+
+def cache_bgi(path: str, cache_dir: str, label_column: Optional[str] = None, chunksize: int = 10_000_000) -> str:
+    """Convert a BGI read file to a binary columnar cache, which can be reloaded
+    without parsing by passing the same `cache_dir` to :func:`read_bgi_as_dataframe`,
+    :func:`read_bgi` or :func:`read_bgi_agg`. The cache is only written if a valid
+    cache does not already exist. Caches are keyed by a fingerprint of the read
+    file, so they are invalidated (and replaced) when the read file changes.
+
+    Args:
+        path: Path to read file.
+        cache_dir: Directory to store caches in.
+        label_column: Column name containing positive cell labels.
+        chunksize: Number of rows to parse at a time when writing the cache.
+
+    Returns:
+        Path to the cache.
+    """
+    cache_path = get_cache_path(path, cache_dir, key=label_column or "")
+    if not has_cache(cache_path):
+        lm.main_info(f"Caching {path} to {cache_path}.")
+        write_cache(iter_bgi_as_dataframe(path, label_column, chunksize), cache_path)
+    else:
+        lm.main_debug(f"Using cache {cache_path}.")
+    return cache_path
+
+
+def read_bgi_as_dataframe(
+    path: str, label_column: Optional[str] = None, cache_dir: Optional[str] = None
+) -> pd.DataFrame:
+    """Read a BGI read file as a pandas DataFrame.
+
+    Args:
+        path: Path to read file.
+        label_column: Column name containing positive cell labels.
+        cache_dir: If provided, the read file is loaded from a binary columnar cache
+            in this directory, which is created with :func:`cache_bgi` if
+            necessary. The coordinate and count columns are memory-mapped.
+
+    Returns:
+        Pandas Dataframe with the following standardized column names.
+            * `gene`: Gene name/ID (whatever was used in the original file)
+            * `x`, `y`: X and Y coordinates
+            * `total`, `spliced`, `unspliced`: Counts for each RNA species.
+                The latter two is only present if they are in the original file.
+    """
+    if cache_dir is not None:
+        return read_cache(cache_bgi(path, cache_dir, label_column))
 
+    dtype, rename = _bgi_read_options(path, label_column)
     return pd.read_csv(
         path,
         sep="\t",
@@ -110,6 +159,145 @@ def read_bgi_as_dataframe(path: str, label_column: Optional[str] = None) -> pd.D
     ).rename(columns=rename)
 
 
+def iter_bgi_as_dataframe(
+    path: str, label_column: Optional[str] = None, chunksize: int = 10_000_000, cache_dir: Optional[str] = None
+) -> Iterator[pd.DataFrame]:
+    """Read a BGI read file as an iterator of pandas DataFrames, each containing
+    at most `chunksize` rows. Only a single chunk is held in memory at a time.
+
+    Args:
+        path: Path to read file.
+        label_column: Column name containing positive cell labels.
+        chunksize: Number of rows to read at a time.
+        cache_dir: If provided, chunks are read from a binary columnar cache in this
+            directory, which is created with :func:`cache_bgi` if necessary.
+
+    Returns:
+        Iterator of Pandas Dataframes with the same standardized column names as
+        :func:`read_bgi_as_dataframe`. Note that the categories of the `geneID`
+        column may differ between chunks.
+    """
+    if cache_dir is not None:
+        yield from iter_cache(cache_bgi(path, cache_dir, label_column, chunksize), chunksize)
+        return
+
+    dtype, rename = _bgi_read_options(path, label_column)
+    with pd.read_csv(path, sep="\t", dtype=dtype, comment="#", chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk.rename(columns=rename)
+
+
+class _ChunkAccumulator:
+    """Accumulate counts over chunks of a read file, summing the values of
+    duplicate keys. Buffered chunks are merged into the accumulated result
+    whenever they outgrow it, so memory usage is proportional to the number of
+    unique keys (i.e. the output size) rather than the number of rows read.
+
+    Args:
+        keys: Columns that identify a unique entry.
+        values: Columns to sum. If empty, the unique keys are accumulated.
+        flush_size: Minimum number of buffered rows before merging.
+    """
+
+    def __init__(self, keys: List[str], values: List[str], flush_size: int):
+        self.keys = keys
+        self.values = values
+        self.flush_size = flush_size
+        self._result = None
+        self._buffer = []
+        self._n_buffered = 0
+
+    def _reduce(self, df: pd.DataFrame) -> pd.DataFrame:
+        if not self.values:
+            return df[self.keys].drop_duplicates()
+        return df.groupby(self.keys, sort=False)[self.values].sum().reset_index()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        frames = self._buffer if self._result is None else [self._result] + self._buffer
+        self._result = self._reduce(pd.concat(frames, ignore_index=True))
+        self._buffer = []
+        self._n_buffered = 0
+
+    def add(self, df: pd.DataFrame):
+        if df.shape[0] == 0:
+            return
+        df = df[self.keys + self.values].astype({value: np.uint32 for value in self.values})
+        reduced = self._reduce(df)
+        self._buffer.append(reduced)
+        self._n_buffered += reduced.shape[0]
+        n_result = 0 if self._result is None else self._result.shape[0]
+        if self._n_buffered > max(self.flush_size, n_result):
+            self._flush()
+
+    def result(self) -> pd.DataFrame:
+        self._flush()
+        if self._result is None:
+            return pd.DataFrame(columns=self.keys + self.values, dtype=np.uint32)
+        return self._result
+
+
+def _read_bgi_agg_chunked(
+    path: str,
+    binsize: int,
+    gene_agg: Optional[Dict[str, Union[List[str], Callable[[str], bool]]]],
+    label_column: Optional[str],
+    chunksize: int,
+    cache_dir: Optional[str] = None,
+) -> Tuple[pd.DataFrame, Optional[pd.DataFrame], Tuple[int, int, int, int]]:
+    """Stream a BGI read file and accumulate counts per (binned) coordinate.
+
+    Args:
+        path: Path to read file.
+        binsize: Size of pixel bins.
+        gene_agg: Dictionary of layer keys to gene names to aggregate.
+        label_column: Column that contains already-segmented cell labels.
+        chunksize: Number of rows to read at a time.
+        cache_dir: Directory containing binary columnar caches of read files.
+
+    Returns:
+        A dataframe containing the binned `x` and `y` coordinates and summed
+        counts of every layer, a dataframe of unique unbinned `x`, `y`, `label`
+        triplets (or None if `label_column` was not provided), and the minimum and
+        maximum unbinned x and y coordinates.
+    """
+    x_min = y_min = np.iinfo(np.uint32).max
+    x_max = y_max = 0
+    counts = None
+    label_points = (
+        _ChunkAccumulator(["x", "y", "label"], [], flush_size=chunksize) if label_column is not None else None
+    )
+    for chunk in iter_bgi_as_dataframe(path, label_column, chunksize, cache_dir):
+        x_min, y_min = min(x_min, chunk["x"].min()), min(y_min, chunk["y"].min())
+        x_max, y_max = max(x_max, chunk["x"].max()), max(y_max, chunk["y"].max())
+        if label_points is not None:
+            label_points.add(chunk[chunk["label"] > 0])
+
+        values = [SKM.X_LAYER] + [col for col in ("spliced", "unspliced") if col in chunk.columns]
+        chunk = chunk.rename(columns={"total": SKM.X_LAYER})
+        if gene_agg:
+            for name, genes in gene_agg.items():
+                mask = chunk["geneID"].isin(genes) if isinstance(genes, list) else chunk["geneID"].map(genes)
+                chunk[name] = np.where(mask.values.astype(bool), chunk[SKM.X_LAYER].values, 0)
+                values.append(name)
+        if binsize > 1:
+            chunk["x"] = bin_indices(chunk["x"].values, 0, binsize)
+            chunk["y"] = bin_indices(chunk["y"].values, 0, binsize)
+
+        if counts is None:
+            counts = _ChunkAccumulator(["x", "y"], values, flush_size=chunksize)
+        counts.add(chunk)
+    if counts is None:
+        raise IOError(f"No reads were found in {path}.")
+
+    return (
+        counts.result(),
+        label_points.result() if label_points is not None else None,
+        (int(x_min), int(y_min), int(x_max), int(y_max)),
+    )
+
+
 def dataframe_to_labels(df: pd.DataFrame, column: str, shape: Optional[Tuple[int, int]] = None) -> np.ndarray:
     """Convert a BGI dataframe that contains cell labels to a labels matrix.
 
@@ -167,6 +355,8 @@ def read_bgi_agg(
     prealigned: bool = False,
     label_column: Optional[str] = None,
     version: Literal["stereo"] = "stereo",
+    chunksize: Optional[int] = None,
+    cache_dir: Optional[str] = None,
 ) -> AnnData:
     """Read BGI read file to calculate total number of UMIs observed per
     coordinate.
@@ -185,6 +375,13 @@ def read_bgi_agg(
         label_column: Column that contains already-segmented cell labels.
         version: BGI technology version. Currently only used to set the scale and
             scale units of each unit coordinate. This may change in the future.
+        chunksize: If provided, the read file is streamed in chunks of this many
+            rows, and counts are binned and summed as each chunk is read. The full
+            read file is never loaded into memory, so peak memory usage depends on
+            the number of (binned) coordinates instead of the number of rows.
+        cache_dir: If provided, the read file is loaded from a binary columnar cache
+            in this directory instead of being parsed, and the cache is created
+            if necessary. See :func:`cache_bgi`.
 
     Returns:
         An AnnData object containing the UMIs per coordinate and the nucleus
@@ -194,10 +391,19 @@ def read_bgi_agg(
         The nuclei image is stored as a Numpy array in `.layers['nuclei']`.
     """
     lm.main_debug(f"Reading data from {path}.")
-    data = read_bgi_as_dataframe(path, label_column)
-    x_min, y_min = data["x"].min(), data["y"].min()
+    label_points = None
+    if chunksize is not None:
+        lm.main_info(f"Streaming counts in chunks of {chunksize} rows.")
+        data, label_points, (x_min, y_min, x_max, y_max) = _read_bgi_agg_chunked(
+            path, binsize, gene_agg, label_column, chunksize, cache_dir
+        )
+    else:
+        data = read_bgi_as_dataframe(path, label_column, cache_dir)
+        x_min, y_min = data["x"].min(), data["y"].min()
+        x_max, y_max = data["x"].max(), data["y"].max()
+        if "label" in data.columns:
+            label_points = data
     x, y = data["x"].values, data["y"].values
-    x_max, y_max = x.max(), y.max()
     shape = (x_max + 1, y_max + 1)
 
     # Read image and update x,y max if appropriate
@@ -224,16 +430,18 @@ def read_bgi_agg(
 
     # Construct labels matrix if present
     labels = None
-    if "label" in data.columns:
+    if label_points is not None:
         lm.main_warning("Using the `label_column` option may result in disconnected labels.")
-        labels = dataframe_to_labels(data, "label", shape)
+        labels = dataframe_to_labels(label_points, "label", shape)
         layers[SKM.LABELS_LAYER_KEY] = labels
 
     if binsize > 1:
         lm.main_info(f"Binning counts with binsize={binsize}.")
         shape = (math.ceil(shape[0] / binsize), math.ceil(shape[1] / binsize))
-        x = bin_indices(x, 0, binsize)
-        y = bin_indices(y, 0, binsize)
+        # Streamed counts are already binned.
+        if chunksize is None:
+            x = bin_indices(x, 0, binsize)
+            y = bin_indices(y, 0, binsize)
         x_min, y_min = x.min(), y.min()
 
         # Resize image if necessary
@@ -246,21 +454,34 @@ def read_bgi_agg(
 
     # See read_bgi_as_dataframe for standardized column names
     lm.main_info("Constructing count matrices.")
-    X = csr_matrix((data["total"].values, (x, y)), shape=shape, dtype=np.uint16)
-    if "spliced" in data.columns:
-        layers[SKM.SPLICED_LAYER_KEY] = csr_matrix((data["spliced"].values, (x, y)), shape=shape, dtype=np.uint16)
-    if "unspliced" in data.columns:
-        layers[SKM.UNSPLICED_LAYER_KEY] = csr_matrix((data["unspliced"].values, (x, y)), shape=shape, dtype=np.uint16)
+    if chunksize is not None:
+        # Streamed spliced, unspliced and `gene_agg` counts are stored in columns
+        # named by their layer keys.
+        X = csr_matrix((data[SKM.X_LAYER].values, (x, y)), shape=shape, dtype=np.uint16)
+        for layer in data.columns.drop(["x", "y", SKM.X_LAYER]):
+            nonzero = data[layer].values > 0
+            layers[layer] = csr_matrix(
+                (data[layer].values[nonzero], (x[nonzero], y[nonzero])),
+                shape=shape,
+                dtype=np.uint16,
+            )
+    else:
+        X = csr_matrix((data["total"].values, (x, y)), shape=shape, dtype=np.uint16)
+        if "spliced" in data.columns:
+            layers[SKM.SPLICED_LAYER_KEY] = csr_matrix((data["spliced"].values, (x, y)), shape=shape, dtype=np.uint16)
+        if "unspliced" in data.columns:
+            layers[SKM.UNSPLICED_LAYER_KEY] = csr_matrix(
+                (data["unspliced"].values, (x, y)), shape=shape, dtype=np.uint16
+            )
 
     # Aggregate gene lists
-    if gene_agg:
+    if gene_agg and chunksize is None:
         lm.main_info("Aggregating counts for genes provided by `gene_agg`.")
         for name, genes in gene_agg.items():
             mask = data["geneID"].isin(genes) if isinstance(genes, list) else data["geneID"].map(genes)
-            data_genes = data[mask]
-            _x, _y = data_genes["x"].values, data_genes["y"].values
+            mask = mask.values.astype(bool)
             layers[name] = csr_matrix(
-                (data_genes["total"].values, (_x, _y)),
+                (data["total"].values[mask], (x[mask], y[mask])),
                 shape=shape,
                 dtype=np.uint16,
             )
@@ -282,6 +503,138 @@ def read_bgi_agg(
     return adata
 
 
+def _label_bins(x: np.ndarray, y: np.ndarray) -> Tuple[pd.Categorical, pd.DataFrame]:
+    """Label binned coordinates as `x-y`. Bins are identified by the integer key
+    `x * ny + y`, so that string labels are only constructed for each unique bin
+    instead of every row.
+
+    Args:
+        x: Binned x coordinates.
+        y: Binned y coordinates.
+
+    Returns:
+        Categorical label of each coordinate, and a dataframe containing the `x`,
+        `y` and `label` of each unique bin.
+    """
+    ny = np.uint64(y.max()) + np.uint64(1) if y.size > 0 else np.uint64(1)
+    key = x.astype(np.uint64) * ny + y.astype(np.uint64)
+    uniq_keys, inverse = np.unique(key, return_inverse=True)
+    x_bin = (uniq_keys // ny).astype(np.uint32)
+    y_bin = (uniq_keys % ny).astype(np.uint32)
+    uniq_labels = pd.Index(x_bin.astype(str)) + "-" + pd.Index(y_bin.astype(str))
+    return (
+        pd.Categorical.from_codes(inverse.ravel(), categories=uniq_labels),
+        pd.DataFrame({"x": x_bin, "y": y_bin, "label": uniq_labels}),
+    )
+
+
+def _lookup_labels(
+    x: np.ndarray, y: np.ndarray, labels: np.ndarray, seg_binsize: int = 1, offset: Tuple[int, int] = (0, 0)
+) -> np.ndarray:
+    """Obtain the label of each coordinate by indexing directly into a labels
+    matrix.
+
+    Args:
+        x: X coordinates.
+        y: Y coordinates.
+        labels: Labels matrix, where each pixel corresponds to a bin of
+            `seg_binsize` x `seg_binsize` coordinates.
+        seg_binsize: Bin size used to obtain the labels matrix.
+        offset: Binned coordinate of the first pixel of the labels matrix.
+
+    Returns:
+        Label of each coordinate. Coordinates outside of the labels matrix are
+        given a label of zero.
+    """
+    label_x = x.astype(np.int64) // seg_binsize - offset[0]
+    label_y = y.astype(np.int64) // seg_binsize - offset[1]
+    in_bounds = (label_x >= 0) & (label_x < labels.shape[0]) & (label_y >= 0) & (label_y < labels.shape[1])
+    cell_labels = np.zeros(x.shape[0], dtype=labels.dtype)
+    cell_labels[in_bounds] = labels[label_x[in_bounds], label_y[in_bounds]]
+    return cell_labels
+
+
+def _read_bgi_chunked(
+    path: str,
+    binsize: Optional[int],
+    label_column: Optional[str],
+    add_props: bool,
+    chunksize: int,
+    cache_dir: Optional[str] = None,
+    labels: Optional[np.ndarray] = None,
+    seg_binsize: int = 1,
+    label_offset: Tuple[int, int] = (0, 0),
+) -> Tuple[pd.DataFrame, List[str], Optional[pd.DataFrame]]:
+    """Stream a BGI read file and accumulate counts per bin (or cell label) and
+    gene.
+
+    Args:
+        path: Path to read file.
+        binsize: Size of pixel bins. Only used when neither `label_column` nor
+            `labels` are provided.
+        label_column: Column that contains already-segmented cell labels.
+        add_props: Whether or not to also accumulate the coordinates of each cell
+            label, which are required to compute label properties.
+        chunksize: Number of rows to read at a time.
+        cache_dir: Directory containing binary columnar caches of read files.
+        labels: Labels matrix used to label each coordinate. See
+            :func:`_lookup_labels`.
+        seg_binsize: Bin size used to obtain `labels`.
+        label_offset: Binned coordinate of the first pixel of `labels`.
+
+    Returns:
+        A dataframe containing the `label`, `geneID` and summed counts of each
+        bin (or cell label) and gene, the sorted names of all genes in the read
+        file, and a dataframe of unique `x`, `y`, `label` triplets (or None if
+        `add_props` is False and `label_column` was provided, or if `labels` was
+        provided).
+    """
+    gene_codes = {}
+    keys = ["label"] if label_column is not None or labels is not None else ["x", "y"]
+    counts = None
+    points = None
+    if label_column is not None and add_props:
+        points = _ChunkAccumulator(["x", "y", "label"], [], flush_size=chunksize)
+    for chunk in iter_bgi_as_dataframe(path, label_column, chunksize, cache_dir):
+        # Gene categories differ between chunks, so they are mapped to global
+        # codes in order of appearance. Genes are recorded before any filtering so
+        # that the columns always match regardless of what method was used.
+        categories = chunk["geneID"].cat.categories
+        for gene in categories:
+            gene_codes.setdefault(gene, len(gene_codes))
+        category_codes = np.array([gene_codes[gene] for gene in categories], dtype=np.uint32)
+        chunk["gene"] = category_codes[chunk["geneID"].cat.codes.values]
+
+        if label_column is not None:
+            chunk = chunk[chunk["label"] > 0]
+            if points is not None:
+                points.add(chunk)
+        elif labels is not None:
+            chunk["label"] = _lookup_labels(chunk["x"].values, chunk["y"].values, labels, seg_binsize, label_offset)
+            chunk = chunk[chunk["label"] != 0]
+        elif binsize > 1:
+            chunk["x"] = bin_indices(chunk["x"].values, 0, binsize)
+            chunk["y"] = bin_indices(chunk["y"].values, 0, binsize)
+
+        if counts is None:
+            values = ["total"] + [col for col in ("spliced", "unspliced") if col in chunk.columns]
+            counts = _ChunkAccumulator(keys + ["gene"], values, flush_size=chunksize)
+        counts.add(chunk)
+    if counts is None:
+        raise IOError(f"No reads were found in {path}.")
+
+    # Counts are summed as uint16 when reading the full dataframe.
+    data = counts.result()
+    data = data.astype({value: np.uint16 for value in counts.values})
+    data["geneID"] = pd.Categorical.from_codes(data.pop("gene").values.astype(int), categories=list(gene_codes))
+
+    if "label" not in keys:
+        data["label"], points = _label_bins(data["x"].values, data["y"].values)
+    elif points is not None:
+        points = points.result()
+    return data, sorted(gene_codes), points
+
+
 @SKM.check_adata_is_type(SKM.ADATA_AGG_TYPE, "segmentation_adata", optional=True)
 def read_bgi(
     path: str,
@@ -293,6 +646,8 @@ def read_bgi(
     label_column: Optional[str] = None,
     add_props: bool = True,
     version: Literal["stereo"] = "stereo",
+    chunksize: Optional[int] = None,
+    cache_dir: Optional[str] = None,
 ) -> AnnData:
     """Read BGI read file as AnnData.
 
@@ -313,6 +668,13 @@ def read_bgi(
             bounding box, centroid, etc.
         version: BGI technology version. Currently only used to set the scale and
             scale units of each unit coordinate. This may change in the future.
+        chunksize: If provided, the read file is streamed in chunks of this many
+            rows, and counts are summed per bin (or cell label) and gene as each
+            chunk is read, so that peak memory usage depends on the size of the
+            output instead of the number of rows.
+        cache_dir: If provided, the read file is loaded from a binary columnar cache
+            in this directory instead of being parsed, and the cache is created
+            if necessary. See :func:`cache_bgi`.
 
     Returns:
         Bins x genes or labels x genes AnnData.
@@ -330,83 +692,88 @@ def read_bgi(
     if isinstance(labels, str):
         labels = np.load(labels)
 
+    # Binned coordinate of the first pixel of the labels matrix.
+    label_offset = (0, 0)
+    if labels_layer is not None:
+        labels = SKM.select_layer_data(segmentation_adata, labels_layer)
+        seg_binsize = SKM.get_uns_spatial_attribute(segmentation_adata, SKM.UNS_SPATIAL_BINSIZE_KEY)
+        label_offset = (int(segmentation_adata.obs_names[0]), int(segmentation_adata.var_names[0]))
+
     lm.main_debug(f"Reading data from {path}.")
-    data = read_bgi_as_dataframe(path, label_column)
-    n_columns = data.shape[1]
+    if chunksize is not None:
+        lm.main_info(f"Streaming counts in chunks of {chunksize} rows.")
+        data, uniq_gene, points = _read_bgi_chunked(
+            path, binsize, label_column, add_props, chunksize, cache_dir, labels, seg_binsize, label_offset
+        )
+    else:
+        data = read_bgi_as_dataframe(path, label_column, cache_dir)
 
-    # Obtain total genes from raw data, so that the columns always match
-    # regardless of what method was used.
-    uniq_gene = sorted(data["geneID"].unique())
+        # Obtain total genes from raw data, so that the columns always match
+        # regardless of what method was used.
+        uniq_gene = sorted(data["geneID"].unique())
 
     props = None
     if label_column is not None:
         lm.main_info(f"Using cell labels from `{label_column}` column.")
         binsize = 1
-        data = data[data["label"] > 0]
+        if chunksize is None:
+            data = data[data["label"] > 0]
         if add_props:
             lm.main_warning(
                 "Using `label_column` as cell labels with `add_props=True` may result in incorrect contours."
             )
-            props = get_points_props(data[["x", "y", "label"]])
+            props = get_points_props(points if chunksize is not None else data[["x", "y", "label"]])
 
     elif binsize is not None:
         lm.main_info(f"Using binsize={binsize}")
         if binsize < 2:
             lm.main_warning("Please consider using a larger bin size.")
 
-        if binsize > 1:
-            x_bin = bin_indices(data["x"].values, 0, binsize)
-            y_bin = bin_indices(data["y"].values, 0, binsize)
-            data["x"], data["y"] = x_bin, y_bin
-
-        data["label"] = data["x"].astype(str) + "-" + data["y"].astype(str)
+        # Streamed counts are already binned and labeled.
+        if chunksize is None:
+            x_bin, y_bin = data["x"].values, data["y"].values
+            if binsize > 1:
+                x_bin = bin_indices(x_bin, 0, binsize)
+                y_bin = bin_indices(y_bin, 0, binsize)
+            data["label"], points = _label_bins(x_bin, y_bin)
         if add_props:
-            props = get_bin_props(data[["x", "y", "label"]].drop_duplicates(), binsize)
+            props = get_bin_props(points, binsize)
 
     # Use labels.
     else:
         binsize = 1
-        shape = (data["x"].max(), data["y"].max())
-        if labels is not None:
+        if labels_layer is None:
             lm.main_info(f"Using labels provided with `labels` argument.")
-            if labels.shape != shape:
-                lm.main_warning(f"Labels matrix {labels.shape} has different shape as data matrix {shape}")
+            if chunksize is None:
+                shape = (data["x"].max(), data["y"].max())
+                if labels.shape != shape:
+                    lm.main_warning(f"Labels matrix {labels.shape} has different shape as data matrix {shape}")
         else:
-            labels = SKM.select_layer_data(segmentation_adata, labels_layer)
-        label_coords = get_coords_labels(labels)
-
-        if labels_layer is not None:
             lm.main_info(f"Using labels provided with `segmentation_adata` and `labels_layer` arguments.")
-            seg_binsize = SKM.get_uns_spatial_attribute(segmentation_adata, SKM.UNS_SPATIAL_BINSIZE_KEY)
-            x_min, y_min = (
-                int(segmentation_adata.obs_names[0]) * seg_binsize,
-                int(segmentation_adata.var_names[0]) * seg_binsize,
-            )
-            label_coords["x"] += x_min
-            label_coords["y"] += y_min
-
-        # When binning was used for segmentation, need to expand indices to cover
-        # every binned pixel.
         if seg_binsize > 1:
             lm.main_warning("Binning was used for segmentation.")
-            coords_dfs = []
-            for i in range(seg_binsize):
-                for j in range(seg_binsize):
-                    coords = label_coords.copy()
-                    coords["x"] += i
-                    coords["y"] += j
-                    coords_dfs.append(coords)
-            label_coords = pd.concat(coords_dfs, ignore_index=True)
-        data = pd.merge(data, label_coords, on=["x", "y"], how="inner")
+
+        # Streamed counts are already labeled.
+        if chunksize is None:
+            cell_labels = _lookup_labels(data["x"].values, data["y"].values, labels, seg_binsize, label_offset)
+            keep = cell_labels != 0
+            data = data[keep].assign(label=cell_labels[keep])
         if add_props:
             props = get_label_props(labels)
 
-    uniq_cell = sorted(data["label"].unique())
+    if isinstance(data["label"].dtype, pd.CategoricalDtype):
+        categories = data["label"].cat.categories
+        order = np.argsort(categories.values)
+        uniq_cell = categories[order].tolist()
+        cell_index = np.empty(len(order), dtype=int)
+        cell_index[order] = np.arange(len(order))
+        x_ind = cell_index[data["label"].cat.codes.values]
+    else:
+        uniq_cell, x_ind = np.unique(data["label"].values, return_inverse=True)
+        x_ind = x_ind.ravel()
+    gene_index = pd.Index(uniq_gene).get_indexer(data["geneID"].cat.categories)
+    y_ind = gene_index[data["geneID"].cat.codes.values]
     shape = (len(uniq_cell), len(uniq_gene))
-    cell_dict = dict(zip(uniq_cell, range(len(uniq_cell))))
-    gene_dict = dict(zip(uniq_gene, range(len(uniq_gene))))
-    x_ind = data["label"].map(cell_dict).astype(int).values
-    y_ind = data["geneID"].map(gene_dict).astype(int).values
 
     # See read_bgi_as_dataframe for standardized column names
     lm.main_info("Constructing count matrices.")
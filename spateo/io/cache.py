@@ -0,0 +1,246 @@
+"""Binary columnar on-disk cache for parsed read files.
+
+Each cache is a directory containing one raw binary file per column, which
+are memory-mapped when loaded, and a JSON manifest describing the dtype of each
+column. Categorical and object columns are dictionary-encoded, with the
+categories stored in the manifest. Caches are keyed by a fingerprint of the source file, so that
+a cache is automatically invalidated when the source file changes.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+from ..logging import logger_manager as lm
+
+MANIFEST_FILENAME = "manifest.json"
+CACHE_VERSION = 1
+# Number of bytes at the start and end of the source file that are hashed.
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+# Number of rows of categorical codes that are remapped at a time.
+REMAP_CHUNK_SIZE = 1 << 24
+
+
+def file_fingerprint(path: str) -> str:
+    """Compute a fingerprint of a file that changes whenever the file is modified.
+
+    Hashing multi-GB read files in their entirety is nearly as slow as parsing
+    them, so only the size, modification time and the first and last
+    `FINGERPRINT_BLOCK_SIZE` bytes of the file are hashed.
+
+    Args:
+        path: Path to file.
+
+    Returns:
+        Hex digest of the fingerprint.
+    """
+    stat = os.stat(path)
+    sha = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        sha.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        if stat.st_size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(stat.st_size - FINGERPRINT_BLOCK_SIZE, FINGERPRINT_BLOCK_SIZE))
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def _cache_prefix(path: str, key: str) -> str:
+    """Prefix shared by all caches of the same source file and key."""
+    path_hash = hashlib.sha256(f"{os.path.abspath(path)}:{key}".encode()).hexdigest()
+    return f"{os.path.basename(path)}.{path_hash[:12]}"
+
+
+def get_cache_path(path: str, cache_dir: str, key: str = "") -> str:
+    """Get the path to the cache of a source file.
+
+    Args:
+        path: Path to source file.
+        cache_dir: Directory containing caches.
+        key: Additional string that identifies how the source file was parsed.
+
+    Returns:
+        Path to the cache directory, which may not exist.
+    """
+    return os.path.join(cache_dir, f"{_cache_prefix(path, key)}.{file_fingerprint(path)[:16]}")
+
+
+def has_cache(cache_path: str) -> bool:
+    """Check whether a complete cache exists at the given path.
+
+    Args:
+        cache_path: Path to cache directory, as returned by :func:`get_cache_path`.
+
+    Returns:
+        True if the cache exists and was written with the current cache version.
+    """
+    manifest_path = os.path.join(cache_path, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return False
+    with open(manifest_path, "r") as f:
+        return json.load(f).get("version") == CACHE_VERSION
+
+
+def write_cache(chunks: Iterable[pd.DataFrame], cache_path: str):
+    """Write dataframe chunks to a columnar cache. Only a single chunk is held in
+    memory at a time. Any other caches of the same source file and key (i.e.
+    those that were invalidated because the source file changed) are removed.
+
+    Args:
+        chunks: Dataframes with identical columns and dtypes. Categorical columns
+            may have different categories in each chunk. Object columns are
+            stored like categorical columns, and must contain hashable values.
+        cache_path: Path to cache directory, as returned by :func:`get_cache_path`.
+
+    Raises:
+        ValueError: If a categorical or object column contains missing values.
+    """
+    cache_dir = os.path.dirname(cache_path) or "."
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary directory so that incomplete caches are never read.
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp.")
+    files = {}
+    try:
+        columns = None
+        categories = {}
+        n_rows = 0
+        for chunk in chunks:
+            if columns is None:
+                columns = {}
+                for name, dtype in chunk.dtypes.items():
+                    if isinstance(dtype, pd.CategoricalDtype) or dtype == object:
+                        # Object columns hold pointers, which can't be written as raw
+                        # binary, so they are dictionary-encoded as well.
+                        categories[name] = {}
+                        columns[name] = {
+                            "dtype": np.dtype(np.uint32).str,
+                            "categorical": True,
+                            "object": dtype == object,
+                        }
+                    else:
+                        columns[name] = {"dtype": np.dtype(dtype).str, "categorical": False}
+                    files[name] = open(os.path.join(tmp_path, f"{name}.bin"), "wb")
+
+            for name, column in chunk.items():
+                if columns[name]["categorical"]:
+                    if columns[name]["object"]:
+                        column = column.astype("category")
+                    if (column.cat.codes.values < 0).any():
+                        raise ValueError(f"Column `{name}` contains missing values, which can not be cached.")
+                    # Map chunk categories to global codes in order of appearance.
+                    codes = categories[name]
+                    for category in column.cat.categories:
+                        codes.setdefault(category, len(codes))
+                    chunk_codes = np.array([codes[category] for category in column.cat.categories], dtype=np.uint32)
+                    values = chunk_codes[column.cat.codes.values]
+                else:
+                    values = column.values
+                np.ascontiguousarray(values, dtype=columns[name]["dtype"]).tofile(files[name])
+            n_rows += chunk.shape[0]
+        for f in files.values():
+            f.close()
+        if columns is None:
+            raise IOError("No rows were written to the cache.")
+
+        # Sort categories, so that the cached categorical columns are identical to
+        # those parsed by pandas.
+        for name, codes in categories.items():
+            uniq = list(codes)
+            order = np.argsort(np.array(uniq, dtype=object))
+            remap = np.empty(len(uniq), dtype=np.uint32)
+            remap[order] = np.arange(len(uniq), dtype=np.uint32)
+            columns[name]["categories"] = [uniq[i] for i in order]
+            if n_rows > 0:
+                values = np.memmap(os.path.join(tmp_path, f"{name}.bin"), dtype=np.uint32, mode="r+", shape=(n_rows,))
+                for start in range(0, n_rows, REMAP_CHUNK_SIZE):
+                    values[start : start + REMAP_CHUNK_SIZE] = remap[values[start : start + REMAP_CHUNK_SIZE]]
+                values.flush()
+                del values
+
+        with open(os.path.join(tmp_path, MANIFEST_FILENAME), "w") as f:
+            json.dump({"version": CACHE_VERSION, "n_rows": n_rows, "columns": columns}, f)
+
+        if os.path.exists(cache_path):
+            shutil.rmtree(cache_path)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        for f in files.values():
+            f.close()
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    prefix = os.path.basename(cache_path).rsplit(".", 1)[0]
+    for stale_path in glob.glob(os.path.join(cache_dir, f"{glob.escape(prefix)}.*")):
+        if stale_path != cache_path:
+            lm.main_debug(f"Removing invalidated cache {stale_path}.")
+            shutil.rmtree(stale_path, ignore_errors=True)
+
+
+def _read_manifest(cache_path: str) -> dict:
+    with open(os.path.join(cache_path, MANIFEST_FILENAME), "r") as f:
+        return json.load(f)
+
+
+def _memmap_columns(cache_path: str, manifest: dict) -> dict:
+    arrays = {}
+    n_rows = manifest["n_rows"]
+    for name, column in manifest["columns"].items():
+        dtype = np.dtype(column["dtype"])
+        if n_rows > 0:
+            # Plain ndarray view of the memory map, so that downstream operations
+            # don't propagate the memmap subclass.
+            arrays[name] = np.asarray(
+                np.memmap(os.path.join(cache_path, f"{name}.bin"), dtype=dtype, mode="r", shape=(n_rows,))
+            )
+        else:
+            arrays[name] = np.empty(0, dtype=dtype)
+    return arrays
+
+
+def _to_dataframe(arrays: dict, manifest: dict, start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+    data = {}
+    for name, column in manifest["columns"].items():
+        values = arrays[name][start:stop]
+        if column.get("object", False):
+            data[name] = np.array(column["categories"], dtype=object)[values]
+        elif column["categorical"]:
+            data[name] = pd.Categorical.from_codes(values, categories=column["categories"])
+        else:
+            data[name] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def read_cache(cache_path: str) -> pd.DataFrame:
+    """Read a columnar cache as a dataframe. Non-categorical columns are
+    memory-mapped (read-only) instead of being loaded into memory.
+
+    Args:
+        cache_path: Path to cache directory, as returned by :func:`get_cache_path`.
+
+    Returns:
+        Dataframe with the same columns as the cached chunks.
+    """
+    manifest = _read_manifest(cache_path)
+    return _to_dataframe(_memmap_columns(cache_path, manifest), manifest)
+
+
+def iter_cache(cache_path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """Read a columnar cache as an iterator of dataframes, each containing at
+    most `chunksize` rows.
+
+    Args:
+        cache_path: Path to cache directory, as returned by :func:`get_cache_path`.
+        chunksize: Number of rows in each chunk.
+
+    Returns:
+        Iterator of dataframes with the same columns as the cached chunks.
+    """
+    manifest = _read_manifest(cache_path)
+    arrays = _memmap_columns(cache_path, manifest)
+    for start in range(0, manifest["n_rows"], chunksize):
+        yield _to_dataframe(arrays, manifest, start, start + chunksize)
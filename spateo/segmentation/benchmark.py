@@ -1,7 +1,7 @@
 """Functions to help segmentation benchmarking, specifically to compare
 two sets of segmentation labels.
 """
-from typing import Optional, Tuple
+from typing import Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
@@ -48,24 +48,56 @@ def iou(labels1: np.ndarray, labels2: np.ndarray) -> sparse.csr_matrix:
     """
     areas1 = np.bincount(labels1.flatten())
     areas2 = np.bincount(labels2.flatten())
-    overlaps = utils.label_overlap(labels1, labels2).astype(float)
-    for i, j in zip(*overlaps.nonzero()):
-        overlap = overlaps[i, j]
-        overlaps[i, j] = overlap / (areas1[i] + areas2[j] - overlap)
-    return overlaps
+    overlaps = utils.label_overlap(labels1, labels2).tocoo()
+    overlap = overlaps.data.astype(float)
+    union = areas1[overlaps.row] + areas2[overlaps.col] - overlap
+    return sparse.csr_matrix((overlap / union, (overlaps.row, overlaps.col)), shape=overlaps.shape)
 
 
-def average_precision(iou: sparse.csr_matrix, tau: float = 0.5) -> float:
+def _true_positives(iou: sparse.spmatrix, taus: np.ndarray) -> np.ndarray:
+    """Number of label pairs with IOU greater than each tau, using a single sort
+    of the nonzero IOUs."""
+    values = np.sort(sparse.csr_matrix(iou).data)
+    return len(values) - np.searchsorted(values, taus, side="right")
+
+
+def precision_recall(
+    iou: sparse.csr_matrix, tau: Union[float, Sequence[float]] = 0.5
+) -> Tuple[Union[float, np.ndarray], Union[float, np.ndarray]]:
+    """Compute precision and recall of predicted labels.
+
+    Args:
+        iou: IOU of true and predicted labels
+        tau: IOU threshold(s) to determine whether a prediction is correct. If
+            multiple thresholds are provided, precision and recall are computed
+            for all of them at once.
+
+    Returns:
+        Precision and recall, as floats if a single `tau` was provided, or
+            arrays with one element per threshold otherwise.
+    """
+    taus = np.asarray(tau, dtype=float)
+    tp = _true_positives(iou, taus.ravel()).reshape(taus.shape)
+    fp = iou.shape[1] - tp - 1
+    fn = iou.shape[0] - tp - 1
+    return tp / (tp + fp), tp / (tp + fn)
+
+
+def average_precision(iou: sparse.csr_matrix, tau: Union[float, Sequence[float]] = 0.5) -> Union[float, np.ndarray]:
     """Compute average precision (AP).
 
     Args:
         iou: IOU of true and predicted labels
-        tau: IOU threshold to determine whether a prediction is correct
+        tau: IOU threshold(s) to determine whether a prediction is correct. If
+            multiple thresholds are provided, the average precision is computed
+            for all of them at once.
 
     Returns:
-        Average precision
+        Average precision, as a float if a single `tau` was provided, or an
+            array with one element per threshold otherwise.
     """
-    tp = (iou > tau).sum()
+    taus = np.asarray(tau, dtype=float)
+    tp = _true_positives(iou, taus.ravel()).reshape(taus.shape)
     fp = iou.shape[1] - tp - 1
     fn = iou.shape[0] - tp - 1
     return tp / (tp + fn + fp)
@@ -164,13 +196,8 @@ def compare(
         return tn, fp, fn, tp, precision, accuracy, f1, ars, homogeneity, completeness, v
 
     def _ap(y_true, y_pred, taus):
-        aps = []
-        _iou = None
-        for tau in taus:
-            if _iou is None:
-                _iou = iou(y_true, y_pred)
-            aps.append(average_precision(_iou, tau))
-        return aps
+        # A single overlap matrix is used for all thresholds.
+        return list(average_precision(iou(y_true, y_pred), list(taus))) if len(taus) > 0 else []
 
     y_true = SKM.select_layer_data(adata, true_layer)
     y_pred = SKM.select_layer_data(adata, pred_layer)
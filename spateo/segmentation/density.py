@@ -1,13 +1,16 @@
 """Functions to segment regions of a slice by UMI density.
 """
 from collections import Counter
+from heapq import heapify, heappop, heappush
 from typing import Dict, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 from anndata import AnnData
 from kneed import KneeLocator
-from scipy.sparse import csr_matrix, issparse, lil_matrix, spmatrix
+from scipy import ndimage
+from scipy.sparse import csr_matrix, diags, issparse, spmatrix
+from skimage.segmentation import slic
 from sklearn import cluster
 from typing_extensions import Literal
 
@@ -30,20 +33,134 @@ def _create_spatial_adjacency(shape: Tuple[int, int]) -> csr_matrix:
     """
     n_rows, n_cols = shape
     n_nodes = n_rows * n_cols
-    adjacency = lil_matrix((n_nodes, n_nodes))
-    for r in range(n_rows):
-        for c in range(n_cols):
-            i = r * n_cols + c
-            # Two inner diagonals
-            if c > 0:
-                adjacency[i - 1, i] = adjacency[i, i - 1] = 1
-            # Two outer diagonals
-            if r > 0:
-                adjacency[i - n_cols, i] = adjacency[i, i - n_cols] = 1
-    return adjacency.tocsr()
-
-
-def _schc(X: np.ndarray, distance_threshold: Optional[float] = None) -> np.ndarray:
+    diagonals, offsets = [], []
+    if n_cols > 1:
+        # Two inner diagonals, excluding the connections between the last and first
+        # columns of consecutive rows.
+        inner = np.ones(n_nodes - 1)
+        inner[n_cols - 1 :: n_cols] = 0
+        diagonals += [inner, inner]
+        offsets += [-1, 1]
+    if n_rows > 1:
+        # Two outer diagonals
+        outer = np.ones(n_nodes - n_cols)
+        diagonals += [outer, outer]
+        offsets += [-n_cols, n_cols]
+    if not diagonals:
+        return csr_matrix((n_nodes, n_nodes))
+    adjacency = diags(diagonals, offsets, shape=(n_nodes, n_nodes), format="csr")
+    adjacency.eliminate_zeros()
+    return adjacency
+
+
+def _region_adjacency(regions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the pairs of regions that are immediate (4-) neighbors of each other.
+
+    Args:
+        regions: Integer array of region labels from 0 to the number of regions.
+
+    Returns:
+        Two integer arrays containing the first and second region of each
+        adjacent pair, with the first region always smaller than the second.
+    """
+    pairs = np.concatenate(
+        [
+            np.stack([regions[:, :-1].ravel(), regions[:, 1:].ravel()], axis=1),
+            np.stack([regions[:-1].ravel(), regions[1:].ravel()], axis=1),
+        ]
+    )
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    pairs.sort(axis=1)
+    pairs = np.unique(pairs, axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def _weighted_ward_tree(
+    means: np.ndarray, sizes: np.ndarray, row: np.ndarray, col: np.ndarray
+) -> Tuple[np.ndarray, int, np.ndarray]:
+    """Connectivity-constrained Ward linkage tree of regions, each of which
+    consists of one or more samples.
+
+    This is equivalent to :func:`sklearn.cluster.ward_tree` on the individual
+    samples, where the samples in each region have already been merged. The
+    regions must be connected.
+
+    Args:
+        means: Mean value of each region.
+        sizes: Number of samples in each region.
+        row: First region of each pair of adjacent regions.
+        col: Second region of each pair of adjacent regions.
+
+    Returns:
+        The children of each non-leaf node, the number of leaves and the
+        distances between the children of each non-leaf node, in the same format
+        as :func:`sklearn.cluster.ward_tree` with `return_distance=True`.
+    """
+    n_leaves = len(means)
+    n_nodes = 2 * n_leaves - 1
+    moments_1 = np.zeros(n_nodes)
+    moments_1[:n_leaves] = sizes
+    moments_2 = np.zeros(n_nodes)
+    moments_2[:n_leaves] = means * sizes
+
+    def _ward_dist(i, j):
+        n_i, n_j = moments_1[i], moments_1[j]
+        return n_i * n_j / (n_i + n_j) * (moments_2[i] / n_i - moments_2[j] / n_j) ** 2
+
+    neighbors = [set() for _ in range(n_nodes)]
+    for i, j in zip(row.tolist(), col.tolist()):
+        neighbors[i].add(j)
+        neighbors[j].add(i)
+    inertia = list(zip(_ward_dist(row, col).tolist(), row.tolist(), col.tolist()))
+    heapify(inertia)
+
+    used_node = np.ones(n_nodes, dtype=bool)
+    children = np.zeros((n_leaves - 1, 2), dtype=np.intp)
+    distances = np.zeros(n_leaves - 1)
+    for k in range(n_leaves, n_nodes):
+        while True:
+            inert, i, j = heappop(inertia)
+            if used_node[i] and used_node[j]:
+                break
+        children[k - n_leaves] = (j, i)
+        distances[k - n_leaves] = inert
+        used_node[i] = used_node[j] = False
+        moments_1[k] = moments_1[i] + moments_1[j]
+        moments_2[k] = moments_2[i] + moments_2[j]
+
+        merged = (neighbors[i] | neighbors[j]) - {i, j}
+        neighbors[i] = neighbors[j] = None
+        for n in merged:
+            neighbors[n].discard(i)
+            neighbors[n].discard(j)
+            neighbors[n].add(k)
+            heappush(inertia, (_ward_dist(k, n), k, n))
+        neighbors[k] = merged
+
+    # 2 is scaling factor to compare w/ sklearn
+    return children, n_leaves, np.sqrt(2.0 * distances)
+
+
+def _superpixels(X: np.ndarray, superpixel_size: int) -> np.ndarray:
+    """Over-segment an array into superpixels of approximately similar values.
+
+    Args:
+        X: Array of values in the range [0, 1]
+        superpixel_size: Approximate number of pixels in each superpixel.
+
+    Returns:
+        Integer array of superpixel labels, from 0 to the number of superpixels.
+    """
+    superpixels = slic(
+        X, n_segments=max(X.size // superpixel_size, 1), compactness=0.1, channel_axis=None, start_label=0
+    )
+    # Make labels contiguous.
+    return np.unique(superpixels, return_inverse=True)[1].reshape(X.shape)
+
+
+def _schc(
+    X: np.ndarray, distance_threshold: Optional[float] = None, superpixel_size: Optional[int] = None
+) -> np.ndarray:
     """Spatially-constrained hierarchical clustering.
 
     Perform hierarchical clustering with Ward linkage on an array
@@ -59,21 +176,42 @@ def _schc(X: np.ndarray, distance_threshold: Optional[float] = None) -> np.ndarr
     distances, making the assumption that for the vast majority of cases, there
     will be less than 1000 density clusters.
 
+    When `superpixel_size` is provided, the array is first over-segmented into
+    superpixels, which are used as the leaves of the Ward tree (weighted by their
+    number of pixels) instead of individual pixels, with spatial constraints given
+    by the adjacency of the superpixels. This reduces the size of the clustering
+    problem by a factor of approximately `superpixel_size`.
+
     Args:
         X: UMI counts per pixel
         distance_threshold: Distance threshold for the Ward linkage
             such that clusters will not be merged if they have
             greater than this distance.
+        superpixel_size: Approximate number of pixels in each superpixel. By
+            default, each pixel is clustered individually.
 
     Returns:
         Clustering result as a Numpy array of same shape, where clusters are
         indicated by integers.
     """
-    lm.main_debug("Constructing spatial adjacency matrix.")
-    adjacency = _create_spatial_adjacency(X.shape)
-    X_flattened = X.flatten()
-    lm.main_debug("Computing Ward tree.")
-    children, _, n_leaves, _, distances = cluster.ward_tree(X_flattened, connectivity=adjacency, return_distance=True)
+    if superpixel_size and superpixel_size > 1:
+        lm.main_debug(f"Computing superpixels of size {superpixel_size}.")
+        superpixels = _superpixels(X, superpixel_size)
+        sizes = np.bincount(superpixels.ravel())
+        means = np.bincount(superpixels.ravel(), weights=X.ravel()) / sizes
+        lm.main_debug(f"Constructing adjacency of {len(sizes)} superpixels.")
+        row, col = _region_adjacency(superpixels)
+        lm.main_debug("Computing Ward tree.")
+        children, n_leaves, distances = _weighted_ward_tree(means, sizes, row, col)
+    else:
+        superpixels = None
+        lm.main_debug("Constructing spatial adjacency matrix.")
+        adjacency = _create_spatial_adjacency(X.shape)
+        X_flattened = X.flatten()
+        lm.main_debug("Computing Ward tree.")
+        children, _, n_leaves, _, distances = cluster.ward_tree(
+            X_flattened, connectivity=adjacency, return_distance=True
+        )
 
     # Find distance threshold if not provided
     if not distance_threshold:
@@ -88,14 +226,56 @@ def _schc(X: np.ndarray, distance_threshold: Optional[float] = None) -> np.ndarr
         distance_threshold = kl.knee
 
     n_clusters = (distances >= distance_threshold).sum() + 1
-    lm.main_debug("Finding {n_clusters} assignments.")
+    lm.main_debug(f"Finding {n_clusters} assignments.")
     assignments = cluster._agglomerative._hc_cut(n_clusters, children, n_leaves)
 
-    return assignments.reshape(X.shape)
+    return assignments.reshape(X.shape) if superpixels is None else assignments[superpixels]
+
+
+def _dilate_labels(X: np.ndarray, bins: np.ndarray, dk: int) -> np.ndarray:
+    """Dilate each label with kernel size `dk`, followed by morphological close
+    and open, in ascending mean density order, such that denser labels take
+    precedence.
+
+    The mean densities and bounding boxes of all labels are found in a single
+    pass, and each label is only dilated within its bounding box (with enough
+    padding for the morphological operations to not be affected by it).
+
+    Args:
+        X: Density of each pixel
+        bins: Positive integer labels of each pixel
+        dk: Kernel size for dilation
+
+    Returns:
+        Dilated labels as a Numpy array of same shape
+    """
+    dilated = np.zeros_like(bins)
+    sizes = np.bincount(bins.ravel())
+    labels = np.flatnonzero(sizes)
+    if len(labels) > 1:
+        means = np.bincount(bins.ravel(), weights=X.ravel())[labels] / sizes[labels]
+        labels = labels[np.argsort(means, kind="stable")]
+    slices = ndimage.find_objects(bins)
+    # The dilation, close and open each extend the mask by at most dk // 2.
+    pad = 3 * (dk // 2) + 1
+    kernel = utils.circle(dk)
+    for label in labels:
+        rows, cols = slices[label - 1]
+        window = (
+            slice(max(rows.start - pad, 0), min(rows.stop + pad, bins.shape[0])),
+            slice(max(cols.start - pad, 0), min(cols.stop + pad, bins.shape[1])),
+        )
+        dilate = cv2.dilate((bins[window] == label).astype(np.uint8), kernel)
+        dilated[window][utils.mclose_mopen(dilate, dk) > 0] = label
+    return dilated
 
 
 def _segment_densities(
-    X: Union[spmatrix, np.ndarray], k: int, dk: int, distance_threshold: Optional[float] = None
+    X: Union[spmatrix, np.ndarray],
+    k: int,
+    dk: int,
+    distance_threshold: Optional[float] = None,
+    superpixel_size: Optional[int] = None,
 ) -> np.ndarray:
     """Segment a matrix containing UMI counts into regions by UMI density.
 
@@ -106,16 +286,18 @@ def _segment_densities(
         distance_threshold: Distance threshold for the Ward linkage
             such that clusters will not be merged if they have
             greater than this distance.
+        superpixel_size: Approximate number of pixels in each superpixel that
+            is used as a leaf of the Ward tree. See :func:`_schc`.
 
     Returns:
         Clustering result as a Numpy array of same shape, where clusters are
         indicated by positive integers.
     """
     # Warn on too large array
-    if X.size > 5e5:
+    if X.size > 5e5 and not (superpixel_size and superpixel_size > 1):
         lm.main_warning(
             f"Array has {X.size} elements. This may take a while and a lot of memory. "
-            "Please consider condensing the array by increasing the binsize."
+            "Please consider condensing the array by increasing the binsize, or providing `superpixel_size`."
         )
 
     # Make dense and normalize.
@@ -129,16 +311,10 @@ def _segment_densities(
     X = utils.conv2d(X, k, mode="gauss")
 
     # Add 1 because 0 should indicate background!
-    bins = _schc(X, distance_threshold=distance_threshold) + 1
+    bins = _schc(X, distance_threshold=distance_threshold, superpixel_size=superpixel_size) + 1
 
     lm.main_debug("Dilating labels in ascending mean density order.")
-    dilated = np.zeros_like(bins)
-    labels = np.unique(bins)
-    for label in sorted(labels, key=lambda label: X[bins == label].mean()):
-        mask = bins == label
-        dilate = cv2.dilate(mask.astype(np.uint8), utils.circle(dk))
-        dilated[utils.mclose_mopen(dilate, dk) > 0] = label
-    return dilated
+    return _dilate_labels(X, bins, dk)
 
 
 @SKM.check_adata_is_type(SKM.ADATA_AGG_TYPE)
@@ -151,6 +327,7 @@ def segment_densities(
     distance_threshold: Optional[float] = None,
     background: Optional[Union[Tuple[int, int], Literal[False]]] = None,
     out_layer: Optional[str] = None,
+    superpixel_size: Optional[int] = None,
 ):
     """Segment into regions by UMI density.
 
@@ -162,7 +339,10 @@ def segment_densities(
     3. The elements of the blurred, binned UMI matrix is hierarchically clustered
         with Ward linkage, distance threshold `distance_threshold`, and spatial
         constraints (immediate neighbors). This yields pixel density bins
-        (a.k.a. labels) the same shape as the binned matrix.
+        (a.k.a. labels) the same shape as the binned matrix. If `superpixel_size`
+        is provided, the binned matrix is first over-segmented into superpixels
+        of approximately this many bins, which are then clustered instead of
+        individual bins.
     4. Each density bin is diluted with kernel size `dk`, starting from the
         bin with the smallest mean UMI (a.k.a. least dense) and going to
         the bin with the largest mean UMI (a.k.a. most dense). This is done in
@@ -192,6 +372,10 @@ def segment_densities(
             default, the bin that is most assigned to the outermost pixels are
             categorized as background. Set to False to turn off background detection.
         out_layer: Layer to put resulting bins. Defaults to `{layer}_bins`.
+        superpixel_size: Approximate number of bins in each superpixel used for
+            hierarchical clustering. This greatly reduces runtime and memory for
+            large arrays, such that a smaller `binsize` may be used. By default,
+            each bin is clustered individually.
     """
     X = SKM.select_layer_data(adata, layer, make_dense=binsize == 1)
     if binsize > 1:
@@ -201,7 +385,7 @@ def segment_densities(
             lm.main_debug("Converting to dense matrix.")
             X = X.A
     lm.main_info("Finding density bins.")
-    bins = _segment_densities(X, k, dk, distance_threshold)
+    bins = _segment_densities(X, k, dk, distance_threshold, superpixel_size)
     if background is not False:
         lm.main_info("Setting background pixels.")
         if background is not None:
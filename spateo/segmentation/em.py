@@ -9,11 +9,10 @@ from functools import partial
 from typing import Dict, Optional, Tuple, Union
 
 import numpy as np
-from joblib import Parallel, delayed
+from joblib import Parallel
 from scipy import special, stats
 from tqdm import tqdm
 
-from ..configuration import config
 from ..errors import SegmentationError
 
 try:
@@ -80,6 +79,132 @@ def nbn_pmf(n, p, X):
     return stats.nbinom(n=float(n), p=float(p)).pmf(X)
 
 
+def histogram_samples(samples: Dict[int, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Histogram the samples of each bin, such that each distinct value of each
+    bin is represented once, along with its multiplicity.
+
+    Args:
+        samples: Dictionary of bin labels to 1D arrays of samples.
+
+    Returns:
+        Four Numpy arrays: the bin labels (in the order of `samples`), and for
+        each distinct (bin, value) pair, the index of the bin, the value and its
+        multiplicity.
+    """
+    labels = np.array(list(samples.keys()))
+    groups = np.repeat(np.arange(len(samples)), [len(_samples) for _samples in samples.values()])
+    values = np.concatenate([np.ravel(_samples) for _samples in samples.values()]) if samples else np.zeros(0)
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.append(starts, len(values)))
+    return labels, groups[starts], values[starts], counts
+
+
+def nbn_em_hist(
+    values: np.ndarray,
+    counts: np.ndarray,
+    groups: Optional[np.ndarray] = None,
+    w: Union[Tuple[float, float], np.ndarray] = (0.99, 0.01),
+    mu: Union[Tuple[float, float], np.ndarray] = (10.0, 300.0),
+    var: Union[Tuple[float, float], np.ndarray] = (20.0, 400.0),
+    max_iter: int = 2000,
+    precision: float = 1e-3,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Run the EM algorithm to estimate the parameters for background and cell
+    UMIs of one or more independent mixtures (i.e. bins), from histogrammed
+    counts.
+
+    Each distinct value is evaluated once per iteration and weighted by its
+    multiplicity, and all mixtures are fit together as a single array problem.
+    Each mixture stops iterating independently, exactly as :func:`nbn_em` would.
+
+    Args:
+        values: Distinct sample values.
+        counts: Multiplicity of each value.
+        groups: Index of the mixture that each value belongs to. Defaults to
+            a single mixture.
+        w: Initial proportions of cell and background, either as a tuple (shared
+            by all mixtures) or an array of shape (n_mixtures, 2).
+        mu: Initial means of cell and background negative binomial distributions,
+            in the same format as `w`.
+        var: Initial variances of cell and background negative binomial
+            distributions, in the same format as `w`.
+        max_iter: Maximum number of iterations.
+        precision: Desired precision. Algorithm will stop once this is reached.
+
+    Returns:
+        Estimated `w`, `r`, `p`, each as an array of shape (n_mixtures, 2).
+    """
+    values = np.asarray(values, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    groups = np.zeros(len(values), dtype=int) if groups is None else np.asarray(groups, dtype=int)
+    w, mu, var = (np.atleast_2d(np.array(param, dtype=float)) for param in (w, mu, var))
+    n_groups = max(len(w), len(mu), len(var), groups.max() + 1 if len(groups) > 0 else 1)
+    w, mu, var = (np.broadcast_to(param, (n_groups, 2)).copy() for param in (w, mu, var))
+    lam, theta = muvar_to_lamtheta(mu, var)
+    r = lamtheta_to_r(lam, theta)
+
+    active = np.ones(n_groups, dtype=bool)
+    for i in range(max_iter):
+        if i == 0 or not active[_groups].all():
+            # Restrict to the mixtures that are still iterating.
+            keep = active[groups]
+            _groups, X, C = groups[keep], values[keep], counts[keep]
+        if not active.any():
+            break
+
+        # E step
+        _r, _theta = r[_groups].T, theta[_groups].T
+        tau = w[_groups].T * stats.nbinom.pmf(X, _r, _theta)
+        tau = np.clip(tau, 1e-10, 1e10)
+        tau /= tau.sum(axis=0)
+
+        beta = 1 - 1 / (1 - theta) - 1 / np.log(theta)
+        delta = _r * (special.digamma(_r + X) - special.digamma(_r))
+
+        # M step, with sums over the samples of each mixture
+        def _segment_sum(weights):
+            return np.stack([np.bincount(_groups, weights=C * _w, minlength=n_groups) for _w in weights], axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tau_sum = _segment_sum(tau)
+            tau_delta_sum = _segment_sum(tau * delta)
+            new_w = tau_sum / tau_sum.sum(axis=1, keepdims=True)
+            new_lam = tau_delta_sum / tau_sum
+            new_theta = beta * tau_delta_sum / _segment_sum(tau * (X - (1 - beta[_groups]).T * delta))
+            new_r = lamtheta_to_r(new_lam, new_theta)
+
+        invalid = (
+            np.any(np.isnan(new_r) | np.isnan(new_w) | np.isnan(new_theta), axis=1)
+            | np.any(np.isinf(new_r) | np.isinf(new_w) | np.isinf(new_theta), axis=1)
+            | np.any((new_r <= 0) | (new_theta > 1) | (new_theta < 0) | (new_w < 0) | (new_w > 1), axis=1)
+        )
+        converged = (
+            np.maximum.reduce(
+                [
+                    np.abs(new_w - w).max(axis=1),
+                    np.abs(new_lam - lam).max(axis=1),
+                    np.abs(new_theta - theta).max(axis=1),
+                ]
+            )
+            < precision
+        )
+        # Mixtures with invalid updates keep their previous estimates.
+        update = active & ~invalid
+        w[update], lam[update], theta[update], r[update] = (
+            new_w[update],
+            new_lam[update],
+            new_theta[update],
+            new_r[update],
+        )
+        active &= ~invalid & ~converged
+
+    return w, r, theta
+
+
 def nbn_em(
     X: np.ndarray,
     w: Tuple[float, float] = (0.99, 0.01),
@@ -103,62 +228,29 @@ def nbn_em(
     Returns:
         Estimated `w`, `r`, `p`.
     """
-    w = np.array(w)
-    mu = np.array(mu)
-    var = np.array(var)
-    lam, theta = muvar_to_lamtheta(mu, var)
-    tau = np.zeros((2,) + X.shape)
-
-    prev_w = w.copy()
-    prev_lam = lam.copy()
-    prev_theta = theta.copy()
-
-    r = lamtheta_to_r(lam, theta)
-    for i in range(max_iter):
-        # E step
-        bp = nbn_pmf(r[0], theta[0], X)
-        cp = nbn_pmf(r[1], theta[1], X)
-        tau[0] = w[0] * bp
-        tau[1] = w[1] * cp
-        # mu = lamtheta_to_muvar(lam, theta)[0]
-
-        # NOTE: tau changes with each line
-        # tau[0][(tau.sum(axis=0) <= 1e-9) & (X < mu[0])] = 1
-        # tau[1][(tau.sum(axis=0) <= 1e-9) & (X > mu[1])] = 1
-        tau = np.clip(tau, 1e-10, 1e10)
-        tau /= tau.sum(axis=0)
-
-        beta = 1 - 1 / (1 - theta) - 1 / np.log(theta)
+    values, counts = np.unique(X, return_counts=True)
+    w, r, p = nbn_em_hist(values, counts, w=w, mu=mu, var=var, max_iter=max_iter, precision=precision)
+    return w[0], r[0], p[0]
 
-        r = r.reshape(-1, 1)
-        delta = r * (special.digamma(r + X) - special.digamma(r))
-
-        tau_sum = tau.sum(axis=1)
-        w = tau_sum / tau_sum.sum()
-        lam = (tau * delta).sum(axis=1) / tau_sum
-        theta = beta * (tau * delta).sum(axis=1) / (tau * (X - (1 - beta).reshape(-1, 1) * delta)).sum(axis=1)
-
-        r = lamtheta_to_r(lam, theta)
-        isnan = np.any(np.isnan(r) | np.isnan(w) | np.isnan(theta))
-        isinf = np.any(np.isinf(r) | np.isinf(w) | np.isinf(theta))
-        isinvalid = np.any((r <= 0) | (theta > 1) | (theta < 0) | (w < 0) | (w > 1))
-        use_prev = isnan or isinf or isinvalid
-
-        if (
-            max(
-                np.abs(w - prev_w).max(),
-                np.abs(lam - prev_lam).max(),
-                np.abs(theta - prev_theta).max(),
-            )
-            < precision
-        ) or use_prev:
-            break
 
-        prev_w = w.copy()
-        prev_lam = lam.copy()
-        prev_theta = theta.copy()
+def _bin_params(
+    em_results: Dict[int, Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]], bins: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Helper function to gather the estimated parameters of the bin of each pixel.
 
-    return (prev_w, lamtheta_to_r(prev_lam, prev_theta), prev_theta) if use_prev else (w, r, theta)
+    Returns:
+        Index of the bin of each pixel, with the same shape as `bins`, whether
+        each bin has estimated parameters, and the `w`, `r`, `p` of each bin, as
+        arrays of shape (2, n_bins). Bins without parameters have NaNs.
+    """
+    labels, inverse = np.unique(bins, return_inverse=True)
+    params = np.full((3, 2, len(labels)), np.nan)
+    found = np.zeros(len(labels), dtype=bool)
+    for i, label in enumerate(labels):
+        if label in em_results:
+            params[:, :, i] = np.array(em_results[label], dtype=float)
+            found[i] = True
+    return inverse.reshape(bins.shape), found, params
 
 
 def conditionals(
@@ -188,13 +280,13 @@ def conditionals(
     if isinstance(em_results, dict):
         if bins is None:
             raise SegmentationError("`em_results` indicate binning was used, but `bins` was not provided")
-        background_cond = np.ones(X.shape)
-        cell_cond = np.zeros(X.shape)
-        for label, (_, r, p) in em_results.items():
-            mask = bins == label
-            samples = X[mask]
-            background_cond[mask] = nbn_pmf(r[0], p[0], samples)
-            cell_cond[mask] = nbn_pmf(r[1], p[1], samples)
+        inverse, found, (_, r, p) = _bin_params(em_results, bins)
+        background_cond = stats.nbinom.pmf(X, r[0][inverse], p[0][inverse])
+        cell_cond = stats.nbinom.pmf(X, r[1][inverse], p[1][inverse])
+        # Pixels in bins without parameters are considered background.
+        missing = ~found[inverse]
+        background_cond[missing] = 1
+        cell_cond[missing] = 0
     else:
         _, r, p = em_results
         background_cond = nbn_pmf(r[0], p[0], X)
@@ -223,13 +315,12 @@ def confidence(
         Numpy array of confidence scores within the range [0, 1].
     """
     bp, cp = conditionals(X, em_results, bins)
-    tau0 = np.zeros(X.shape)
-    tau1 = np.zeros(X.shape)
     if isinstance(em_results, dict):
-        for label, (w, _, _) in em_results.items():
-            mask = bins == label
-            tau0[mask] = w[0] * bp[mask]
-            tau1[mask] = w[1] * cp[mask]
+        inverse, found, (w, _, _) = _bin_params(em_results, bins)
+        # Pixels in bins without parameters have undefined confidence.
+        w[:, ~found] = 0.0
+        tau0 = w[0][inverse] * bp
+        tau1 = w[1][inverse] * cp
     else:
         w, _, _ = em_results
         tau0 = w[0] * bp
@@ -283,9 +374,14 @@ def run_em(
     """
     samples = {}  # key 0 when bins = None
     if bins is not None:
-        for label in np.unique(bins):
+        # Gather the pixels of all bins with a single sort, in the same order as
+        # boolean indexing of each bin.
+        labels, bin_counts = np.unique(bins, return_counts=True)
+        order = np.argsort(bins, axis=None, kind="stable")
+        X_sorted = np.ravel(X)[order]
+        for label, _samples in zip(labels, np.split(X_sorted, np.cumsum(bin_counts)[:-1])):
             if label > 0:
-                samples[label] = X[bins == label]
+                samples[label] = _samples
                 _params = params.get(label, params)
                 if set(_params.keys()) != {"w", "mu", "var"}:
                     raise SegmentationError("`params` must contain exactly the keys `w`, `mu`, `var`.")
@@ -307,15 +403,19 @@ def run_em(
             _samples = rng.choice(_samples, _downsample, replace=False, p=weights / weights.sum())
         final_samples[label] = np.array(_samples)
 
-    # Run in parallel
-    results = {}
-    for label, (res_w, res_r, res_p) in zip(
-        final_samples.keys(),
-        ParallelWithProgress(n_jobs=config.n_threads, total=len(final_samples), desc="Running EM")(
-            delayed(nbn_em)(final_samples[label], max_iter=max_iter, precision=precision, **params.get(label, params))
-            for label in final_samples
-        ),
-    ):
-        results[label] = (tuple(res_w), tuple(res_r), tuple(res_p))
+    # Fit all bins at once on the histogrammed samples
+    labels, groups, values, counts = histogram_samples(final_samples)
+    label_params = [params.get(label, params) for label in labels]
+    res_w, res_r, res_p = nbn_em_hist(
+        values,
+        counts,
+        groups,
+        max_iter=max_iter,
+        precision=precision,
+        **{key: np.array([_params[key] for _params in label_params]) for key in ("w", "mu", "var")},
+    )
+    results = {
+        label: (tuple(res_w[i]), tuple(res_r[i]), tuple(res_p[i])) for i, label in enumerate(final_samples.keys())
+    }
 
     return results if bins is not None else results[0]
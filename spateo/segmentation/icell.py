@@ -3,12 +3,14 @@ generate a cell mask, NOT to identify individual cells.
 
 Original author @HailinPan, refactored by @Lioscro.
 """
+import inspect
 from functools import partial
-from typing import Dict, Optional, Tuple, Union
+from typing import Dict, Iterator, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 from anndata import AnnData
+from joblib import Parallel, delayed
 from scipy.sparse import issparse, spmatrix
 from skimage import filters
 from typing_extensions import Literal
@@ -18,6 +20,10 @@ from ..errors import SegmentationError
 from ..logging import logger_manager as lm
 from . import bp, em, moran, utils, vi
 
+# Maximum number of pixels from which :func:`_score_pixels_tiled` estimates the negative binomial mixture. Larger
+# arrays are subsampled uniformly at random.
+TILED_FIT_PIXELS = 1 << 24
+
 
 def _mask_cells_from_stain(X: np.ndarray, otsu_classes: int = 3, otsu_index: int = 0, mk: int = 7) -> np.ndarray:
     """Create a boolean mask indicating cells from stained image."""
@@ -239,6 +245,48 @@ def _score_pixels(
         SegmentationError: If `bins` and/or `certain_mask` was provided but
             their sizes do not match `X`
     """
+    method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs = _check_score_pixels_args(
+        X, method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs, certain_mask, bins
+    )
+
+    # Convert X to dense array
+    if issparse(X):
+        lm.main_debug("Converting X to dense array.")
+        X = X.A
+
+    # All methods require some kind of 2D convolution to start off
+    lm.main_debug(f"Computing 2D convolution with k={k}.")
+    res = utils.conv2d(X, k, mode="gauss" if method in ("gauss", "moran") else "circle", bins=bins)
+
+    # All methods other than gauss requires EM
+    if method == "gauss":
+        # For just "gauss" method, we should rescale to [0, 1] because all the
+        # other methods eventually produce an array of [0, 1] values.
+        res = utils.scale_to_01(res)
+    elif method == "moran":
+        res = moran.run_moran(res, mask=None if bins is None else bins > 0, **moran_kwargs)
+        # Rescale
+        res /= res.max()
+    else:
+        nb_results = _fit_nb_mixture(res, method, em_kwargs, vi_kwargs, bins)
+        res = _score_nb_mixture(res, k, method, nb_results, bp_kwargs, certain_mask, bins)
+
+    return res
+
+
+def _check_score_pixels_args(
+    X: Union[spmatrix, np.ndarray],
+    method: str,
+    moran_kwargs: Optional[dict],
+    em_kwargs: Optional[dict],
+    vi_kwargs: Optional[dict],
+    bp_kwargs: Optional[dict],
+    certain_mask: Optional[np.ndarray],
+    bins: Optional[np.ndarray],
+) -> Tuple[str, dict, dict, dict, dict]:
+    """Validate the arguments of :func:`_score_pixels`, and return the
+    lowercase method and keyword argument dictionaries.
+    """
     if method.lower() not in ("gauss", "moran", "em", "em+gauss", "em+bp", "vi+gauss", "vi+bp"):
         raise SegmentationError(f"Unknown method `{method}`")
     if certain_mask is not None and X.shape != certain_mask.shape:
@@ -260,59 +308,311 @@ def _score_pixels(
         lm.main_warning(f"`vi_kwargs` will be ignored.")
     if bp_kwargs and "bp" not in method:
         lm.main_warning(f"`bp_kwargs` will be ignored.")
+    return method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs
 
-    # Convert X to dense array
+
+def _fit_nb_mixture(
+    res: np.ndarray, method: str, em_kwargs: dict, vi_kwargs: dict, bins: Optional[np.ndarray] = None
+) -> Union[dict, tuple]:
+    """Estimate the parameters of the negative binomial mixture of background and
+    cell UMIs, using EM or VI depending on the `method`.
+
+    Args:
+        res: Convolved UMI counts per pixel.
+        method: Method, as passed to :func:`_score_pixels`.
+        em_kwargs: Keyword arguments to the :func:`em.run_em` function.
+        vi_kwargs: Keyword arguments to the :func:`vi.run_vi` function.
+        bins: Pixel bins to estimate separately.
+
+    Returns:
+        Return value of :func:`em.run_em` or :func:`vi.run_vi`.
+    """
+    # Obtain initial parameter estimates with Otsu thresholding.
+    # These may be overridden by providing the appropriate kwargs.
+    nb_kwargs = dict(params=_initial_nb_params(res, bins=bins))
+    if "em" in method:
+        nb_kwargs.update(em_kwargs)
+        lm.main_debug(f"Running EM with kwargs {nb_kwargs}.")
+        return em.run_em(res, bins=bins, **nb_kwargs)
+    nb_kwargs.update(vi_kwargs)
+    lm.main_debug(f"Running VI with kwargs {nb_kwargs}.")
+    return vi.run_vi(res, bins=bins, **nb_kwargs)
+
+
+def _score_nb_mixture(
+    res: np.ndarray,
+    k: int,
+    method: str,
+    nb_results: Union[dict, tuple],
+    bp_kwargs: dict,
+    certain_mask: Optional[np.ndarray] = None,
+    bins: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Score each pixel using the estimated negative binomial mixture, followed by
+    belief propagation or a Gaussian blur depending on the `method`.
+
+    Args:
+        res: Convolved UMI counts per pixel.
+        k: Kernel size for the Gaussian blur.
+        method: Method, as passed to :func:`_score_pixels`.
+        nb_results: Return value of :func:`_fit_nb_mixture`.
+        bp_kwargs: Keyword arguments to the :func:`bp.run_bp` function.
+        certain_mask: A boolean Numpy array indicating which pixels are certain
+            to be occupied.
+        bins: Pixel bins, as was passed to :func:`_fit_nb_mixture`.
+
+    Returns:
+        [0, 1] score of each pixel being a cell.
+    """
+    if "em" in method:
+        conditional_func = partial(em.conditionals, em_results=nb_results, bins=bins)
+    else:
+        conditional_func = partial(vi.conditionals, vi_results=nb_results, bins=bins)
+
+    if "bp" in method:
+        lm.main_debug("Computing conditionals.")
+        background_cond, cell_cond = conditional_func(res)
+        if certain_mask is not None:
+            background_cond[certain_mask] = 1e-2
+            cell_cond[certain_mask] = 1 - (1e-2)
+        lm.main_debug(f"Running BP with kwargs {bp_kwargs}.")
+        res = bp.run_bp(background_cond, cell_cond, **bp_kwargs)
+    else:
+        lm.main_debug("Computing confidences.")
+        res = em.confidence(res, em_results=nb_results, bins=bins)
+        if certain_mask is not None:
+            res = np.clip(res + certain_mask, 0, 1)
+
+    if "gauss" in method:
+        lm.main_debug("Computing Gaussian blur.")
+        res = utils.conv2d(res, k, mode="gauss", bins=bins)
+    return res
+
+
+def _fit_nb_mixture_subsample(
+    res: np.ndarray, method: str, em_kwargs: dict, vi_kwargs: dict, bins: Optional[np.ndarray] = None
+) -> Union[dict, tuple]:
+    """Estimate the parameters of the negative binomial mixture like
+    :func:`_fit_nb_mixture`, from at most `TILED_FIT_PIXELS` pixels drawn
+    uniformly at random, such that the estimation does not copy the whole array.
+    A fractional `downsample` of EM/VI is scaled up accordingly, such that the
+    same number of samples is used.
+
+    Args:
+        res: Convolved UMI counts per pixel.
+        method: Method, as passed to :func:`_score_pixels`.
+        em_kwargs: Keyword arguments to the :func:`em.run_em` function.
+        vi_kwargs: Keyword arguments to the :func:`vi.run_vi` function.
+        bins: Pixel bins to estimate separately.
+
+    Returns:
+        Return value of :func:`em.run_em` or :func:`vi.run_vi`.
+    """
+    if res.size <= TILED_FIT_PIXELS:
+        return _fit_nb_mixture(res, method, em_kwargs, vi_kwargs, bins)
+
+    run_func, nb_kwargs = (em.run_em, em_kwargs) if "em" in method else (vi.run_vi, vi_kwargs)
+    rng = np.random.default_rng(nb_kwargs.get("seed"))
+    pixels = np.sort(rng.choice(res.size, TILED_FIT_PIXELS, replace=False))
+    lm.main_debug(f"Estimating the negative binomial mixture from {TILED_FIT_PIXELS} random pixels.")
+    downsample = nb_kwargs.get("downsample", inspect.signature(run_func).parameters["downsample"].default)
+    if downsample <= 1:
+        nb_kwargs = dict(nb_kwargs, downsample=min(downsample * res.size / TILED_FIT_PIXELS, 1.0))
+    if "em" in method:
+        em_kwargs = nb_kwargs
+    else:
+        vi_kwargs = nb_kwargs
+    return _fit_nb_mixture(
+        res.reshape(-1)[pixels], method, em_kwargs, vi_kwargs, None if bins is None else bins.reshape(-1)[pixels]
+    )
+
+
+def _iter_tiles(
+    shape: Tuple[int, int], tile_size: int, halo: int
+) -> Iterator[Tuple[Tuple[slice, slice], Tuple[slice, slice], Tuple[slice, slice]]]:
+    """Split an array into non-overlapping tiles, each of which is extended by a
+    halo of neighboring pixels (clipped to the array).
+
+    Args:
+        shape: Shape of the array.
+        tile_size: Size of each tile, excluding the halo.
+        halo: Number of pixels to extend each tile by, on all sides.
+
+    Yields:
+        3-element tuples of slices, containing the tile in the array, the tile
+        with its halo in the array, and the tile within the tile with its halo.
+    """
+    for row in range(0, shape[0], tile_size):
+        for col in range(0, shape[1], tile_size):
+            tile = (slice(row, min(row + tile_size, shape[0])), slice(col, min(col + tile_size, shape[1])))
+            outer = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, n)) for s, n in zip(tile, shape))
+            inner = tuple(slice(s.start - o.start, s.stop - o.start) for s, o in zip(tile, outer))
+            yield tile, outer, inner
+
+
+def _conv_tile(X: Union[spmatrix, np.ndarray], bins: Optional[np.ndarray], k: int, mode: str) -> np.ndarray:
+    """Helper function to compute the 2D convolution of a single tile."""
+    return utils.conv2d(X.A if issparse(X) else X, k, mode=mode, bins=bins)
+
+
+def _score_tile(
+    res: np.ndarray,
+    certain_mask: Optional[np.ndarray],
+    bins: Optional[np.ndarray],
+    k: int,
+    method: str,
+    moran_kwargs: dict,
+    moments: Optional[Tuple[float, float, float, int]],
+    nb_results: Optional[Union[dict, tuple]],
+    bp_kwargs: dict,
+) -> np.ndarray:
+    """Helper function to score the pixels of a single tile of the convolved UMI
+    counts, given the model fit on the whole array."""
+    if method == "moran":
+        return moran.run_moran(res, mask=None if bins is None else bins > 0, moments=moments, **moran_kwargs)
+    return _score_nb_mixture(res, k, method, nb_results, bp_kwargs, certain_mask, bins)
+
+
+def _score_pixels_tiled(
+    X: Union[spmatrix, np.ndarray],
+    k: int,
+    method: Literal["gauss", "moran", "EM", "EM+gauss", "EM+BP", "VI+gauss", "VI+BP"],
+    moran_kwargs: Optional[dict] = None,
+    em_kwargs: Optional[dict] = None,
+    vi_kwargs: Optional[dict] = None,
+    bp_kwargs: Optional[dict] = None,
+    certain_mask: Optional[np.ndarray] = None,
+    bins: Optional[np.ndarray] = None,
+    tile_size: int = 2048,
+    n_jobs: int = 1,
+) -> np.ndarray:
+    """Tiled version of :func:`_score_pixels`, for arrays that are too large to
+    be processed at once.
+
+    The convolution and the scoring of each pixel are computed in overlapping
+    tiles, each extended by a halo of neighboring pixels that is large enough for
+    the convolution kernels (and belief propagation messages) to not be affected by
+    the tile boundaries. Only the model parameters (i.e. those estimated by EM/VI
+    and the global Moran's I statistics) are computed from the whole array. Apart
+    from the per-tile arrays, only a single array of the size of `X` is held in
+    memory (the convolved counts, which are overwritten by the final scores), and
+    `X` is never densified as a whole. For arrays of more than `TILED_FIT_PIXELS`
+    pixels, EM/VI are run on a random subsample of that many pixels, in which case
+    the results are no longer identical to those of :func:`_score_pixels`. All results are identical
+    to those of :func:`_score_pixels`, except for belief propagation, which is
+    run separately for each tile and is therefore approximate close to the halo
+    boundary.
+
+    Args:
+        X: UMI counts per pixel as either a sparse or dense array.
+        k: Kernel size for convolution.
+        method: Method to use. See :func:`_score_pixels`.
+        moran_kwargs: Keyword arguments to the :func:`moran.run_moran` function.
+        em_kwargs: Keyword arguments to the :func:`em.run_em` function.
+        vi_kwargs: Keyword arguments to the :func:`vi.run_vi` function.
+        bp_kwargs: Keyword arguments to the :func:`bp.run_bp` function.
+        certain_mask: A boolean Numpy array indicating which pixels are certain
+            to be occupied, a-priori.
+        bins: Pixel bins to segment separately. Only takes effect when the EM
+            algorithm is run.
+        tile_size: Size of each (square) tile, excluding the halo.
+        n_jobs: Number of tiles to process in parallel, each in a separate process.
+
+    Returns:
+        [0, 1] score of each pixel being a cell.
+
+    Raises:
+        SegmentationError: If `bins` and/or `certain_mask` was provided but
+            their sizes do not match `X`
+    """
+    method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs = _check_score_pixels_args(
+        X, method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs, certain_mask, bins
+    )
     if issparse(X):
-        lm.main_debug("Converting X to dense array.")
-        X = X.A
+        X = X.tocsr()
+    if tile_size < 1:
+        raise SegmentationError("`tile_size` must be positive.")
+
+    def _select(arr, s):
+        return None if arr is None else arr[s]
+
+    def _run_tiles(func, halo, *args, out=None):
+        """Run `func` on each tile with its halo, and stitch the inner tiles.
+
+        If `out` is provided, the inner tiles are written into it, even if it is
+        also the first argument: each inner tile is only written once all tiles
+        whose halo reads it have been processed.
+        """
+        tiles = list(_iter_tiles(X.shape, tile_size, halo))
+        # Tiles are in row-major order, so the last tile whose halo overlaps a tile
+        # is the one `reach` tiles below and to the right of it.
+        reach = -(-halo // tile_size)
+        n_rows, n_cols = -(-X.shape[0] // tile_size), -(-X.shape[1] // tile_size)
+        last_reader = [
+            min(i // n_cols + reach, n_rows - 1) * n_cols + min(i % n_cols + reach, n_cols - 1)
+            for i in range(len(tiles))
+        ]
+        pending = {}
+        with Parallel(n_jobs=n_jobs) as parallel:
+            # Process a limited number of tiles at once, such that the results of
+            # at most this many tiles, and of the tiles pending to be written (at
+            # most `reach` rows of tiles), are held in memory.
+            for start in range(0, len(tiles), max(n_jobs, 1)):
+                batch = tiles[start : start + max(n_jobs, 1)]
+                results = parallel(delayed(func)(*(_select(arg, outer) for arg in args)) for _, outer, _ in batch)
+                for i, ((_, _, inner), result) in enumerate(zip(batch, results), start):
+                    if out is None:
+                        out = np.empty(X.shape, dtype=result.dtype)
+                    # Copy, such that the halo of the result is not kept alive.
+                    pending[i] = result[inner].copy()
+                for i in [i for i in pending if last_reader[i] < start + len(batch)]:
+                    out[tiles[i][0]] = pending.pop(i)
+        return out
 
     # All methods require some kind of 2D convolution to start off
-    lm.main_debug(f"Computing 2D convolution with k={k}.")
-    res = utils.conv2d(X, k, mode="gauss" if method in ("gauss", "moran") else "circle", bins=bins)
+    lm.main_debug(f"Computing 2D convolution with k={k} in tiles of size {tile_size}.")
+    mode = "gauss" if method in ("gauss", "moran") else "circle"
+    res = _run_tiles(partial(_conv_tile, k=k, mode=mode), k // 2, X, bins)
 
-    # All methods other than gauss requires EM
     if method == "gauss":
-        # For just "gauss" method, we should rescale to [0, 1] because all the
-        # other methods eventually produce an array of [0, 1] values.
-        res = utils.scale_to_01(res)
-    elif method == "moran":
-        res = moran.run_moran(res, mask=None if bins is None else bins > 0, **moran_kwargs)
-        # Rescale
+        # Rescale to [0, 1] in place.
+        res_min = res.min()
+        res -= res_min
         res /= res.max()
-    else:
-        # Obtain initial parameter estimates with Otsu thresholding.
-        # These may be overridden by providing the appropriate kwargs.
-        nb_kwargs = dict(params=_initial_nb_params(res, bins=bins))
-        if "em" in method:
-            nb_kwargs.update(em_kwargs)
-            lm.main_debug(f"Running EM with kwargs {nb_kwargs}.")
-            em_results = em.run_em(res, bins=bins, **nb_kwargs)
-            conditional_func = partial(em.conditionals, em_results=em_results, bins=bins)
-        else:
-            nb_kwargs.update(vi_kwargs)
-            lm.main_debug(f"Running VI with kwargs {nb_kwargs}.")
-            vi_results = vi.run_vi(res, bins=bins, **nb_kwargs)
-            conditional_func = partial(vi.conditionals, vi_results=vi_results, bins=bins)
+        return res
 
+    moments = nb_results = None
+    if method == "moran":
+        moments = moran.moran_moments(res, mask=None if bins is None else bins > 0)
+        halo = moran_kwargs.get("k", 7) // 2
+    else:
+        nb_results = _fit_nb_mixture_subsample(res, method, em_kwargs, vi_kwargs, bins)
+        halo = k // 2 if "gauss" in method else 0
         if "bp" in method:
-            lm.main_debug("Computing conditionals.")
-            background_cond, cell_cond = conditional_func(res)
-            if certain_mask is not None:
-                background_cond[certain_mask] = 1e-2
-                cell_cond[certain_mask] = 1 - (1e-2)
-            lm.main_debug(f"Running BP with kwargs {bp_kwargs}.")
-            res = bp.run_bp(background_cond, cell_cond, **bp_kwargs)
-        else:
-            lm.main_debug("Computing confidences.")
-            res = em.confidence(res, em_results=em_results, bins=bins)
-            if certain_mask is not None:
-                res = np.clip(res + certain_mask, 0, 1)
-
-        if "gauss" in method:
-            lm.main_debug("Computing Gaussian blur.")
-            res = utils.conv2d(res, k, mode="gauss", bins=bins)
-
-    return res
+            # Messages propagate by at most one neighborhood radius per iteration.
+            halo += (bp_kwargs.get("k", 3) // 2) * bp_kwargs.get("max_iter", 100)
+
+    lm.main_debug(f"Scoring pixels in tiles of size {tile_size} with halo {halo}.")
+    score_func = partial(
+        _score_tile,
+        k=k,
+        method=method,
+        moran_kwargs=moran_kwargs,
+        moments=moments,
+        nb_results=nb_results,
+        bp_kwargs=bp_kwargs,
+    )
+    # The scores overwrite the convolved counts, such that only one array of the
+    # size of `X` is held in memory.
+    scores = _run_tiles(
+        score_func, halo, res, certain_mask, bins, out=res if np.issubdtype(res.dtype, np.floating) else None
+    )
+    del res
+
+    if method == "moran":
+        # Rescale
+        scores /= scores.max()
+    return scores
 
 
 @SKM.check_adata_is_type(SKM.ADATA_AGG_TYPE)
@@ -332,6 +632,8 @@ def score_and_mask_pixels(
     certain_layer: Optional[str] = None,
     scores_layer: Optional[str] = None,
     mask_layer: Optional[str] = None,
+    tile_size: Optional[int] = None,
+    n_jobs: int = 1,
 ):
     """Score and mask pixels by how likely it is occupied.
 
@@ -373,8 +675,16 @@ def score_and_mask_pixels(
         scores_layer: Layer to save pixel scores before thresholding. Defaults
             to `{layer}_scores`.
         mask_layer: Layer to save the final mask. Defaults to `{layer}_mask`.
+        tile_size: If provided, pixels are scored in square tiles of this size
+            (plus a halo of neighboring pixels), such that the UMI counts are never
+            converted to a dense array as a whole. This is useful for whole-chip
+            arrays. Scores are identical to those without tiling, except for
+            belief propagation, which is approximate close to tile boundaries.
+            See :func:`_score_pixels_tiled`.
+        n_jobs: Number of tiles to process in parallel. Only used when
+            `tile_size` is provided.
     """
-    X = SKM.select_layer_data(adata, layer, make_dense=True)
+    X = SKM.select_layer_data(adata, layer, make_dense=tile_size is None)
     certain_mask = None
     if certain_layer:
         certain_mask = SKM.select_layer_data(adata, certain_layer).astype(bool)
@@ -385,7 +695,12 @@ def score_and_mask_pixels(
             bins = SKM.select_layer_data(adata, bins_layer)
     method = method.lower()
     lm.main_info(f"Scoring pixels with {method} method.")
-    scores = _score_pixels(X, k, method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs, certain_mask, bins)
+    if tile_size is None:
+        scores = _score_pixels(X, k, method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs, certain_mask, bins)
+    else:
+        scores = _score_pixels_tiled(
+            X, k, method, moran_kwargs, em_kwargs, vi_kwargs, bp_kwargs, certain_mask, bins, tile_size, n_jobs
+        )
     scores_layer = scores_layer or SKM.gen_new_layer_key(layer, SKM.SCORES_SUFFIX)
     SKM.set_layer_data(adata, scores_layer, scores)
 
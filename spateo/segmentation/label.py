@@ -9,9 +9,11 @@ import numpy as np
 from anndata import AnnData
 from joblib import Parallel, delayed
 from numba import njit
+from scipy import ndimage
 from skimage import feature, filters, measure, segmentation
 from sympy import Segment
 from tqdm import tqdm
+from typing_extensions import Literal
 
 from ..configuration import SKM, config
 from ..errors import SegmentationError
@@ -180,28 +182,91 @@ def watershed(
     SKM.set_layer_data(adata, out_layer, labels)
 
 
+def _expand_labels_edt(
+    labels: np.ndarray,
+    distance: int,
+    max_area: int,
+    mask: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Expand labels up to a certain distance in a single pass, using the
+    Euclidean distance transform.
+
+    Each unlabeled pixel within `distance` of a label (and within the mask) is
+    assigned to its nearest label. Pixels are claimed in order of increasing
+    distance, and each label stops claiming pixels once it reaches `max_area`.
+    Claimed pixels that are not connected to their label (i.e. because the mask
+    separates them) are discarded.
+
+    Args:
+        labels: Numpy array containing integer labels.
+        distance: Maximum Euclidean distance to expand.
+        max_area: Maximum area of each label.
+        mask: Only expand within the provided mask.
+
+    Returns:
+        New label array with expanded labels.
+    """
+    distances, (rows, cols) = ndimage.distance_transform_edt(labels == 0, return_indices=True)
+    claim = (labels == 0) & (distances <= distance)
+    if mask is not None:
+        claim &= mask
+    claim_idx = np.flatnonzero(claim)
+    claim_labels = labels[rows.flat[claim_idx], cols.flat[claim_idx]]
+    claim_distances = distances.flat[claim_idx]
+    del distances, rows, cols
+
+    # Emulate a priority queue: within each label, claim pixels in order of
+    # increasing distance, until the label's area budget is spent.
+    areas = np.bincount(labels.flatten())
+    budget = np.clip(max_area - areas, 0, None)
+    order = np.lexsort((claim_distances, claim_labels))
+    sorted_labels = claim_labels[order]
+    starts = np.searchsorted(sorted_labels, sorted_labels, side="left")
+    keep = order[(np.arange(len(order)) - starts) < budget[sorted_labels]]
+
+    expanded = labels.copy()
+    expanded.flat[claim_idx[keep]] = claim_labels[keep]
+
+    # Discard claimed pixels that are not connected to any original label pixel.
+    components = measure.label(expanded, background=0, connectivity=1)
+    connected = np.zeros(components.max() + 1, dtype=bool)
+    connected[components[labels > 0]] = True
+    expanded[~connected[components]] = 0
+    expanded[labels > 0] = labels[labels > 0]
+    return expanded
+
+
 def _expand_labels(
     labels: np.ndarray,
     distance: int,
     max_area: int,
     mask: Optional[np.ndarray] = None,
+    mode: Literal["iterative", "edt"] = "iterative",
 ) -> np.ndarray:
     """Expand labels up to a certain distance, while ignoring labels that are
     above a certain size.
 
     Args:
         labels: Numpy array containing integer labels.
-        distance: Distance to expand. Internally, this is used as the number
-            of iterations of distance 1 dilations.
+        distance: Distance to expand. In `iterative` mode, this is used as the
+            number of iterations of distance 1 dilations.
         max_area: Maximum area of each label.
         mask: Only expand within the provided mask.
+        mode: Expansion mode. `iterative` runs `distance` rounds of distance 1
+            dilations, where pixels neighboring more than one label are never
+            claimed. `edt` expands all labels in a single pass using the
+            Euclidean distance transform. See :func:`_expand_labels_edt`.
 
     Returns:
         New label array with expanded labels.
     """
+    if mode not in ("iterative", "edt"):
+        raise SegmentationError(f"Unknown mode `{mode}`")
     masked_labels = labels[mask] if mask is not None else labels
     if (masked_labels > 0).all() or (masked_labels == 0).all():
         return labels
+    if mode == "edt":
+        return _expand_labels_edt(labels, distance, max_area, mask=mask)
 
     @njit
     def _expand(X, areas, max_area, mask, start_i, end_i):
@@ -274,6 +339,7 @@ def expand_labels(
     max_area: int = 400,
     mask_layer: Optional[str] = None,
     out_layer: Optional[str] = None,
+    mode: Literal["iterative", "edt"] = "iterative",
 ):
     """Expand labels up to a certain distance.
 
@@ -281,11 +347,14 @@ def expand_labels(
         adata: Input Anndata
         layer: Layer from which the labels were derived. Then, `{layer}_labels`
             is used as the labels. If not present, it is taken as a literal.
-        distance: Distance to expand. Internally, this is used as the number
-            of iterations of distance 1 dilations.
+        distance: Distance to expand. In `iterative` mode, this is used as the
+            number of iterations of distance 1 dilations.
         max_area: Maximum area of each label.
         mask_layer: Layer containing mask to restrict expansion to within.
         out_layer: Layer to save results. By default, uses `{layer}_labels_expanded`.
+        mode: Expansion mode. `iterative` runs `distance` rounds of distance 1
+            dilations. `edt` expands all labels in a single pass using the
+            Euclidean distance transform, which is much faster for large arrays.
     """
     label_layer = SKM.gen_new_layer_key(layer, SKM.LABELS_SUFFIX)
     if label_layer not in adata.layers:
@@ -293,7 +362,7 @@ def expand_labels(
     labels = SKM.select_layer_data(adata, label_layer)
     mask = SKM.select_layer_data(adata, mask_layer) if mask_layer else None
     lm.main_info("Expanding labels.")
-    expanded = _expand_labels(labels, distance, max_area, mask=mask)
+    expanded = _expand_labels(labels, distance, max_area, mask=mask, mode=mode)
     out_layer = out_layer or SKM.gen_new_layer_key(label_layer, SKM.EXPANDED_SUFFIX)
     SKM.set_layer_data(adata, out_layer, expanded)
 
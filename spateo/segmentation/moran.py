@@ -7,7 +7,7 @@ from typing import Optional, Tuple
 import cv2
 import numpy as np
 from anndata import AnnData
-from scipy import signal, stats
+from scipy import stats
 from skimage.filters import sobel, threshold_otsu
 from skimage.segmentation import watershed
 
@@ -16,19 +16,19 @@ from ..logging import logger_manager as lm
 from . import utils
 
 
-def moranI(
-    X: np.ndarray, kernel: np.ndarray, mask: Optional[np.ndarray] = None
-) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-    """Compute Moran's I for cell masking.
+def moran_moments(X: np.ndarray, mask: Optional[np.ndarray] = None) -> Tuple[float, float, float, int]:
+    """Compute the global statistics of an array that are used to compute
+    Moran's I. These can be computed once for a whole array and then reused
+    when computing Moran's I for tiles of that array.
 
     Args:
         X: Numpy array containing (possibly smoothed) UMI counts or binarized
             values.
-        kernel: 2D kernel containing weights
         mask: If provided, only consider pixels within the mask
 
     Returns:
-        A 4-element tuple containing (z, c, i, pvalue).
+        A 4-element tuple containing the mean, second and fourth central
+        moments, and the number of considered pixels.
     """
     masked_X = X
     n = X.size
@@ -36,16 +36,38 @@ def moranI(
         masked_X = X[mask]
         n = mask.sum()
     x_bar = masked_X.sum() / n
+    z_masked = masked_X - x_bar
+    m2 = (z_masked**2).sum() / n
+    m4 = (z_masked**4).sum() / n
+    return x_bar, m2, m4, n
 
-    z = X - x_bar
-    z_masked = z if mask is None else z[mask]
 
-    m2 = (z_masked**2).sum() / n
-    c = signal.convolve2d(z, kernel, boundary="symm", mode="same")
+def moranI(
+    X: np.ndarray,
+    kernel: np.ndarray,
+    mask: Optional[np.ndarray] = None,
+    moments: Optional[Tuple[float, float, float, int]] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Compute Moran's I for cell masking.
+
+    Args:
+        X: Numpy array containing (possibly smoothed) UMI counts or binarized
+            values.
+        kernel: 2D kernel containing weights
+        mask: If provided, only consider pixels within the mask
+        moments: Global statistics, as returned by :func:`moran_moments`. By
+            default, these are computed from `X` and `mask`.
+
+    Returns:
+        A 4-element tuple containing (z, c, i, pvalue).
+    """
+    x_bar, m2, m4, n = moments if moments is not None else moran_moments(X, mask)
+
+    z = X - x_bar
+    c = utils.convolve(z, kernel)
     i = z / m2 * c
     ei = -kernel.sum() / (n - 1)
     wi2 = (kernel**2).sum()
-    m4 = (z_masked**4).sum() / n
     b2 = m4 / (m2**2)
     tow_wikh = (kernel.reshape(-1, 1) * kernel.reshape(1, -1)).sum()
     vari = wi2 * (n - b2) / (n - 1) + tow_wikh * (2 * b2 - n) / ((n - 1) * (n - 2)) - kernel.sum() ** 2 / (n - 1) ** 2
@@ -54,7 +76,13 @@ def moranI(
     return z, c, i, pvalue
 
 
-def run_moran(X: np.ndarray, k: int = 7, p_threshold: float = 0.05, mask: Optional[np.ndarray] = None) -> np.ndarray:
+def run_moran(
+    X: np.ndarray,
+    k: int = 7,
+    p_threshold: float = 0.05,
+    mask: Optional[np.ndarray] = None,
+    moments: Optional[Tuple[float, float, float, int]] = None,
+) -> np.ndarray:
     """Compute scores using Moran's I method.
 
     Args:
@@ -63,6 +91,8 @@ def run_moran(X: np.ndarray, k: int = 7, p_threshold: float = 0.05, mask: Option
         k: Kernel size
         p_threshold: P-value threshold. Test. Test Test
         mask: If provided, only consider pixels within the mask
+        moments: Global statistics, as returned by :func:`moran_moments`. By
+            default, these are computed from `X` and `mask`.
 
     Returns:
         A 2D Numpy array indicating pixel scores
@@ -73,7 +103,7 @@ def run_moran(X: np.ndarray, k: int = 7, p_threshold: float = 0.05, mask: Option
     kernel = (ky * kx.T) * utils.circle(k)
     kernel[(k - 1) // 2, (k - 1) // 2] = 0
 
-    z, c, i, pvalue = moranI(X, kernel, mask=mask)
+    z, c, i, pvalue = moranI(X, kernel, mask=mask, moments=moments)
 
     # Set pixels whose p values are < p_threshold to zero, which indicate
     # no spatial correlation.
@@ -6,7 +6,7 @@ import cv2
 import numpy as np
 from anndata import AnnData
 from kneed import KneeLocator
-from scipy import signal, sparse
+from scipy import ndimage, signal, sparse
 from skimage.segmentation import find_boundaries
 from tqdm import tqdm
 from typing_extensions import Literal
@@ -97,6 +97,48 @@ def median_blur(X: np.ndarray, k: int) -> np.ndarray:
     return cv2.medianBlur(src=X.astype(np.uint8), ksize=k)
 
 
+# Kernels with at least this many rows or columns are convolved with overlap-add
+# FFT, instead of directly, by :func:`convolve`.
+FFT_MIN_KERNEL_SIZE = 11
+
+
+def convolve(X: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Convolve an array with a 2D kernel using symmetric boundary conditions.
+
+    The result is the same as `signal.convolve2d(X, kernel, boundary="symm", mode="same")`,
+    but the convolution method is chosen depending on the kernel. Constant
+    (i.e. square) kernels are applied as box filters, which take constant time
+    per pixel regardless of the kernel size. Other kernels with at least
+    :attr:`FFT_MIN_KERNEL_SIZE` rows or columns are applied with overlap-add FFT,
+    which processes the array in blocks. All other kernels are applied directly.
+
+    Args:
+        X: The array to convolve.
+        kernel: 2D kernel with an odd number of rows and columns.
+
+    Returns:
+        The convolved array, with the same dtype as :func:`signal.convolve2d` would
+        return.
+    """
+    dtype = np.result_type(X, kernel)
+    kh, kw = kernel.shape
+    if kh % 2 == 0 or kw % 2 == 0 or kh > X.shape[0] or kw > X.shape[1]:
+        return signal.convolve2d(X, kernel, boundary="symm", mode="same")
+
+    if (kernel == kernel.flat[0]).all():
+        conv = kernel.flat[0] * cv2.boxFilter(
+            X.astype(np.float64), -1, (kw, kh), normalize=False, borderType=cv2.BORDER_REFLECT
+        )
+    elif max(kh, kw) >= FFT_MIN_KERNEL_SIZE:
+        padded = np.pad(X.astype(np.float64), ((kh // 2, kh // 2), (kw // 2, kw // 2)), mode="symmetric")
+        conv = signal.oaconvolve(padded, kernel.astype(np.float64), mode="valid")
+    else:
+        return signal.convolve2d(X, kernel, boundary="symm", mode="same")
+    if np.issubdtype(dtype, np.integer):
+        conv = np.rint(conv)
+    return conv.astype(dtype, copy=False)
+
+
 def conv2d(
     X: np.ndarray, k: int, mode: Literal["gauss", "median", "circle", "square"], bins: Optional[np.ndarray] = None
 ) -> np.ndarray:
@@ -109,7 +151,10 @@ def conv2d(
             gauss:
             circle:
             square:
-        bins: Convolve per bin. Zeros are ignored.
+        bins: Convolve per bin. Zeros are ignored. Each bin is convolved only
+            within its bounding box (extended by the kernel radius), which yields
+            the same result as convolving the whole array with all other bins
+            set to zero.
 
     Returns:
         The convolved array
@@ -133,14 +178,20 @@ def conv2d(
         if mode == "median":
             return median_blur(_X, k)
         kernel = np.ones((k, k), dtype=np.uint8) if mode == "square" else circle(k)
-        return signal.convolve2d(_X, kernel, boundary="symm", mode="same")
+        return convolve(_X, kernel)
 
     if bins is not None:
         conv = np.zeros(X.shape)
-        for label in np.unique(bins):
-            if label > 0:
-                mask = bins == label
-                conv[mask] = _conv(X * mask)[mask]
+        r = k // 2
+        for label, slices in enumerate(ndimage.find_objects(bins.astype(int, copy=False)), 1):
+            if slices is None:
+                continue
+            # Pixels of the bin only depend on pixels within the kernel radius,
+            # and the window is clipped at the array boundaries, such that the
+            # boundary conditions are unchanged.
+            window = tuple(slice(max(sl.start - r, 0), min(sl.stop + r, n)) for sl, n in zip(slices, X.shape))
+            mask = bins[window] == label
+            conv[window][mask] = _conv(X[window] * mask)[mask]
         return conv
     return _conv(X)
 
@@ -310,17 +361,17 @@ def label_overlap(X: np.ndarray, Y: np.ndarray) -> sparse.csr_matrix:
             each label are overlapping.
     """
 
-    def _label_overlap(X, Y):
-        overlap = sparse.dok_matrix((X.max() + 1, Y.max() + 1), dtype=np.uint)
-        for i in range(X.size):
-            overlap[X[i], Y[i]] += 1
-        return overlap
-
     if X.shape != Y.shape:
         raise SegmentationError(
             f"Both arrays must have the same shape, but one is {X.shape} and the other is {Y.shape}."
         )
-    return _label_overlap(X.flatten(), Y.flatten()).tocsr()
+    X = X.ravel()
+    Y = Y.ravel()
+    # Duplicate (row, column) pairs are summed when converting to CSR.
+    overlap = sparse.coo_matrix(
+        (np.ones(X.size, dtype=np.uint), (X, Y)), shape=(X.max(initial=0) + 1, Y.max(initial=0) + 1)
+    )
+    return overlap.tocsr()
 
 
 def clahe(X: np.ndarray, clip_limit: float = 1.0, tile_grid: Tuple[int, int] = (100, 100)) -> np.ndarray:
@@ -1,6 +1,4 @@
-import multiprocessing
 import sys
-from functools import partial
 from typing import List, Optional, Tuple, Union
 
 import dynamo as dyn
@@ -11,7 +9,7 @@ import scipy
 import scipy.stats
 from anndata import AnnData
 from dynamo.tools.sampling import sample
-from scipy.sparse import csr_matrix, issparse
+from scipy.sparse import csc_matrix, csr_matrix, issparse
 from scipy.stats import norm
 from statsmodels.stats.multitest import multipletests
 from tqdm import tqdm
@@ -206,10 +204,36 @@ def downsampling(
     return adata
 
 
+def _bootstrap_perm(n: int, seed: int) -> Optional[np.ndarray]:
+    """The permutation of the bins of a bootstrap, the same as shuffling the rows of the expression matrix with
+    `shuffle_adata`. The bootstrap with seed 0 is the observed data."""
+    return None if seed == 0 else np.random.RandomState(seed).permutation(n)
+
+
+def _gene_matrix(adata: AnnData, gene_ids: Union[List, np.ndarray]) -> Union[np.ndarray, csc_matrix]:
+    """The bins x genes expression matrix of the given genes, in CSC format if sparse."""
+    X = adata.X[:, adata.var_names.get_indexer(gene_ids)]
+    return X.tocsc() if issparse(X) else np.asarray(X)
+
+
+def _positive_ratios(X: Union[np.ndarray, csc_matrix]) -> np.ndarray:
+    """The fraction of bins expressing each gene, which is the same in all bootstraps."""
+    return np.asarray((X > 0).sum(axis=0)).flatten() / X.shape[0]
+
+
+def _target_histogram(adata: AnnData, target: Union[List, np.ndarray, str]) -> np.ndarray:
+    """The target distribution, either given or the normalized expression of the target gene."""
+    if isinstance(target, str):
+        b = _gene_matrix(adata, [target])
+        b = np.array(b.toarray() if issparse(b) else b, dtype=np.float64).flatten()
+        return b / np.sum(b)
+    return np.asarray(target, dtype=np.float64)
+
+
 def cal_wass_dis_for_genes(
     inp0: Tuple[csr_matrix, AnnData], inp1: Tuple[int, List, np.ndarray, int]
 ) -> Tuple[List, np.ndarray, np.ndarray]:
-    """Calculate Wasserstein distances for a list of genes.
+    """Calculate Wasserstein distances for a list of genes with the exact solver.
 
     Args:
         inp0: A tuple of the sparse matrix of spatial distance between nearest neighbors, and the adata object.
@@ -224,21 +248,10 @@ def cal_wass_dis_for_genes(
 
     M, adata = inp0
     seed, gene_ids, b, numItermax = inp1
-    adata = shuffle_adata(adata, seed)
-    ws = []
-    pos_rs = []
-    if issparse(adata.X):
-        df = pd.DataFrame(adata.X.A, columns=adata.var_names)
-    else:
-        df = pd.DataFrame(adata.X, columns=adata.var_names)
-
-    for gene_id in gene_ids:
-        a = np.array(df.loc[:, gene_id], dtype=np.float64) / np.array(df.loc[:, gene_id], dtype=np.float64).sum()
-        w = cal_wass_dis(M, a, b, numItermax=numItermax)
-        pos_r = np.sum(a > 0) / len(a)
-        ws.append(w)
-        pos_rs.append(pos_r)
-    return gene_ids, ws, pos_rs
+    X = _gene_matrix(adata, gene_ids)
+    solver = get_wass_dis_solver(M, b, method="emd", numItermax=numItermax)
+    ws = cal_wass_dis_batch(X, solver, perm=_bootstrap_perm(X.shape[0], seed))
+    return gene_ids, ws, _positive_ratios(X)
 
 
 # within slice
@@ -259,6 +272,8 @@ def cal_wass_dist_bs(
     rank_p: bool = True,
     bin_num: int = 100,
     larger_or_small: str = "larger",
+    ot_method: Literal["emd", "sinkhorn", "tree"] = "emd",
+    reg: float = 0.02,
 ) -> Tuple[pd.DataFrame, AnnData]:
     """Computing Wasserstein distance for an AnnData to identify spatially variable genes.
 
@@ -272,13 +287,17 @@ def cal_wass_dist_bs(
         numItermax: The maximum number of iterations before stopping the optimization algorithm if it has not converged.
         gene_set: Gene set that will be used to compute Wasserstein distances, default is for all genes.
         target: The target gene expression distribution or the target gene name.
-        processes: The process number for parallel computing
+        processes: Not used anymore, all genes of a bootstrap are solved together against the shared distance matrix.
         bootstrap: Bootstrap number for permutation to calculate p-value
         min_dis_cutoff: Cells/Bins whose min distance to 30th neighbors are larger than this cutoff would be filtered.
         max_dis_cutoff: Cells/Bins whose max distance to 30th neighbors are larger than this cutoff would be filtered.
         rank_p: Whether to calculate p value in ranking manner.
         bin_num: Classy genes into bin_num groups according to mean Wasserstein distance from bootstrap.
         larger_or_small: In what direction to get p value. Larger means the right tail area of the null distribution.
+        ot_method: The optimal transport solver, see `get_wass_dis_solver`. "emd" computes the exact distances gene by
+            gene. "sinkhorn" (entropic regularized distances of all genes at once) and "tree" (a closed-form upper
+            bound, by far the fastest) are opt-in approximations that speed up large gene sets.
+        reg: The entropic regularization of the "sinkhorn" solver, relative to the largest distance.
 
     Returns:
         w_df: A dataframe storing information related to the Wasserstein distances.
@@ -299,40 +318,30 @@ def cal_wass_dist_bs(
     if gene_set is None:
         gene_set = bin_scale_adata.var_names
 
-    if isinstance(target, (list, np.ndarray)):
-        b = target
-    if isinstance(target, str):
-        b = (
-            bin_scale_adata[:, target].X.A.flatten()
-            if issparse(bin_scale_adata[:, target].X)
-            else bin_scale_adata[:, target].X.flatten()
-        )
-        b = np.array(b, dtype=np.float64)
-        b = b / np.sum(b)
-
-    genes, ws, pos_rs = cal_wass_dis_for_genes((M, bin_scale_adata), (0, gene_set, b, numItermax))
-    w_df_ori = pd.DataFrame({"gene_id": genes, "Wasserstein_distance": ws, "positive_ratio": pos_rs})
-
-    pool = multiprocessing.Pool(processes=processes)
-
-    inputs = [(i, gene_set, b, numItermax) for i in range(1, bootstrap + 1)]
-    res = []
-    for result in tqdm(
-        pool.imap_unordered(partial(cal_wass_dis_for_genes, (M, bin_scale_adata)), inputs), total=len(inputs)
-    ):
-        res.append(result)
-
-    genes, ws, pos_rs = zip(*res)
-    genes = [g for i in genes for g in i]
-    ws = [g for i in ws for g in i]
-    pos_rs = [g for i in pos_rs for g in i]
-    w_df = pd.DataFrame({"gene_id": genes, "Wasserstein_distance": ws, "positive_ratio": pos_rs})
-    mean_std_df = pd.DataFrame(
+    b = _target_histogram(bin_scale_adata, target)
+    X = _gene_matrix(bin_scale_adata, gene_set)
+    solver = get_wass_dis_solver(M, b, method=ot_method, reg=reg, numItermax=numItermax)
+
+    w_df_ori = pd.DataFrame(
         {
-            "mean": w_df.groupby("gene_id")["Wasserstein_distance"].mean().to_list(),
-            "std": w_df.groupby("gene_id")["Wasserstein_distance"].std().to_list(),
-        },
-        index=w_df.groupby("gene_id")["Wasserstein_distance"].mean().index,
+            "gene_id": gene_set,
+            "Wasserstein_distance": cal_wass_dis_batch(X, solver),
+            "positive_ratio": _positive_ratios(X),
+        }
+    )
+
+    # Bootstraps permute the bins, i.e. the rows of the expression matrix:
+    bs_ws = np.array(
+        [
+            cal_wass_dis_batch(X, solver, perm=_bootstrap_perm(X.shape[0], seed))
+            for seed in tqdm(range(1, bootstrap + 1))
+        ]
+    )
+    genes = np.tile(np.asarray(gene_set), bootstrap)
+    ws = bs_ws.flatten()
+    mean_std_df = pd.DataFrame(
+        {"mean": bs_ws.mean(axis=0), "std": bs_ws.std(axis=0, ddof=1)},
+        index=w_df_ori["gene_id"],
     )
     w_df = pd.concat([w_df_ori.set_index("gene_id"), mean_std_df], axis=1)
     w_df["zscore"] = (w_df["Wasserstein_distance"] - w_df["mean"]) / w_df["std"]
@@ -374,6 +383,8 @@ def cal_wass_dis_nobs(
     target: Union[List, np.ndarray, str] = [],
     min_dis_cutoff: float = 2.0,
     max_dis_cutoff: float = 6.0,
+    ot_method: Literal["emd", "sinkhorn", "tree"] = "emd",
+    reg: float = 0.02,
 ) -> Tuple[pd.DataFrame, AnnData]:
     """Computing Wasserstein distance for a AnnData to identify spatially variable genes.
 
@@ -389,6 +400,9 @@ def cal_wass_dis_nobs(
         target: the target distribution or the target gene name.
         min_dis_cutoff: Cells/Bins whose min distance to 30 neighbors are larger than this cutoff would be filtered.
         max_dis_cutoff: Cells/Bins whose max distance to 30 neighbors are larger than this cutoff would be filtered.
+        ot_method: The optimal transport solver, see `get_wass_dis_solver`. "emd" computes the exact distances, while
+            "sinkhorn" and "tree" are opt-in faster approximations.
+        reg: The entropic regularization of the "sinkhorn" solver, relative to the largest distance.
 
     Returns:
         w_df: A dataframe storing information related to the Wasserstein distances.
@@ -407,19 +421,12 @@ def cal_wass_dis_nobs(
     if gene_set is None:
         gene_set = bin_scale_adata.var_names
 
-    if isinstance(target, (list, np.ndarray)):
-        b = target
-    if isinstance(target, str):
-        b = (
-            bin_scale_adata[:, target].X.A.flatten()
-            if issparse(bin_scale_adata[:, target].X)
-            else bin_scale_adata[:, target].X.flatten()
-        )
-        b = np.array(b, dtype=np.float64)
-        b = b / np.sum(b)
-
-    genes, ws, pos_rs = cal_wass_dis_for_genes((M, bin_scale_adata), (0, gene_set, b, numItermax))
-    w_df = pd.DataFrame({"Wasserstein_distance": ws, "positive_ratio": pos_rs}, index=genes)
+    b = _target_histogram(bin_scale_adata, target)
+    X = _gene_matrix(bin_scale_adata, gene_set)
+    solver = get_wass_dis_solver(M, b, method=ot_method, reg=reg, numItermax=numItermax)
+    w_df = pd.DataFrame(
+        {"Wasserstein_distance": cal_wass_dis_batch(X, solver), "positive_ratio": _positive_ratios(X)}, index=gene_set
+    )
     return w_df
 
 
@@ -488,6 +495,8 @@ def cal_wass_dis_target_on_genes(
     top_n: int = 100,
     min_dis_cutoff: float = 2.0,
     max_dis_cutoff: float = 6.0,
+    ot_method: Literal["emd", "sinkhorn", "tree"] = "emd",
+    reg: float = 0.02,
 ) -> Tuple[dict, AnnData]:
     """Find genes in gene_set that have similar distribution to each target_genes.
 
@@ -506,6 +515,9 @@ def cal_wass_dis_target_on_genes(
         top_n: Number of top genes to select.
         min_dis_cutoff: Cells/Bins whose min distance to 30th neighbors are larger than this cutoff would be filtered.
         max_dis_cutoff: Cells/Bins whose max distance to 30th neighbors are larger than this cutoff would be filtered.
+        ot_method: The optimal transport solver, see `get_wass_dis_solver`. "emd" computes the exact distances, while
+            "sinkhorn" and "tree" are opt-in faster approximations.
+        reg: The entropic regularization of the "sinkhorn" solver, relative to the largest distance.
 
     Returns:
         w_genes: The dictionary of the Wasserstein distance. Each key corresponds to a gene name while the corresponding
@@ -526,16 +538,15 @@ def cal_wass_dis_target_on_genes(
     if gene_set is None:
         gene_set = bin_scale_adata.var_names
 
-    if issparse(bin_scale_adata.X):
-        df = pd.DataFrame(bin_scale_adata.X.A, columns=bin_scale_adata.var_names)
-    else:
-        df = pd.DataFrame(bin_scale_adata.X, columns=bin_scale_adata.var_names)
-
+    X = _gene_matrix(bin_scale_adata, gene_set)
+    pos_rs = _positive_ratios(X)
     w_genes = {}
     for gene in target_genes:
-        b = np.array(df.loc[:, gene], dtype=np.float64) / np.array(df.loc[:, gene], dtype=np.float64).sum(0)
-        genes, ws, pos_rs = cal_wass_dis_for_genes((M, bin_scale_adata), (0, gene_set, b, numItermax))
-        w_genes[gene] = pd.DataFrame({"gene_id": genes, "Wasserstein_distance": ws, "positive_ratio": pos_rs})
+        b = _target_histogram(bin_scale_adata, gene)
+        solver = get_wass_dis_solver(M, b, method=ot_method, reg=reg, numItermax=numItermax)
+        w_genes[gene] = pd.DataFrame(
+            {"gene_id": gene_set, "Wasserstein_distance": cal_wass_dis_batch(X, solver), "positive_ratio": pos_rs}
+        )
 
     if bootstrap == 0:
         return w_genes, bin_scale_adata
@@ -557,6 +568,8 @@ def cal_wass_dis_target_on_genes(
             processes=processes,
             larger_or_small="small",
             rank_p=False,
+            ot_method=ot_method,
+            reg=reg,
         )
 
         w_genes[gene] = w_df
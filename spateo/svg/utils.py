@@ -1,12 +1,16 @@
-from typing import List, Optional, Union
+from typing import Callable, List, Optional, Union
 
 import dynamo as dyn
 import numpy as np
 import ot
 import pandas as pd
 from anndata import AnnData
-from scipy.sparse import csr_matrix, issparse
-from scipy.sparse.csgraph import floyd_warshall
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+from scipy.sparse.csgraph import (
+    breadth_first_order,
+    floyd_warshall,
+    minimum_spanning_tree,
+)
 
 try:
     from typing import Literal
@@ -295,6 +299,123 @@ def cal_wass_dis(M, a, b=[], numItermax=1000000):
     return W
 
 
+def get_wass_dis_solver(
+    M: np.ndarray,
+    b: np.ndarray,
+    method: Literal["emd", "sinkhorn", "tree"] = "emd",
+    reg: float = 0.02,
+    numItermax: int = 1000000,
+    stopThr: float = 1e-3,
+) -> Callable[[np.ndarray], np.ndarray]:
+    """Get a function computing the Wasserstein distances of many histograms to a target histogram at once, with a
+    shared cost matrix.
+
+    Args:
+        M: (ns, ns) array, float – Loss matrix, e.g. the geodesic distances of the bins.
+        b: (ns,) array, float – Target histogram.
+        method: The solver, either "emd" for the exact solution of each histogram, "sinkhorn" for the entropic
+            regularized solution of all histograms at once with log-domain Sinkhorn iterations, or "tree" for the
+            closed-form Wasserstein distance on the minimum spanning tree of M, an upper bound of the exact distance
+            which is exact if M is a tree metric.
+        reg: For the "sinkhorn" method, the entropic regularization, relative to the largest cost. It must be at least
+            1/500, as smaller regularizations make the kernel underflow.
+        numItermax: The maximum number of iterations of the "emd" and "sinkhorn" methods.
+        stopThr: For the "sinkhorn" method, the stopping threshold on the L1 error of the source marginals.
+
+    Returns:
+        A function of the (ns, n_hists) array of the source histograms (columns summing to 1) that returns their
+        Wasserstein distances to `b`.
+    """
+    M = np.asarray(M, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+
+    if method == "emd":
+        return lambda A: np.array([cal_wass_dis(M, np.ascontiguousarray(a), b, numItermax=numItermax) for a in A.T])
+
+    if method == "tree":
+        tree = minimum_spanning_tree(M)
+        order, parents = breadth_first_order(tree + tree.T, 0, directed=False)
+        if len(order) < len(b):
+            raise ValueError("The minimum spanning tree of the distance matrix is disconnected.")
+        edge_weights = M[order[1:], parents[order[1:]]]
+        depths = np.zeros(len(b), dtype=np.int64)
+        for node in order[1:]:
+            depths[node] = depths[parents[node]] + 1
+        # Non-root nodes grouped by depth, from the leaves up to the root:
+        levels = [order[1:][depths[order[1:]] == depth] for depth in range(depths.max(), 0, -1)]
+
+        def tree_solver(A: np.ndarray) -> np.ndarray:
+            # Mass transported through the edge to the parent of each node: the excess of the subtree of the node.
+            excess = A - b[:, None]
+            for nodes in levels:
+                np.add.at(excess, parents[nodes], excess[nodes])
+            return edge_weights @ np.abs(excess[order[1:]])
+
+        return tree_solver
+
+    if method == "sinkhorn":
+        if reg < 1 / 500:
+            raise ValueError(f"The sinkhorn regularization `reg` must be at least 1/500, got {reg}.")
+        scale = M.max()
+        K = np.exp(-M / scale / reg)
+        KM = K * (M / scale)
+        with np.errstate(divide="ignore"):
+            log_b = np.log(b)[:, None]
+
+        def _lse(f: np.ndarray) -> np.ndarray:
+            # Log-sum-exp of (f_j - M_ij) / reg over j, for each i and column, with the kernel shared by all columns.
+            f_max = f.max(axis=0)
+            return np.log(K @ np.exp((f - f_max) / reg)) + f_max / reg
+
+        def sinkhorn_solver(A: np.ndarray) -> np.ndarray:
+            with np.errstate(divide="ignore"):
+                log_a = np.log(A)
+            f, g = np.zeros(A.shape), np.zeros(A.shape)
+            for i in range(numItermax):
+                f = reg * (log_a - _lse(g))
+                g = reg * (log_b - _lse(f))
+                if i % 10 == 9 and np.abs(np.exp(f / reg + _lse(g)) - A).sum(axis=0).max() < stopThr:
+                    break
+            f_max, g_max = f.max(axis=0), g.max(axis=0)
+            transport_cost = (np.exp((f - f_max) / reg) * (KM @ np.exp((g - g_max) / reg))).sum(axis=0)
+            return scale * transport_cost * np.exp((f_max + g_max) / reg)
+
+        return sinkhorn_solver
+
+    raise ValueError(f"method must be one of 'emd', 'sinkhorn' or 'tree', got {method}.")
+
+
+def cal_wass_dis_batch(
+    X: Union[np.ndarray, csc_matrix],
+    solver: Callable[[np.ndarray], np.ndarray],
+    perm: Optional[np.ndarray] = None,
+    block_size: Optional[int] = None,
+) -> np.ndarray:
+    """Compute the Wasserstein distances of the expression histograms of all genes, in blocks of genes.
+
+    Args:
+        X: The bins x genes expression matrix. Sparse matrices should be in CSC format for efficient column slicing.
+        solver: The function computing the distances of a block of histograms, see `get_wass_dis_solver`.
+        perm: Optional permutation of the bins (rows of X), e.g. for bootstraps.
+        block_size: The number of genes solved at once. By default, blocks of about 2**22 values.
+
+    Returns:
+        The Wasserstein distance of each gene, NaN for genes that are not expressed.
+    """
+    if block_size is None:
+        block_size = max(1, 2**22 // max(X.shape[0], 1))
+    ws = np.full(X.shape[1], np.nan)
+    for start in range(0, X.shape[1], block_size):
+        block = X[:, start : start + block_size]
+        A = np.array(block.toarray() if issparse(block) else block, dtype=np.float64)
+        if perm is not None:
+            A = A[perm]
+        totals = A.sum(axis=0)
+        expressed = totals > 0
+        ws[start : start + block_size][expressed] = solver(A[:, expressed] / totals[expressed])
+    return ws
+
+
 def cal_rank_p(genes, ws, w_df, bin_num=100):
     ws_dict = {}
     for g, w in zip(genes, ws):
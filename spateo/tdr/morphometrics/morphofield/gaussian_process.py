@@ -89,7 +89,11 @@ def _gp_velocity(X: np.ndarray, vf_dict: dict) -> np.ndarray:
         quary_kernel = _con_K_geodist(norm_x, vf_dict["kernel_dict"], vf_dict["beta"])
     else:
         raise ValueError(f"current only support cdist and geodist")
-    quary_velocities = np.dot(quary_kernel, vf_dict["C"])
+    return _gp_kernel_velocity(X, norm_x, np.dot(quary_kernel, vf_dict["C"]), vf_dict)
+
+
+def _gp_kernel_velocity(X: np.ndarray, norm_x: np.ndarray, quary_velocities: np.ndarray, vf_dict: dict) -> np.ndarray:
+    """Velocities of the coordinates ``X`` from the kernel term ``K @ C`` of their normalized coordinates ``norm_x``."""
     quary_rigid = np.dot(norm_x, vf_dict["R"].T) + vf_dict["t"]
     quary_norm_x = quary_velocities + quary_rigid
     quary_x = quary_norm_x * vf_dict["norm_dict"]["scale_fixed"] + vf_dict["norm_dict"]["mean_fixed"]
@@ -1,9 +1,15 @@
-from typing import Callable, Optional, Tuple
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
 
 import numpy as np
 from anndata import AnnData
+from scipy.spatial.distance import cdist
 from tqdm import tqdm
 
+# Maximum number of kernel values between coordinates and control points calculated at once.
+BLOCK_VALUES = 2**22
+# Number of control points whose kernel values are calculated at once.
+CTRL_BLOCK = 2**12
+
 #########################
 # Differential Geometry #
 #########################
@@ -140,7 +146,68 @@ def compute_sensitivity(f_jac, X):
 #################
 
 
-def Jacobian_GP_gaussian_kernel(X: np.ndarray, vf_dict: dict, vectorize: bool = False) -> np.ndarray:
+def _gp_jacobian_blocks(
+    X: np.ndarray, vf_dict: dict, block_size: Optional[int] = None
+) -> Iterator[Tuple[slice, np.ndarray, np.ndarray]]:
+    """Iterate over blocks of coordinates with the velocities and analytical Jacobians of a GP vector field.
+
+    Only the kernel values of a block of coordinates and a chunk of control points are in memory at a time. With the
+    euclidean distance, the displacements ``D[n, m] = x_n - y_m`` are never formed either: the Jacobian
+    ``sum_m K[n, m] * C[m, i] * D[n, m, j]`` is ``(K @ C)[n, i] * x[n, j] - (K @ CY)[n, i, j]`` with
+    ``CY[m, i, j] = C[m, i] * y[m, j]``, so that the velocities and Jacobians of a block are a single matrix product.
+
+    Args:
+        X: Coordinates where the Jacobian is evaluated.
+        vf_dict: A dictionary containing RKHS vector field control points, Gaussian bandwidth, and RKHS coefficients.
+        block_size: The number of coordinates of each block. By default, ``BLOCK_VALUES`` kernel values per block.
+
+    Yields:
+        The slice of the coordinates of the block, their velocities (n x d) and their Jacobians (n x d x d, where
+        ``J[n, i, j]`` is df_i/dx_j).
+    """
+    from ..morphofield.gaussian_process import _con_K_geodist, _gp_kernel_velocity
+
+    norm_dict = vf_dict["norm_dict"]
+    pre_scale = norm_dict["scale_fixed"] / norm_dict["scale_transformed"]
+    x_norm = (X - norm_dict["mean_transformed"]) / norm_dict["scale_transformed"]
+    ctrl, C, beta = np.asarray(vf_dict["X_ctrl"]), np.asarray(vf_dict["C"]), vf_dict["beta"]
+    (n, d), m = x_norm.shape, ctrl.shape[0]
+    geodist = vf_dict["kernel_dict"]["dist"] != "cdist"
+    if block_size is None:
+        block_size = max(1, BLOCK_VALUES // (m * d if geodist else min(m, CTRL_BLOCK)))
+    if not geodist:
+        CY = np.hstack([C, (C[:, :, None] * ctrl[:, None, :]).reshape(m, d * d)])
+
+    for start in range(0, n, block_size):
+        cells = slice(start, min(start + block_size, n))
+        x_block = x_norm[cells]
+        if geodist:
+            K, D = _con_K_geodist(x_block, vf_dict["kernel_dict"], beta, return_d=True)
+            K = K.reshape(len(x_block), -1)
+            KC = K @ C
+            J = np.matmul(K[:, None, :] * D, C).transpose(0, 2, 1)
+        else:
+            KCY = np.zeros((len(x_block), CY.shape[1]))
+            for ctrl_start in range(0, m, CTRL_BLOCK):
+                ctrl_chunk = slice(ctrl_start, min(ctrl_start + CTRL_BLOCK, m))
+                K = cdist(x_block, ctrl[ctrl_chunk], "sqeuclidean")
+                np.exp(-beta * K, out=K)
+                KCY += K @ CY[ctrl_chunk]
+            KC = KCY[:, :d]
+            J = KC[:, :, None] * x_block[:, None, :] - KCY[:, d:].reshape(-1, d, d)
+        yield cells, _gp_kernel_velocity(X[cells], x_block, KC, vf_dict), -2 * beta * pre_scale * J
+
+
+def _curl(J: np.ndarray) -> np.ndarray:
+    """Curl of a stack of n x 2 x 2 or n x 3 x 3 Jacobians, where ``J[n, i, j]`` is df_i/dx_j."""
+    if J.shape[1] == 2:
+        return J[:, 1, 0] - J[:, 0, 1]
+    return np.stack([J[:, 2, 1] - J[:, 1, 2], J[:, 0, 2] - J[:, 2, 0], J[:, 1, 0] - J[:, 0, 1]], axis=1)
+
+
+def Jacobian_GP_gaussian_kernel(
+    X: np.ndarray, vf_dict: dict, vectorize: bool = False, block_size: Optional[int] = None
+) -> np.ndarray:
     """analytical Jacobian for RKHS vector field functions with Gaussian kernel.
 
     Args:
@@ -148,40 +215,110 @@ def Jacobian_GP_gaussian_kernel(X: np.ndarray, vf_dict: dict, vectorize: bool =
     vf_dict: A dictionary containing RKHS vector field control points, Gaussian bandwidth,
         and RKHS coefficients.
         Essential keys: 'X_ctrl', 'beta', 'C'
+    vectorize: Deprecated, the Jacobians are always calculated by memory-bounded blocks of coordinates.
+    block_size: The number of coordinates whose Jacobians are calculated at once.
 
     Returns:
         Jacobian matrices stored as d-by-d-by-n numpy arrays evaluated at x.
             d is the number of dimensions and n the number of coordinates in x.
     """
-    from ..morphofield.gaussian_process import _con_K, _con_K_geodist
+    X = np.asarray(X, dtype=np.float64)
+    J = np.zeros((X.shape[-1], X.shape[-1], len(np.atleast_2d(X))))
+    for cells, _, J_block in _gp_jacobian_blocks(np.atleast_2d(X), vf_dict, block_size):
+        J[:, :, cells] = J_block.transpose(1, 2, 0)
+    return J[:, :, 0] if X.ndim == 1 else J
 
-    pre_scale = vf_dict["norm_dict"]["scale_fixed"] / vf_dict["norm_dict"]["scale_transformed"]
-    x_norm = (X - vf_dict["norm_dict"]["mean_transformed"]) / vf_dict["norm_dict"]["scale_transformed"]
-    if x_norm.ndim == 1:
-        if vf_dict["kernel_dict"]["dist"] == "cdist":
-            K, D = _con_K(x_norm[None, :], vf_dict["X_ctrl"], vf_dict["beta"], return_d=True)
-        else:
-            K, D = _con_K_geodist(x_norm[None, :], vf_dict["kernel_dict"], vf_dict["beta"], return_d=True)
-        J = (vf_dict["C"].T * K) @ D[0].T
-    elif not vectorize:
-        n, d = x_norm.shape
-        J = np.zeros((d, d, n))
-        for i, xi in enumerate(x_norm):
-            if vf_dict["kernel_dict"]["dist"] == "cdist":
-                K, D = _con_K(xi[None, :], vf_dict["X_ctrl"], vf_dict["beta"], return_d=True)
-            else:
-                K, D = _con_K_geodist(xi[None, :], vf_dict["kernel_dict"], vf_dict["beta"], return_d=True)
-            J[:, :, i] = (vf_dict["C"].T * K) @ D[0].T
-    else:
-        if vf_dict["kernel_dict"]["dist"] == "cdist":
-            K, D = _con_K(x_norm, vf_dict["X_ctrl"], vf_dict["beta"], return_d=True)
-        else:
-            K, D = _con_K_geodist(x_norm, vf_dict["kernel_dict"], vf_dict["beta"], return_d=True)
-        if K.ndim == 1:
-            K = K[None, :]
-        J = np.einsum("nm, mi, njm -> ijn", K, vf_dict["C"], D)
 
-    return -2 * vf_dict["beta"] * J * pre_scale
+def compute_gp_geometry(
+    X: np.ndarray,
+    vf_dict: dict,
+    quantities: Sequence[str] = ("divergence",),
+    formula: int = 2,
+    block_size: Optional[int] = None,
+) -> Dict[str, np.ndarray]:
+    """Calculate differential geometry quantities of a GP vector field in a single pass over blocks of coordinates.
+
+    The velocities and Jacobians of each block are reduced to the requested quantities right away, so that the memory
+    usage does not depend on the number of coordinates beyond the returned arrays.
+
+    Args:
+        X: Coordinates where the quantities are evaluated.
+        vf_dict: A dictionary containing RKHS vector field control points, Gaussian bandwidth, and RKHS coefficients.
+        quantities: The quantities to calculate, among ``'velocity'``, ``'jacobian'``, ``'divergence'``, ``'curl'``,
+            ``'acceleration'``, ``'curvature'`` and ``'torsion'``.
+        formula: Which formula of curvature will be used, see :func:`compute_curvature`.
+        block_size: The number of coordinates processed at once.
+
+    Returns:
+        A dictionary of the requested quantities:
+
+        * ``'velocity'``: the n x d velocities.
+        * ``'jacobian'``: the d x d x n Jacobians.
+        * ``'divergence'``: the n divergences.
+        * ``'curl'``: the n curls in 2D, or the n x 3 curl vectors in 3D.
+        * ``'acceleration'`` and ``'acceleration_vector'``: the n norms and the n x d acceleration vectors.
+        * ``'curvature'`` and ``'curvature_vector'``: the n curvatures and, for ``formula=2``, the n x d curvature
+          vectors.
+        * ``'torsion'``: the n x 3 torsion vectors.
+    """
+    X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+    (n, d), quantities = X.shape, set(quantities)
+    unknown = quantities - {"velocity", "jacobian", "divergence", "curl", "acceleration", "curvature", "torsion"}
+    if unknown:
+        raise ValueError(f"Unknown differential geometry quantities: {sorted(unknown)}.")
+    if "curl" in quantities and d not in (2, 3):
+        raise ValueError(f"X has incorrect dimensions.")
+    if "torsion" in quantities and d != 3:
+        raise ValueError(f"torsion is only defined in 3 dimension.")
+
+    shapes = {
+        "velocity": (n, d),
+        "jacobian": (d, d, n),
+        "divergence": (n,),
+        "curl": (n,) if d == 2 else (n, 3),
+        "acceleration": (n,),
+        "acceleration_vector": (n, d),
+        "curvature": (n,),
+        "curvature_vector": (n, d),
+        "torsion": (n, d),
+    }
+    keys = set(quantities)
+    if "acceleration" in quantities:
+        keys.add("acceleration_vector")
+    if "curvature" in quantities and formula == 2:
+        keys.add("curvature_vector")
+    res = {key: np.zeros(shapes[key]) for key in keys}
+
+    for cells, v, J in _gp_jacobian_blocks(X, vf_dict, block_size):
+        if "velocity" in res:
+            res["velocity"][cells] = v
+        if "jacobian" in res:
+            res["jacobian"][:, :, cells] = J.transpose(1, 2, 0)
+        if "divergence" in res:
+            res["divergence"][cells] = np.trace(J, axis1=1, axis2=2)
+        if "curl" in res:
+            res["curl"][cells] = _curl(J)
+        if not quantities & {"acceleration", "curvature", "torsion"}:
+            continue
+
+        a = np.einsum("nij,nj->ni", J, v)
+        a_norm = np.linalg.norm(a, axis=1)
+        v_norm = np.linalg.norm(v, axis=1)
+        if "acceleration" in res:
+            res["acceleration"][cells] = a_norm
+            res["acceleration_vector"][cells] = a
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if "curvature" in res and formula == 1:
+                res["curvature"][cells] = a_norm / v_norm**2
+            elif "curvature" in res:
+                vv, va = (v * v).sum(axis=1), (v * a).sum(axis=1)
+                cur_mat = (a * vv[:, None] - v * va[:, None]) / (v_norm**4)[:, None]
+                res["curvature_vector"][cells] = cur_mat
+                res["curvature"][cells] = np.linalg.norm(cur_mat, axis=1)
+            if "torsion" in res:
+                aJa = np.einsum("ni,nij,nj->n", a, J, a)
+                res["torsion"][cells] = v * (aJa / (v_norm * a_norm) ** 2)[:, None]
+    return res
 
 
 class GPVectorField:
@@ -212,36 +349,55 @@ class GPVectorField:
 
         return _gp_velocity(X, self.vf_dict)
 
-    def compute_acceleration(self, X: Optional[np.ndarray] = None, **kwargs):
+    def compute_acceleration(self, X: Optional[np.ndarray] = None, block_size: Optional[int] = None, **kwargs):
         X = self.data["X"] if X is None else X
-        f_jac = self.get_Jacobian(**kwargs)
-        return compute_acceleration(vf=self.func, f_jac=f_jac, X=X)
+        res = compute_gp_geometry(X, self.vf_dict, quantities=("acceleration",), block_size=block_size)
+        return res["acceleration"], res["acceleration_vector"]
 
-    def compute_curvature(self, X: Optional[np.ndarray] = None, formula: int = 2, **kwargs):
+    def compute_curvature(
+        self, X: Optional[np.ndarray] = None, formula: int = 2, block_size: Optional[int] = None, **kwargs
+    ):
         X = self.data["X"] if X is None else X
-        f_jac = self.get_Jacobian(**kwargs)
-        return compute_curvature(vf=self.func, f_jac=f_jac, X=X, formula=formula)
+        res = compute_gp_geometry(X, self.vf_dict, quantities=("curvature",), formula=formula, block_size=block_size)
+        return res["curvature"], res.get("curvature_vector")
 
     def compute_curl(
-        self, X: Optional[np.ndarray] = None, dim1: int = 0, dim2: int = 1, dim3: int = 2, **kwargs
+        self,
+        X: Optional[np.ndarray] = None,
+        dim1: int = 0,
+        dim2: int = 1,
+        dim3: int = 2,
+        block_size: Optional[int] = None,
+        **kwargs,
     ) -> np.ndarray:
         X = self.data["X"] if X is None else X
-        if dim3 is None or X.shape[1] == 2:
-            X = X[:, [dim1, dim2]]
-        else:
-            X = X[:, [dim1, dim2, dim3]]
-        f_jac = self.get_Jacobian(**kwargs)
-        return compute_curl(f_jac=f_jac, X=X)
+        dims = [dim1, dim2] if dim3 is None or X.shape[1] == 2 else [dim1, dim2, dim3]
 
-    def compute_torsion(self, X: Optional[np.ndarray] = None, **kwargs) -> np.ndarray:
-        X = self.data["X"] if X is None else X
-        f_jac = self.get_Jacobian(**kwargs)
-        return compute_torsion(vf=self.func, f_jac=f_jac, X=X)
+        # The curl of the selected dimensions, from the corresponding block of each Jacobian. In 3D, same n x 3 x 3
+        # layout as ``compute_curl``.
+        curl = np.zeros(len(X)) if len(dims) == 2 else np.zeros((len(X), 3, 3))
+        for cells, _, J in _gp_jacobian_blocks(X, self.vf_dict, block_size):
+            curl_block = _curl(J[:, dims][:, :, dims])
+            curl[cells] = curl_block if len(dims) == 2 else curl_block[:, None, :]
+        return curl
 
-    def compute_divergence(self, X: Optional[np.ndarray] = None, **kwargs) -> np.ndarray:
+    def compute_torsion(self, X: Optional[np.ndarray] = None, block_size: Optional[int] = None, **kwargs) -> np.ndarray:
+        X = self.data["X"] if X is None else X
+        torsion = compute_gp_geometry(X, self.vf_dict, quantities=("torsion",), block_size=block_size)["torsion"]
+        # Same n x 3 x 3 layout as ``compute_torsion``.
+        return np.repeat(torsion[:, None, :], 3, axis=1)
+
+    def compute_divergence(
+        self,
+        X: Optional[np.ndarray] = None,
+        block_size: Optional[int] = None,
+        vectorize_size: Optional[int] = None,
+        **kwargs,
+    ) -> np.ndarray:
         X = self.data["X"] if X is None else X
-        f_jac = self.get_Jacobian(**kwargs)
-        return compute_divergence(f_jac=f_jac, X=X)
+        # ``vectorize_size`` is the name of the block size in ``compute_divergence``, kept for backwards compatibility.
+        block_size = vectorize_size if block_size is None else block_size
+        return compute_gp_geometry(X, self.vf_dict, quantities=("divergence",), block_size=block_size)["divergence"]
 
     def get_Jacobian(self, method: str = "analytical", **kwargs) -> Callable:
         """
@@ -175,7 +175,7 @@ def morphofield_curl(
 
     X, V = vector_field_class.get_data()
     curl = vector_field_class.compute_curl(X=X, method=method)
-    curl_mag = np.array([np.linalg.norm(i) for i in curl])
+    curl_mag = np.linalg.norm(curl.reshape(len(curl), -1), axis=1)
 
     adata.obs[key_added] = curl_mag
     adata.obsm[key_added] = curl
@@ -216,7 +216,7 @@ def morphofield_torsion(
 
     X, V = vector_field_class.get_data()
     torsion_mat = vector_field_class.compute_torsion(X=X, method=method)
-    torsion = np.array([np.linalg.norm(i) for i in torsion_mat])
+    torsion = np.linalg.norm(torsion_mat.reshape(len(torsion_mat), -1), axis=1)
 
     adata.obs[key_added] = torsion
     adata.uns[key_added] = torsion_mat
@@ -300,7 +300,7 @@ def morphofield_jacobian(
 
     cell_idx = np.arange(adata.n_obs)
     Js = Jac_func(x=X[cell_idx])
-    Js_det = [np.linalg.det(Js[:, :, i]) for i in np.arange(Js.shape[2])]
+    Js_det = np.linalg.det(Js.transpose(2, 0, 1))
 
     adata.obs[key_added] = Js_det
     adata.uns[key_added] = Js
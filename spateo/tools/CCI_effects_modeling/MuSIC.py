@@ -7,9 +7,8 @@ import itertools
 import json
 import os
 import re
-from functools import partial
+from collections import OrderedDict
 from itertools import product
-from multiprocessing import Pool
 from typing import Callable, Dict, List, Literal, Optional, Tuple, Union
 
 import anndata
@@ -26,10 +25,34 @@ from ...logging import logger_manager as lm
 from ...preprocessing.normalize import factor_normalization
 from ...preprocessing.transform import log1p
 from ...tools.spatial_smooth import smooth
-from ..find_neighbors import find_bw_for_n_neighbors, get_wi, neighbors
+from ..find_neighbors import (
+    SpatialNeighbors,
+    compute_spatial_weights,
+    find_bw_for_n_neighbors,
+    neighbors,
+)
 from ..spatial_degs import moran_i
 from .distributions import Gaussian, NegativeBinomial, Poisson
-from .regression_utils import compute_betas_local, iwls, multicollinearity_check
+from .regression_utils import (
+    compute_betas_local,
+    compute_betas_local_batch,
+    get_fisher_moments,
+    iwls,
+    iwls_batch,
+    multicollinearity_check,
+)
+from .result_store import (
+    is_hdf5_path,
+    is_result_file,
+    read_result_columns,
+    read_results,
+    result_target,
+    write_results,
+)
+
+# Maximum number of elements of the per-neighbor outer products that are stacked when fitting a batch of local
+# regression models at once:
+LOCAL_FIT_BATCH_ELEMENTS = 1 << 25
 
 
 # ---------------------------------------------------------------------------------------------------
@@ -111,7 +134,9 @@ class MuSIC:
         cci_dir: Full path to the directory containing cell-cell communication databases
         species: Selects the cell-cell communication database the relevant ligands will be drawn from. Options:
                 "human", "mouse".
-        output_path: Full path name for the .csv file in which results will be saved
+        output_path: Full path name for the .csv file in which results will be saved. If the file has an .h5 or .hdf5
+            extension, results will be saved in HDF5 format instead.
+        output_float32: Set True to save results in single precision. Only applies to HDF5 outputs.
 
 
         coords_key: Key in .obsm of the AnnData object that contains the coordinates of the cells
@@ -181,6 +206,11 @@ class MuSIC:
         self.bw = None
         self.minbw = None
         self.maxbw = None
+        # Neighbor lists and spatial weights, reused between bandwidths and targets:
+        self._neighbor_cache = {}
+        self._spatial_weights_cache = OrderedDict()
+        self._fisher_moments_cache = None
+        self._initial_predictions_cache = None
 
         self.distr = None
         self.kernel = None
@@ -291,8 +321,8 @@ class MuSIC:
 
         if len(file_list) > 0:
             for file in file_list:
-                if not "predictions" in file:
-                    check = pd.read_csv(os.path.join(parent_dir, file), index_col=0)
+                if is_result_file(file):
+                    check = read_results(os.path.join(parent_dir, file), columns=[])
                     if any([name not in check.index for name in self.sample_names]):
                         self.map_new_cells()
                     break
@@ -341,6 +371,7 @@ class MuSIC:
         self.cci_dir = self.arg_retrieve.cci_dir
         self.species = self.arg_retrieve.species
         self.output_path = self.arg_retrieve.output_path
+        self.output_float32 = self.arg_retrieve.output_float32
         self.custom_ligands_path = self.arg_retrieve.custom_lig_path
         self.custom_ligands = self.arg_retrieve.ligand
         self.custom_receptors_path = self.arg_retrieve.custom_rec_path
@@ -512,22 +543,16 @@ class MuSIC:
                 subset = self.adata[self.adata.obs[self.group_key].isin(self.group_subset)]
                 fitted_indices = [self.sample_names.get_loc(name) for name in subset.obs_names]
                 # Add cells that are neighboring cells of the chosen type, but which are not of the chosen type:
-                get_wi_partial = partial(
-                    get_wi,
-                    n_samples=self.n_samples,
-                    coords=self.coords,
+                w_subset = compute_spatial_weights(
+                    self.coords,
+                    self.n_neighbors_secreted,
+                    rows=fitted_indices,
                     fixed_bw=False,
                     exclude_self=True,
                     kernel="bisquare",
-                    bw=self.n_neighbors_secreted,
                     threshold=0.01,
-                    sparse_array=True,
                     normalize_weights=True,
                 )
-
-                with Pool() as pool:
-                    weights = pool.map(get_wi_partial, fitted_indices)
-                w_subset = scipy.sparse.vstack(weights)
                 rows, cols = w_subset.nonzero()
                 unique_indices = list(set(cols))
                 names_all_neighbors = self.sample_names[unique_indices]
@@ -2404,8 +2429,8 @@ class MuSIC:
         file_list = [f for f in os.listdir(parent_dir) if os.path.isfile(os.path.join(parent_dir, f))]
 
         for file in file_list:
-            if not "predictions" in file:
-                check = pd.read_csv(os.path.join(parent_dir, file), index_col=0)
+            if is_result_file(file):
+                check = read_results(os.path.join(parent_dir, file), columns=[])
                 break
         # Only check this if the initial run has already finished (i.e. postprocessing has already been performed):
         if check.index.dtype != "float64" and check.index.dtype != "float32":
@@ -2591,24 +2616,165 @@ class MuSIC:
 
         normalize_weights = True if self.normalize else False
 
-        get_wi_partial = partial(
-            get_wi,
-            n_samples=self.n_samples,
-            coords=self.coords,
-            fixed_bw=bw_fixed,
+        w = self._get_spatial_weights(
+            self.coords,
+            bw,
+            bw_fixed=bw_fixed,
             exclude_self=exclude_self,
             kernel=kernel,
-            bw=bw,
             threshold=0.01,
-            sparse_array=True,
             normalize_weights=normalize_weights,
         )
+        return w
+
+    def _get_spatial_weights(
+        self,
+        data: np.ndarray,
+        bw: Union[float, int],
+        bw_fixed: bool,
+        exclude_self: bool,
+        kernel: str,
+        threshold: float,
+        normalize_weights: bool,
+    ) -> scipy.sparse.csr_matrix:
+        """Compute spatial weights for all samples at once, reusing the neighbor lists found for previous
+        bandwidths. The neighbor lists are built up to the largest bandwidth of the search range, such that the
+        neighbor search is only performed once during bandwidth optimization, and the weights of the most recently
+        used bandwidths are kept, such that they can be shared between the local fits for each sample.
+
+        Args:
+            data: Array of shape (n_samples, n_features) used to compute distances between samples- typically the
+                spatial coordinates
+            bw: Bandwidth for the spatial kernel
+            bw_fixed: Whether the bandwidth is a distance (True) or a number of nearest neighbors (False)
+            exclude_self: Whether to exclude each sample itself from its nearest neighbors
+            kernel: Kernel to use for the spatial weights
+            threshold: Weights below this threshold will be set to zero
+            normalize_weights: Whether to normalize the weights of each sample to sum to 1
 
-        with Pool() as pool:
-            weights = pool.map(get_wi_partial, range(self.n_samples))
-        w = scipy.sparse.vstack(weights)
+        Returns:
+            w: Sparse array of shape (n_samples, n_samples), where row i contains the weights for sample i
+        """
+        if bw == np.inf:
+            return compute_spatial_weights(data, bw)
+
+        key = (id(data), bw, bw_fixed, exclude_self, kernel, threshold, normalize_weights)
+        if key in self._spatial_weights_cache:
+            self._spatial_weights_cache.move_to_end(key)
+            return self._spatial_weights_cache[key][1]
+
+        # The data array is stored alongside the neighbor lists, so that its id cannot be reused while cached:
+        neighbor_key = (id(data), bw_fixed, exclude_self)
+        cached_data, spatial_neighbors = self._neighbor_cache.get(neighbor_key, (None, None))
+        if cached_data is not data or not spatial_neighbors.covers(bw):
+            max_bw = bw if self.maxbw is None else max(bw, self.maxbw)
+            spatial_neighbors = SpatialNeighbors(data, max_bw, fixed=bw_fixed, exclude_self=exclude_self)
+            self._neighbor_cache[neighbor_key] = (data, spatial_neighbors)
+
+        w = spatial_neighbors.weights(bw, kernel=kernel, threshold=threshold, normalize_weights=normalize_weights)
+        self._spatial_weights_cache[key] = (data, w)
+        while len(self._spatial_weights_cache) > 4:
+            self._spatial_weights_cache.popitem(last=False)
         return w
 
+    def _get_initial_predictions(self, y: np.ndarray) -> np.ndarray:
+        """Initial predictions of the dependent variable for IWLS, which are computed once per dependent variable
+        array, as they can depend on all of its values.
+
+        Args:
+            y: Dependent variable array
+
+        Returns:
+            Initial predictions for each sample
+        """
+        if self._initial_predictions_cache is None or self._initial_predictions_cache[0] is not y:
+            self._initial_predictions_cache = (y, self.distr_obj.initial_predictions(y))
+        return self._initial_predictions_cache[1]
+
+    def _get_fisher_moments(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Moments of the independent variable array used to compute the inverse Fisher matrix of each local fit,
+        which are computed once per independent variable array.
+
+        Args:
+            X: Independent variable array
+
+        Returns:
+            Output of :func `get_fisher_moments` for `X`
+        """
+        if self._fisher_moments_cache is None or self._fisher_moments_cache[0] is not X:
+            self._fisher_moments_cache = (X, get_fisher_moments(X))
+        return self._fisher_moments_cache[1]
+
+    def _get_all_local_weights(self, bw: Union[float, int], coords: Optional[np.ndarray] = None):
+        """Spatial weights for all samples, which are shared between the local fits for each sample, before
+        restricting them by cell type.
+
+        Args:
+            bw: Bandwidth for the spatial kernel
+            coords: Coordinates of all samples
+
+        Returns:
+            w: Sparse array of shape (n_samples, n_samples), where row i contains the weights for sample i
+        """
+        if self.use_expression_neighbors:
+            return self._get_spatial_weights(self.feature_distance, bw, self.bw_fixed, False, "uniform", 1e-5, False)
+        return self._get_spatial_weights(coords, bw, self.bw_fixed, False, self.kernel.lower(), 1e-5, False)
+
+    def _get_local_weights(
+        self,
+        indices: np.ndarray,
+        y: np.ndarray,
+        bw: Union[float, int],
+        coords: Optional[np.ndarray] = None,
+        mask_indices: Optional[np.ndarray] = None,
+    ) -> scipy.sparse.csr_matrix:
+        """Spatial weights of the local regression models of a set of samples. Depending on the model type, weights
+        are restricted to samples of the same cell type as the sample in question (for samples that do not express
+        the dependent variable, or for all samples in niche models).
+
+        Args:
+            indices: Indices of the samples for which local regression models are to be fitted
+            y: Response variable
+            bw: Bandwidth for the spatial kernel
+            coords: Coordinates of all samples
+            mask_indices: Optional indices of samples to mask out of the local regressions
+
+        Returns:
+            w: Sparse array of shape (len(indices), n_samples), where row k contains the nonzero weights for the
+                regression of sample indices[k], as well as an explicitly stored (possibly zero) weight for the sample
+                itself. Column indices are sorted within each row.
+        """
+        w = self._get_all_local_weights(bw, coords)[indices]
+        n_rows = len(indices)
+        rows = np.repeat(np.arange(n_rows), np.diff(w.indptr))
+        cols = w.indices
+        weights = w.data.copy()
+
+        # Only consider samples of the same cell type if the condition is met:
+        if self.mod_type == "niche" or hasattr(self, "target"):
+            condition = np.ones(n_rows, dtype=bool)
+        else:
+            # Distance in "signaling space", conditioned on target expression and cell type:
+            condition = np.asarray(y).reshape(-1)[indices] == 0
+        weights[condition[rows] & (self.ct_vec[cols] != self.ct_vec[indices][rows])] = 0.0
+
+        if mask_indices is not None:
+            weights[np.isin(cols, mask_indices)] = 0.0
+
+        is_self = cols == indices[rows]
+        keep = (weights != 0) | is_self
+        # Add zero weights for the samples that are not among their own neighbors:
+        missing = np.ones(n_rows, dtype=bool)
+        missing[rows[is_self]] = False
+        rows = np.concatenate((rows[keep], np.flatnonzero(missing)))
+        cols = np.concatenate((cols[keep], indices[missing]))
+        weights = np.concatenate((weights[keep], np.zeros(missing.sum())))
+
+        order = np.lexsort((cols, rows))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n_rows))))
+        # Construct from the CSR arrays directly, so that the explicit zeros are kept:
+        return scipy.sparse.csr_matrix((weights[order], cols[order], indptr), shape=(n_rows, w.shape[1]))
+
     def local_fit(
         self,
         i: int,
@@ -2659,55 +2825,22 @@ class MuSIC:
         # Get the index in the original AnnData object for the point in question.
         sample_index = i
 
-        if self.init_betas is not None:
-            init_betas = self.init_betas[y_label]
-            if not isinstance(init_betas, np.ndarray):
-                init_betas = init_betas.values
-            if init_betas.ndim == 1:
-                init_betas = init_betas.reshape(-1, 1)
-        else:
-            init_betas = None
+        init_betas = self._get_init_betas(y_label)
 
-        if self.mod_type == "niche" or hasattr(self, "target"):
-            if y[i] == 0:
-                cov = np.where(y == 0, 1, 0).reshape(-1)
-                celltype_i = self.ct_vec[i]
-                ct = np.where(self.ct_vec == celltype_i, 1, 0).reshape(-1)
-            else:
-                cov = None
-                celltype_i = self.ct_vec[i]
-                ct = np.where(self.ct_vec == celltype_i, 1, 0).reshape(-1)
-            expr_mat = None
-        else:
-            # Distance in "signaling space", conditioned on target expression and cell type:
-            if y[i] == 0:
-                cov = np.where(y == 0, 1, 0).reshape(-1)
-                celltype_i = self.ct_vec[i]
-                ct = np.where(self.ct_vec == celltype_i, 1, 0).reshape(-1)
-            else:
-                cov = None
-                ct = None
-            expr_mat = self.feature_distance
-        wi = get_wi(
-            i,
-            n_samples=len(X),
-            cov=cov,
-            ct=ct,
-            coords=coords,
-            expr_mat=expr_mat,
-            fixed_bw=self.bw_fixed,
-            kernel=self.kernel,
-            bw=bw,
-            use_expression_neighbors=self.use_expression_neighbors,
-        ).reshape(-1, 1)
+        # Samples with zero weight do not contribute to the local fit, so restrict the fit to the samples with
+        # nonzero weight (and sample i itself, at position i_pos):
+        w = self._get_local_weights(np.array([i]), y, bw, coords=coords, mask_indices=mask_indices)
+        local_indices = w.indices
+        i_pos = np.searchsorted(local_indices, i)
+        wi = w.data.reshape(-1, 1)
+        y_local = y[local_indices]
+        X_local = X[local_indices]
 
-        if mask_indices is not None:
-            wi[mask_indices] = 0.0
-        else:
+        if mask_indices is None:
             mask_indices = []
 
         if self.distr == "gaussian" or fit_predictor:
-            betas, pseudoinverse, inv_cov = compute_betas_local(y, X, wi, clip=self.clip)
+            betas, pseudoinverse, inv_cov = compute_betas_local(y_local, X_local, wi, clip=self.clip)
             if i in mask_indices:
                 betas = np.zeros_like(betas)
                 pred_y = 0.0
@@ -2719,16 +2852,17 @@ class MuSIC:
             # Reshape coefficients if necessary:
             betas = betas.flatten()
             # Effect of deleting sample i from the dataset on the estimated predicted value at sample i:
-            hat_i = np.dot(X[i], pseudoinverse[:, i])
+            hat_i = np.dot(X[i], pseudoinverse[:, i_pos])
             # Diagonals of the inverse covariance matrix (used to compute standard errors):
             inv_diag = np.diag(inv_cov)
 
         elif self.distr == "poisson" or self.distr == "nb":
             betas, y_hat, _, final_irls_weights, _, _, pseudoinverse, fisher_inv = iwls(
-                y,
-                X,
+                y_local,
+                X_local,
                 distr=self.distr,
                 init_betas=init_betas,
+                init_y_hat=self._get_initial_predictions(y)[local_indices],
                 tol=self.tolerance,
                 clip=self.clip,
                 max_iter=self.max_iter,
@@ -2738,13 +2872,14 @@ class MuSIC:
                 link=None,
                 ridge_lambda=self.ridge_lambda,
                 mask=feature_mask,
+                fisher_moments=self._get_fisher_moments(X),
             )
 
             if i in mask_indices:
                 betas = np.zeros_like(betas)
                 pred_y = 0.0
             else:
-                pred_y = y_hat[i]
+                pred_y = y_hat[i_pos]
                 # Adjustment for the pseudocount added in preprocessing:
                 pred_y -= 1
                 pred_y[pred_y < 0] = 0
@@ -2756,7 +2891,7 @@ class MuSIC:
             # Reshape coefficients if necessary:
             betas = betas.flatten()
             # Effect of deleting sample i from the dataset on the estimated predicted value at sample i:
-            hat_i = np.dot(X[i], pseudoinverse[:, i]) * final_irls_weights[i][0]
+            hat_i = np.dot(X[i], pseudoinverse[:, i_pos]) * final_irls_weights[i_pos][0]
             # Diagonals of the inverse Fisher matrix (used to compute standard errors):
             inv_diag = np.diag(fisher_inv).reshape(-1)
 
@@ -2778,6 +2913,116 @@ class MuSIC:
                 bw_diagnostic = pred_y
             return [bw_diagnostic, hat_i]
 
+    def _get_init_betas(self, y_label: str) -> Optional[np.ndarray]:
+        """Initial coefficients for IWLS for the given response variable, if provided."""
+        if self.init_betas is None:
+            return None
+        init_betas = self.init_betas[y_label]
+        if not isinstance(init_betas, np.ndarray):
+            init_betas = init_betas.values
+        if init_betas.ndim == 1:
+            init_betas = init_betas.reshape(-1, 1)
+        return init_betas
+
+    def local_fit_batch(
+        self,
+        indices: np.ndarray,
+        y: np.ndarray,
+        X: np.ndarray,
+        bw: Union[float, int],
+        y_label: str,
+        coords: Optional[np.ndarray] = None,
+        mask_indices: Optional[np.ndarray] = None,
+        feature_mask: Optional[np.ndarray] = None,
+        final: bool = False,
+        fit_predictor: bool = False,
+    ) -> np.ndarray:
+        """Fit the local regression models of a batch of samples at once. Equivalent to calling :func `local_fit`
+        for each sample, but the weighted normal equations of all samples in the batch are built and solved together.
+
+        Args:
+            indices: Indices of samples for which local regression models are to be fitted
+            y: Response variable
+            X: Independent variable array
+            bw: Bandwidth for the spatial kernel
+            y_label: Name of the response variable
+            coords: Can be optionally used to provide coordinates for samples- used if subsampling was performed to
+                maintain all original sample coordinates (to take original neighborhoods into account)
+            mask_indices: Can be optionally used to provide indices of samples to mask out of the dataset
+            feature_mask: Can be optionally used to provide a mask for features to mask out of the dataset
+            final: Set True to indicate that no additional parameter selection needs to be performed; the model can
+                be fit and more stats can be returned.
+            fit_predictor: Set True to indicate that dependent variable to fit is a linear predictor rather than a
+                true response variable
+
+        Returns:
+            Array with one row per sample, containing the outputs of :func `local_fit` for that sample- if `final`
+            is True, the sample index, diagnostic, hat_i, betas and leverages, otherwise the bandwidth diagnostic and
+            hat_i.
+        """
+        indices = np.asarray(indices)
+        w = self._get_local_weights(indices, y, bw, coords=coords, mask_indices=mask_indices)
+        rows = np.repeat(np.arange(len(indices)), np.diff(w.indptr))
+        # Position of the entry of each sample itself among the stored entries of the weights:
+        self_entries = np.flatnonzero(w.indices == indices[rows])
+        X_self = X[indices]
+        if mask_indices is not None:
+            masked = np.isin(indices, mask_indices)
+        else:
+            masked = np.zeros(len(indices), dtype=bool)
+
+        if self.distr == "gaussian" or fit_predictor:
+            betas, inv_cov = compute_betas_local_batch(y, X, w, clip=self.clip)
+            betas[masked] = 0.0
+            pred_y = np.einsum("bk,bk->b", X_self, betas)
+            residual = np.asarray(y).reshape(-1)[indices] - pred_y
+            diagnostic = residual
+            # Effect of deleting sample i from the dataset on the estimated predicted value at sample i:
+            hat_i = np.einsum("bk,bkl,bl->b", X_self, inv_cov, X_self) * w.data[self_entries]
+            # Diagonals of the inverse covariance matrix (used to compute standard errors):
+            inv_diag = np.diagonal(inv_cov, axis1=1, axis2=2)
+
+        elif self.distr == "poisson" or self.distr == "nb":
+            init_betas = self._get_init_betas(y_label)
+            if init_betas is not None and init_betas.shape[0] == X.shape[0]:
+                init_betas = init_betas[indices]
+            betas, y_hat, _, final_irls_weights, inv_cov, fisher_inv = iwls_batch(
+                y,
+                X,
+                w,
+                distr=self.distr,
+                init_betas=init_betas,
+                init_y_hat=self._get_initial_predictions(y),
+                tol=self.tolerance,
+                clip=self.clip,
+                max_iter=self.max_iter,
+                link=None,
+                ridge_lambda=self.ridge_lambda,
+                mask=feature_mask,
+                fisher_moments=self._get_fisher_moments(X),
+            )
+            betas[masked] = 0.0
+            # Adjustment for the pseudocount added in preprocessing:
+            pred_y = np.maximum(y_hat[self_entries] - 1, 0)
+            pred_y[masked] = 0.0
+            diagnostic = pred_y
+            # Effect of deleting sample i from the dataset on the estimated predicted value at sample i:
+            hat_i = (
+                np.einsum("bk,bkl,bl->b", X_self, inv_cov, X_self)
+                * final_irls_weights[self_entries] ** 2
+                * w.data[self_entries]
+            )
+            # Diagonals of the inverse Fisher matrix (used to compute standard errors):
+            inv_diag = np.diagonal(fisher_inv, axis1=1, axis2=2)
+
+        else:
+            raise ValueError("Invalid `distr` specified. Must be one of 'gaussian', 'poisson', or 'nb'.")
+
+        if final:
+            return np.column_stack((indices, diagnostic, hat_i, betas, inv_diag))
+        # For bandwidth optimization:
+        return np.column_stack((diagnostic, hat_i))
+
     def find_optimal_bw(self, range_lowest: float, range_highest: float, function: Callable) -> float:
         """Perform golden section search to find the optimal bandwidth.
 
@@ -2926,15 +3171,16 @@ class MuSIC:
         else:
             true = y
 
-        if final:
-            local_fit_outputs = np.empty((self.x_chunk.shape[0], 2 * n_features + 3), dtype=np.float64)
+        # Local models are fit in batches, sized such that the stacked outer products of each batch fit in memory:
+        avg_n_neighbors = max(self._get_all_local_weights(bw, coords).nnz / n_samples, 1.0)
+        batch_size = max(1, int(LOCAL_FIT_BATCH_ELEMENTS // (avg_n_neighbors * n_features**2)))
+        batch_starts = range(0, self.x_chunk.shape[0], batch_size)
 
+        if final:
             # Fitting for each location, or each location that is among the subsampled points:
-            pos = 0
-            # for i in self.x_chunk:
-            for pos, i in enumerate(tqdm(self.x_chunk, desc="Fitting using final bandwidth...")):
-                local_fit_outputs[pos] = self.local_fit(
-                    i,
+            local_fit_outputs = [
+                self.local_fit_batch(
+                    self.x_chunk[start : start + batch_size],
                     y,
                     X,
                     y_label=y_label,
@@ -2945,7 +3191,8 @@ class MuSIC:
                     final=final,
                     fit_predictor=fit_predictor,
                 )
-                pos += 1
+                for start in tqdm(batch_starts, desc="Fitting using final bandwidth...")
+            ]
 
             # Gather data to the central process such that an array is formed where each sample has its own
             # measurements:
@@ -3035,16 +3282,10 @@ class MuSIC:
             return
 
         # If not the final run:
-        if self.distr == "gaussian" or fit_predictor:
-            # Compute AICc using the sum of squared residuals:
-            RSS = 0
-            trace_hat = 0
-            nan_count = 0
-
-            # for i in self.x_chunk:
-            for pos, i in enumerate(tqdm(self.x_chunk, desc="Fitting for each location...")):
-                fit_outputs = self.local_fit(
-                    i,
+        fit_outputs = np.vstack(
+            [
+                self.local_fit_batch(
+                    self.x_chunk[start : start + batch_size],
                     y,
                     X,
                     y_label=y_label,
@@ -3055,13 +3296,14 @@ class MuSIC:
                     final=False,
                     fit_predictor=fit_predictor,
                 )
-                # fit_outputs = np.concatenate(([sample_index, 0.0, 0.0], zero_placeholder, zero_placeholder))
-                err, hat_i = fit_outputs[0], fit_outputs[1]
-                RSS += err**2
-                if np.isnan(hat_i):
-                    nan_count += 1
-                else:
-                    trace_hat += hat_i
+                for start in tqdm(batch_starts, desc="Fitting for each location...")
+            ]
+        )
+
+        if self.distr == "gaussian" or fit_predictor:
+            # Compute AICc using the sum of squared residuals:
+            RSS = np.sum(fit_outputs[:, 0] ** 2)
+            trace_hat = np.nansum(fit_outputs[:, 1])
 
             aicc = self.compute_aicc_linear(RSS, trace_hat, n_samples=n_samples)
             self.logger.info(f"Bandwidth: {bw:.3f}, Linear AICc: {aicc:.3f}")
@@ -3069,31 +3311,8 @@ class MuSIC:
 
         elif self.distr == "poisson" or self.distr == "nb":
             # Compute AICc using the fitted and observed values:
-            nans = np.empty(self.x_chunk.shape[0], dtype=bool)
-            trace_hats = np.empty(self.x_chunk.shape[0], dtype=np.float64)
-            pos = 0
-            y_pred = np.empty(self.x_chunk.shape[0], dtype=np.float64)
-
-            # for i in self.x_chunk:
-            for pos, i in enumerate(tqdm(self.x_chunk, desc="Fitting for each location...")):
-                fit_outputs = self.local_fit(
-                    i,
-                    y,
-                    X,
-                    y_label=y_label,
-                    coords=coords,
-                    mask_indices=mask_indices,
-                    feature_mask=feature_mask,
-                    bw=bw,
-                    final=False,
-                    fit_predictor=fit_predictor,
-                )
-                y_pred_i, hat_i = fit_outputs[0], fit_outputs[1]
-                if np.isnan(hat_i) or np.isnan(y_pred_i):
-                    nans[pos] = 1
-                y_pred[pos] = y_pred_i
-                trace_hats[pos] = hat_i
-                pos += 1
+            y_pred, trace_hats = fit_outputs[:, 0], fit_outputs[:, 1]
+            nans = np.isnan(trace_hats) | np.isnan(y_pred)
 
             # Send data to the central process:
             all_y_pred = np.array(y_pred).reshape(-1, 1)
@@ -3184,8 +3403,7 @@ class MuSIC:
                 parent_dir = os.path.dirname(self.output_path)
             file_list = [f for f in os.listdir(parent_dir) if os.path.isfile(os.path.join(parent_dir, f))]
             for filename in file_list:
-                parts = filename.split("_")
-                if len(parts) > 1 and parts[-1].startswith(target + ".csv"):
+                if "_" in filename and is_result_file(filename) and result_target(filename) == target:
                     self.logger.info(f"Model has already been fit for target {target}. Moving on to next target.")
                     found = True
                     break
@@ -3292,11 +3510,11 @@ class MuSIC:
                 if "cci_deg_detection" in parent_dir:
                     parent_dir = os.path.dirname(parent_dir)
                 files = os.listdir(parent_dir)
-                csv_files = [file for file in files if file.endswith(".csv") and "prediction" not in file]
-                if csv_files:
-                    first_csv = csv_files[0]
-                    # Split the string at underscores and remove the last part (extension)
-                    id_tag = first_csv.rsplit("_", 1)[0]
+                result_files = [file for file in files if is_result_file(file)]
+                if result_files:
+                    first_file = result_files[0]
+                    # Split the string at underscores and remove the last part (target and extension)
+                    id_tag, ext = first_file.rsplit("_", 1)[0], os.path.splitext(first_file)[1]
                 else:
                     raise FileNotFoundError(
                         f"No files found in the parent directory of the upstream model: {parent_dir}."
@@ -3305,11 +3523,10 @@ class MuSIC:
                 # For target gene analysis, we want to filter to those TFs that are actually part of the relevant
                 # signaling pathway (not all TFs will interact w/ the signaling)- for ligand/receptor analysis,
                 # fine to look at all TFs that can putatively regulate expression.
-                path = os.path.join(parent_dir, id_tag + f"_{target}.csv")
+                path = os.path.join(parent_dir, id_tag + f"_{target}{ext}")
                 targets_df = pd.read_csv(os.path.join(parent_dir, id_tag, "design_matrix", "targets.csv"), index_col=0)
                 if target in targets_df.columns:  # i.e. if this gene is among the target genes of the upstream model
-                    target_file = pd.read_csv(path, index_col=0)
-                    regulators = [c for c in target_file.columns if c.startswith("b_")]
+                    regulators = [c for c in read_result_columns(path) if c.startswith("b_")]
                     regulators = [c.replace("b_", "") for c in regulators]
                     ligands = regulators
 
@@ -3615,7 +3832,8 @@ class MuSIC:
         """Save the results of the GWR model to file, and return the coefficients.
 
         Args:
-            data: Elements of data to save to .csv
+            data: Elements of data to save to .csv or HDF5 (depending on the extension of the output path). The first
+                column contains the index of each sample.
             header: Column names
             label: Optional, can be used to provide unique ID to save file- notably used when multiple dependent
                 variables with different names are fit during this process.
@@ -3652,8 +3870,13 @@ class MuSIC:
         else:
             path = self.output_path
 
-        # Save to .csv:
-        np.savetxt(path, data, delimiter=",", header=header[:-1], comments="")
+        if is_hdf5_path(path):
+            columns = header[:-1].split(",")
+            df = pd.DataFrame(data[:, 1:], index=pd.Index(data[:, 0], name=columns[0]), columns=columns[1:])
+            write_results(path, df, float32=self.output_float32)
+        else:
+            # Save to .csv:
+            np.savetxt(path, data, delimiter=",", header=header[:-1], comments="")
         self.saved = True
 
     def predict_and_save(
@@ -3726,9 +3949,14 @@ class MuSIC:
         file_list = [f for f in os.listdir(parent_dir) if os.path.isfile(os.path.join(parent_dir, f))]
 
         for file in file_list:
-            if not "predictions" in file:
-                target = file.split("_")[-1][:-4]
-                all_outputs = pd.read_csv(os.path.join(parent_dir, file), index_col=0)
+            if is_result_file(file):
+                target = result_target(file)
+                # Only the coefficients and standard errors are needed:
+                result_columns = read_result_columns(os.path.join(parent_dir, file))
+                all_outputs = read_results(
+                    os.path.join(parent_dir, file),
+                    columns=[col for col in result_columns if col.startswith("b_") or col.startswith("se_")],
+                )
                 betas = all_outputs[[col for col in all_outputs.columns if col.startswith("b_")]]
                 feat_sub = [col.replace("b_", "") for col in betas.columns]
                 if isinstance(betas.index[0], int) or isinstance(betas.index[0], float):
@@ -3782,7 +4010,7 @@ class MuSIC:
                     # Concatenate coefficients and standard errors to re-associate each row with its name in the AnnData
                     # object, save back to file path:
                     all_outputs = pd.concat([betas, standard_errors], axis=1)
-                    all_outputs.to_csv(os.path.join(parent_dir, file))
+                    write_results(os.path.join(parent_dir, file), all_outputs, float32=self.output_float32)
                 else:
                     if not load_for_interpreter:
                         # Same processing as for subsampling, but without the subsampling:
@@ -3805,7 +4033,7 @@ class MuSIC:
                         # Concatenate coefficients and standard errors to re-associate each row with its name in the AnnData
                         # object, save back to file path:
                         all_outputs = pd.concat([betas, standard_errors], axis=1)
-                        all_outputs.to_csv(os.path.join(parent_dir, file))
+                        write_results(os.path.join(parent_dir, file), all_outputs, float32=self.output_float32)
 
                 # Save coefficients and standard errors to dictionary:
                 all_coeffs[target] = betas
@@ -3822,12 +4050,13 @@ class MuSIC:
         parent_dir = os.path.dirname(self.output_path)
         all_intercepts = {}
         for file in os.listdir(parent_dir):
-            all_outputs = pd.read_csv(os.path.join(parent_dir, file), index_col=0)
-            intercepts = all_outputs["intercept"].values
+            if not is_result_file(file):
+                continue
+            intercepts = read_results(os.path.join(parent_dir, file), columns=["intercept"])["intercept"].values
 
             # If there were multiple dependent variables, save coefficients to dictionary:
             if file != os.path.basename(self.output_path):
-                all_intercepts[file.split("_")[-1]] = intercepts
+                all_intercepts[result_target(file)] = intercepts
             else:
                 all_intercepts = intercepts
 
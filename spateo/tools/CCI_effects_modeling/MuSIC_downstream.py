@@ -57,6 +57,12 @@ from ..dimensionality_reduction import find_optimal_pca_components, pca_fit
 from ..utils import compute_corr_ci, create_new_coordinate
 from .MuSIC import MuSIC
 from .regression_utils import assign_significance, multitesting_correction, wald_test
+from .result_store import (
+    is_result_file,
+    read_result_columns,
+    read_results,
+    result_target,
+)
 from .SWR import define_spateo_argparse
 
 
@@ -8193,9 +8199,8 @@ class MuSIC_Interpreter(MuSIC):
         all_targets = []
         target_to_file = {}
         for file in lr_model_output_files:
-            if file.endswith(".csv") and "predictions" not in file:
-                parts = file.split("_")
-                target_str = parts[-1].replace(".csv", "")
+            if is_result_file(file):
+                target_str = result_target(file)
                 # And map the target to the file name:
                 target_to_file[target_str] = os.path.join(lr_model_output_dir, file)
                 all_targets.append(target_str)
@@ -8210,9 +8215,8 @@ class MuSIC_Interpreter(MuSIC):
                 ligand_folder = os.path.join(downstream_model_dir, "cci_deg_detection", "ligand_analysis")
                 ligand_files = os.listdir(ligand_folder)
                 for file in ligand_files:
-                    if file.endswith(".csv"):
-                        parts = file.split("_")
-                        ligand_str = parts[-1].replace(".csv", "")
+                    if is_result_file(file):
+                        ligand_str = result_target(file)
                         # And map the ligand to the file name:
                         ligand_to_file[ligand_str] = os.path.join(ligand_folder, file)
                         all_modeled_ligands.append(ligand_str)
@@ -8235,9 +8239,8 @@ class MuSIC_Interpreter(MuSIC):
                 target_folder = os.path.join(downstream_model_dir, "cci_deg_detection", "target_gene_analysis")
                 target_files = os.listdir(target_folder)
                 for file in target_files:
-                    if file.endswith(".csv"):
-                        parts = file.split("_")
-                        target_str = parts[-1].replace(".csv", "")
+                    if is_result_file(file):
+                        target_str = result_target(file)
                         # And map the target to the file name:
                         modeled_target_to_file[target_str] = os.path.join(target_folder, file)
                         all_modeled_targets.append(target_str)
@@ -8288,8 +8291,9 @@ class MuSIC_Interpreter(MuSIC):
                 # Load file corresponding to this target:
                 file_name = target_to_file[target]
                 file_path = os.path.join(lr_model_output_dir, file_name)
-                target_df = pd.read_csv(file_path, index_col=0)
-                target_df = target_df.loc[:, [col for col in target_df.columns if col.startswith("b_")]]
+                target_df = read_results(
+                    file_path, columns=[col for col in read_result_columns(file_path) if col.startswith("b_")]
+                )
                 # Compute average predicted absolute value effect size over the chosen cell subset to populate
                 # L:R-to-target dataframe:
                 target_df.columns = [col.replace("b_", "") for col in target_df.columns if col.startswith("b_")]
@@ -8370,8 +8374,9 @@ class MuSIC_Interpreter(MuSIC):
                 ligand_expression_mask = (adata[:, ligand].X > 0).toarray().flatten()
                 file_name = ligand_to_file[ligand]
                 file_path = os.path.join(downstream_model_dir, "cci_deg_detection", "ligand_analysis", file_name)
-                ligand_df = pd.read_csv(file_path, index_col=0)
-                ligand_df = ligand_df.loc[:, [col for col in ligand_df.columns if col.startswith("b_")]]
+                ligand_df = read_results(
+                    file_path, columns=[col for col in read_result_columns(file_path) if col.startswith("b_")]
+                )
                 ligand_df.columns = [col.replace("b_", "") for col in ligand_df.columns if col.startswith("b_")]
                 if regulator_subset is not None:
                     ligand_df = ligand_df.loc[:, [col for col in ligand_df.columns if col in regulator_subset]]
@@ -8456,8 +8461,9 @@ class MuSIC_Interpreter(MuSIC):
                 target_expression_mask = (adata[:, target].X > 0).toarray().flatten()
                 file_name = modeled_target_to_file[target]
                 file_path = os.path.join(downstream_model_dir, "cci_deg_detection", "target_gene_analysis", file_name)
-                target_df = pd.read_csv(file_path, index_col=0)
-                target_df = target_df.loc[:, [col for col in target_df.columns if col.startswith("b_")]]
+                target_df = read_results(
+                    file_path, columns=[col for col in read_result_columns(file_path) if col.startswith("b_")]
+                )
                 target_df.columns = [col.replace("b_", "") for col in target_df.columns if col.startswith("b_")]
                 if regulator_subset is not None:
                     target_df = target_df.loc[:, [col for col in target_df.columns if col in regulator_subset]]
@@ -49,7 +49,9 @@ def define_spateo_argparse(**kwargs):
         output_path: Full path name for the .csv file in which results will be saved. Make sure the parent directory
             is empty- any existing files will be deleted. It is recommended to create a new folder to serve as the
             output directory. This should be supplied of the form '/path/to/file.csv', where file.csv will store
-            coefficients. The name of the target will be appended at runtime.
+            coefficients. The name of the target will be appended at runtime. If the file has an .h5 or .hdf5
+            extension, results will be saved in HDF5 format instead, which is faster to write and load.
+        output_float32: Flag to save results in single precision. Only applies to HDF5 outputs.
 
 
         custom_lig_path: Path to .txt file containing a custom list of ligands. Each ligand should have its own line
@@ -229,7 +231,12 @@ def define_spateo_argparse(**kwargs):
             "any existing files will be deleted. It is recommended to create "
             "a new folder to serve as the output directory. This should be "
             "supplied of the form '/path/to/file.csv', where file.csv will "
-            "store coefficients. The name of the target will be appended at runtime.",
+            "store coefficients. The name of the target will be appended at runtime. Use an .h5 or .hdf5 extension "
+            "to save results in HDF5 format.",
+        },
+        "-output_float32": {
+            "action": "store_true",
+            "help": "Save results in single precision. Only applies to HDF5 outputs.",
         },
         "-custom_lig_path": {"type": str},
         "-ligand": {
@@ -555,7 +562,13 @@ if __name__ == "__main__":
         "any existing files will be deleted. It is recommended to create "
         "a new folder to serve as the output directory. This should be "
         "supplied of the form '/path/to/file.csv', where file.csv will "
-        "store coefficients. The name of the target will be appended at runtime.",
+        "store coefficients. The name of the target will be appended at runtime. Use an .h5 or .hdf5 extension "
+        "to save results in HDF5 format.",
+    )
+    parser.add_argument(
+        "-output_float32",
+        action="store_true",
+        help="Save results in single precision. Only applies to HDF5 outputs.",
     )
     parser.add_argument("-custom_lig_path", type=str)
     parser.add_argument(
@@ -1,9 +1,7 @@
 """
 Auxiliary functions to aid in the interpretation functions for the spatial and spatially-lagged regression models.
 """
-from typing import Callable, List, Optional, Union
-
-from joblib import Parallel, delayed
+from typing import Callable, List, Optional, Tuple, Union
 
 try:
     from typing import Literal
@@ -16,6 +14,7 @@ import scipy
 import statsmodels.stats.multitest
 import tensorflow as tf
 from numpy import linalg
+from scipy.linalg import cho_factor, cho_solve
 from sklearn.metrics import confusion_matrix, recall_score
 from sklearn.preprocessing import MinMaxScaler
 from statsmodels.stats.outliers_influence import variance_inflation_factor
@@ -32,6 +31,10 @@ from .distributions import Binomial, Gaussian, Link, NegativeBinomial, Poisson
 # from .distributions import Gaussian, Link, NegativeBinomial, Poisson
 
 
+# Maximum number of elements of the masks used to draw batches of row permutations in :func `permutation_testing`:
+PERMUTATION_MASK_ELEMENTS = 1 << 24
+
+
 # ---------------------------------------------------------------------------------------------------
 # Sparse matrix operations
 # ---------------------------------------------------------------------------------------------------
@@ -184,6 +187,10 @@ def compute_betas_local(
     Source: Iteratively (Re)weighted Least Squares (IWLS), Fotheringham, A. S., Brunsdon, C., & Charlton, M. (2002).
     Geographically weighted regression: the analysis of spatially varying relationships.
 
+    Samples with zero spatial weight do not contribute to the fit, so `y`, `x` and `w` can be restricted to the
+    samples with nonzero weight (the neighborhood of the sample in question), in which case the columns of the
+    pseudoinverse correspond to the given samples only.
+
     Args:
         y: Array of shape [n_samples,]; dependent variable
         x: Array of shape [n_samples, n_features]; independent variables
@@ -219,18 +226,19 @@ def compute_betas_local(
         xtx += ridge_lambda * identity
 
     try:
-        cov_inverse = linalg.inv(xtx)
-    except:
-        cov_inverse = linalg.pinv(xtx)
-
-    try:
-        xtx_inv_xt = np.dot(linalg.inv(xtx), xT)
-        # xtx_inv_xt = linalg.solve(xtx, xT)
-    except:
-        xtx_inv_xt = np.dot(linalg.pinv(xtx), xT)
-    pseudoinverse = xtx_inv_xt
+        # Solve the normal equations using the Cholesky factorization of the (symmetric) Gram matrix:
+        factor = cho_factor(xtx)
+        cov_inverse = cho_solve(factor, np.eye(xtx.shape[0]))
+        pseudoinverse = cho_solve(factor, xT)
+    except linalg.LinAlgError:
+        # Gram matrix is not positive definite, e.g. if a feature is zero for all samples with nonzero weight:
+        try:
+            cov_inverse = linalg.inv(xtx)
+        except:
+            cov_inverse = linalg.pinv(xtx)
+        pseudoinverse = np.dot(cov_inverse, xT)
 
-    betas = np.dot(xtx_inv_xt, y)
+    betas = np.dot(pseudoinverse, y)
     if clip is not None:
         # Upper and lower bound to constrain betas and prevent numerical overflow:
         betas = np.clip(betas, -clip, clip)
@@ -238,11 +246,29 @@ def compute_betas_local(
     return betas, pseudoinverse, cov_inverse
 
 
+def _get_distribution(distr: Literal["gaussian", "poisson", "nb", "binomial"], link: Optional[Link] = None):
+    """Get the distribution family object for a distribution name, with the family's default link if none is given."""
+    if distr == "gaussian":
+        link = link or Gaussian.__init__.__defaults__[0]
+        distr = Gaussian(link)
+    elif distr == "poisson":
+        link = link or Poisson.__init__.__defaults__[0]
+        distr = Poisson(link)
+    elif distr == "nb":
+        link = link or NegativeBinomial.__init__.__defaults__[0]
+        distr = NegativeBinomial(link)
+    elif distr == "binomial":
+        link = link or Binomial.__init__.__defaults__[0]
+        distr = Binomial(link)
+    return distr
+
+
 def iwls(
     y: Union[np.ndarray, scipy.sparse.csr_matrix, scipy.sparse.csc_matrix],
     x: Union[np.ndarray, scipy.sparse.csr_matrix, scipy.sparse.csc_matrix],
     distr: Literal["gaussian", "poisson", "nb", "binomial"] = "gaussian",
     init_betas: Optional[np.ndarray] = None,
+    init_y_hat: Optional[np.ndarray] = None,
     offset: Optional[np.ndarray] = None,
     tol: float = 1e-8,
     clip: Optional[Union[float, np.ndarray]] = None,
@@ -253,6 +279,7 @@ def iwls(
     link: Optional[Link] = None,
     ridge_lambda: Optional[float] = None,
     mask: Optional[np.ndarray] = None,
+    fisher_moments: Optional[Tuple[np.ndarray, np.ndarray]] = None,
 ):
     """Iteratively weighted least squares (IWLS) algorithm to compute the regression coefficients for a given set of
     dependent and independent variables.
@@ -265,6 +292,9 @@ def iwls(
         x: Array of shape [n_samples, n_features]; independent variables
         distr: Distribution family for the dependent variable; one of "gaussian", "poisson", "nb", "binomial"
         init_betas: Array of shape [n_features,]; initial regression coefficients
+        init_y_hat: Optional array of shape [n_samples, 1]; initial predicted values of the dependent variable. If
+            not given, will be computed from "y" by the distribution family, which for some families depends on all
+            values of "y"- should therefore be given if "y" is restricted to the samples with nonzero spatial weight.
         offset: Optional array of shape [n_samples,]; if provided, will be added to the linear predictor. This is
             meant to deal with differences in scale that are not caused by the predictor variables,
             e.g. by differences in library size
@@ -283,6 +313,9 @@ def iwls(
         variance: Variance function for the distribution family. If None, will default to the default value for the
             specified distribution family.
         ridge_lambda: Ridge regularization parameter.
+        fisher_moments: Optional output of :func `get_fisher_moments` for the full independent variable array.
+            Can be given for Poisson and negative binomial models if "x" and "y" are restricted to the samples with
+            nonzero spatial weight, in which case the inverse Fisher matrix is still computed over all samples.
 
     Returns:
         betas: Array of shape [n_features, 1]; regression coefficients
@@ -329,19 +362,7 @@ def iwls(
 
     # Get appropriate distribution family based on specified:
     mod_distr = distr  # string specifying distribution assumption of the model
-
-    if distr == "gaussian":
-        link = link or Gaussian.__init__.__defaults__[0]
-        distr = Gaussian(link)
-    elif distr == "poisson":
-        link = link or Poisson.__init__.__defaults__[0]
-        distr = Poisson(link)
-    elif distr == "nb":
-        link = link or NegativeBinomial.__init__.__defaults__[0]
-        distr = NegativeBinomial(link)
-    elif distr == "binomial":
-        link = link or Binomial.__init__.__defaults__[0]
-        distr = Binomial(link)
+    distr = _get_distribution(distr, link)
 
     if init_betas is None:
         betas = np.zeros((x.shape[1], 1))
@@ -349,7 +370,7 @@ def iwls(
         betas = init_betas
 
     # Initial values:
-    y_hat = distr.initial_predictions(y)
+    y_hat = distr.initial_predictions(y) if init_y_hat is None else init_y_hat
     linear_predictor = distr.get_predictors(y_hat)
 
     while difference > tol and n_iter < max_iter:
@@ -391,6 +412,10 @@ def iwls(
         difference = np.min(abs(new_betas - betas))
         betas = new_betas
 
+    # Coefficients of the final linear predictor, before thresholding:
+    if fisher_moments is not None and (mod_distr == "poisson" or mod_distr == "nb"):
+        inv = get_fisher_inverse_from_moments(*fisher_moments, betas)
+
     # Set zero coefficients to zero:
     betas[betas == 1e-6] = 0.0
     # Threshold coefficients where appropriate:
@@ -412,7 +437,8 @@ def iwls(
                 inv = linalg.pinv(xtx)
 
     elif mod_distr == "poisson" or mod_distr == "nb":
-        inv = get_fisher_inverse(x, linear_predictor)
+        if fisher_moments is None:
+            inv = get_fisher_inverse(x, linear_predictor)
     else:
         inv = None
 
@@ -423,6 +449,286 @@ def iwls(
         return betas, y_hat, n_iter, w_final, linear_predictor, adjusted_predictor, pseudoinverse, inv
 
 
+# ---------------------------------------------------------------------------------------------------
+# Batched local regression
+# ---------------------------------------------------------------------------------------------------
+def _segment_sum(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """Sums the entries belonging to each row of a CSR structure.
+
+    Args:
+        values: Array of shape [n_entries, ...]; values of each stored entry
+        indptr: Array of shape [n_rows + 1,]; row pointers of the CSR structure
+
+    Returns:
+        sums: Array of shape [n_rows, ...]; sum of the values in each row
+    """
+    sums = np.zeros((len(indptr) - 1,) + values.shape[1:])
+    nonempty = np.diff(indptr) > 0
+    if np.any(nonempty):
+        # Empty rows contribute no entries, so the entries between consecutive nonempty rows belong to the first:
+        sums[nonempty] = np.add.reduceat(values, indptr[:-1][nonempty], axis=0)
+    return sums
+
+
+def _weighted_gram(x: np.ndarray, entry_weights: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """Weighted Gram matrices X^T W X of many local regressions at once.
+
+    Args:
+        x: Array of shape [n_entries, n_features]; independent variables of the sample of each stored entry
+        entry_weights: Array of shape [n_entries,]; weight of each stored entry
+        indptr: Array of shape [n_rows + 1,]; row pointers, where each row is a local regression
+
+    Returns:
+        xtx: Array of shape [n_rows, n_features, n_features]
+    """
+    return _segment_sum(np.einsum("e,ek,el->ekl", entry_weights, x, x), indptr)
+
+
+def batched_inverse(xtx: np.ndarray) -> np.ndarray:
+    """Inverts a stack of symmetric positive semi-definite matrices (e.g. Gram matrices) using batched Cholesky
+    factorizations. Matrices that are not positive definite (e.g. if a feature is zero for all samples of a local
+    regression) are pseudo-inverted instead.
+
+    Args:
+        xtx: Array of shape [n_matrices, n_features, n_features]
+
+    Returns:
+        inverse: Array of shape [n_matrices, n_features, n_features]
+    """
+    inverse = np.zeros_like(xtx)
+    if xtx.shape[0] == 0:
+        return inverse
+    identity = np.broadcast_to(np.eye(xtx.shape[1]), xtx.shape)
+
+    try:
+        positive_definite = np.ones(xtx.shape[0], dtype=bool)
+        chol = np.linalg.cholesky(xtx)
+    except linalg.LinAlgError:
+        positive_definite = np.linalg.eigvalsh(xtx)[:, 0] > 0
+        try:
+            chol = np.linalg.cholesky(xtx[positive_definite])
+        except linalg.LinAlgError:
+            # Rounding can make the factorization fail for matrices with tiny positive eigenvalues:
+            for idx in np.flatnonzero(positive_definite):
+                try:
+                    np.linalg.cholesky(xtx[idx])
+                except linalg.LinAlgError:
+                    positive_definite[idx] = False
+            chol = np.linalg.cholesky(xtx[positive_definite])
+
+    if np.any(positive_definite):
+        chol_inv = np.linalg.solve(chol, identity[positive_definite])
+        inverse[positive_definite] = np.einsum("bji,bjk->bik", chol_inv, chol_inv)
+    if not np.all(positive_definite):
+        inverse[~positive_definite] = np.linalg.pinv(xtx[~positive_definite], hermitian=True)
+    return inverse
+
+
+def compute_betas_local_batch(
+    y: np.ndarray,
+    x: np.ndarray,
+    w: scipy.sparse.csr_matrix,
+    ridge_lambda: float = 0.0,
+    clip: Optional[Union[float, np.ndarray]] = None,
+):
+    """Batched version of :func `compute_betas_local`, which fits the weighted least squares regressions for many
+    samples at once by building and solving the stacked normal equations.
+
+    Args:
+        y: Array of shape [n_samples,] or [n_samples, 1]; dependent variable
+        x: Array of shape [n_samples, n_features]; independent variables
+        w: Sparse array of shape [n_regressions, n_samples]; each row contains the spatial weights of one regression
+        ridge_lambda: Regularization parameter for Ridge regression
+        clip: Upper and lower bound to constrain betas and prevent numerical overflow. Either one floating point
+            value or an array of shape [n_regressions,] with a bound for each regression.
+
+    Returns:
+        betas: Array of shape [n_regressions, n_features]; regression coefficients
+        cov_inverse: Array of shape [n_regressions, n_features, n_features]; inverse of the covariance matrix of each
+            regression. Together with the spatial weights, this determines the pseudoinverse of each regression.
+    """
+    y = np.asarray(y).reshape(-1)
+    n_features = x.shape[1]
+    x_entries = x[w.indices]
+    y_entries = y[w.indices]
+
+    # Regressions in which all weighted dependent or independent variables are zero are not fit:
+    nonzero_entries = w.data != 0
+    zero = (_segment_sum((nonzero_entries & (y_entries != 0)).astype(float), w.indptr) == 0) | (
+        _segment_sum((nonzero_entries & np.any(x_entries != 0, axis=1)).astype(float), w.indptr) == 0
+    )
+
+    xtx = _weighted_gram(x_entries, w.data, w.indptr)
+    # Ridge regularization:
+    if ridge_lambda is not None:
+        xtx += ridge_lambda * np.eye(n_features)
+    xty = _segment_sum((w.data * y_entries)[:, None] * x_entries, w.indptr)
+
+    cov_inverse = batched_inverse(xtx)
+    betas = np.einsum("bkl,bl->bk", cov_inverse, xty)
+    if clip is not None:
+        # Upper and lower bound to constrain betas and prevent numerical overflow:
+        clip = np.asarray(clip).reshape(-1, 1)
+        betas = np.clip(betas, -clip, clip)
+
+    betas[zero] = 1e-20
+    cov_inverse[zero] = 0.0
+    return betas, cov_inverse
+
+
+def iwls_batch(
+    y: np.ndarray,
+    x: np.ndarray,
+    w: scipy.sparse.csr_matrix,
+    distr: Literal["poisson", "nb"] = "poisson",
+    init_betas: Optional[np.ndarray] = None,
+    init_y_hat: Optional[np.ndarray] = None,
+    tol: float = 1e-8,
+    clip: Optional[Union[float, np.ndarray]] = None,
+    threshold: float = 1e-4,
+    max_iter: int = 200,
+    link: Optional[Link] = None,
+    ridge_lambda: Optional[float] = None,
+    mask: Optional[np.ndarray] = None,
+    fisher_moments: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+):
+    """Batched version of :func `iwls` for geographically-weighted generalized linear models, which runs the IWLS
+    iterations of many local regressions at once. Each local regression stops iterating once it has converged,
+    exactly as it would in :func `iwls`.
+
+    Args:
+        y: Array of shape [n_samples, 1]; dependent variable
+        x: Array of shape [n_samples, n_features]; independent variables
+        w: Sparse array of shape [n_regressions, n_samples]; each row contains the spatial weights of one regression.
+            Samples with explicitly stored zero weight do not contribute to the fit, but their predicted values and
+            IWLS weights are computed.
+        distr: Distribution family for the dependent variable; one of "poisson" or "nb"
+        init_betas: Optional array of shape [n_features,] or [n_regressions, n_features]; initial regression
+            coefficients
+        init_y_hat: Optional array of shape [n_samples, 1]; initial predicted values of the dependent variable. If
+            not given, will be computed from "y" by the distribution family.
+        tol: Convergence tolerance
+        clip: Upper and lower bound to constrain betas and prevent numerical overflow. Either one floating point
+            value or an array of shape [n_regressions,] with a bound for each regression.
+        threshold: Coefficients with absolute values below this threshold will be set to zero
+        max_iter: Maximum number of iterations if convergence is not reached
+        link: Link function for the distribution family. If None, will default to the default value for the specified
+            distribution family.
+        ridge_lambda: Ridge regularization parameter.
+        mask: Optional array of shape [n_features,]; see :func `iwls`
+        fisher_moments: Optional output of :func `get_fisher_moments` for "x". Will be computed if not given.
+
+    Returns:
+        betas: Array of shape [n_regressions, n_features]; regression coefficients
+        y_hat: Array of shape [n_entries,]; predicted value of the dependent variable for each stored entry of "w"
+        n_iter: Array of shape [n_regressions,]; number of iterations completed by each regression
+        w_final: Array of shape [n_entries,]; final IWLS weights for each stored entry of "w"
+        cov_inverse: Array of shape [n_regressions, n_features, n_features]; inverse of the weighted covariance
+            matrix of the final iteration of each regression
+        inv: Array of shape [n_regressions, n_features, n_features]; the inverse Fisher matrix of each regression
+    """
+    y = np.asarray(y).reshape(-1)
+    n_regressions, n_features = w.shape[0], x.shape[1]
+    rows = np.repeat(np.arange(n_regressions), np.diff(w.indptr))
+    x_entries = x[w.indices]
+    y_entries = y[w.indices]
+    spatial_weights = w.data
+    distr = _get_distribution(distr, link)
+
+    if isinstance(clip, np.ndarray):
+        clip = clip.reshape(-1, 1)
+    if mask is not None:
+        mask = mask.reshape(1, -1)
+    if fisher_moments is None:
+        fisher_moments = get_fisher_moments(x)
+
+    # Regressions in which all weighted dependent or independent variables are zero are not fit:
+    nonzero_entries = spatial_weights != 0
+    zero = (_segment_sum((nonzero_entries & (y_entries != 0)).astype(float), w.indptr) == 0) | (
+        _segment_sum((nonzero_entries & np.any(x_entries != 0, axis=1)).astype(float), w.indptr) == 0
+    )
+
+    if init_betas is None:
+        betas = np.zeros((n_regressions, n_features))
+    else:
+        betas = np.broadcast_to(np.asarray(init_betas).reshape(-1, n_features), (n_regressions, n_features)).copy()
+    n_iter = np.zeros(n_regressions, dtype=int)
+    cov_inverse = np.zeros((n_regressions, n_features, n_features))
+    w_final = np.zeros_like(spatial_weights, dtype=float)
+
+    # Initial values:
+    if init_y_hat is None:
+        init_y_hat = distr.initial_predictions(y)
+    y_hat = np.asarray(init_y_hat).reshape(-1)[w.indices].astype(float)
+    linear_predictor = distr.get_predictors(y_hat)
+
+    active = ~zero & (max_iter > 0)
+    while np.any(active):
+        counts = np.diff(w.indptr)[active]
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        entries = active[rows]
+        x_active = x_entries[entries]
+        y_active = y_entries[entries]
+        sw_active = spatial_weights[entries]
+        lp_active = linear_predictor[entries]
+        y_hat_active = y_hat[entries]
+
+        weights = distr.weights(lp_active)
+        # Compute adjusted predictor from the difference between the predicted mean response variable and observed y:
+        adjusted_predictor = lp_active + (distr.link.deriv(y_hat_active) * (y_active - y_hat_active))
+        weights = np.sqrt(weights)
+        w_final[entries] = weights
+        w_adjusted_predictor = adjusted_predictor * weights
+
+        # Solve the weighted least squares problem of each regression:
+        xtx = _weighted_gram(x_active, sw_active * weights * weights, indptr)
+        if ridge_lambda is not None:
+            xtx += ridge_lambda * np.eye(n_features)
+        xtz = _segment_sum((sw_active * weights * w_adjusted_predictor)[:, None] * x_active, indptr)
+        active_cov_inverse = batched_inverse(xtx)
+        new_betas = np.einsum("bkl,bl->bk", active_cov_inverse, xtz)
+        if clip is not None:
+            active_clip = clip[active] if isinstance(clip, np.ndarray) else clip
+            new_betas = np.clip(new_betas, -active_clip, active_clip)
+        # Regressions in which all weighted variables are zero:
+        unfit = (_segment_sum((sw_active * w_adjusted_predictor != 0).astype(float), indptr) == 0) | (
+            _segment_sum(((sw_active * weights)[:, None] * x_active != 0).any(axis=1).astype(float), indptr) == 0
+        )
+        new_betas[unfit] = 1e-20
+        active_cov_inverse[unfit] = 0.0
+
+        # Mask operations:
+        if mask is not None:
+            neg_mask = (new_betas < 0) & (mask == -1.0) | (new_betas > 0)
+            new_betas[~neg_mask] = 1e-6
+
+        linear_predictor[entries] = np.einsum("ek,ek->e", x_active, np.repeat(new_betas, counts, axis=0))
+        y_hat[entries] = distr.predict(linear_predictor[entries])
+
+        difference = np.min(np.abs(new_betas - betas[active]), axis=1)
+        betas[active] = new_betas
+        cov_inverse[active] = active_cov_inverse
+        n_iter[active] += 1
+        active[active] = (difference > tol) & (n_iter[active] < max_iter)
+
+    # Inverse Fisher matrix from the coefficients of the final linear predictor, before thresholding:
+    xtx_inverse, x_cov = fisher_moments
+    var = np.maximum(np.einsum("bk,kl,bl->b", betas, x_cov, betas), 0.0)
+    inv = var[:, None, None] * xtx_inverse
+
+    # Set zero coefficients to zero:
+    betas[betas == 1e-6] = 0.0
+    # Threshold coefficients where appropriate:
+    betas[np.abs(betas) < threshold] = 0.0
+
+    # Regressions that were not fit:
+    betas[zero] = 0.0
+    y_hat[zero[rows]] = 0.0
+    inv[zero] = 0.0
+
+    return betas, y_hat, n_iter, w_final, cov_inverse, inv
+
+
 # ---------------------------------------------------------------------------------------------------
 # Objective functions for logistic models
 # ---------------------------------------------------------------------------------------------------
@@ -755,6 +1061,44 @@ def get_fisher_inverse(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     return inverse_fisher
 
 
+def get_fisher_moments(x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Precomputes the quantities needed to compute the inverse Fisher matrix of :func `get_fisher_inverse` for any
+    coefficients of a linear model, without needing the linear predictor of every sample.
+
+    Args:
+        x: Array of shape [n_samples, n_features]; independent variable array
+
+    Returns:
+        xtx_inverse: Array of shape [n_features, n_features]; inverse of the Gram matrix of x
+        x_cov: Array of shape [n_features, n_features]; covariance matrix of the features of x
+    """
+    xtx = np.matmul(x.T, x)
+    try:
+        xtx_inverse = np.linalg.inv(xtx)
+    except:
+        xtx_inverse = np.linalg.pinv(xtx)
+    x_cov = np.atleast_2d(np.cov(x, rowvar=False, bias=True))
+    return xtx_inverse, x_cov
+
+
+def get_fisher_inverse_from_moments(xtx_inverse: np.ndarray, x_cov: np.ndarray, betas: np.ndarray) -> np.ndarray:
+    """Computes the inverse Fisher matrix of :func `get_fisher_inverse` for the linear predictor x @ betas, using the
+    moments of x from :func `get_fisher_moments`. The variance of the linear predictor is betas.T @ x_cov @ betas,
+    and the inverse of x.T @ x / var is var * (x.T @ x)^-1.
+
+    Args:
+        xtx_inverse: Array of shape [n_features, n_features]; inverse of the Gram matrix of x
+        x_cov: Array of shape [n_features, n_features]; covariance matrix of the features of x
+        betas: Array of shape [n_features, 1]; coefficients of the linear predictor
+
+    Returns:
+        inverse_fisher : np.ndarray
+    """
+    betas = betas.reshape(-1)
+    var = max(float(betas @ x_cov @ betas), 0.0)
+    return var * xtx_inverse
+
+
 def run_permutation_test(data, thresh, subset_rows=None, subset_cols=None):
     """Permutes the input data array and calculates whether the mean of the permuted array is higher than the
         provided value.
@@ -798,49 +1142,150 @@ def run_permutation_test(data, thresh, subset_rows=None, subset_cols=None):
     return is_higher
 
 
+def _permuted_row_images(rng: np.random.Generator, n_rows: int, n_images: int, n_permutations: int) -> np.ndarray:
+    """Images of "n_images" distinct rows under each of a batch of random row permutations, i.e. uniformly random
+    ordered samples of distinct row indices, without permuting (or even storing) all rows for each permutation.
+
+    Args:
+        rng: Random number generator
+        n_rows: Total number of rows
+        n_images: Number of rows whose images are drawn
+        n_permutations: Number of permutations in the batch
+
+    Returns:
+        images: Array of shape [n_permutations, n_images]
+    """
+    if n_images * n_images <= 2 * n_rows:
+        # Rows drawn independently are all distinct with a probability of about 1/e or more, so the permutations whose
+        # rows are not all distinct are simply redrawn, at a cost that does not depend on the total number of rows:
+        images = rng.integers(0, n_rows, size=(n_permutations, n_images))
+        redraw = np.arange(n_permutations)
+        while len(redraw) > 0:
+            sorted_images = np.sort(images[redraw], axis=1)
+            redraw = redraw[np.any(sorted_images[:, 1:] == sorted_images[:, :-1], axis=1)]
+            images[redraw] = rng.integers(0, n_rows, size=(len(redraw), n_images))
+        return images
+
+    images = np.empty((n_permutations, n_images), dtype=np.intp)
+    # Bound the memory used to keep track of the rows that were already drawn:
+    chunk_size = max(1, PERMUTATION_MASK_ELEMENTS // n_rows)
+    for start in range(0, n_permutations, chunk_size):
+        stop = min(start + chunk_size, n_permutations)
+        chunk = np.arange(stop - start)
+        drawn = np.zeros((stop - start, n_rows), dtype=bool)
+        # Floyd's algorithm draws a uniformly random subset of rows for all permutations at once:
+        for k, j in enumerate(range(n_rows - n_images, n_rows)):
+            t = rng.integers(0, j + 1, size=stop - start)
+            t = np.where(drawn[chunk, t], j, t)
+            drawn[chunk, t] = True
+            images[start:stop, k] = t
+    # The subsets are uniformly random, but their order is not:
+    return rng.permuted(images, axis=1)
+
+
 def permutation_testing(
     data: Union[np.ndarray, scipy.sparse.csr_matrix],
     n_permutations: int = 10000,
     n_jobs: int = 1,
     subset_rows: Optional[Union[np.ndarray, List[int]]] = None,
     subset_cols: Optional[Union[np.ndarray, List[int]]] = None,
+    significance_threshold: Optional[float] = None,
+    batch_size: int = 1000,
+    random_state: Optional[int] = None,
 ) -> float:
-    """Permutes the input array and calculates the p-value based on the number of times the mean of the permuted
-        array is higher than the provided value.
+    """Permutes the rows of the input array and calculates the p-value based on the number of times the mean of the
+        permuted array is higher than the provided value.
+
+    Permutations are drawn in batches, as the images of the subset rows under each permutation, such that the input
+    is never copied or densified. If only rows are subset, each permuted mean only depends on the row sums of the
+    input. When there are few distinct row sums (e.g. for counts), the number of selected rows with each distinct row
+    sum follows a multivariate hypergeometric distribution, which is sampled directly.
 
     Args:
         data: Input array or sparse matrix
         n_permutations: Number of permutations
-        n_jobs: Number of parallel jobs to use (-1 for all available CPUs)
+        n_jobs: Unused, as permutations are computed in vectorized batches. Kept for backwards compatibility.
         subset_rows: Optional indices to subset the rows of 'data' (to take the mean value of only the subset of
             interest)
         subset_cols: Optional indices to subset the columns of 'data' (to take the mean value of only the subset of
             interest)
+        significance_threshold: Optional significance threshold for early stopping. If given, permutations will stop
+            being drawn once it is certain whether the p-value will be above or below this threshold, in which case
+            the p-value is estimated from the permutations drawn so far.
+        batch_size: Number of permutations drawn at once
+        random_state: Optional seed for the random number generator
 
     Returns:
         pval: The calculated p-value.
     """
-    if scipy.sparse.isspmatrix_csr(data):
-        data = data.A
+    if scipy.sparse.issparse(data):
+        data = data.tocsr()
+    elif data.ndim == 1:
+        data = data.reshape(-1, 1)
+    n_rows, n_cols = data.shape
+    rng = np.random.default_rng(random_state)
+
+    if subset_rows is None:
+        # The mean over all rows is invariant to permutation of the rows, so no permuted mean can be higher:
+        return 1 / (n_permutations + 1)
+    rows = np.arange(n_rows)[subset_rows].reshape(-1)
+    cols = None if subset_cols is None else np.arange(n_cols)[subset_cols]
+
+    if cols is not None:
+        # Rows and columns index individual elements, as in "data[subset_rows, subset_cols]":
+        rows, cols = np.broadcast_arrays(rows, cols.reshape(-1))
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+
+        def get_means(images):
+            permuted_rows = images[:, inverse].reshape(-1)
+            permuted_cols = np.tile(cols, images.shape[0])
+            values = np.asarray(data[permuted_rows, permuted_cols], dtype=float).reshape(images.shape[0], -1)
+            return values.mean(axis=1)
+
+        mean_observed = get_means(unique_rows.reshape(1, -1))[0]
+
+        def draw_means(n_batch):
+            return get_means(_permuted_row_images(rng, n_rows, len(unique_rows), n_batch))
 
-    if subset_rows is not None:
-        if subset_cols is not None:
-            mean_observed = np.mean(data[subset_rows, subset_cols])
-        else:
-            mean_observed = np.mean(data[subset_rows, :])
-    elif subset_cols is not None:
-        mean_observed = np.mean(data[:, subset_cols])
     else:
-        mean_observed = np.mean(data)
+        row_sums = np.asarray(data.sum(axis=1), dtype=float).reshape(-1)
+        norm = len(rows) * n_cols
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
 
-    n_trials_higher = sum(
-        Parallel(n_jobs=n_jobs)(
-            delayed(run_permutation_test)(data, mean_observed, subset_rows, subset_cols) for _ in range(n_permutations)
-        )
-    )
+        values, counts = np.unique(row_sums, return_counts=True)
+        # Sampling the hypergeometric distribution costs the number of distinct row sums per permutation, which is
+        # only worth it if it is not more than the number of subset rows:
+        if len(unique_rows) == len(rows) and len(values) <= len(rows):
+            # Sum the observed and permuted rows in the same way, so that identical subsets give identical means:
+            mean_observed = np.bincount(np.searchsorted(values, row_sums[rows]), minlength=len(values)) @ values / norm
+
+            def draw_means(n_batch):
+                selected = rng.multivariate_hypergeometric(counts, len(rows), size=n_batch, method="marginals")
+                return selected @ values / norm
+
+        else:
+            mean_observed = row_sums[rows].sum() / norm
+
+            def draw_means(n_batch):
+                images = _permuted_row_images(rng, n_rows, len(unique_rows), n_batch)
+                return row_sums[images[:, inverse]].sum(axis=1) / norm
+
+    n_trials_higher = 0
+    n_drawn = 0
+    while n_drawn < n_permutations:
+        n_batch = min(batch_size, n_permutations - n_drawn)
+        n_trials_higher += int(np.sum(draw_means(n_batch) > mean_observed))
+        n_drawn += n_batch
+
+        if significance_threshold is not None and n_drawn < n_permutations:
+            # The p-value can only increase with further permutations, by at most the number of remaining permutations:
+            above = (n_trials_higher + 1) / (n_permutations + 1) > significance_threshold
+            below = (n_trials_higher + n_permutations - n_drawn + 1) / (n_permutations + 1) <= significance_threshold
+            if above or below:
+                break
 
     # Add 1 to numerator and denominator for continuity correction
-    p_value = (n_trials_higher + 1) / (n_permutations + 1)
+    p_value = (n_trials_higher + 1) / (n_drawn + 1)
     return p_value
 
 
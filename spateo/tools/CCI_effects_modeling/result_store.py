@@ -0,0 +1,119 @@
+"""
+Reading and writing the per-target result files (coefficients, standard errors and diagnostics) of MuSIC models.
+
+Results are saved either as .csv files or, if the output path has an .h5/.hdf5 extension, as HDF5 files. In the HDF5
+files, the values are stored in a single two-dimensional dataset that is chunked by column, such that any subset of
+columns can be loaded without reading (or parsing) the rest of the file.
+"""
+import os
+from typing import List, Optional, Sequence
+
+import h5py
+import numpy as np
+import pandas as pd
+
+CSV_EXTENSIONS = (".csv",)
+HDF5_EXTENSIONS = (".h5", ".hdf5")
+RESULT_EXTENSIONS = CSV_EXTENSIONS + HDF5_EXTENSIONS
+# Maximum number of rows in each chunk of the HDF5 value dataset.
+HDF5_CHUNK_ROWS = 1 << 16
+
+
+def is_hdf5_path(path: str) -> bool:
+    """Whether results at the given path are stored in HDF5 format."""
+    return os.path.splitext(path)[1].lower() in HDF5_EXTENSIONS
+
+
+def is_result_file(filename: str) -> bool:
+    """Whether a file in a MuSIC output directory contains the fitted results for a target (i.e. is a .csv or HDF5
+    file that does not contain predictions)."""
+    return os.path.splitext(filename)[1].lower() in RESULT_EXTENSIONS and "predictions" not in filename
+
+
+def result_target(filename: str) -> str:
+    """Name of the target whose results are stored in a file, which is appended to the output file name."""
+    return os.path.splitext(os.path.basename(filename))[0].split("_")[-1]
+
+
+def write_results(path: str, df: pd.DataFrame, float32: bool = False) -> None:
+    """Saves a dataframe of model results to .csv or HDF5, depending on the extension of the path.
+
+    Args:
+        path: Path to the output file
+        df: Dataframe of results, with one row per sample
+        float32: Set True to store values in single precision. Only applies to HDF5 files.
+    """
+    if not is_hdf5_path(path):
+        df.to_csv(path)
+        return
+
+    dtype = np.float32 if float32 else np.float64
+    index = df.index.values
+    if index.dtype.kind in "OUS":
+        index = index.astype(str).astype(object)
+        index_dtype = h5py.string_dtype()
+    else:
+        index_dtype = index.dtype
+
+    with h5py.File(path, "w") as f:
+        f.create_dataset("index", data=index, dtype=index_dtype)
+        f["index"].attrs["name"] = "" if df.index.name is None else str(df.index.name)
+        f.create_dataset("columns", data=np.array(df.columns.astype(str), dtype=object), dtype=h5py.string_dtype())
+        n_rows, n_columns = df.shape
+        chunks = (max(1, min(n_rows, HDF5_CHUNK_ROWS)), 1) if n_rows > 0 and n_columns > 0 else None
+        f.create_dataset("values", data=df.values.astype(dtype, copy=False), chunks=chunks)
+
+
+def read_result_columns(path: str) -> List[str]:
+    """Names of the columns in a result file, without loading any of the values.
+
+    Args:
+        path: Path to the result file
+
+    Returns:
+        columns: Names of the columns, excluding the index
+    """
+    if not is_hdf5_path(path):
+        return pd.read_csv(path, index_col=0, nrows=0).columns.tolist()
+    with h5py.File(path, "r") as f:
+        return f["columns"].asstr()[:].tolist()
+
+
+def read_results(path: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """Loads model results from .csv or HDF5, depending on the extension of the path.
+
+    Args:
+        path: Path to the result file
+        columns: Optional subset of columns to load. If not given, all columns will be loaded.
+
+    Returns:
+        df: Dataframe of results, indexed by sample
+    """
+    if not is_hdf5_path(path):
+        if columns is None:
+            return pd.read_csv(path, index_col=0)
+        wanted = set(columns)
+        usecols = [0] + [i + 1 for i, col in enumerate(read_result_columns(path)) if col in wanted]
+        df = pd.read_csv(path, index_col=0, usecols=usecols)
+        return df.loc[:, [col for col in columns if col in df.columns]]
+
+    with h5py.File(path, "r") as f:
+        index = f["index"]
+        index_values = index.asstr()[:] if h5py.check_string_dtype(index.dtype) else index[:]
+        index = pd.Index(index_values, name=index.attrs.get("name") or None)
+        all_columns = f["columns"].asstr()[:].tolist()
+        if columns is None:
+            positions = np.arange(len(all_columns))
+        else:
+            lookup = {col: i for i, col in enumerate(all_columns)}
+            positions = np.array([lookup[col] for col in columns if col in lookup], dtype=int)
+        if len(positions) == len(all_columns) and np.all(positions == np.arange(len(all_columns))):
+            values = f["values"][:]
+        elif len(positions) > 0:
+            # Fancy indexing in h5py requires increasing indices:
+            order = np.argsort(positions)
+            values = np.empty((len(index), len(positions)), dtype=f["values"].dtype)
+            values[:, order] = f["values"][:, positions[order]]
+        else:
+            values = np.empty((len(index), 0), dtype=f["values"].dtype)
+    return pd.DataFrame(values, index=index, columns=[all_columns[i] for i in positions])
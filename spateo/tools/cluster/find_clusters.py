@@ -1,3 +1,4 @@
+from functools import partial
 from typing import Optional
 
 try:
@@ -33,6 +34,7 @@ def spagcn_pyg(
     x_array: str = None,
     y_array: str = None,
     seed: int = 100,
+    n_neighbors: Optional[int] = None,
     copy: bool = False,
 ) -> Optional[anndata.AnnData]:
     """Function to find clusters with spagcn.
@@ -58,6 +60,9 @@ def spagcn_pyg(
         x_array: The key(colname) in `adata.obs` which contains corresponding x-coordinates. Defaults to None.
         y_array: The key(colname) in `adata.obs` which contains corresponding y-coordinates. Defaults to None.
         seed: Global seed for `random`, `torch`, `numpy`. Defaults to 100.
+        n_neighbors: If given, use a sparse adjacent matrix of the distances of each spot to its `n_neighbors` nearest
+            neighbors instead of the dense matrix of all distances, e.g. for cell-bin data with many cells. Defaults to
+            None.
         copy: Whether to return a new deep copy of `adata` instead of updating `adata` object passed in arguments. Defaults to False.
 
     Returns:
@@ -88,16 +93,21 @@ def spagcn_pyg(
     s = 1
     b = 49
 
+    if n_neighbors is None:
+        adj_func = calculate_adj_matrix
+    else:
+        adj_func = partial(calculate_sparse_adj_matrix, n_neighbors=n_neighbors)
+
     if his_img_path is None:
         if total_umi is None:
-            adj = calculate_adj_matrix(x=x_array, y=y_array, histology=False)
+            adj = adj_func(x=x_array, y=y_array, histology=False)
         else:
             total_umi = adata.obs[total_umi].tolist()
             total_umi = [int(x / max(total_umi) * 254 + 1) for x in total_umi]
             total_umi_mtx = pd.DataFrame({"x_pos": x_pixel, "y_pos": y_pixel, "n_umis": total_umi})
             total_umi_mtx = total_umi_mtx.pivot(index="x_pos", columns="y_pos", values="n_umis").fillna(1).to_numpy()
             umi_gs_img = np.dstack((total_umi_mtx, total_umi_mtx, total_umi_mtx)).astype(int)
-            adj = calculate_adj_matrix(
+            adj = adj_func(
                 x=x_array,
                 y=y_array,
                 x_pixel=x_pixel,
@@ -109,7 +119,7 @@ def spagcn_pyg(
             )
     else:
         img = cv2.imread(his_img_path)
-        adj = calculate_adj_matrix(
+        adj = adj_func(
             x=x_array,
             y=y_array,
             x_pixel=x_pixel,
@@ -169,7 +179,11 @@ def spagcn_pyg(
 
     if refine_shape is not None:
         # Do cluster refinement(optional)
-        adj_2d = calculate_adj_matrix(x=x_array, y=y_array, histology=False)
+        if n_neighbors is not None:
+            # The refinement votes over the 6 (hexagon) or 4 (square) nearest neighbors of each spot.
+            num_nbs = 6 if refine_shape == "hexagon" else 4
+            adj_func = partial(calculate_sparse_adj_matrix, n_neighbors=max(n_neighbors, num_nbs))
+        adj_2d = adj_func(x=x_array, y=y_array, histology=False)
         refined_pred = refine(
             sample_id=adata.obs.index.tolist(),
             pred=adata.obs["spagcn_pred"].tolist(),
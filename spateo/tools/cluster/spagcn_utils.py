@@ -2,17 +2,62 @@ import math
 import random
 
 import anndata as ad
-import numba
 import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
-from scipy.sparse import issparse
+from scipy.sparse import csr_matrix, identity, issparse
+from scipy.spatial import cKDTree, distance
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 
 from ...logging import logger_manager as lm
 
+# Maximum number of pairwise distances computed at once by `calculate_adj_matrix`.
+ADJ_BLOCK_SIZE = 1 << 22
+
+
+def _histology_z(x, y, x_pixel, y_pixel, image, beta=49, alpha=1):
+    """(Part of spagcn algorithm) The third coordinate of the spots from the mean color of the histology image around
+    each spot, computed from an integral image of the region covered by the spots.
+
+    Args:
+        x, y, x_pixel, y_pixel, image, beta, alpha: see `calculate_adj_matrix`.
+
+    Returns:
+        class: `numpy.ndarray`: the scaled histology coordinate of each spot.
+    """
+    assert (x_pixel is not None) & (y_pixel is not None) & (image is not None)
+    assert (len(x) == len(x_pixel)) & (len(y) == len(y_pixel))
+    beta_half = round(beta / 2)
+    x_pixel = np.asarray(x_pixel, dtype=np.int64)
+    y_pixel = np.asarray(y_pixel, dtype=np.int64)
+    x0 = np.clip(x_pixel - beta_half, 0, image.shape[0])
+    x1 = np.clip(x_pixel + beta_half + 1, 0, image.shape[0])
+    y0 = np.clip(y_pixel - beta_half, 0, image.shape[1])
+    y1 = np.clip(y_pixel + beta_half + 1, 0, image.shape[1])
+    # Integral image of the region covered by the windows of the spots, one channel at a time to limit memory.
+    x_min, x_max, y_min, y_max = x0.min(), x1.max(), y0.min(), y1.max()
+    x0, x1, y0, y1 = x0 - x_min, x1 - x_min, y0 - y_min, y1 - y_min
+    with np.errstate(divide="ignore", invalid="ignore"):
+        area = (x1 - x0) * (y1 - y0)
+        g = []
+        integral = np.zeros((x_max - x_min + 1, y_max - y_min + 1))
+        for channel in range(3):
+            # Accumulate in place, such that no temporary copies of the image are made.
+            integral[1:, 1:] = image[x_min:x_max, y_min:y_max, channel]
+            np.cumsum(integral[1:, 1:], axis=0, out=integral[1:, 1:])
+            np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+            g.append((integral[x1, y1] - integral[x0, y1] - integral[x1, y0] + integral[x0, y0]) / area)
+    c0, c1, c2 = g
+    lm.main_info(f"Var of c0,c1,c2 = {np.var(c0)}, {np.var(c1)}, {np.var(c2)}")
+    c3 = (c0 * np.var(c0) + c1 * np.var(c1) + c2 * np.var(c2)) / (np.var(c0) + np.var(c1) + np.var(c2))
+    c4 = (c3 - np.mean(c3)) / np.std(c3)
+    z_scale = np.max([np.std(x), np.std(y)]) * alpha
+    z = c4 * z_scale
+    lm.main_info(f"Var of x,y,z = {np.var(x)}, {np.var(y)}, {np.var(z)}")
+    return z
+
 
 def calculate_adj_matrix(x, y, x_pixel=None, y_pixel=None, image=None, beta=49, alpha=1, histology=True):
     """(Part of spagcn algorithm) Function to calculate adjacent matrix according to spatial coordinate and image pixels.
@@ -32,47 +77,77 @@ def calculate_adj_matrix(x, y, x_pixel=None, y_pixel=None, image=None, beta=49,
     """
 
     if histology:
-        assert (x_pixel is not None) & (x_pixel is not None) & (image is not None)
-        assert (len(x) == len(x_pixel)) & (len(y) == len(y_pixel))
         lm.main_info("Calculateing adj matrix using histology image...")
-        beta_half = round(beta / 2)
-        g = []
-        max_x = image.shape[0]
-        max_y = image.shape[1]
-        for i in range(len(x_pixel)):
-            nbs = image[
-                max(0, x_pixel[i] - beta_half) : min(max_x, x_pixel[i] + beta_half + 1),
-                max(0, y_pixel[i] - beta_half) : min(max_y, y_pixel[i] + beta_half + 1),
-            ]
-            g.append(np.mean(np.mean(nbs, axis=0), axis=0))
-        c0, c1, c2 = [], [], []
-        for i in g:
-            c0.append(i[0])
-            c1.append(i[1])
-            c2.append(i[2])
-        c0 = np.array(c0)
-        c1 = np.array(c1)
-        c2 = np.array(c2)
-        lm.main_info(f"Var of c0,c1,c2 = {np.var(c0)}, {np.var(c1)}, {np.var(c2)}")
-        c3 = (c0 * np.var(c0) + c1 * np.var(c1) + c2 * np.var(c2)) / (np.var(c0) + np.var(c1) + np.var(c2))
-        c4 = (c3 - np.mean(c3)) / np.std(c3)
-        z_scale = np.max([np.std(x), np.std(y)]) * alpha
-        z = c4 * z_scale
-        z = z.tolist()
-        lm.main_info(f"Var of x,y,z = {np.var(x)}, {np.var(y)}, {np.var(z)}")
+        z = _histology_z(x, y, x_pixel, y_pixel, image, beta=beta, alpha=alpha)
         X = np.array([x, y, z]).T.astype(np.float32)
     else:
         lm.main_info("Calculateing adj matrix using xy only...")
         X = np.array([x, y]).T.astype(np.float32)
-    n = X.shape[0]
-    adj = np.empty((n, n), dtype=np.float32)
-    for i in numba.prange(n):
-        for j in numba.prange(n):
-            adj[i][j] = np.sqrt(np.sum((X[i] - X[j]) ** 2))
+    # Fill the matrix in blocks of rows, such that only a block of double precision distances is held in memory.
+    adj = np.empty((X.shape[0], X.shape[0]), dtype=np.float32)
+    block_size = max(1, ADJ_BLOCK_SIZE // max(X.shape[0], 1))
+    for start in range(0, X.shape[0], block_size):
+        adj[start : start + block_size] = distance.cdist(X[start : start + block_size], X)
     return adj
 
 
+def calculate_sparse_adj_matrix(
+    x, y, x_pixel=None, y_pixel=None, image=None, beta=49, alpha=1, histology=True, n_neighbors=30, radius=None
+):
+    """(Part of spagcn algorithm) Sparse version of `calculate_adj_matrix`, which only keeps the distances of the spots
+    to their nearest neighbors, found with a KD-tree, for large datasets.
+
+    The diagonal is not stored: `calculate_p` and `SpaGCN` account for each spot being its own neighbor. The
+    neighborhoods are symmetrized, and the weights of the spots beyond the neighborhoods are truncated to zero.
+
+    Args:
+        x, y, x_pixel, y_pixel, image, beta, alpha, histology: see `calculate_adj_matrix`.
+        n_neighbors (int, optional): the number of nearest neighbors of each spot. Ignored if `radius` is given.
+            Defaults to 30.
+        radius (float, optional): if given, the neighbors of each spot are all spots within this distance instead.
+            Defaults to None.
+
+    Returns:
+        class: `scipy.sparse.csr_matrix`: the distances between neighboring spots.
+    """
+    if histology:
+        lm.main_info("Calculateing sparse adj matrix using histology image...")
+        z = _histology_z(x, y, x_pixel, y_pixel, image, beta=beta, alpha=alpha)
+        X = np.array([x, y, z]).T.astype(np.float32)
+    else:
+        lm.main_info("Calculateing sparse adj matrix using xy only...")
+        X = np.array([x, y]).T.astype(np.float32)
+    n = X.shape[0]
+    tree = cKDTree(X)
+    if radius is not None:
+        pairs = tree.query_pairs(r=radius, output_type="ndarray")
+    else:
+        _, neighbors = tree.query(X, k=min(n_neighbors + 1, n))
+        rows = np.repeat(np.arange(n, dtype=np.int64), neighbors.shape[1])
+        cols = neighbors.ravel().astype(np.int64)
+        # Unique unordered pairs, such that the neighborhoods are symmetric:
+        keys = np.unique(np.minimum(rows, cols) * n + np.maximum(rows, cols))
+        pairs = np.c_[keys // n, keys % n]
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    rows, cols = np.r_[pairs[:, 0], pairs[:, 1]], np.r_[pairs[:, 1], pairs[:, 0]]
+    # Explicit zero distances of duplicated spots are kept as edges.
+    dist = np.linalg.norm(X[rows] - X[cols], axis=1).astype(np.float32)
+    return csr_matrix((dist, (rows, cols)), shape=(n, n))
+
+
+def _exp_adj(adj, l):
+    """Gaussian weights exp(-d^2 / (2 l^2)) of the spots at distance d, with sparse adjacency matrices including each
+    spot as its own neighbor."""
+    if issparse(adj):
+        adj_exp = csr_matrix(adj, copy=True)
+        adj_exp.data = np.exp(-1 * (adj_exp.data**2) / (2 * (l**2)))
+        return (adj_exp + identity(adj.shape[0], dtype=adj_exp.dtype, format="csr")).tocsr()
+    return np.exp(-1 * (adj**2) / (2 * (l**2)))
+
+
 def calculate_p(adj, l):
+    if issparse(adj):
+        return np.sum(np.exp(-1 * (adj.data**2) / (2 * (l**2)))) / adj.shape[0]
     adj_exp = np.exp(-1 * (adj**2) / (2 * (l**2)))
     return np.mean(np.sum(adj_exp, 1)) - 1
 
@@ -82,7 +157,7 @@ def search_l(p, adj, start=0.01, end=1000, tol=0.01, max_run=100):
 
     Args:
         p (float, optional): parameter `p` in spagcn algorithm. See `SpaGCN` for details.
-        adj (class: `numpy.ndarray`): the calculated adjacent matrix in spagcn algorithm.
+        adj (class: `numpy.ndarray` or `scipy.sparse.csr_matrix`): the calculated adjacent matrix in spagcn algorithm.
         start (float, optional): lower boundary of search. Defaults to 0.01.
         end (int, optional): upper boundary of search. Defaults to 1000.
         tol (float, optional): step length for search. Defaults to 0.01.
@@ -268,12 +343,15 @@ def refine(sample_id, pred, dis, shape="square"):
     Args:
         sample_id (list): list of sample(cell, spot or bin) names.
         pred (list): list of spatial domains corresponding to the sample_id list.
-        dis (class: `numpy.ndarray`): the calculated adjacent matrix in spagcn algorithm.
+        dis (class: `numpy.ndarray` or `scipy.sparse.csr_matrix`): the calculated adjacent matrix in spagcn algorithm,
+            dense or sparse (see `calculate_sparse_adj_matrix`, with at least as many neighbors as the topology).
         shape (str, optional): Smooth the spatial domains with given spatial topology, "hexagon" for Visium data, "square" for ST data. Defaults to "square".
 
     Returns:
         [list]: list of refined spatial domains corresponding to the sample_id list.
     """
+    if issparse(dis):
+        return _refine_sparse(pred, dis, shape=shape)
     refined_pred = []
     pred = pd.DataFrame({"pred": pred}, index=sample_id)
     dis_df = pd.DataFrame(dis, index=sample_id, columns=sample_id)
@@ -297,6 +375,30 @@ def refine(sample_id, pred, dis, shape="square"):
     return refined_pred
 
 
+def _refine_sparse(pred, dis, shape="square"):
+    """Vectorized `refine` with the stored neighbors of a sparse adjacency matrix."""
+    if shape == "hexagon":
+        num_nbs = 6
+    elif shape == "square":
+        num_nbs = 4
+    else:
+        lm.main_info("Shape not recongized, shape='hexagon' for Visium data, 'square' for ST data.")
+    labels, codes = np.unique(np.asarray(pred), return_inverse=True)
+    n, n_labels = dis.shape[0], len(labels)
+    dis = csr_matrix(dis)
+    # The num_nbs nearest stored neighbors of each sample, in addition to the sample itself:
+    rows = np.repeat(np.arange(n), np.diff(dis.indptr))
+    order = np.lexsort((dis.data, rows))
+    rows, cols = rows[order], dis.indices[order]
+    rank = np.arange(len(rows)) - dis.indptr[rows]
+    cols = np.r_[np.arange(n), cols[rank < num_nbs]]
+    rows = np.r_[np.arange(n), rows[rank < num_nbs]]
+    votes = np.bincount(rows * n_labels + codes[cols], minlength=n * n_labels).reshape(n, n_labels)
+    self_votes = votes[np.arange(n), codes]
+    to_refine = (self_votes < num_nbs / 2) & (votes.max(axis=1) > num_nbs / 2)
+    return labels[np.where(to_refine, votes.argmax(axis=1), codes)].tolist()
+
+
 class GraphConvolution(nn.Module):
     """
     Simple GCN layer, similar to https://arxiv.org/abs/1609.02907
@@ -321,7 +423,7 @@ class GraphConvolution(nn.Module):
 
     def forward(self, input, adj):
         support = torch.mm(input, self.weight)
-        output = torch.spmm(adj, support)
+        output = torch.sparse.mm(adj, support) if adj.is_sparse else torch.mm(adj, support)
         if self.bias is not None:
             return output + self.bias
         else:
@@ -331,6 +433,16 @@ class GraphConvolution(nn.Module):
         return self.__class__.__name__ + " (" + str(self.in_features) + " -> " + str(self.out_features) + ")"
 
 
+def _torch_adj(adj):
+    """The adjacency matrix as a float32 torch tensor, sparse for sparse matrices."""
+    if issparse(adj):
+        adj = adj.tocoo()
+        indices = torch.from_numpy(np.vstack([adj.row, adj.col]).astype(np.int64))
+        values = torch.from_numpy(adj.data.astype(np.float32))
+        return torch.sparse_coo_tensor(indices, values, adj.shape).coalesce()
+    return torch.FloatTensor(adj)
+
+
 class simple_GC_DEC(nn.Module):
     """
     Simple NN model constructed with a GraphConvolution layer followed by a DeepEmbeddingClustering layer.
@@ -388,7 +500,8 @@ class simple_GC_DEC(nn.Module):
         elif opt == "adam":
             optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=weight_decay)
 
-        features = self.gc(torch.FloatTensor(X), torch.FloatTensor(adj))
+        adj = _torch_adj(adj)
+        features = self.gc(torch.FloatTensor(X), adj)
         # ----------------------------------------------------------------
         if init == "kmeans":
             lm.main_info("Initializing cluster centers with kmeans, n_clusters known")
@@ -417,7 +530,6 @@ class simple_GC_DEC(nn.Module):
         y_pred_last = y_pred
         self.mu = nn.parameter.Parameter(torch.Tensor(self.n_clusters, self.nhid))
         X = torch.FloatTensor(X)
-        adj = torch.FloatTensor(adj)
         self.trajectory.append(y_pred)
         features = pd.DataFrame(features.detach().numpy(), index=np.arange(0, features.shape[0]))
         Group = pd.Series(y_pred, index=np.arange(0, features.shape[0]), name="Group")
@@ -451,7 +563,7 @@ class simple_GC_DEC(nn.Module):
                 break
 
     def predict(self, X, adj):
-        z, q = self(torch.FloatTensor(X), torch.FloatTensor(adj))
+        z, q = self(torch.FloatTensor(X), _torch_adj(adj))
         return z, q
 
 
@@ -487,7 +599,8 @@ class SpaGCN(object):
 
         Args:
             adata (class:`~anndata.AnnData`): an Annadata object.
-            adj (class: `numpy.ndarray`): the calculated adjacent matrix in spagcn algorithm.
+            adj (class: `numpy.ndarray` or `scipy.sparse.csr_matrix`): the calculated adjacent matrix in spagcn
+                algorithm, dense or sparse (see `calculate_sparse_adj_matrix`).
             num_pcs (int, optional): number of pcs(out dimension of PCA) to use. Defaults to 50.
             lr (float, optional): learning rate in neural network. Defaults to 0.005.
             max_epochs (int, optional): max epochs to train in neural network. Defaults to 2000.
@@ -519,7 +632,7 @@ class SpaGCN(object):
         ###------------------------------------------###
         if self.l is None:
             raise ValueError("l should be set before fitting the model!")
-        adj_exp = np.exp(-1 * (adj**2) / (2 * (self.l**2)))
+        adj_exp = _exp_adj(adj, self.l)
         # ----------Train model----------
         self.model = simple_GC_DEC(embed.shape[1], embed.shape[1])
         self.model.fit(
@@ -4,14 +4,11 @@ from typing import Callable, List, Optional, Union
 import numpy as np
 import pandas as pd
 from anndata import AnnData
-from joblib import Parallel, delayed
 from scipy import stats
-from scipy.sparse import issparse
-from scipy.spatial import distance
+from scipy.sparse import csc_matrix, csr_matrix, issparse
 from scipy.stats import mannwhitneyu
 from sklearn.neighbors import NearestNeighbors
 from statsmodels.sandbox.stats.multicomp import multipletests
-from tqdm import tqdm
 
 try:
     from typing import Literal
@@ -21,6 +18,256 @@ except ImportError:
 from ..configuration import SKM
 from ..logging import logger_manager as lm
 
+# Number of genes that are ranked at once in `_rank_sums`.
+RANK_BLOCK_SIZE = 1000
+
+
+def _dense(X) -> np.ndarray:
+    return X.toarray() if issparse(X) else np.asarray(X)
+
+
+def _group_indicator(codes: np.ndarray, n_groups: int) -> csr_matrix:
+    """One-hot matrix of the groups of cells. Cells with a negative code do not belong to any group."""
+    cells = np.where(codes >= 0)[0]
+    return csr_matrix((np.ones(len(cells)), (cells, codes[cells])), shape=(len(codes), n_groups))
+
+
+def _group_stats(X, codes: np.ndarray, n_groups: int):
+    """Number of cells, number of expressing cells and total expression of each group of cells, as well as the total
+    expression and the total squared expression of each gene across all cells.
+
+    Args:
+        X: Cells x genes expression matrix.
+        codes: The group index of each cell. Cells with a negative code do not belong to any group.
+        n_groups: The number of groups.
+
+    Returns:
+        The number of cells (groups), the number of expressing cells (groups x genes), the total expression
+        (groups x genes), the total expression (genes) and the total squared expression (genes).
+    """
+    indicator = _group_indicator(codes, n_groups).T.tocsr()
+    n = np.asarray(indicator.sum(axis=1)).ravel()
+    nnz = _dense(indicator @ (X != 0).astype(np.float64))
+    sums = _dense(indicator @ X)
+    total_sum = np.asarray(X.sum(axis=0)).ravel()
+    total_sq = np.asarray(X.multiply(X).sum(axis=0) if issparse(X) else np.square(X).sum(axis=0)).ravel()
+    return n, nnz, sums, total_sum, total_sq
+
+
+def _rank_sums(X, codes: np.ndarray, n_groups: int):
+    """Sum of the ranks of the cells of each group, where the cells are ranked by their expression of each gene.
+
+    Only the nonzero values are sorted: all zeros of a gene share the same average rank.
+
+    Args:
+        X: Cells x genes expression matrix.
+        codes: The group index of each cell.
+        n_groups: The number of groups.
+
+    Returns:
+        The rank sums (groups x genes) and the tie term ``sum(t^3 - t)`` over the groups of ``t`` tied values of each
+        gene, used for the tie correction of the Mann-Whitney U test.
+    """
+    indicator = _group_indicator(codes, n_groups).T.tocsr()
+    X = csc_matrix(X)
+    n_cells, n_genes = X.shape
+    rank_sums = np.zeros((n_groups, n_genes))
+    tie_term = np.zeros(n_genes)
+    for start in range(0, n_genes, RANK_BLOCK_SIZE):
+        block = X[:, start : start + RANK_BLOCK_SIZE]
+        block.eliminate_zeros()
+        n_block = block.shape[1]
+        nnz = np.diff(block.indptr)
+        cols = np.repeat(np.arange(n_block), nnz)
+
+        # Sort the nonzero values of each gene, and find the runs of tied values.
+        order = np.lexsort((block.data, cols))
+        values, value_cols = block.data[order], cols[order]
+        is_start = np.r_[True, (values[1:] != values[:-1]) | (value_cols[1:] != value_cols[:-1])]
+        run = np.cumsum(is_start) - 1
+        run_sizes = np.bincount(run)
+        run_starts = np.where(is_start)[0] - block.indptr[value_cols[is_start]]
+
+        # Average ranks among the nonzero values, shifted past the zeros for the positive values.
+        n_zero = n_cells - nnz
+        n_neg = np.bincount(cols[block.data < 0], minlength=n_block)
+        ranks = np.empty(len(order))
+        ranks[order] = run_starts[run] + (run_sizes[run] + 1) / 2 + np.where(values > 0, n_zero[value_cols], 0)
+        zero_rank = n_neg + (n_zero + 1) / 2
+
+        nz_rank_sums = _dense(indicator @ csc_matrix((ranks, block.indices, block.indptr), shape=block.shape))
+        n_nonzero = _dense(indicator @ (block != 0).astype(np.float64))
+        group_sizes = np.asarray(indicator.sum(axis=1))
+        rank_sums[:, start : start + n_block] = nz_rank_sums + (group_sizes - n_nonzero) * zero_rank
+        tie_term[start : start + n_block] = np.bincount(
+            value_cols[is_start], weights=run_sizes**3.0 - run_sizes, minlength=n_block
+        ) + (n_zero**3.0 - n_zero)
+    return rank_sums, tie_term
+
+
+def _mannwhitneyu_pvals(
+    X,
+    is_test: np.ndarray,
+    rank_sum: Optional[np.ndarray] = None,
+    tie_term: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Two-sided Mann-Whitney U test of the test cells against the other cells for every gene, matching
+    `scipy.stats.mannwhitneyu` with its default arguments.
+
+    Args:
+        X: Cells x genes expression matrix.
+        is_test: Whether each cell belongs to the test group.
+        rank_sum: Rank sums of the test cells from `_rank_sums`. Calculated if not given.
+        tie_term: The tie term from `_rank_sums`. Calculated if not given.
+
+    Returns:
+        The p-value of each gene.
+    """
+    if rank_sum is None or tie_term is None:
+        rank_sums, tie_term = _rank_sums(X, (~is_test).astype(int), 2)
+        rank_sum = rank_sums[0]
+    n1 = is_test.sum()
+    n2 = len(is_test) - n1
+    n = n1 + n2
+    U1 = rank_sum - n1 * (n1 + 1) / 2
+    U = np.maximum(U1, n1 * n2 - U1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (U - n1 * n2 / 2 - 0.5) / np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    pvals = np.clip(2 * stats.norm.sf(z), 0, 1)
+
+    # Like scipy, use the exact distribution for small samples without ties.
+    if min(n1, n2) <= 8:
+        for i in np.where(tie_term == 0)[0]:
+            vals = _dense(X[:, i]).ravel()
+            pvals[i] = mannwhitneyu(vals[is_test], vals[~is_test])[1]
+    return pvals
+
+
+def _marker_table(
+    genes: List[str],
+    test_group: str,
+    control_groups: List[str],
+    n: np.ndarray,
+    nnz: np.ndarray,
+    sums: np.ndarray,
+    total_sum: np.ndarray,
+    total_sq: np.ndarray,
+    pvals: np.ndarray,
+    num_cells: int,
+    method: Literal["multiple", "pairwise"] = "multiple",
+    qval_thresh: float = 0.05,
+    ratio_expr_thresh: float = 0.1,
+    diff_ratio_expr_thresh: float = 0,
+    log2fc_thresh: float = 0,
+) -> pd.DataFrame:
+    """Build the differential expression table of `find_cluster_degs` from the statistics of `_group_stats`, given
+    for the test group followed by the control groups, and the p-values of the test group against the (combined)
+    control groups."""
+    genes = np.asarray(genes)
+    # Genes that are expressed in too few cells of the test group are skipped.
+    ratio_expr = nnz[0] / n[0]
+    keep = ratio_expr >= ratio_expr_thresh
+    ratio_expr, nnz, sums, total_sum, total_sq = (
+        ratio_expr[keep],
+        nnz[:, keep],
+        sums[:, keep],
+        total_sum[keep],
+        total_sq[keep],
+    )
+    genes, pvals = genes[keep], pvals[:, keep]
+
+    # jsd_adj_score between perfect distribution and empirical distribution
+    perc_spec = np.zeros(len(n))
+    perc_spec[0] = 1.0
+    perc = nnz.T / num_cells
+    M = (perc + perc_spec) / 2
+    js_divergence = 0.5 * stats.entropy(perc, M, axis=1) + 0.5 * stats.entropy(perc_spec[None, :], M, axis=1)
+    jsd_adj_score = 1 - js_divergence
+
+    def pearson(group_sum, group_size):
+        # Pearson's correlation between the expression and the indicator vector of a set of cells.
+        cov = group_sum - total_sum * group_size / num_cells
+        return cov / np.sqrt((total_sq - total_sum**2 / num_cells) * (group_size - group_size**2 / num_cells))
+
+    def cosine(group_sum, group_size):
+        return group_sum / (np.sqrt(total_sq) * np.sqrt(group_size))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pearson_test_score = pearson(sums[0], n[0])
+        cosine_test_score = cosine(sums[0], n[0])
+        test_mean = sums[0] / n[0] + 1e-9
+
+        if method == "multiple":
+            control_n, control_nnz, control_sums = [n[1:].sum()], [nnz[1:].sum(axis=0)], [sums[1:].sum(axis=0)]
+            control_names = [control_groups]
+        else:
+            control_n, control_nnz, control_sums = n[1:], nnz[1:], sums[1:]
+            control_names = list(control_groups)
+
+        columns = []
+        for group_n, group_nnz, group_sum, p in zip(control_n, control_nnz, control_sums, pvals):
+            log2fc = np.log2(test_mean / (group_sum / group_n + 1e-9) + 10e-5)
+            p = np.where(group_nnz > 0, p, 1)
+            diff_ratio_expr = ratio_expr - group_nnz / group_n
+            pearson_control_score = pearson(group_sum, group_n)
+            pearson_score = pearson_test_score**3 / (pearson_control_score**2 + pearson_test_score**2)
+            cosine_control_score = cosine(group_sum, group_n)
+            cosine_score = cosine_test_score**3 / (cosine_control_score**2 + cosine_test_score**2)
+            combined_score = (
+                -log2fc * np.log(p) * ratio_expr * diff_ratio_expr * pearson_score * cosine_score * jsd_adj_score
+            )
+            columns.append((log2fc, p, diff_ratio_expr, pearson_score, cosine_score, combined_score))
+
+    # One row per gene and control group, in gene-major order.
+    log2fc, p, diff_ratio_expr, pearson_score, cosine_score, combined_score = (
+        np.stack(values, axis=1).ravel() for values in zip(*columns)
+    )
+    n_controls = len(columns)
+    de = pd.DataFrame(
+        {
+            "gene": np.repeat(genes, n_controls),
+            "control_group": [control_names[i] for i in np.tile(np.arange(n_controls), len(genes))],
+            "log2fc": log2fc,
+            "pval": p,
+            "ratio_expr": np.repeat(ratio_expr, n_controls),
+            "diff_ratio_expr": diff_ratio_expr,
+            "person_score": pearson_score,
+            "cosine_score": cosine_score,
+            "jsd_adj_score": np.repeat(jsd_adj_score, n_controls),
+            "combined_score": combined_score,
+        }
+    )
+
+    if de.shape[0] > 1:
+        de["qval"] = multipletests(de["pval"].values, method="fdr_bh")[1]
+    else:
+        de["qval"] = [np.nan for _ in range(de.shape[0])]
+
+    de["test_group"] = [test_group for _ in range(de.shape[0])]
+
+    out_order = [
+        "gene",
+        "test_group",
+        "control_group",
+        "ratio_expr",
+        "diff_ratio_expr",
+        "person_score",
+        "cosine_score",
+        "jsd_adj_score",
+        "log2fc",
+        "combined_score",
+        "pval",
+        "qval",
+    ]
+
+    de = de[out_order].sort_values(by="qval")
+
+    de = de[
+        (de.qval < qval_thresh) & (de.diff_ratio_expr > diff_ratio_expr_thresh) & (de.log2fc > log2fc_thresh)
+    ].reset_index(drop=True)
+
+    return de
+
 
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE)
 def find_spatial_cluster_degs(
@@ -167,6 +414,9 @@ def find_cluster_degs(
     Raises:
         ValueError: If the `method` is not one of "pairwise" or "multiple".
     """
+    if type(control_groups) == str:
+        control_groups = [control_groups]
+
     test_cells = adata.obs[group] == test_group
     control_cells = adata.obs[group].isin(control_groups)
 
@@ -192,197 +442,38 @@ def find_cluster_degs(
     else:
         X_data = adata[:, genes].X if layer is None else adata[:, genes].layers[layer]
 
-    sparse = issparse(X_data)
-
-    if type(control_groups) == str:
-        control_groups = [control_groups]
-
-    num_groups = len(control_groups)
-    num_test_cells = test_cells.sum()
-    num_control_cells = control_cells.sum()
-    num_cells = X_data.shape[0]
-
-    # perfect specificity, used in calculating JSD:
-    perc_spec = np.repeat(0.0, num_groups + 1)
-    perc_spec[0] = 1.0
-
-    de = []
-    for i_gene, gene in tqdm(enumerate(genes), desc="identifying top markers for each group"):
-        all_vals = X_data[:, i_gene].A if sparse else X_data[:, i_gene]
-        all_vals = all_vals.reshape(-1)
-        test_vals = all_vals[test_cells]
-        control_vals = all_vals[control_cells]
-        test_mean = test_vals.mean() + 1e-9
-
-        # ratio_expr
-        ratio_expr = len(test_vals.nonzero()[0]) / num_test_cells
-        if ratio_expr < ratio_expr_thresh:
-            continue
-
-        # jsd_adj_score between perfect distribution and empirical distribution
-        perc = [len(test_vals.nonzero()[0]) / num_cells]
-        perc.extend([len(all_vals[adata.obs[group] == x].nonzero()[0]) / num_cells for x in control_groups])
-
-        M = (perc + perc_spec) / 2
-        js_divergence = 0.5 * stats.entropy(perc, M) + 0.5 * stats.entropy(perc_spec, M)
-        jsd_adj_score = 1 - js_divergence
-
-        # pearson_test_score, maximal will be
-        test_group_spec = np.repeat(0, num_cells)
-        test_group_spec[test_cells] = 1
-        pearson_test_score = 1 - distance.correlation(all_vals, test_group_spec)
-
-        # cosine_test_score
-        cosine_test_score = 1 - distance.cosine(all_vals, test_group_spec)
-
-        if method == "multiple":
-            # log2fc
-            control_mean = control_vals.mean() + 1e-9
-            log2fc = np.log2(test_mean / control_mean + 10e-5)
-
-            # pvals
-            if len(control_vals.nonzero()[0]) > 0:
-                pvals = mannwhitneyu(test_vals, control_vals)[1]
-            else:
-                pvals = 1
-
-            # diff_ratio_expr
-            diff_ratio_expr = ratio_expr - len(control_vals.nonzero()[0]) / num_control_cells
-
-            # pearson_score
-            control_group_spec = np.repeat(0, num_cells)
-            control_group_spec[control_cells] = 1
-            pearson_control_score = 1 - distance.correlation(all_vals, control_group_spec)
-            pearson_score = np.power(pearson_test_score, 3) / (
-                np.power(pearson_control_score, 2) + np.power(pearson_test_score, 2)
-            )
-
-            # cosine_score
-            cosine_control_score = 1 - distance.cosine(all_vals, control_group_spec)
-            cosine_score = np.power(cosine_test_score, 3) / (
-                np.power(cosine_control_score, 2) + np.power(cosine_test_score, 2)
-            )
-
-            de.append(
-                (
-                    gene,
-                    control_groups,
-                    log2fc,
-                    pvals,
-                    ratio_expr,
-                    diff_ratio_expr,
-                    pearson_score,
-                    cosine_score,
-                    jsd_adj_score,
-                    -log2fc
-                    * (np.log(pvals))
-                    * ratio_expr
-                    * diff_ratio_expr
-                    * pearson_score
-                    * cosine_score
-                    * jsd_adj_score,
-                )
-            )
-        elif method == "pairwise":
-            for i in range(num_groups):
-                control_cells = adata.obs[group] == control_groups[i]
-                control_vals = all_vals[control_cells]
-
-                # log2fc
-                control_mean = np.mean(control_vals, axis=0) + 1e-9
-                log2fc = np.log2(test_mean / control_mean + 10e-5)
-
-                # pvals
-                if len(control_vals.nonzero()[0]) > 0:
-                    pvals = mannwhitneyu(test_vals, control_vals)[1]
-                else:
-                    pvals = 1
-
-                # diff_ratio_expr
-                diff_ratio_expr = ratio_expr - len(control_vals.nonzero()[0]) / len(control_vals)
-
-                # pearson_score
-                control_group_spec = np.repeat(0, num_cells)
-                control_group_spec[control_cells] = 1
-                pearson_control_score = 1 - distance.correlation(all_vals, control_group_spec)
-                pearson_score = np.power(pearson_test_score, 3) / (
-                    np.power(pearson_control_score, 2) + np.power(pearson_test_score, 2)
-                )
-
-                # cosine_score
-                cosine_control_score = 1 - distance.cosine(all_vals, control_group_spec)
-                cosine_score = np.power(cosine_test_score, 3) / (
-                    np.power(cosine_control_score, 2) + np.power(cosine_test_score, 2)
-                )
-
-                de.append(
-                    (
-                        gene,
-                        control_groups[i],
-                        log2fc,
-                        pvals,
-                        ratio_expr,
-                        diff_ratio_expr,
-                        pearson_score,
-                        cosine_score,
-                        jsd_adj_score,
-                        -log2fc
-                        * (np.log(pvals))
-                        * ratio_expr
-                        * diff_ratio_expr
-                        * pearson_score
-                        * cosine_score
-                        * jsd_adj_score,
-                    )
-                )
-        else:
-            lm.main_exception(f"`method` must be one of 'multiple' or 'pairwise' but {method} is passed")
-
-    de = pd.DataFrame(
-        de,
-        columns=[
-            "gene",
-            "control_group",
-            "log2fc",
-            "pval",
-            "ratio_expr",
-            "diff_ratio_expr",
-            "person_score",
-            "cosine_score",
-            "jsd_adj_score",
-            "combined_score",
-        ],
-    )
-
-    if de.shape[0] > 1:
-        de["qval"] = multipletests(de["pval"].values, method="fdr_bh")[1]
+    groups = [test_group] + list(control_groups)
+    codes = pd.Categorical(adata.obs[group], categories=groups).codes
+    n, nnz, sums, total_sum, total_sq = _group_stats(X_data, codes, len(groups))
+
+    if method == "multiple":
+        pool = codes >= 0
+        pvals = _mannwhitneyu_pvals(X_data[pool], codes[pool] == 0)[None, :]
+    elif method == "pairwise":
+        pvals = np.zeros((len(control_groups), X_data.shape[1]))
+        for i in range(len(control_groups)):
+            pool = (codes == 0) | (codes == i + 1)
+            pvals[i] = _mannwhitneyu_pvals(X_data[pool], codes[pool] == 0)
     else:
-        de["qval"] = [np.nan for _ in range(de.shape[0])]
-
-    de["test_group"] = [test_group for _ in range(de.shape[0])]
-
-    out_order = [
-        "gene",
-        "test_group",
-        "control_group",
-        "ratio_expr",
-        "diff_ratio_expr",
-        "person_score",
-        "cosine_score",
-        "jsd_adj_score",
-        "log2fc",
-        "combined_score",
-        "pval",
-        "qval",
-    ]
-
-    de = de[out_order].sort_values(by="qval")
-
-    de = de[
-        (de.qval < qval_thresh) & (de.diff_ratio_expr > diff_ratio_expr_thresh) & (de.log2fc > log2fc_thresh)
-    ].reset_index(drop=True)
-
-    return de
+        lm.main_exception(f"`method` must be one of 'multiple' or 'pairwise' but {method} is passed")
+
+    return _marker_table(
+        genes,
+        test_group,
+        control_groups,
+        n,
+        nnz,
+        sums,
+        total_sum,
+        total_sq,
+        pvals,
+        num_cells=X_data.shape[0],
+        method=method,
+        qval_thresh=qval_thresh,
+        ratio_expr_thresh=ratio_expr_thresh,
+        diff_ratio_expr_thresh=diff_ratio_expr_thresh,
+        log2fc_thresh=log2fc_thresh,
+    )
 
 
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE)
@@ -410,9 +501,8 @@ def find_all_cluster_degs(
             directly.
         copy: If True (default) a new copy of the adata object will be returned,
             otherwise if False, the adata will be updated inplace.
-        n_cores: `int` (default=1)
-            The maximum number of concurrently running jobs. By default it is 1 and thus no
-            parallel computing code is used at all. When -1 all CPUs are used.
+        n_jobs: Not used anymore, as the markers of all groups are now found at once. Kept for backwards
+            compatibility.
 
     Returns:
         An `~anndata.AnnData` with a new property `cluster_markers` in
@@ -452,45 +542,30 @@ def find_all_cluster_degs(
     if len(cluster_set) < 2:
         lm.main_exception(f"the number of groups for the argument {group} must be at least two.")
 
+    # Every group is tested against all other groups, so the statistics of all groups are computed in one pass, and
+    # the cells only need to be ranked once.
+    codes = pd.Categorical(adata.obs[group], categories=cluster_set).codes
+    n, nnz, sums, total_sum, total_sq = _group_stats(X_data, codes, len(cluster_set))
+    rank_sums, tie_term = _rank_sums(X_data, codes, len(cluster_set))
+
     deg_tables = [None] * len(cluster_set)
     deg_lists = [None] * len(cluster_set)
-    if len(cluster_set) > 2:
-
-        def single_group(i, test_group, cluster_set, adata, genes, X_data, group, de_tables, de_genes):
-            control_groups = sorted(set(cluster_set).difference([test_group]))
-
-            de = find_cluster_degs(
-                adata,
-                test_group,
-                control_groups,
-                genes=genes,
-                X_data=X_data,
-                group=group,
-            )
-
-            deg_list = [k for k, v in Counter(de["gene"]).items() if v >= 1]
-
-            return de, deg_list
-
-        deg_tuple, deg_names_tuple = zip(
-            *Parallel(n_jobs)(
-                delayed(single_group)(i, test_group, cluster_set, adata, genes, X_data, group, deg_tables, deg_lists)
-                for i, test_group in enumerate(cluster_set)
-            )
-        )
-        deg_tables, deg_lists = list(deg_tuple), list(deg_names_tuple)
-
-    else:
-        de = find_cluster_degs(
-            adata,
-            cluster_set[0],
-            cluster_set[1],
-            genes=genes,
-            X_data=X_data,
-            group=group,
+    for i in range(len(cluster_set)) if len(cluster_set) > 2 else [0]:
+        order = np.r_[i, np.delete(np.arange(len(cluster_set)), i)]
+        de = _marker_table(
+            genes,
+            cluster_set[i],
+            list(cluster_set[order[1:]]),
+            n[order],
+            nnz[order],
+            sums[order],
+            total_sum,
+            total_sq,
+            _mannwhitneyu_pvals(X_data, codes == i, rank_sum=rank_sums[i], tie_term=tie_term)[None, :],
+            num_cells=X_data.shape[0],
         )
-        deg_tables[0] = de.copy()
-        deg_lists[0] = [k for k, v in Counter(de["gene"]).items() if v >= 1]
+        deg_tables[i] = de
+        deg_lists[i] = [k for k, v in Counter(de["gene"]).items() if v >= 1]
 
     if copy:
         adata_1 = adata.copy()
@@ -13,14 +13,18 @@ import pandas as pd
 import scipy
 from anndata import AnnData
 from joblib import Parallel, delayed
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import pdist, squareform
 from sklearn.decomposition import PCA
 from sklearn.metrics import pairwise_distances
-from sklearn.neighbors import NearestNeighbors
+from sklearn.neighbors import BallTree, NearestNeighbors
 
 from ..configuration import SKM
 from ..logging import logger_manager as lm
 
+# Distance metrics that can be queried with a KD-tree, mapped to the corresponding Minkowski p-norm:
+KDTREE_METRICS = {"euclidean": 2, "cityblock": 1, "manhattan": 1, "chebyshev": np.inf}
+
 
 # ---------------------------------------------------------------------------------------------------
 # Utility functions
@@ -179,6 +183,74 @@ def compute_distances_and_connectivities(
     return distances, connectivities
 
 
+def build_spatial_index(coords: np.ndarray, metric: str = "euclidean") -> Union[cKDTree, BallTree]:
+    """Build a spatial index for nearest neighbor and radius queries. Minkowski-type metrics use a
+    :class `scipy.spatial.cKDTree`, all others a :class `sklearn.neighbors.BallTree`.
+
+    Args:
+        coords: Array of shape (n_samples, n_features) containing the coordinates of all points.
+        metric: Distance metric. Options: "euclidean", "cityblock", "chebyshev", or any of the metrics supported by
+            :class `sklearn.neighbors.BallTree`.
+
+    Returns:
+        index: The spatial index
+    """
+    coords = np.asarray(coords, dtype=float)
+    if metric in KDTREE_METRICS:
+        return cKDTree(coords)
+    if metric not in BallTree.valid_metrics:
+        raise ValueError(
+            f"Metric {metric} is not supported by the spatial index. Valid options: {list(KDTREE_METRICS)} or "
+            f"{BallTree.valid_metrics}."
+        )
+    return BallTree(coords, metric=metric)
+
+
+def query_knn(
+    index: Union[cKDTree, BallTree], coords: np.ndarray, n_neighbors: int, metric: str = "euclidean"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the nearest neighbors of each query point using a spatial index built with :func `build_spatial_index`.
+
+    Args:
+        index: The spatial index
+        coords: Array of shape (n_queries, n_features) containing the coordinates of the query points.
+        n_neighbors: Number of nearest neighbors to find for each query point (including the point itself, if it is
+            part of the index).
+        metric: Distance metric used to build the index.
+
+    Returns:
+        distances: Array of shape (n_queries, n_neighbors) containing the sorted distances to the nearest neighbors
+        indices: Array of shape (n_queries, n_neighbors) containing the indices of the nearest neighbors
+    """
+    coords = np.asarray(coords, dtype=float)
+    if isinstance(index, cKDTree):
+        distances, indices = index.query(coords, k=n_neighbors, p=KDTREE_METRICS[metric], workers=-1)
+        # cKDTree squeezes the neighbors axis when k == 1:
+        return distances.reshape(-1, n_neighbors), indices.reshape(-1, n_neighbors)
+    return index.query(coords, k=n_neighbors)
+
+
+def count_neighbors_in_radius(
+    index: Union[cKDTree, BallTree], coords: np.ndarray, radius: float, metric: str = "euclidean"
+) -> np.ndarray:
+    """Count the number of indexed points within `radius` (inclusive) of each query point, without storing the
+    neighbors themselves.
+
+    Args:
+        index: The spatial index
+        coords: Array of shape (n_queries, n_features) containing the coordinates of the query points.
+        radius: Radius in distance units
+        metric: Distance metric used to build the index.
+
+    Returns:
+        counts: Array of shape (n_queries, ) containing the number of neighbors of each query point
+    """
+    coords = np.asarray(coords, dtype=float)
+    if isinstance(index, cKDTree):
+        return index.query_ball_point(coords, r=radius, p=KDTREE_METRICS[metric], return_length=True, workers=-1)
+    return index.query_radius(coords, r=radius, count_only=True)
+
+
 def calculate_distances_chunk(
     coords_chunk: np.ndarray,
     chunk_start_idx: int,
@@ -224,6 +296,7 @@ def find_bw_for_n_neighbors(
     verbose: bool = True,
     max_iterations: int = 100,
     alpha: float = 0.5,
+    use_spatial_index: bool = False,
 ) -> float:
     """Finds the bandwidth such that on average, cells in the sample have n neighbors.
 
@@ -240,7 +313,11 @@ def find_bw_for_n_neighbors(
         max_iterations: Will stop the process and return the bandwidth that results in the closest number of neighbors
             to the specified target if it takes more than this number of iterations.
         alpha: Factor used in determining the new bandwidth- ratio of found neighbors to target neighbors will be
-            raised to this power.
+            raised to this power. Not used if the spatial index is used.
+        use_spatial_index: If True and distances are Euclidean and not normalized, neighbors within each candidate
+            bandwidth are counted with radius queries on a KD-tree and the bandwidth is found by binary search, which
+            requires O(n) memory instead of computing all pairwise distances. The bandwidth found this way generally
+            differs from the one found by the default search, though both yield close to `target_n_neighbors`.
 
     Returns:
         bandwidth: Bandwidth in distance units
@@ -258,6 +335,17 @@ def find_bw_for_n_neighbors(
 
     metric = "jaccard" if "jaccard" in coords_key else "euclidean"
 
+    if use_spatial_index and metric == "euclidean" and not normalize_distances:
+        return _find_bw_for_n_neighbors_spatial_index(
+            coords,
+            anchor_coords,
+            target_n_neighbors=target_n_neighbors,
+            initial_bw=initial_bw,
+            exclude_self=exclude_self,
+            verbose=verbose,
+            max_iterations=max_iterations,
+        )
+
     # If normalize_distances is True, get the indices of nonzero columns for each row in the distance matrix- only
     # used if metric is Euclidean distance:
     if normalize_distances and metric == "euclidean":
@@ -332,6 +420,72 @@ def find_bw_for_n_neighbors(
     return closest_bw
 
 
+def _find_bw_for_n_neighbors_spatial_index(
+    coords: np.ndarray,
+    anchor_coords: np.ndarray,
+    target_n_neighbors: int = 6,
+    initial_bw: Optional[float] = None,
+    exclude_self: bool = False,
+    verbose: bool = True,
+    max_iterations: int = 100,
+) -> float:
+    """Binary search for the bandwidth such that on average, anchor cells have n neighbors, counting neighbors within
+    each candidate bandwidth with radius queries on a KD-tree. See :func `find_bw_for_n_neighbors`.
+
+    Returns:
+        bandwidth: Bandwidth in distance units
+    """
+    index = build_spatial_index(coords)
+
+    def avg_neighbors(bw: float) -> float:
+        counts = count_neighbors_in_radius(index, anchor_coords, bw)
+        return np.mean(counts - 1 if exclude_self else counts)
+
+    bandwidth = 88 if initial_bw is None else initial_bw
+    if verbose:
+        print(f"Initial bandwidth: {bandwidth}")
+
+    lower_bound = 0.9 * target_n_neighbors
+    upper_bound = 1.1 * target_n_neighbors
+    closest_bw = bandwidth
+    closest_avg_neighbors = float("inf")
+    # The average number of neighbors is nondecreasing in the bandwidth, so the search interval is first expanded
+    # until it contains the target, then bisected.
+    low, high = 0.0, None
+
+    for iteration in range(1, max_iterations + 1):
+        avg = avg_neighbors(bandwidth)
+        if verbose:
+            print(f"For bandwidth {bandwidth}, found {avg} neighbors on average.")
+
+        if abs(target_n_neighbors - closest_avg_neighbors) > abs(target_n_neighbors - avg):
+            closest_bw = bandwidth
+            closest_avg_neighbors = avg
+
+        if lower_bound <= avg <= upper_bound:
+            if verbose:
+                print(f"Final bandwidth: {bandwidth}")
+            return bandwidth
+
+        if avg < lower_bound:
+            low = bandwidth
+            bandwidth = bandwidth * 2 if high is None else (low + high) / 2
+        else:
+            high = bandwidth
+            bandwidth = (low + high) / 2
+
+        if verbose:
+            print(f"Iteration {iteration}, new bandwidth: {bandwidth}")
+
+    if verbose:
+        print(
+            f"Max iterations reached. Returning closest bandwidth: {closest_bw}, with average neighbors: "
+            f"{closest_avg_neighbors}"
+        )
+
+    return closest_bw
+
+
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE)
 def find_threshold_distance(
     adata: anndata.AnnData,
@@ -339,6 +493,7 @@ def find_threshold_distance(
     n_neighbors: int = 10,
     chunk_size: int = 1000,
     normalize_distances: bool = False,
+    use_spatial_index: bool = False,
 ) -> float:
     """Finds threshold distance beyond which there is a dramatic increase in the average distance to remaining
     nearest neighbors.
@@ -351,12 +506,20 @@ def find_threshold_distance(
         chunk_size: Number of cells to compute pairwise distance for at once
         normalize_distances: Whether to normalize the distances by the number of nonzero columns (should be used only
             if the entry in .obs[coords_key] contains something other than x-, y-, z-coordinates).
+        use_spatial_index: If True and distances are not normalized, the nearest neighbors are found with a KD-tree
+            instead of computing all pairwise distances, which gives the same threshold up to floating point error.
 
     Returns:
         bandwidth: Bandwidth in distance units
     """
     coords = adata.obsm[coords_key]
 
+    if use_spatial_index and not normalize_distances:
+        k_nearest_distances, _ = query_knn(build_spatial_index(coords), coords, n_neighbors)
+        mean_k_distances = np.mean(k_nearest_distances, axis=1)
+        std_k_distances = np.std(k_nearest_distances, axis=1)
+        return np.max(mean_k_distances + 3 * std_k_distances)
+
     # If normalize_distances is True, get the indices of nonzero columns for each row in the distance matrix:
     if normalize_distances:
         n_nonzeros = {}
@@ -510,25 +673,40 @@ class Kernel(object):
             self.kernel = scipy.sparse.csr_matrix(self.kernel)
 
     def _kernel_functions(self, x):
-        if self.function == "triangular":
-            return 1 - x
-        elif self.function == "uniform":
-            return np.ones(x.shape) * 0.5
-        elif self.function == "quadratic":
-            return (3.0 / 4) * (1 - x**2)
-        # elif self.function == "bisquare":
-        #     return (15.0 / 16) * (1 - x**2) ** 2
-        elif self.function == "bisquare":
-            return (1 - (x) ** 2) ** 2
-        elif self.function == "gaussian":
-            return np.exp(-0.5 * (x) ** 2)
-        elif self.function == "exponential":
-            return np.exp(-x)
-        else:
-            raise ValueError(
-                f'Unsupported kernel function. Valid options: "triangular", "uniform", "quadratic", '
-                f'"bisquare", "gaussian" or "exponential". Got {self.function}.'
-            )
+        return kernel_function(x, self.function)
+
+
+def kernel_function(x: np.ndarray, function: str) -> np.ndarray:
+    """Evaluate a kernel function on distances scaled by the bandwidth. See :class `Kernel` for the definition of
+    each kernel.
+
+    Args:
+        x: Array of distances divided by the bandwidth
+        function: The name of the kernel function. Valid options: "triangular", "uniform", "quadratic",
+            "bisquare", "gaussian" or "exponential"
+
+    Returns:
+        Array of the same shape as `x` containing the kernel values
+    """
+    if function == "triangular":
+        return 1 - x
+    elif function == "uniform":
+        return np.ones(x.shape) * 0.5
+    elif function == "quadratic":
+        return (3.0 / 4) * (1 - x**2)
+    # elif function == "bisquare":
+    #     return (15.0 / 16) * (1 - x**2) ** 2
+    elif function == "bisquare":
+        return (1 - (x) ** 2) ** 2
+    elif function == "gaussian":
+        return np.exp(-0.5 * (x) ** 2)
+    elif function == "exponential":
+        return np.exp(-x)
+    else:
+        raise ValueError(
+            f'Unsupported kernel function. Valid options: "triangular", "uniform", "quadratic", '
+            f'"bisquare", "gaussian" or "exponential". Got {function}.'
+        )
 
 
 def get_wi(
@@ -602,6 +780,189 @@ def get_wi(
     return wi
 
 
+class SpatialNeighbors(object):
+    """Neighbor lists of a set of samples, sorted by distance and truncated at a maximum bandwidth. Spatial weights
+    for any bandwidth up to the maximum can be computed from the neighbor lists for all samples at once, without
+    querying the spatial index again, which allows the neighbor search to be shared between all bandwidths visited
+    during bandwidth optimization. The weights are identical to those computed by :class `Kernel` for each sample.
+
+    Args:
+        coords: Array of shape (n_samples, n_features) containing the coordinates of all samples
+        max_bw: Largest bandwidth for which weights will be computed. If `fixed` is True, this is a distance,
+            otherwise the number of nearest neighbors.
+        fixed: If True, bandwidths are treated as fixed distances. Otherwise, they are treated as the number of
+            nearest neighbors to include in the bandwidth estimation.
+        exclude_self: If True, each sample is not counted as one of its own nearest neighbors when computing
+            adaptive bandwidths, and is given zero weight.
+        rows: Optional indices of the samples for which to find neighbors. If not given, will find neighbors for all
+            samples.
+        eps: Error-correcting factor by which adaptive bandwidths are multiplied
+    """
+
+    def __init__(
+        self,
+        coords: np.ndarray,
+        max_bw: Union[float, int],
+        fixed: bool = True,
+        exclude_self: bool = False,
+        rows: Optional[np.ndarray] = None,
+        eps: float = 1.0000001,
+    ):
+        coords = np.asarray(coords, dtype=float)
+        self.n_samples = coords.shape[0]
+        self.rows = np.arange(self.n_samples) if rows is None else np.asarray(rows)
+        self.fixed = fixed
+        self.exclude_self = exclude_self
+        self.eps = eps
+        self.max_bw = max_bw
+
+        index = cKDTree(coords)
+        query = coords[self.rows]
+        if fixed:
+            pairs = cKDTree(query).sparse_distance_matrix(index, float(max_bw), output_type="ndarray")
+            row, col, dist = pairs["i"], pairs["j"], pairs["v"]
+        else:
+            row, col, dist = self._adaptive_neighbors(index, query, self._rank(max_bw))
+
+        order = np.lexsort((dist, row))
+        self.indices = col[order]
+        self.distances = dist[order]
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=len(self.rows)))))
+
+    def _rank(self, bw: Union[float, int]) -> int:
+        """Position of the neighbor that defines an adaptive bandwidth in each sorted neighbor list."""
+        rank = int(bw) + 1 if self.exclude_self else int(bw)
+        return min(rank, self.n_samples - 1)
+
+    def _adaptive_neighbors(
+        self, index: cKDTree, query: np.ndarray, rank: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find all neighbors within the adaptive bandwidth of each query point. The number of nearest neighbors
+        retrieved is doubled for the query points that have ties at the bandwidth, so that all tied neighbors are
+        included, as they are by :class `Kernel`."""
+        rows, cols, dists = [], [], []
+        todo = np.arange(query.shape[0])
+        n_neighbors = min(rank + 2, self.n_samples)
+        while todo.size > 0:
+            distances, indices = index.query(query[todo], k=n_neighbors, workers=-1)
+            distances, indices = distances.reshape(todo.size, -1), indices.reshape(todo.size, -1)
+            bandwidth = distances[:, rank] * self.eps
+            if n_neighbors < self.n_samples:
+                done = distances[:, -1] > bandwidth
+            else:
+                done = np.ones(todo.size, dtype=bool)
+            keep = (distances <= bandwidth[:, None]) & done[:, None]
+            rows.append(np.repeat(todo, keep.sum(axis=1)))
+            cols.append(indices[keep])
+            dists.append(distances[keep])
+            todo = todo[~done]
+            n_neighbors = min(2 * n_neighbors, self.n_samples)
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+    def covers(self, bw: Union[float, int]) -> bool:
+        """Check whether the neighbor lists contain all neighbors needed to compute weights for a bandwidth.
+
+        Args:
+            bw: Bandwidth for the spatial kernel
+
+        Returns:
+            True if weights for `bw` can be computed from these neighbor lists
+        """
+        if self.fixed:
+            return bw <= self.max_bw
+        return self._rank(bw) <= self._rank(self.max_bw)
+
+    def weights(
+        self,
+        bw: Union[float, int],
+        kernel: str = "gaussian",
+        threshold: float = 1e-5,
+        normalize_weights: bool = False,
+    ) -> scipy.sparse.csr_matrix:
+        """Compute the spatial weights of all samples for a given bandwidth.
+
+        Args:
+            bw: Bandwidth for the spatial kernel. Must not be larger than the maximum bandwidth of the neighbor lists.
+            kernel: The name of the kernel function to use. Valid options: "triangular", "uniform", "quadratic",
+                "bisquare", "gaussian" or "exponential"
+            threshold: Threshold for the kernel density estimation. If the density is below this threshold, the
+                density will be set to zero.
+            normalize_weights: If True, the weights of each sample will be normalized to sum to 1.
+
+        Returns:
+            w: Sparse array of shape (n_rows, n_samples), where row i contains the weights for the i-th sample of
+                :attr `rows`
+        """
+        if not self.covers(bw):
+            raise ValueError(f"Bandwidth {bw} exceeds the maximum bandwidth of the neighbor lists ({self.max_bw}).")
+
+        n_rows = len(self.rows)
+        row = np.repeat(np.arange(n_rows), np.diff(self.indptr))
+        if self.fixed:
+            bandwidth = float(bw)
+        else:
+            bandwidth = (self.distances[self.indptr[:-1] + self._rank(bw)] * self.eps)[row]
+
+        bw_dist = self.distances / bandwidth
+        # Bisquare and uniform need to be truncated if the sample is outside of the provided bandwidth:
+        keep = bw_dist <= 1
+        # Exclude self as a neighbor:
+        if self.exclude_self:
+            keep &= bw_dist != 0.0
+        row, col = row[keep], self.indices[keep]
+        w = kernel_function(bw_dist[keep], kernel.lower())
+
+        # Set density to zero if below threshold:
+        keep = w >= threshold
+        row, col, w = row[keep], col[keep], w[keep]
+
+        # Normalize the kernel by the number of non-zero neighbors, if applicable:
+        if normalize_weights:
+            w = w / np.bincount(row, minlength=n_rows)[row]
+
+        return scipy.sparse.csr_matrix((w, (row, col)), shape=(n_rows, self.n_samples))
+
+
+def compute_spatial_weights(
+    coords: np.ndarray,
+    bw: Union[float, int],
+    rows: Optional[np.ndarray] = None,
+    fixed_bw: bool = True,
+    exclude_self: bool = False,
+    kernel: str = "gaussian",
+    threshold: float = 1e-5,
+    normalize_weights: bool = False,
+) -> scipy.sparse.csr_matrix:
+    """Get spatial weights for many samples at once. Equivalent to stacking the sparse outputs of :func `get_wi`
+    for each sample, but uses a spatial index instead of computing the distances between all pairs of samples.
+
+    Args:
+        coords: Array of shape (n_samples, 2) or (n_samples, 3) representing the spatial coordinates of each sample
+        bw: Bandwidth for the spatial kernel
+        rows: Optional indices of the samples for which weights are to be calculated. If not given, will compute
+            weights for all samples.
+        fixed_bw: If True, `bw` is treated as a spatial distance for computing spatial weights. Otherwise,
+            it is treated as the number of neighbors.
+        exclude_self: If True, ignore each sample itself when computing the kernel density estimation
+        kernel: The name of the kernel function to use. Valid options: "triangular", "uniform", "quadratic",
+            "bisquare", "gaussian" or "exponential"
+        threshold: Threshold for the kernel density estimation. If the density is below this threshold, the density
+            will be set to zero.
+        normalize_weights: If True, the weights will be normalized to sum to 1.
+
+    Returns:
+        w: Sparse array of shape (n_rows, n_samples) containing the weights for each sample of interest
+    """
+    n_samples = coords.shape[0]
+    n_rows = n_samples if rows is None else len(rows)
+    if bw == np.inf:
+        return scipy.sparse.csr_matrix(np.ones((n_rows, n_samples)))
+
+    return SpatialNeighbors(coords, bw, fixed=fixed_bw, exclude_self=exclude_self, rows=rows).weights(
+        bw, kernel=kernel, threshold=threshold, normalize_weights=normalize_weights
+    )
+
+
 # ---------------------------------------------------------------------------------------------------
 # Construct nearest neighbor graphs
 # ---------------------------------------------------------------------------------------------------
@@ -614,6 +975,7 @@ def construct_nn_graph(
     exclude_self: bool = True,
     make_symmetrical: bool = False,
     save_id: Union[None, str] = None,
+    sparse: bool = False,
 ) -> None:
     """Constructing bucket-to-bucket nearest neighbors graph.
 
@@ -629,9 +991,33 @@ def construct_nn_graph(
         make_symmetrical: Set True to make sure adjacency matrix is symmetrical (i.e. ensure that if A is a neighbor
             of B, B is also included among the neighbors of A)
         save_id: Optional string; if not None, will save distance matrix and neighbors matrix to path:
-        './neighbors/{save_id}_distance.csv' and path: './neighbors/{save_id}_neighbors.csv', respectively.
+        './neighbors/{save_id}_distance.csv' and path: './neighbors/{save_id}_neighbors.csv', respectively. If
+        `sparse` is True, these are instead saved with :func `scipy.sparse.save_npz` to
+        './neighbors/{save_id}_distance.npz' and './neighbors/{save_id}_neighbors.npz'.
+        sparse: Set True to find neighbors with a KD-tree (or ball tree, for non-Minkowski metrics) instead of
+            computing all pairwise distances. The distance matrix stored in .obsp then only contains the distances
+            to each bucket's nearest neighbors, as a sparse matrix, so that memory usage is O(n_buckets *
+            n_neighbors) instead of O(n_buckets^2).
     """
     position = adata.obsm[spatial_key]
+    if sparse:
+        distance_matrix, adj = sparse_nn_graph(
+            position,
+            n_neighbors=n_neighbors,
+            metric=dist_metric,
+            exclude_self=exclude_self,
+            make_symmetrical=make_symmetrical,
+        )
+        adata.obsp["distance_matrix"] = distance_matrix
+        adata.obsp["adj"] = adj
+
+        if save_id is not None:
+            if not os.path.exists(os.path.join(os.getcwd(), "neighbors")):
+                os.makedirs(os.path.join(os.getcwd(), "neighbors"))
+            scipy.sparse.save_npz(os.path.join(os.getcwd(), f"neighbors/{save_id}_distance.npz"), distance_matrix)
+            scipy.sparse.save_npz(os.path.join(os.getcwd(), f"neighbors/{save_id}_neighbors.npz"), adj)
+        return
+
     # calculate distance matrix
     distance_matrix = calculate_distance(position, dist_metric)
     n_bucket = distance_matrix.shape[0]
@@ -668,6 +1054,55 @@ def construct_nn_graph(
     adata.obsp["adj"] = scipy.sparse.csr_matrix(adj)
 
 
+def sparse_nn_graph(
+    coords: np.ndarray,
+    n_neighbors: int = 8,
+    metric: str = "euclidean",
+    exclude_self: bool = True,
+    make_symmetrical: bool = False,
+) -> Tuple[scipy.sparse.csr_matrix, scipy.sparse.csr_matrix]:
+    """Construct a nearest neighbors graph with a spatial index, without computing all pairwise distances. Each
+    sample's nearest point (assumed to be the sample itself) is skipped, as in :func `construct_nn_graph`.
+
+    Args:
+        coords: Array of shape (n_samples, n_features) containing the coordinates of all points.
+        n_neighbors: Number of nearest neighbors to find for each sample.
+        metric: Distance metric. See :func `build_spatial_index`.
+        exclude_self: Set True to set elements along the diagonal to zero.
+        make_symmetrical: Set True to make sure the adjacency matrix is symmetrical (i.e. ensure that if A is a
+            neighbor of B, B is also included among the neighbors of A)
+
+    Returns:
+        distances: Sparse matrix of shape (n_samples, n_samples) containing the distance from each sample to its
+            nearest neighbors (and from each neighbor back to the sample, if `make_symmetrical` is True).
+        adj: Sparse binary adjacency matrix of shape (n_samples, n_samples)
+    """
+    n_samples = coords.shape[0]
+    n_neighbors = min(n_neighbors, n_samples - 1)
+    knn_distances, knn_indices = query_knn(build_spatial_index(coords, metric), coords, n_neighbors + 1, metric)
+    knn_distances, knn_indices = knn_distances[:, 1:], knn_indices[:, 1:]
+
+    rows = np.repeat(np.arange(n_samples), n_neighbors)
+    adj = scipy.sparse.csr_matrix(
+        (np.ones(rows.size), (rows, knn_indices.ravel())),
+        shape=(n_samples, n_samples),
+    )
+    distances = scipy.sparse.csr_matrix(
+        (knn_distances.ravel(), (rows, knn_indices.ravel())),
+        shape=(n_samples, n_samples),
+    )
+
+    if make_symmetrical:
+        adj = adj.maximum(adj.T).tocsr()
+        distances = distances.maximum(distances.T).tocsr()
+
+    if exclude_self:
+        adj.setdiag(0)
+        adj.eliminate_zeros()
+
+    return distances, adj
+
+
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE, "adata")
 def neighbors(
     adata: AnnData,
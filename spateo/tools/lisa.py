@@ -13,8 +13,10 @@ with warnings.catch_warnings():
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix
 
 from ..configuration import SKM
+from .moran import gene_blocks, local_moran, spatial_weights
 
 
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE)
@@ -107,6 +109,8 @@ def local_moran_i(
         layer: the key to the layer. If it is None, adata.X will be used by default.
         n_neighbors: The number of nearest neighbors of each bucket that will be used in calculating the spatial lag.
         copy: Whether to copy the adata object.
+        n_jobs: Not used anymore, as the local Moran's I of all genes is now calculated with shared conditional
+            permutations and matrix products. Kept for backwards compatibility.
 
     Returns:
         Depend on the `copy` argument, return a deep copied adata object (when `copy = True`) or inplace updated adata
@@ -133,188 +137,54 @@ def local_moran_i(
     >>>         dyn.pl.space(adata, color=group, highlights=[i], pointsize=0.1, alpha=1, figsize=(12, 8))
     >>>         st.pl.space(adata, color=markers_df[i].index, pointsize=0.1, alpha=1, figsize=(12, 8))
     """
-    from pysal import explore
-    from pysal.lib import weights
-
     group_num = adata.obs[group].value_counts()
     group_name = adata.obs[group]
-    uniq_g, group_name = group_name.unique(), group_name.to_list()
-
-    # Generate W from the GeoDataFrame
-    w = weights.distance.KNN.from_array(adata.obsm[spatial_key], k=n_neighbors)
+    uniq_g = group_name.unique()
+    codes = pd.Categorical(group_name, categories=uniq_g).codes
+    group_indicator = csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(len(uniq_g), len(codes)))
 
-    # Row-standardization
-    w.transform = "R"
+    # Generate the row-standardized k nearest neighbors weights
+    w = spatial_weights(adata.obsm[spatial_key], k=n_neighbors)
 
     if genes is None:
         genes = adata.var.index[adata.var.use_for_pca]
     else:
         genes = adata.var.index.intersection(genes)
 
-    db = pd.DataFrame(adata.obsm[spatial_key], columns=["x", "y"])
-
     suffix = ["_num", "_frac", "_spec"]
 
-    # hotspot: HH; coldspot: LL; doughnut: HL, diamond: LH; the first one is the query point
+    # hotspot: HH; coldspot: LL; doughnut: LH, diamond: HL; the first one is the query point
     # while the second the neighbors. Order on the quantile plot is 1, 3, 2, 4
-    def _assign_columns(type):
-        cat_group_list = [type + i + "_group" for i in suffix]
-        cat_val_list = [type + i + "_val" for i in suffix]
-        adata.var[cat_group_list[0]], adata.var[cat_group_list[1]], adata.var[cat_group_list[2]] = None, None, None
-        adata.var[cat_val_list[0]], adata.var[cat_val_list[1]], adata.var[cat_val_list[2]] = None, None, None
-
-    for i in ["hotspot", "coldspot", "doughnut", "diamond"]:
-        _assign_columns(i)
-
-    the_tuple = (
-        np.zeros(len(uniq_g)),
-        np.zeros(len(uniq_g)),
-        np.zeros(len(uniq_g)),
-    )
-    hotspot_num, hotspot_frac, hotspot_spec = the_tuple
-    coldspot_num, coldspot_frac, coldspot_spec = the_tuple
-    doughnut_num, doughnut_frac, doughnut_spec = the_tuple
-    diamond_num, diamond_frac, diamond_spec = the_tuple
-
-    valid_inds_list = [np.array(group_name) == g for g in uniq_g]
-
-    ###
-    def _single(
-        cur_g,
-        db,
-        w,
-        adata,
-        uniq_g,
-        valid_inds_list,
-        hotspot_num,
-        hotspot_frac,
-        hotspot_spec,
-        coldspot_num,
-        coldspot_frac,
-        coldspot_spec,
-        doughnut_num,
-        doughnut_frac,
-        doughnut_spec,
-        diamond_num,
-        diamond_frac,
-        diamond_spec,
-    ):
-        if layer is None:
-            db["exp"] = adata[:, cur_g].X.A.flatten()
-        else:
-            db["exp"] = np.log1p(adata[:, cur_g].layers[layer].A.flatten())
-
-        db["w_exp"] = weights.spatial_lag.lag_spatial(w, db["exp"])
-
-        db["exp"] = db["exp"].astype(np.float64)
-        lisa = explore.esda.moran.Moran_Local(db["exp"], w, permutations=199)
-
-        # find significant cells
-        sig = 1 * (lisa.p_sim < 0.05)
-
-        # get quantiles (z-score of cells within the neighborhood and that of the smoothed expression)
-        hotspot = 1 * (sig * lisa.q == 1)
-        coldspot = 3 * (sig * lisa.q == 3)
-        doughnut = 2 * (sig * lisa.q == 2)
-        diamond = 4 * (sig * lisa.q == 4)
-
-        # calculate the value
-        def _get_nums(spots, valid_inds, g):
-            return (
-                sum(spots[valid_inds] > 0),  # number of {*} (like hotspot, colospot, etc.) in this cell group
-                sum(spots[valid_inds] > 0) / group_num[g],  # fraction of {*} in this cell group
-                sum(spots[valid_inds] > 0) / sum(spots > 0),  # specificity of {*} in this cell group
-            )
-
-        # calculate the maximum val across all cell groups
-        def _get_group_max(num, frac, spec):
-            return (np.max(num), np.max(frac), np.max(spec))
-
-        # get the group name with the maximum
-        def _get_max_group_name(num, frac, spec):
-            return (
-                uniq_g[np.argsort(num)[-1]],
-                uniq_g[np.argsort(frac)[-1]],
-                uniq_g[np.argsort(spec)[-1]],
-            )
-
-        for ind, g in enumerate(uniq_g):
-            valid_inds = valid_inds_list[ind]
-            hotspot_num[ind], hotspot_frac[ind], hotspot_spec[ind] = _get_nums(hotspot, valid_inds, g)
-            coldspot_num[ind], coldspot_frac[ind], coldspot_spec[ind] = _get_nums(coldspot, valid_inds, g)
-            doughnut_num[ind], doughnut_frac[ind], doughnut_spec[ind] = _get_nums(doughnut, valid_inds, g)
-            diamond_num[ind], diamond_frac[ind], diamond_spec[ind] = _get_nums(diamond, valid_inds, g)
-
-        (
-            adata.var.loc[cur_g, "hotspot_num_val"],
-            adata.var.loc[cur_g, "hotspot_frac_val"],
-            adata.var.loc[cur_g, "hotspot_spec_val"],
-        ) = _get_group_max(hotspot_num, hotspot_frac, hotspot_spec)
-        (
-            adata.var.loc[cur_g, "coldspot_num_val"],
-            adata.var.loc[cur_g, "coldspot_frac_val"],
-            adata.var.loc[cur_g, "coldspot_spec_val"],
-        ) = _get_group_max(coldspot_num, coldspot_frac, coldspot_spec)
-        (
-            adata.var.loc[cur_g, "doughnut_num_val"],
-            adata.var.loc[cur_g, "doughnut_frac_val"],
-            adata.var.loc[cur_g, "doughnut_spec_val"],
-        ) = _get_group_max(doughnut_num, doughnut_frac, doughnut_spec)
-        (
-            adata.var.loc[cur_g, "diamond_num_val"],
-            adata.var.loc[cur_g, "diamond_frac_val"],
-            adata.var.loc[cur_g, "diamond_spec_val"],
-        ) = _get_group_max(diamond_num, diamond_frac, diamond_spec)
-
-        (
-            adata.var.loc[cur_g, "hotspot_num_group"],
-            adata.var.loc[cur_g, "hotspot_frac_group"],
-            adata.var.loc[cur_g, "hotspot_spec_group"],
-        ) = _get_max_group_name(hotspot_num, hotspot_frac, hotspot_spec)
-        (
-            adata.var.loc[cur_g, "coldspot_num_group"],
-            adata.var.loc[cur_g, "coldspot_frac_group"],
-            adata.var.loc[cur_g, "coldspot_spec_group"],
-        ) = _get_max_group_name(coldspot_num, coldspot_frac, coldspot_spec)
-        (
-            adata.var.loc[cur_g, "doughnut_num_group"],
-            adata.var.loc[cur_g, "doughnut_frac_group"],
-            adata.var.loc[cur_g, "doughnut_spec_group"],
-        ) = _get_max_group_name(doughnut_num, doughnut_frac, doughnut_spec)
-        (
-            adata.var.loc[cur_g, "diamond_num_group"],
-            adata.var.loc[cur_g, "diamond_frac_group"],
-            adata.var.loc[cur_g, "diamond_spec_group"],
-        ) = _get_max_group_name(diamond_num, diamond_frac, diamond_spec)
-        return adata.var.loc[cur_g, :].values
-
-    # parallel computing
-    res = Parallel(n_jobs)(
-        delayed(_single)(
-            cur_g,
-            db,
-            w,
-            adata,
-            uniq_g,
-            valid_inds_list,
-            hotspot_num,
-            hotspot_frac,
-            hotspot_spec,
-            coldspot_num,
-            coldspot_frac,
-            coldspot_spec,
-            doughnut_num,
-            doughnut_frac,
-            doughnut_spec,
-            diamond_num,
-            diamond_frac,
-            diamond_spec,
-        )
-        for cur_g in genes
-    )
-    res = pd.DataFrame(res, index=genes)
-    res = res.drop(columns=0)
-    res.columns = adata.var.loc[genes, :].columns.drop("mt")
+    spot_types = {"hotspot": 1, "doughnut": 2, "coldspot": 3, "diamond": 4}
+    for type in spot_types:
+        for i in suffix:
+            adata.var[type + i + "_group"], adata.var[type + i + "_val"] = None, None
+
+    X = adata[:, genes].X if layer is None else adata[:, genes].layers[layer]
+    # number of each type of spots in each cell group
+    spot_nums = {type: np.zeros((len(uniq_g), len(genes))) for type in spot_types}
+    for block_genes, exp in gene_blocks(X):
+        if layer is not None:
+            exp = np.log1p(exp)
+        _, q, p_sim, _ = local_moran(exp, w, permutations=199)
+
+        # find significant cells, and get their quadrant (z-score of cells within the neighborhood and that of the
+        # smoothed expression)
+        spots = (p_sim < 0.05) * q
+        for type, quadrant in spot_types.items():
+            spot_nums[type][:, block_genes] = group_indicator @ (spots == quadrant)
+
+    group_size = group_num[uniq_g].values[:, None]
+    for type, num in spot_nums.items():
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # number, fraction and specificity of {*} (like hotspot, colospot, etc.) in each cell group
+            stats = [num, num / group_size, num / num.sum(axis=0)]
+        for i, stat in zip(suffix, stats):
+            # the maximum val across all cell groups and the group name with the maximum
+            adata.var.loc[genes, type + i + "_val"] = np.max(stat, axis=0)
+            adata.var.loc[genes, type + i + "_group"] = uniq_g[np.argsort(stat, axis=0)[-1]]
+
+    res = adata.var.loc[genes, :].drop(columns="mt", errors="ignore")
     return res
 
 
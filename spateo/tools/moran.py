@@ -0,0 +1,219 @@
+"""Global and local Moran's I of many genes at once.
+
+The spatial weights are stored once as a scipy CSR matrix, and the statistics of a block of genes are calculated with
+sparse matrix products. The permutations are shared by all genes of a block, and, for the local Moran's I, the
+conditional permutations are also shared by all cells, like in the conditional randomization of ``esda``.
+"""
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags, issparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from scipy.spatial import cKDTree
+
+# Maximum number of values of a block of genes, i.e. number of cells x number of genes.
+BLOCK_VALUES = 2**24
+# Number of values of a chunk of cells x genes on which all conditional permutations are run at once.
+CHUNK_VALUES = 2**15
+
+
+def spatial_weights(
+    coords: np.ndarray,
+    k: int = 5,
+    kernel: bool = False,
+    row_standardize: bool = True,
+) -> csr_matrix:
+    """Spatial weights matrix of the cells.
+
+    Args:
+        coords: Spatial coordinates of the cells.
+        k: If ``kernel`` is False, the number of nearest neighbors of each cell, which get a weight of 1. Otherwise, the
+            bandwidth of the gaussian kernel: each cell is weighted by the kernel of its distance, divided by the
+            bandwidth, to all cells within the bandwidth, including itself.
+        kernel: Whether to use gaussian kernel weights instead of nearest neighbor weights.
+        row_standardize: Whether to scale the weights of each cell to sum to 1.
+
+    Returns:
+        The cells x cells weights matrix.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    n = coords.shape[0]
+    tree = cKDTree(coords)
+    if kernel:
+        pairs = tree.query_pairs(r=k, output_type="ndarray")
+        rows = np.r_[pairs[:, 0], pairs[:, 1], np.arange(n)]
+        cols = np.r_[pairs[:, 1], pairs[:, 0], np.arange(n)]
+        dist = np.linalg.norm(coords[rows] - coords[cols], axis=1)
+        W = csr_matrix(((2 * np.pi) ** -0.5 * np.exp(-((dist / k) ** 2) / 2), (rows, cols)), shape=(n, n))
+    else:
+        _, neighbors = tree.query(coords, k=k + 1)
+        # Drop each cell from its own neighbors, or the farthest neighbor if it is not found because of duplicates.
+        is_self = neighbors == np.arange(n)[:, None]
+        is_self[~is_self.any(axis=1), -1] = True
+        neighbors = neighbors[~is_self].reshape(n, k)
+        W = csr_matrix((np.ones(n * k), neighbors.ravel(), np.arange(0, n * k + 1, k)), shape=(n, n))
+    if row_standardize:
+        row_sums = np.asarray(W.sum(axis=1)).ravel()
+        W = diags(1 / np.where(row_sums > 0, row_sums, 1)) @ W
+    return W.tocsr()
+
+
+def gene_blocks(
+    X: Union[np.ndarray, csr_matrix], block_size: Optional[int] = None
+) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Iterate over blocks of genes (columns) of an expression matrix as dense float64 arrays.
+
+    Args:
+        X: Cells x genes expression matrix.
+        block_size: The number of genes of each block. By default, ``BLOCK_VALUES`` values per block.
+
+    Yields:
+        The slice of the genes of the block, and the block.
+    """
+    if block_size is None:
+        block_size = max(1, BLOCK_VALUES // max(X.shape[0], 1))
+    X = X.tocsc() if issparse(X) else X
+    for start in range(0, X.shape[1], block_size):
+        genes = slice(start, min(start + block_size, X.shape[1]))
+        block = X[:, genes]
+        yield genes, np.array(block.toarray() if issparse(block) else block, dtype=np.float64)
+
+
+def _pseudo_p_value(observed: np.ndarray, sims: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Folded pseudo p-value and z-score of the observed statistics against their permutations (first axis)."""
+    permutations = sims.shape[0]
+    larger = (sims >= observed).sum(axis=0)
+    larger = np.minimum(larger, permutations - larger)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_sim = (observed - sims.mean(axis=0)) / sims.std(axis=0)
+    return (larger + 1.0) / (permutations + 1.0), z_sim
+
+
+def global_moran(
+    X: Union[np.ndarray, csr_matrix],
+    W: csr_matrix,
+    permutations: int = 199,
+    block_size: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Global Moran's I of each gene, with pseudo p-values from random permutations of the cells.
+
+    Args:
+        X: Cells x genes expression matrix.
+        W: Cells x cells spatial weights matrix, see :func:`spatial_weights`.
+        permutations: Number of random permutations of the cells, shared by all genes of a block.
+        block_size: The number of genes processed at once.
+        seed: Seed of the random permutations.
+
+    Returns:
+        The Moran's I, the one-tailed pseudo p-value and the z-score against the permutations of each gene.
+    """
+    rng = np.random.default_rng(seed)
+    n = X.shape[0]
+    s0 = W.sum()
+    # Order the cells such that neighbors are close in memory, which makes the products with W cache friendly.
+    order = reverse_cuthill_mckee(W, symmetric_mode=False)
+    W, X = W[order][:, order], X[order]
+    I = np.zeros(X.shape[1])
+    p_sim = np.full(X.shape[1], np.nan)
+    z_sim = np.full(X.shape[1], np.nan)
+    for genes, Z in gene_blocks(X, block_size):
+        Z -= Z.mean(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = n / s0 / (Z * Z).sum(axis=0)
+        I[genes] = scale * np.einsum("ij,ij->j", Z, W @ Z)
+        if permutations:
+            sims = np.zeros((permutations, Z.shape[1]))
+            for i in range(permutations):
+                Zp = Z[rng.permutation(n)]
+                sims[i] = scale * np.einsum("ij,ij->j", Zp, W @ Zp)
+            p_sim[genes], z_sim[genes] = _pseudo_p_value(I[genes], sims)
+    return I, p_sim, z_sim
+
+
+def local_moran(
+    Y: np.ndarray,
+    W: csr_matrix,
+    permutations: int = 199,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Local Moran's I of each cell for a block of genes, with pseudo p-values from conditional permutations.
+
+    In each conditional permutation, the neighbors of each cell are replaced by random other cells. The random cells
+    are shared by all cells and genes, such that the spatial lags of a permutation are two dense matrix products.
+
+    Args:
+        Y: Dense cells x genes expression matrix, e.g. a block from :func:`gene_blocks`.
+        W: Cells x cells spatial weights matrix, see :func:`spatial_weights`.
+        permutations: Number of conditional permutations.
+        seed: Seed of the random permutations.
+
+    Returns:
+        The local Moran's I, the quadrant (1: HH, 2: LH, 3: LL, 4: HL, for the cell and its spatial lag), the one-tailed
+        pseudo p-value and the z-score against the permutations of each cell and gene (cells x genes).
+    """
+    rng = np.random.default_rng(seed)
+    n = Y.shape[0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Z = (Y - Y.mean(axis=0)) / Y.std(axis=0)
+        scale = (n - 1) / (Z * Z).sum(axis=0)
+    lag = W @ Z
+    Is = scale * Z * lag
+    q = np.select([(Z > 0) & (lag > 0), (Z <= 0) & (lag > 0), (Z <= 0) & (lag <= 0)], [1, 2, 3], 4)
+    p_sim = np.full(Z.shape, np.nan)
+    z_sim = np.full(Z.shape, np.nan)
+    if not permutations:
+        return Is, q, p_sim, z_sim
+
+    # Weights of the neighbors of each cell, padded to the maximal number of neighbors. Self weights stay on the cell.
+    self_weights = W.diagonal()
+    W_other = (W - diags(self_weights)).tocsr()
+    W_other.eliminate_zeros()
+    cardinalities = np.diff(W_other.indptr)
+    max_card = cardinalities.max()
+    neighbor_weights = np.zeros((n, max_card))
+    rows = np.repeat(np.arange(n), cardinalities)
+    neighbor_weights[rows, np.arange(W_other.nnz) - W_other.indptr[rows]] = W_other.data
+
+    # Random indices among the n - 1 other cells of each permutation: index ``i`` is cell ``i`` if it is below the cell,
+    # and cell ``i + 1`` otherwise, such that a cell is never its own random neighbor.
+    ids = np.stack([rng.choice(n - 1, size=max_card, replace=False) for _ in range(permutations)])
+    Z_ids = Z[np.hstack([ids, ids + 1])]
+    self_lag = self_weights[:, None] * Z if self_weights.any() else np.zeros(Z.shape)
+
+    # The permuted statistics are ``scale * Z`` times the permuted lags, so only the lags are compared and accumulated:
+    # the number of permuted lags that are at least (and at most) the observed lag, and their sum and sum of squares.
+    # All permutations are run on a chunk of cells at a time, which keeps the running statistics in cache.
+    n_above = np.zeros(Z.shape, dtype=np.int32)
+    n_below = np.zeros(Z.shape, dtype=np.int32)
+    lag_sum = np.zeros(Z.shape)
+    lag_sq = np.zeros(Z.shape)
+    chunk_size = max(1, CHUNK_VALUES // Z.shape[1])
+    for start in range(0, n, chunk_size):
+        cells = slice(start, min(start + chunk_size, n))
+        chunk_weights = neighbor_weights[cells]
+        chunk_lag, chunk_self_lag = lag[cells], self_lag[cells]
+        chunk_above, chunk_below, chunk_sum, chunk_sq = n_above[cells], n_below[cells], lag_sum[cells], lag_sq[cells]
+        permuted_weights = np.zeros((chunk_weights.shape[0], 2 * max_card))
+        for i in range(permutations):
+            is_below = ids[i] < np.arange(cells.start, cells.stop)[:, None]
+            np.multiply(chunk_weights, is_below, out=permuted_weights[:, :max_card])
+            np.multiply(chunk_weights, ~is_below, out=permuted_weights[:, max_card:])
+            permuted_lag = permuted_weights @ Z_ids[i]
+            permuted_lag += chunk_self_lag
+            chunk_above += permuted_lag >= chunk_lag
+            chunk_below += permuted_lag <= chunk_lag
+            chunk_sum += permuted_lag
+            permuted_lag *= permuted_lag
+            chunk_sq += permuted_lag
+
+    scaled = scale * Z
+    larger = np.select([scaled > 0, scaled < 0, scaled == 0], [n_above, n_below, permutations], 0)
+    larger = np.minimum(larger, permutations - larger)
+    p_sim = (larger + 1.0) / (permutations + 1.0)
+    lag_mean = lag_sum / permutations
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_sim = (Is - scaled * lag_mean) / (
+            np.abs(scaled) * np.sqrt(np.maximum(lag_sq / permutations - lag_mean**2, 0))
+        )
+    return Is, q, p_sim, z_sim
@@ -5,8 +5,6 @@ from typing import List, Optional
 import numpy as np
 import pandas as pd
 from anndata import AnnData
-from joblib import Parallel, delayed
-from scipy.sparse import issparse
 from statsmodels.sandbox.stats.multicomp import multipletests
 
 from ..logging import logger_manager as lm
@@ -17,6 +15,7 @@ except ImportError:
     from typing_extensions import Literal
 
 from ..configuration import SKM
+from .moran import global_moran, spatial_weights
 
 
 @SKM.check_adata_is_type(SKM.ADATA_UMI_TYPE)
@@ -59,17 +58,16 @@ def moran_i(
             Number of neighbors to use by default for kneighbors queries.
         weighted : 'str'(defult='kernel')
             Spatial weights, defult is None, 'kernel' is based on kernel functions.
-        permutations: `int` (default=999)
-            Number of random permutations for calculation of pseudo-p_values.
-        n_cores: `int` (default=30)
-            The maximum number of concurrently running jobs, If -1 all CPUs are used.
-            If 1 is given, no parallel computing code is used at all.
+        permutations: `int` (default=199)
+            Number of random permutations for calculation of pseudo-p_values. The permutations are shared by blocks
+            of genes.
+        n_jobs: `int` (default=1)
+            Not used anymore, as all genes are now tested at once with sparse matrix products. Kept for backwards
+            compatibility.
     Returns
     -------
         A pandas DataFrame of the Moran' I test results.
     """
-    from pysal import explore, lib
-
     if layer is None:
         X_data = adata.X
     else:
@@ -77,47 +75,26 @@ def moran_i(
     if genes is None:
         genes = adata.var_names
     else:
-        genes = genes
+        genes = pd.Index(genes)
+        missing = genes[~genes.isin(adata.var_names)]
+        if len(missing) > 0:
+            raise ValueError(f"Genes {list(missing)} are not in `adata.var_names`.")
+        X_data = X_data[:, adata.var_names.get_indexer(genes)]
     if x is None:
-        x = adata.obsm[spatial_key][:, 0].tolist()
-    else:
-        x = x
+        x = adata.obsm[spatial_key][:, 0]
     if y is None:
-        y = adata.obsm[spatial_key][:, 1].tolist()
-    else:
-        y = y
+        y = adata.obsm[spatial_key][:, 1]
     if model == "3d":
         if z is None:
-            z = adata.obsm[spatial_key][:, 2].tolist()
-        else:
-            z = z
-        xymap = pd.DataFrame({"x": x, "y": y, "z": z})
+            z = adata.obsm[spatial_key][:, 2]
+        coords = np.column_stack([x, y, z])
     else:
-        xymap = pd.DataFrame({"x": x, "y": y})
-    if weighted is not None:
-        # weighted matrix (kernel distance)
-        kw = lib.weights.Kernel(xymap, k, function="gaussian")
-        W = lib.weights.W(kw.neighbors, kw.weights)
-    else:
-        # weighted matrix (in:1,out:0)
-        kd = lib.cg.KDTree(np.array(xymap))
-        nw = lib.weights.KNN(kd, k)
-        W = lib.weights.W(nw.neighbors, nw.weights)
-
-    # computing the moran_i for a single gene, and then used the joblib.Parallel to compute all genes in adata object.
-    def _single(gene, X_data, W, adata, permutations):
-        cur_X = X_data[:, adata.var.index == gene].A if issparse(X_data) else X_data[:, adata.var.index == gene]
-        mbi = explore.esda.moran.Moran(cur_X, W, permutations=permutations, two_tailed=False)
-        Moran_I = mbi.I
-        p_value = mbi.p_sim
-        statistics = mbi.z_sim
-        return [gene, Moran_I, p_value, statistics]
+        coords = np.column_stack([x, y])
 
-    # parallel computing
-    res = Parallel(n_jobs)(delayed(_single)(gene, X_data, W, adata, permutations) for gene in adata.var_names)
-    res = pd.DataFrame(res, index=adata.var_names)
-    res = res.drop(columns=0)
-    res.columns = ["moran_i", "moran_p_val", "moran_z"]
+    # weighted matrix: kernel distance if `weighted`, otherwise k nearest neighbors (in:1,out:0), row-standardized
+    W = spatial_weights(coords, k=k, kernel=weighted is not None)
+    moran_I, p_value, statistics = global_moran(X_data, W, permutations=permutations)
+    res = pd.DataFrame({"moran_i": moran_I, "moran_p_val": p_value, "moran_z": statistics}, index=genes)
     res["moran_q_val"] = multipletests(res["moran_p_val"], method="fdr_bh")[1]
     return res
 
@@ -1,10 +1,6 @@
-import functools
-import gc
-from multiprocessing import Pool, cpu_count
 from typing import Optional, Tuple, Union
 
 import numpy as np
-import psutil
 import scipy
 
 from ..logging import logger_manager as lm
@@ -28,6 +24,9 @@ def smooth(
 ) -> Tuple[scipy.sparse.csr_matrix, Optional[Union[np.ndarray, scipy.sparse.csr_matrix]], Optional[np.ndarray]]:
     """Leverages neighborhood information to smooth gene expression.
 
+    The weights matrix is processed in sparse format: the cell type and gene expression masks are only evaluated on
+    its stored neighbor pairs, such that no n x n array is allocated.
+
     Args:
         X: Gene expression array or sparse matrix (shape n x m, where n is the number of cells and m is the number of
             genes)
@@ -37,18 +36,18 @@ def smooth(
         gene_expr_subset: Optional, array corresponding to the expression of select genes (shape n x k,
             where k is the number of genes in the subset). If given, will smooth only over cells that largely match
             the expression patterns over these genes (assessed using a Jaccard index threshold that is greater than
-            the median score).
+            the median score over the pairs of neighbors).
         min_jaccard: Optional, and only used if 'gene_expr_subset' is also given. Minimum Jaccard similarity score to
             be considered "nonzero".
         manual_mask: Optional, binary array of shape n x n. For each cell (row), manually indicate which neighbors (
             if any) to use for smoothing.
         normalize_W: Set True to scale the rows of the weights matrix to sum to 1. Use this to smooth by taking an
             average over the entire neighborhood, including zeros. Set False to take the average over only the
-            nonzero elements in the neighborhood.
-        return_discrete: Set True to return
+            nonzero elements in the neighborhood, for the cells that do not express the gene.
+        return_discrete: Set True to round the smoothed values to integers
         smoothing_threshold: Optional, sets the threshold for smoothing in terms of the number of neighboring cells
             that must express each gene for a cell to be smoothed for that gene. The more gene-expressing neighbors,
-            the more confidence in the biological signal.
+            the more confidence in the biological signal. Only used if 'normalize_W' is False.
         n_subsample: Optional, sets the number of random neighbor samples to use in the smoothing. If not given,
             will use all neighbors (nonzero weights) for each cell.
         return_W: Set True to return the weights matrix post-processing
@@ -59,24 +58,17 @@ def smooth(
         d: Only if normalize_W is True, returns the row sums of the weights matrix
     """
     logger = lm.get_main_logger()
-    logger.info(
-        "Warning- this can be quite memory intensive when 'gene_expr_subset' is provided, depending on the "
-        "size of the AnnData object. If this is the case it is recommended only to use cell types."
-    )
 
-    if scipy.sparse.isspmatrix_csr(X):
-        logger.info(f"Initial sparsity of array: {X.count_nonzero()}")
-    else:
-        logger.info(f"Initial sparsity of array: {np.count_nonzero(X)}")
+    is_sparse_X, is_sparse_W = scipy.sparse.issparse(X), scipy.sparse.issparse(W)
+    X = scipy.sparse.csr_matrix(X, dtype=np.float64)
+    X.eliminate_zeros()
+    W = scipy.sparse.csr_matrix(W, dtype=np.float64)
+    W.eliminate_zeros()
+    logger.info(f"Initial sparsity of array: {X.nnz}")
 
     # Subsample weights array if applicable:
     if n_subsample is not None:
-        # Threshold for smoothing (check that a sufficient number of neighbors express a given gene for increased
-        # confidence of biological signal- must be greater than or equal to this threshold for smoothing):
-        if scipy.sparse.isspmatrix_csr(W):
-            W = subsample_neighbors_sparse(W, n_subsample)
-        else:
-            W = subsample_neighbors_dense(W, n_subsample)
+        W = subsample_neighbors_sparse(W, n_subsample)
 
     if smoothing_threshold is not None:
         threshold = smoothing_threshold
@@ -91,26 +83,20 @@ def smooth(
             "Manual mask provided. Will use this to smooth, ignoring inputs to 'ct' and 'gene_expr_subset' if "
             "provided."
         )
-        W = W.multiply(manual_mask)
+        W = scipy.sparse.csr_matrix(W.multiply(manual_mask))
     else:
+        # Neighbor pairs (stored entries) of the weights matrix, on which the masks are evaluated:
+        rows = np.repeat(np.arange(W.shape[0]), np.diff(W.indptr))
+        cols = W.indices
+
         # Incorporate cell type information
         if ct is not None:
-            if not isinstance(ct, np.ndarray):
-                ct = np.array(ct)
-            if ct.ndim != 1:
-                ct = ct.flatten()
-
+            ct = np.asarray(ct).flatten()
             logger.info(
                 "Conditioning smoothing on cell type- only information from cells of the same type will be used."
             )
-            rows, cols = np.where(ct[:, None] == ct)
-            sparse_ct_matrix = scipy.sparse.coo_matrix((np.ones_like(rows), (rows, cols)), shape=(len(ct), len(ct)))
-            ct_masks = sparse_ct_matrix.tocsr()
             logger.info("Modifying spatial weights considering cell type...")
-            W = W.multiply(ct_masks)
-
-            # ct_masks can be quite large- delete to free up memory once it's no longer necessary
-            del ct_masks
+            W.data *= ct[rows] == ct[cols]
 
         # Incorporate gene expression information
         if gene_expr_subset is not None:
@@ -118,96 +104,99 @@ def smooth(
                 "Conditioning smoothing on gene expression- only information from cells with similar gene "
                 "expression patterns will be used."
             )
-            jaccard_mat = compute_jaccard_similarity_matrix(gene_expr_subset, min_jaccard=min_jaccard)
+            jaccard = edge_jaccard_similarity(gene_expr_subset, rows, cols, min_jaccard=min_jaccard)
             logger.info("Computing median Jaccard score from nonzero entries only")
-            if scipy.sparse.isspmatrix_csr(jaccard_mat):
-                jaccard_threshold = sparse_matrix_median(jaccard_mat, nonzero_only=True)
-            else:
-                jaccard_threshold = np.median(jaccard_mat[jaccard_mat != 0])
+            jaccard_threshold = np.median(jaccard[jaccard != 0]) if np.any(jaccard != 0) else 0
             logger.info(f"Threshold Jaccard score: {jaccard_threshold}")
-            # Generate a mask where Jaccard similarities are greater than the threshold, and apply to the weights
-            # matrix:
-            jaccard_mask = jaccard_mat >= jaccard_threshold
-            W = W.multiply(jaccard_mask)
-
-    if scipy.sparse.isspmatrix_csr(W):
-        # Calculate the average number of non-zero weights per row for a sparse matrix
-        row_nonzeros = W.getnnz(axis=1)  # Number of non-zero elements per row
-        average_nonzeros = row_nonzeros.mean()  # Average over all rows
-    else:
-        # Calculate the average number of non-zero weights per row for a dense matrix
-        row_nonzeros = (W != 0).sum(axis=1)  # Boolean matrix where True=1 for non-zeros, then sum per row
-        average_nonzeros = row_nonzeros.mean()  # Average over all rows
-    logger.info(f"Average number of non-zero weights per cell: {average_nonzeros}")
-
-    # Original nonzero entries and values (keep these around):
-    initial_nz_rows, initial_nz_cols = X.nonzero()
-    if scipy.sparse.isspmatrix_csr(X):
-        initial_nz_vals = X[initial_nz_rows, initial_nz_cols].A1
-    else:
-        initial_nz_vals = X[initial_nz_rows, initial_nz_cols]
+            # Mask the neighbors whose Jaccard similarities are smaller than the threshold:
+            W.data *= jaccard >= jaccard_threshold
+        W.eliminate_zeros()
+
+    logger.info(f"Average number of non-zero weights per cell: {W.nnz / max(W.shape[0], 1)}")
 
     if normalize_W:
-        if type(W) == np.ndarray:
-            d = np.sum(W, 1).flatten()
-        else:
-            d = np.sum(W, 1).A.flatten()
-        W = scipy.sparse.diags(1 / d) @ W if scipy.sparse.isspmatrix_csr(W) else np.diag(1 / d) @ W
-        # Note that W @ X already returns sparse in this scenario, csr_matrix is just used to convert to common format
-        x_new = scipy.sparse.csr_matrix(W @ X) if scipy.sparse.isspmatrix_csr(X) else W @ X
+        d = np.asarray(W.sum(axis=1)).flatten()
+        W = scipy.sparse.diags(1 / np.where(d != 0, d, 1)) @ W
+        x_new = scipy.sparse.csr_matrix(W @ X)
 
         if return_discrete:
-            if scipy.sparse.isspmatrix_csr(x_new):
-                data = x_new.data
-                data[:] = np.where((0 < data) & (data < 1), 1, np.round(data))
-            else:
-                x_new = np.where((0 < x_new) & (x_new < 1), 1, np.round(x_new))
-        if scipy.sparse.isspmatrix_csr(x_new):
-            logger.info(f"Sparsity of smoothed array: {x_new.count_nonzero()}")
-        else:
-            logger.info(f"Sparsity of smoothed array: {np.count_nonzero(x_new)}")
+            x_new.data = np.where((0 < x_new.data) & (x_new.data < 1), 1, np.round(x_new.data))
+    else:
+        # Cells that do not express a gene take the weighted average over their neighbors that express it, if more
+        # than 'threshold' neighbors express it:
+        expressed = X.copy()
+        expressed.data = np.ones_like(expressed.data)
+        W_binary = W.copy()
+        W_binary.data = np.ones_like(W_binary.data)
+        eligible = W_binary @ expressed
+        eligible.data = (eligible.data > threshold).astype(np.float64)
+        eligible = eligible - eligible.multiply(expressed)
+        weight_sums = W @ expressed
+        weight_sums.data = 1 / weight_sums.data
+        x_new = scipy.sparse.csr_matrix((W @ X).multiply(weight_sums).multiply(eligible)) + X
 
-        if return_W:
-            return x_new, W, d
-        else:
-            return x_new, d
+        if return_discrete:
+            x_new.data = np.round(x_new.data)
+    x_new.eliminate_zeros()
+    logger.info(f"Sparsity of smoothed array: {x_new.nnz}")
+
+    if not is_sparse_X:
+        x_new = x_new.toarray()
+    if not is_sparse_W:
+        W = W.toarray()
+
+    if normalize_W:
+        return (x_new, W, d) if return_W else (x_new, d)
+    return (x_new, W) if return_W else x_new
+
+
+def edge_jaccard_similarity(
+    data: Union[np.ndarray, scipy.sparse.csr_matrix],
+    rows: np.ndarray,
+    cols: np.ndarray,
+    min_jaccard: float = 0.1,
+    chunk_size: int = 2**16,
+) -> np.ndarray:
+    """Compute the Jaccard similarity of given pairs of samples (rows of the input data), e.g. the stored entries of a
+    sparse spatial weights matrix, processing the pairs in chunks for memory efficiency.
+
+    Args:
+        data: A dense numpy array or a sparse matrix, with rows as samples and columns as features
+        rows: Indices of the first sample of each pair
+        cols: Indices of the second sample of each pair
+        min_jaccard: Minimum Jaccard similarity to be considered "nonzero"
+        chunk_size: The number of pairs to process in a single chunk
+
+    Returns:
+        jaccard: Jaccard similarity coefficient of each pair
+    """
+    if scipy.sparse.issparse(data):
+        data_bool = scipy.sparse.csr_matrix(data != 0, dtype=np.float64)
+        row_sums = np.asarray(data_bool.sum(axis=1)).flatten()
     else:
-        processor_func = functools.partial(smooth_process_column, X=X, W=W, threshold=threshold)
-        pool = Pool(cpu_count())
-        mod = pool.map(processor_func, range(X.shape[1]))
-        x_new = scipy.sparse.hstack(mod)
-
-        # Add back in the original nonzero entries:
-        if scipy.sparse.isspmatrix_csr(X):
-            orig_values = scipy.sparse.csr_matrix((initial_nz_vals, (initial_nz_rows, initial_nz_cols)), shape=X.shape)
-            x_new = x_new + orig_values
-        else:
-            x_new[initial_nz_rows, initial_nz_cols] = initial_nz_vals
+        data_bool = np.asarray(data) > 0
+        row_sums = data_bool.sum(axis=1)
 
-        # Convert to CSR format for more efficient storage:
-        if scipy.sparse.isspmatrix_csr(x_new):
-            logger.info(f"Sparsity of smoothed array: {x_new.count_nonzero()}")
+    jaccard = np.zeros(len(rows))
+    for chunk_start in range(0, len(rows), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        if scipy.sparse.issparse(data_bool):
+            intersection = np.asarray(data_bool[rows[chunk]].multiply(data_bool[cols[chunk]]).sum(axis=1)).flatten()
         else:
-            logger.info(f"Sparsity of smoothed array: {np.count_nonzero(x_new)}")
+            intersection = (data_bool[rows[chunk]] & data_bool[cols[chunk]]).sum(axis=1)
+        union = row_sums[rows[chunk]] + row_sums[cols[chunk]] - intersection
+        jaccard[chunk] = intersection / np.maximum(union, 1)
 
-        if return_discrete:
-            if scipy.sparse.isspmatrix_csr(x_new):
-                data = x_new.data
-                data[:] = np.round(data)
-            else:
-                x_new = np.round(x_new)
-
-        if return_W:
-            return x_new, W
-        else:
-            return x_new
+    jaccard[jaccard < min_jaccard] = 0.0
+    return jaccard
 
 
 def compute_jaccard_similarity_matrix(
     data: Union[np.ndarray, scipy.sparse.csr_matrix], chunk_size: int = 1000, min_jaccard: float = 0.1
-) -> np.ndarray:
+) -> Union[np.ndarray, scipy.sparse.csr_matrix]:
     """Compute the Jaccard similarity matrix for input data with rows corresponding to samples and columns
-    corresponding to features, processing in chunks for memory efficiency.
+    corresponding to features, processing in chunks for memory efficiency. Sparse input gives a sparse output, which
+    is assembled from sparse chunks without allocating a dense n x n array.
 
     Args:
         data: A dense numpy array or a sparse matrix in CSR format, with rows as features
@@ -217,53 +206,41 @@ def compute_jaccard_similarity_matrix(
     Returns:
         jaccard_matrix: A square matrix of Jaccard similarity coefficients
     """
+    logger = lm.get_main_logger()
     n_samples = data.shape[0]
-    jaccard_matrix = np.zeros((n_samples, n_samples))
+    is_sparse = scipy.sparse.issparse(data)
 
-    if scipy.sparse.isspmatrix_csr(data):  # Check if input is a sparse matrix
-        # Ensure the matrix is in CSR format for efficient row slicing
-        data = scipy.sparse.csr_matrix(data)
-        data_bool = data.astype(bool).astype(int)
-        row_sums = data_bool.sum(axis=1)
-        data_bool_T = data_bool.T
-        row_sums_T = row_sums.T
+    if is_sparse:
+        data_bool = scipy.sparse.csr_matrix(data != 0, dtype=np.float64)
+        row_sums = np.asarray(data_bool.sum(axis=1)).flatten()
     else:
-        data_bool = (data > 0).astype(int)
-        row_sums = data_bool.sum(axis=1).reshape(-1, 1)
-        data_bool_T = data_bool.T
-        row_sums_T = row_sums.T
+        data_bool = (np.asarray(data) > 0).astype(np.float64)
+        row_sums = data_bool.sum(axis=1)
 
     # Compute Jaccard similarities in chunks
+    chunks = []
     for chunk_start in range(0, n_samples, chunk_size):
         chunk_end = min(chunk_start + chunk_size, n_samples)
-        print(f"Pairwise Jaccard similarity computation: processing rows {chunk_start} to {chunk_end}...")
-
-        # Compute similarities for the current chunk
-        chunk_intersection = data_bool[chunk_start:chunk_end].dot(data_bool_T)
-        chunk_union = row_sums[chunk_start:chunk_end] + row_sums_T - chunk_intersection
-        chunk_similarity = chunk_intersection / np.maximum(chunk_union, 1)
-        chunk_similarity[chunk_similarity < min_jaccard] = 0.0
-
-        jaccard_matrix[chunk_start:chunk_end] = chunk_similarity
-
-        # Print available memory
-        memory_stats = psutil.virtual_memory()
-        print(f"Available memory: {memory_stats.available / (1024 * 1024):.2f} MB")
-
-        print(f"Completed rows {chunk_start} to {chunk_end}.")
-
-        # Clean up memory for the next chunk
-        del chunk_intersection, chunk_union, chunk_similarity
-        gc.collect()
-
-    print("Pairwise Jaccard similarity computation: all chunks processed. Converting to final format...")
-    if np.any(np.isnan(jaccard_matrix)) or np.any(np.isinf(jaccard_matrix)):
-        raise ValueError("jaccard_matrix contains NaN or Inf values")
-
-    if scipy.sparse.isspmatrix_csr(data):
-        jaccard_matrix = scipy.sparse.csr_matrix(jaccard_matrix)
-    print("Returning pairwise Jaccard similarity matrix...")
+        logger.debug(f"Pairwise Jaccard similarity computation: processing rows {chunk_start} to {chunk_end}...")
+
+        intersection = data_bool[chunk_start:chunk_end] @ data_bool.T
+        if is_sparse:
+            # Only pairs sharing a feature have a nonzero similarity:
+            intersection = scipy.sparse.coo_matrix(intersection)
+            union = row_sums[chunk_start + intersection.row] + row_sums[intersection.col] - intersection.data
+            similarity = intersection.data / np.maximum(union, 1)
+            similarity[similarity < min_jaccard] = 0.0
+            chunk = scipy.sparse.csr_matrix(
+                (similarity, (intersection.row, intersection.col)), shape=(chunk_end - chunk_start, n_samples)
+            )
+            chunk.eliminate_zeros()
+        else:
+            union = row_sums[chunk_start:chunk_end, None] + row_sums[None, :] - intersection
+            chunk = intersection / np.maximum(union, 1)
+            chunk[chunk < min_jaccard] = 0.0
+        chunks.append(chunk)
 
+    jaccard_matrix = scipy.sparse.vstack(chunks, format="csr") if is_sparse else np.vstack(chunks)
     return jaccard_matrix
 
 
@@ -305,123 +282,6 @@ def sparse_matrix_median(spmat: scipy.sparse.csr_matrix, nonzero_only: bool = Fa
     return median_value
 
 
-def smooth_process_column(
-    i: int,
-    X: Union[np.ndarray, scipy.sparse.csr_matrix],
-    W: Union[np.ndarray, scipy.sparse.csr_matrix],
-    threshold: float,
-) -> scipy.sparse.csr_matrix:
-    """Helper function for parallelization of smoothing via probabilistic selection of expression values.
-
-    Args:
-        i: Index of the column to be processed
-        X: Dense or sparse array input data matrix
-        W: Dense or sparse array pairwise spatial weights matrix
-        threshold: Threshold value for the number of feature-expressing neighbors for a given row to be included in
-            the smoothing.
-        random_state: Optional, set a random seed for reproducibility
-
-    Returns:
-        smoothed_column: Processed column after probabilistic smoothing
-    """
-    feat = X[:, i].toarray().flatten() if scipy.sparse.isspmatrix_csr(X) else X[:, i]
-    # Find the rows that meet the threshold criterion:
-    eligible_rows = get_eligible_rows(W, feat, threshold)
-    # Sample over eligible rows:
-    sampled_values = sample_from_eligible_neighbors(W, feat, eligible_rows)
-    # Create a sparse matrix with the sampled values:
-    smoothed_column = scipy.sparse.csr_matrix(sampled_values.reshape(-1, 1))
-    return smoothed_column
-
-
-def get_eligible_rows(
-    W: Union[np.ndarray, scipy.sparse.csr_matrix],
-    feat: Union[np.ndarray, scipy.sparse.csr_matrix],
-    threshold: float,
-) -> np.ndarray:
-    """Helper function for parallelization of smoothing via probabilistic selection of expression values.
-
-    Args:
-        W: Dense or sparse array pairwise spatial weights matrix
-        feat: 1D array of feature expression values
-        threshold: Threshold value for the number of feature-expressing neighbors for a given row to be included in
-            the smoothing.
-
-    Returns:
-        eligible_rows: Array of row indices that meet the threshold criterion
-    """
-    if feat.ndim == 1:
-        feat = feat.reshape(-1, 1)
-    feat_sp = scipy.sparse.csr_matrix(feat).transpose()
-
-    if scipy.sparse.isspmatrix_csr(W):
-        W = W.multiply(feat_sp)
-        # Check the number of non-zero weights per row after scaling
-        nnz_new = W.getnnz(axis=1)
-        # Find the rows that meet the threshold criterion
-        eligible_rows = np.where(nnz_new > threshold)[0]
-    else:
-        W = W * feat_sp
-        # Compute the number of nonzero weights per row in the updated array:
-        nnz_new = (W != 0).sum(axis=1)
-        # Find the rows that meet the threshold criterion:
-        eligible_rows = np.where(nnz_new >= threshold)[0]
-
-    # Remove rows that were nonzero in the original array (these do not need to be smoothed):
-    eligible_rows = np.setdiff1d(eligible_rows, np.where(feat != 0)[0])
-
-    return eligible_rows
-
-
-def sample_from_eligible_neighbors(
-    W: Union[np.ndarray, scipy.sparse.csr_matrix],
-    feat: Union[np.ndarray, scipy.sparse.csr_matrix],
-    eligible_rows: np.ndarray,
-):
-    """Sample feature values probabilistically based on weights matrix W.
-
-    Args:
-        W: Dense or sparse array pairwise spatial weights matrix
-        feat: 1D array of feature expression values
-        eligible_rows: Array of row indices that meet a prior-determined threshold criterion
-
-    Returns:
-        sampled_values: Array of sampled values
-    """
-    sampled_values = np.zeros(W.shape[0])
-
-    if scipy.sparse.isspmatrix_csr(W):
-        for row in eligible_rows:
-            start_index = W.indptr[row]
-            end_index = W.indptr[row + 1]
-            indices = W.indices[start_index:end_index]
-            data = W.data[start_index:end_index]
-
-            # Filter based on nonzero feature values
-            valid_mask = feat[indices] != 0
-            valid_indices = indices[valid_mask]
-            valid_data = data[valid_mask]
-
-            # Sample from the valid entries:
-            if valid_data.size > 0:
-                probabilities = valid_data / valid_data.sum()
-                sampled_index = np.random.choice(valid_indices, p=probabilities)
-                sampled_values[row] = feat[sampled_index]
-    else:
-        for row in eligible_rows:
-            valid_mask = (W[row, :] != 0) & (feat != 0)
-            valid_data = W[row, valid_mask]
-            valid_indices = np.where(valid_mask)[0]
-
-            # Sample from the valid entries:
-            if valid_data.size > 0:
-                probabilities = valid_data / valid_data.sum()
-                sampled_index = np.random.choice(valid_indices, p=probabilities)
-                sampled_values[row] = feat[sampled_index]
-
-    return sampled_values
-
-
 def subsample_neighbors_dense(W: np.ndarray, n: int, verbose: bool = False) -> np.ndarray:
     """Given dense spatial weights matrix W and number of random neighbors n to take, perform subsampling.
 
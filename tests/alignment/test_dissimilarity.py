@@ -0,0 +1,57 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from spateo.alignment.methods import dissimilarity, utils
+
+from ..mixins import TestMixin
+
+
+class TestDissimilarity(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.X_A = rng.poisson(2, (60, 8)).astype(float)
+        self.X_B = rng.poisson(2, (50, 8)).astype(float)
+
+    def test_factors_dissimilarity(self):
+        for metric in ("kl", "euclidean"):
+            expected = utils.calc_exp_dissimilarity(self.X_A, self.X_B, dissimilarity=metric)
+            for to_backend in (np.asarray, torch.from_numpy):
+                factors_A = dissimilarity.exp_factors(to_backend(self.X_A), metric)
+                factors_B = dissimilarity.exp_factors(to_backend(self.X_B), metric)
+                np.testing.assert_allclose(
+                    np.asarray(dissimilarity.factors_dissimilarity(factors_A, factors_B)), expected, atol=1e-12
+                )
+                np.testing.assert_allclose(
+                    np.asarray(dissimilarity.factors_dissimilarity(factors_A.take([3, 1]), factors_B.take(slice(5)))),
+                    expected[[3, 1], :5],
+                    atol=1e-12,
+                )
+
+            # A basis that spans all genes does not change the dissimilarity.
+            basis = dissimilarity.fit_exp_basis([self.X_A, self.X_B], metric, n_components=8)
+            np.testing.assert_allclose(basis.T @ basis, np.eye(8), atol=1e-10)
+            factors_A, factors_B = (dissimilarity.exp_factors(X, metric, basis) for X in (self.X_A, self.X_B))
+            self.assertEqual(factors_A.X.shape, (60, 8))
+            np.testing.assert_allclose(dissimilarity.factors_dissimilarity(factors_A, factors_B), expected, atol=1e-10)
+
+    def test_get_exp_factors_cache(self):
+        for n_components in (None, 4):
+            expected = dissimilarity.get_exp_factors([self.X_A, self.X_B], n_components=n_components)
+            for _ in range(2):
+                factors = dissimilarity.get_exp_factors(
+                    [self.X_A, self.X_B], genes=list("abcdefgh"), n_components=n_components, cache_dir=self.temp_dir
+                )
+                for factor, expected_factor in zip(factors, expected):
+                    for value, expected_value in zip(factor, expected_factor):
+                        np.testing.assert_allclose(value, expected_value)
+        # One basis and two factors for each rank.
+        self.assertEqual(len(os.listdir(self.temp_dir)), 5)
+
+        # Different genes or expression are cached separately.
+        dissimilarity.get_exp_factors([self.X_A], genes=list("abcdefgz"), cache_dir=self.temp_dir)
+        dissimilarity.get_exp_factors([self.X_A + 1], genes=list("abcdefgh"), cache_dir=self.temp_dir)
+        self.assertEqual(len(os.listdir(self.temp_dir)), 7)
@@ -0,0 +1,118 @@
+import random
+from unittest import TestCase
+
+import numpy as np
+import torch
+from anndata import AnnData
+
+from spateo.alignment.methods import dissimilarity, morpho, utils
+
+from ..mixins import TestMixin
+
+
+class TestMorpho(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.coordsA = rng.random((60, 2)) * 10
+        self.coordsB = rng.random((50, 2)) * 10
+        self.X_A = rng.poisson(2, (60, 8)).astype(float)
+        self.X_B = rng.poisson(2, (50, 8)).astype(float)
+
+    def test_calc_paired_exp_dissimilarity(self):
+        rows = np.array([0, 5, 59, 5])
+        cols = np.array([1, 1, 49, 0])
+        for metric in ("kl", "euclidean"):
+            expected = utils.calc_exp_dissimilarity(self.X_A, self.X_B, dissimilarity=metric)[rows, cols]
+            np.testing.assert_allclose(
+                dissimilarity.calc_paired_exp_dissimilarity(
+                    self.X_A, self.X_B, rows, cols, dissimilarity=metric, chunk_size=16
+                ),
+                expected,
+            )
+
+    def test_plan_chunks(self):
+        plan = utils.plan_chunks(n_rows=100, bytes_per_row=64, memory_budget=64 * 30)
+        self.assertEqual((plan.chunk_size, plan.n_chunks), (30, 4))
+        self.assertEqual(utils.plan_chunks(n_rows=100, bytes_per_row=64, memory_budget=10).chunk_size, 1)
+        self.assertEqual(utils.plan_chunks(n_rows=100, bytes_per_row=64, memory_budget=2**30).n_chunks, 1)
+
+    def test_chunked_distances(self):
+        # A budget of a few rows forces many chunks.
+        budget = 50 * utils.DIST_TEMPORARIES * 8 * 7
+        np.testing.assert_allclose(
+            utils.cal_dist(self.coordsA, self.coordsB, memory_budget=budget),
+            utils.cal_dist(self.coordsA, self.coordsB, chunk_num=1),
+        )
+        np.testing.assert_allclose(
+            utils.calc_exp_dissimilarity(self.X_A, self.X_B, memory_budget=budget),
+            utils.calc_exp_dissimilarity(self.X_A, self.X_B, chunk_num=1),
+        )
+        rng = np.random.default_rng(2021)
+        kwargs = dict(
+            XnAHat=self.coordsA,
+            XnB=self.coordsB,
+            X_A=self.X_A,
+            X_B=self.X_B,
+            sigma2=0.2,
+            beta2=0.1,
+            alpha=rng.random(60),
+            gamma=0.5,
+            Sigma=rng.random(60) * 0.1,
+        )
+        np.testing.assert_allclose(
+            morpho.get_P_chunk(memory_budget=60 * utils.P_TEMPORARIES * 8 * 7, **kwargs),
+            morpho.get_P_chunk(memory_budget=2**30, **kwargs),
+        )
+
+    def test_get_P_topk(self):
+        rng = np.random.default_rng(2021)
+        alpha, Sigma = rng.random(60), rng.random(60) * 0.1
+        GeneDistMat = utils.calc_exp_dissimilarity(self.X_A, self.X_B)
+        kwargs = dict(XnAHat=self.coordsA, XnB=self.coordsB, sigma2=0.2, beta2=0.1, alpha=alpha, gamma=0.5, Sigma=Sigma)
+        expected = morpho.get_P(
+            GeneDistMat=GeneDistMat, SpatialDistMat=utils.cal_dist(self.coordsA, self.coordsB), **kwargs
+        )
+        for to_backend in (np.asarray, torch.from_numpy):
+            backend_kwargs = {k: to_backend(v) if isinstance(v, np.ndarray) else v for k, v in kwargs.items()}
+            # With all spots as candidates, the result is exact.
+            rows, cols, SpatialDist = morpho.get_topk_candidates(backend_kwargs["XnAHat"], backend_kwargs["XnB"], 60)
+            Ps = morpho.get_P_topk(
+                GeneDist=to_backend(GeneDistMat)[rows, cols],
+                SpatialDist=SpatialDist,
+                rows=rows,
+                cols=cols,
+                **backend_kwargs
+            )
+            for P, P_expected in zip(Ps, expected):
+                np.testing.assert_allclose(np.asarray(P), P_expected[np.asarray(rows), np.asarray(cols)], atol=1e-12)
+
+        rows, cols, SpatialDist = morpho.get_topk_candidates(self.coordsA, self.coordsB, 20)
+        np.testing.assert_array_equal(np.bincount(cols), np.full(50, 20))
+        P, _, _ = morpho.get_P_topk(
+            GeneDist=GeneDistMat[rows, cols], SpatialDist=SpatialDist, rows=rows, cols=cols, **kwargs
+        )
+        np.testing.assert_allclose(P, expected[0][rows, cols], atol=1e-3)
+
+    def test_BA_align_sparse_top_k(self):
+        rng = np.random.default_rng(2021)
+        X = rng.poisson(2, (150, 10)).astype(float)
+        coords = rng.random((150, 2)) * 10
+        sampleA = AnnData(X=X)
+        sampleA.obsm["spatial"] = coords
+        sampleB = AnnData(X=X.copy())
+        sampleB.obsm["spatial"] = coords + 1
+        results = []
+        for sparse_top_k in (None, 20):
+            random.seed(0)
+            np.random.seed(0)
+            A, B = sampleA.copy(), sampleB.copy()
+            _, P, _ = morpho.BA_align(
+                A, B, max_iter=20, iter_key_added=None, verbose=False, dtype="float64", sparse_top_k=sparse_top_k
+            )
+            results.append((B.obsm["Nonrigid_align_spatial"], P))
+        (dense_coords, dense_P), (sparse_coords, sparse_P) = results
+        self.assertEqual(sparse_P.shape, dense_P.shape)
+        self.assertEqual(sparse_P.nnz, 150 * 20)
+        np.testing.assert_allclose(sparse_coords, dense_coords, atol=1e-3)
+        np.testing.assert_allclose(sparse_P.toarray(), dense_P, atol=1e-3)
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import numpy as np
+from anndata import AnnData
+
+from spateo.alignment.morpho_alignment import morpho_align
+
+from ..mixins import TestMixin
+
+
+class TestMorphoAlignment(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.coords = rng.random((80, 2)) * 10
+        X = rng.poisson(2, (80, 15)).astype(np.float32)
+        self.models = []
+        for i in range(3):
+            angle = 0.2 * i
+            R = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            model = AnnData(X=X.copy())
+            model.obsm["spatial"] = self.coords @ R.T + i
+            self.models.append(model)
+
+    def test_morpho_align_n_jobs(self):
+        params = dict(max_iter=30, dtype="float64", verbose=False, SVI_mode=False)
+        serial, _, _ = morpho_align(self.models, n_jobs=1, **params)
+        parallel, pis, sigma2s = morpho_align(self.models, n_jobs=2, **params)
+        self.assertEqual(len(pis), 2)
+        self.assertEqual(len(sigma2s), 2)
+        for model_serial, model_parallel in zip(serial, parallel):
+            np.testing.assert_allclose(
+                model_parallel.obsm["align_spatial"], model_serial.obsm["align_spatial"], atol=1e-6
+            )
+            np.testing.assert_allclose(model_parallel.obsm["align_spatial"], self.coords, atol=1e-6)
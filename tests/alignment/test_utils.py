@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+from anndata import AnnData
+
+from spateo.alignment import utils
+
+from ..mixins import TestMixin
+
+
+def _mean_shift(modelA, modelB, spatial_key="spatial"):
+    return modelB.obsm[spatial_key].mean(axis=0) - modelA.obsm[spatial_key].mean(axis=0), modelB.X.sum()
+
+
+class TestUtils(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.rng = np.random.default_rng(2021)
+
+    def test_affine(self):
+        X = self.rng.random((30, 2))
+        M1 = np.vstack([[[0, -1], [1, 0]], [[1, 2]]]).astype(float)
+        M2 = np.vstack([[[2, 0], [0, 2]], [[-3, 0.5]]]).astype(float)
+        np.testing.assert_allclose(utils._fit_affine(X, utils._apply_affine(M1, X)), M1, atol=1e-10)
+        np.testing.assert_allclose(
+            utils._apply_affine(utils._compose_affine(M1, M2), X),
+            utils._apply_affine(M1, utils._apply_affine(M2, X)),
+        )
+
+    def test_run_pairwise(self):
+        models = []
+        for i in range(4):
+            model = AnnData(X=np.full((10, 3), i, dtype=np.float32))
+            model.obsm["align_spatial"] = self.rng.random((10, 2)) + i
+            models.append(model)
+
+        results = utils.run_pairwise(_mean_shift, models, spatial_key="align_spatial", n_jobs=2)
+        self.assertEqual(len(results), 3)
+        for i, (shift, total) in enumerate(results):
+            expected = models[i + 1].obsm["align_spatial"].mean(axis=0) - models[i].obsm["align_spatial"].mean(axis=0)
+            np.testing.assert_allclose(shift, expected)
+            self.assertEqual(total, 30 * (i + 1))
@@ -1,4 +1,10 @@
-from unittest import TestCase
+import os
+import time
+from unittest import TestCase, skipUnless
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
 
 import spateo.io.bgi as bgi
 
@@ -26,3 +32,83 @@ class TestIOBGI(TestMixin, TestCase):
         self.assertEqual(12600, int(adata.var_names[0]))
         self.assertIn("pp", adata.uns)
         self.assertEqual((299, 300), adata.shape)
+
+    def test_read_bgi_agg_chunksize(self):
+        adata = bgi.read_bgi_agg(self.bgi_counts_path, binsize=3)
+        adata_chunked = bgi.read_bgi_agg(self.bgi_counts_path, binsize=3, chunksize=10000)
+        self.assertEqual(adata.shape, adata_chunked.shape)
+        self.assertEqual(adata.obs_names.tolist(), adata_chunked.obs_names.tolist())
+        self.assertEqual(adata.var_names.tolist(), adata_chunked.var_names.tolist())
+        self.assertEqual(adata.X.dtype, adata_chunked.X.dtype)
+        np.testing.assert_array_equal(adata.X.A, adata_chunked.X.A)
+
+    def test_read_bgi_chunksize(self):
+        adata = bgi.read_bgi(self.bgi_counts_path, binsize=50)
+        adata_chunked = bgi.read_bgi(self.bgi_counts_path, binsize=50, chunksize=10000)
+        self.assertEqual(adata.obs_names.tolist(), adata_chunked.obs_names.tolist())
+        self.assertEqual(adata.var_names.tolist(), adata_chunked.var_names.tolist())
+        np.testing.assert_array_equal(adata.X.A, adata_chunked.X.A)
+        np.testing.assert_array_equal(adata.obsm["spatial"], adata_chunked.obsm["spatial"])
+
+    def test_read_bgi_labels(self):
+        agg = bgi.read_bgi_agg(self.bgi_counts_path, binsize=2)
+        labels = np.zeros(agg.shape, dtype=int)
+        labels[:20, :20] = 1
+        labels[50:60, 40:80] = 2
+        agg.layers["labels"] = labels
+        adata = bgi.read_bgi(self.bgi_counts_path, segmentation_adata=agg, labels_layer="labels")
+        self.assertEqual(["1", "2"], adata.obs_names.tolist())
+
+        # Each read is assigned to the label of the bin containing it.
+        df = bgi.read_bgi_as_dataframe(self.bgi_counts_path)
+        x = df["x"].values // 2 - int(agg.obs_names[0])
+        y = df["y"].values // 2 - int(agg.var_names[0])
+        for label in (1, 2):
+            self.assertEqual(df["total"].values[labels[x, y] == label].sum(), adata[str(label)].X.sum())
+
+        adata_chunked = bgi.read_bgi(
+            self.bgi_counts_path, segmentation_adata=agg, labels_layer="labels", chunksize=10000
+        )
+        np.testing.assert_array_equal(adata.X.A, adata_chunked.X.A)
+
+    @skipUnless(os.environ.get("SPATEO_BENCHMARK_GEM_ROWS"), "set SPATEO_BENCHMARK_GEM_ROWS to run the benchmark")
+    def test_read_bgi_benchmark(self):
+        # Opt-in benchmark of the integer bin keys of read_bgi against the previous string keys, on a synthetic GEM of
+        # SPATEO_BENCHMARK_GEM_ROWS rows (e.g. 100000000), with 20k genes on a 20k x 20k pixel chip. Bin properties are
+        # not computed, as they are the same in both implementations.
+        n_rows, binsize = int(os.environ["SPATEO_BENCHMARK_GEM_ROWS"]), 50
+        rng = np.random.default_rng(2021)
+        genes = np.array([f"gene{i}" for i in range(20000)])
+        path = os.path.join(self.temp_dir, "synthetic.gem")
+        with open(path, "w") as f:
+            f.write("geneID\tx\ty\tMIDCount\n")
+            for start in range(0, n_rows, 10**7):
+                size = min(10**7, n_rows - start)
+                pd.DataFrame(
+                    {
+                        "geneID": genes[rng.integers(0, len(genes), size)],
+                        "x": rng.integers(0, 20000, size),
+                        "y": rng.integers(0, 20000, size),
+                        "MIDCount": rng.integers(1, 5, size),
+                    }
+                ).to_csv(f, sep="\t", header=False, index=False)
+
+        start = time.perf_counter()
+        adata = bgi.read_bgi(path, binsize=binsize, add_props=False)
+        new_time = time.perf_counter() - start
+
+        # Previous implementation: `x-y` string label for every row, and dict maps over every row.
+        start = time.perf_counter()
+        data = bgi.read_bgi_as_dataframe(path)
+        data["x"] = bgi.bin_indices(data["x"].values, 0, binsize)
+        data["y"] = bgi.bin_indices(data["y"].values, 0, binsize)
+        data["label"] = data["x"].astype(str) + "-" + data["y"].astype(str)
+        uniq_cell, uniq_gene = sorted(data["label"].unique()), sorted(data["geneID"].unique())
+        x_ind = data["label"].map(dict(zip(uniq_cell, range(len(uniq_cell))))).astype(int).values
+        y_ind = data["geneID"].map(dict(zip(uniq_gene, range(len(uniq_gene))))).astype(int).values
+        X = csr_matrix((data["total"].values, (x_ind, y_ind)), shape=(len(uniq_cell), len(uniq_gene)))
+        old_time = time.perf_counter() - start
+
+        self.assertEqual(uniq_cell, adata.obs_names.tolist())
+        self.assertEqual((X != adata.X).nnz, 0)
+        self.assertLess(new_time, old_time)
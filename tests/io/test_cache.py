@@ -0,0 +1,68 @@
+import os
+import shutil
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+import spateo.io.bgi as bgi
+import spateo.io.cache as cache
+
+from ..mixins import TestMixin
+
+
+class TestIOCache(TestMixin, TestCase):
+    def test_read_bgi_as_dataframe_cache(self):
+        df = bgi.read_bgi_as_dataframe(self.bgi_counts_path)
+        df_cached = bgi.read_bgi_as_dataframe(self.bgi_counts_path, cache_dir=self.temp_dir)
+        pd.testing.assert_frame_equal(df, df_cached)
+        # Coordinates are memory-mapped, not copied into memory.
+        base = df_cached["x"].values
+        while base.base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        self.assertIsInstance(base, np.memmap)
+        self.assertEqual(1, len(os.listdir(self.temp_dir)))
+
+        # Reloading uses the existing cache.
+        cache_path = bgi.cache_bgi(self.bgi_counts_path, self.temp_dir)
+        self.assertTrue(cache.has_cache(cache_path))
+        pd.testing.assert_frame_equal(df, cache.read_cache(cache_path))
+
+    def test_iter_cache(self):
+        cache_path = bgi.cache_bgi(self.bgi_counts_path, self.temp_dir)
+        chunks = list(cache.iter_cache(cache_path, 10000))
+        self.assertEqual(8, len(chunks))
+        pd.testing.assert_frame_equal(
+            bgi.read_bgi_as_dataframe(self.bgi_counts_path), pd.concat(chunks, ignore_index=True)
+        )
+
+    def test_cache_invalidated(self):
+        path = os.path.join(self.temp_dir, "counts.gem.gz")
+        shutil.copy(self.bgi_counts_path, path)
+        cache_dir = os.path.join(self.temp_dir, "cache")
+        cache_path = bgi.cache_bgi(path, cache_dir)
+
+        bgi.read_bgi_as_dataframe(path).head(100).to_csv(path, sep="\t", index=False)
+        df = bgi.read_bgi_as_dataframe(path, cache_dir=cache_dir)
+        self.assertEqual(100, df.shape[0])
+        self.assertFalse(os.path.exists(cache_path))
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+
+    def test_read_bgi_cache(self):
+        adata = bgi.read_bgi(self.bgi_counts_path, binsize=50)
+        adata_cached = bgi.read_bgi(self.bgi_counts_path, binsize=50, cache_dir=self.temp_dir)
+        self.assertEqual(adata.obs_names.tolist(), adata_cached.obs_names.tolist())
+        self.assertEqual(adata.var_names.tolist(), adata_cached.var_names.tolist())
+        np.testing.assert_array_equal(adata.X.A, adata_cached.X.A)
+
+    def test_write_cache_object(self):
+        chunks = [
+            pd.DataFrame({"gene": np.array(["b", "a", "b"], dtype=object), "x": [1, 2, 3]}),
+            pd.DataFrame({"gene": np.array(["c", "a"], dtype=object), "x": [4, 5]}),
+        ]
+        cache_path = os.path.join(self.temp_dir, "cache")
+        cache.write_cache(chunks, cache_path)
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), cache.read_cache(cache_path))
+
+        with self.assertRaises(ValueError):
+            cache.write_cache([pd.DataFrame({"gene": np.array(["a", None], dtype=object)})], cache_path)
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+
+import spateo.segmentation.benchmark as benchmark
+
+from ..mixins import TestMixin
+
+
+class TestBenchmark(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.labels1 = np.array([[0, 1, 1], [2, 2, 0], [3, 3, 3]])
+        self.labels2 = np.array([[0, 1, 1], [1, 2, 0], [2, 2, 0]])
+
+    def test_iou(self):
+        expected = np.zeros((4, 3))
+        areas1 = np.bincount(self.labels1.flatten())
+        areas2 = np.bincount(self.labels2.flatten())
+        for i in range(4):
+            for j in range(3):
+                overlap = ((self.labels1 == i) & (self.labels2 == j)).sum()
+                if overlap > 0:
+                    expected[i, j] = overlap / (areas1[i] + areas2[j] - overlap)
+        np.testing.assert_allclose(expected, benchmark.iou(self.labels1, self.labels2).A)
+
+    def test_average_precision(self):
+        iou = benchmark.iou(self.labels1, self.labels2)
+        taus = [0.1, 0.4, 0.5, 0.9]
+        aps = benchmark.average_precision(iou, taus)
+        for tau, ap in zip(taus, aps):
+            tp = (iou > tau).sum()
+            expected = tp / (tp + (iou.shape[1] - tp - 1) + (iou.shape[0] - tp - 1))
+            self.assertAlmostEqual(expected, benchmark.average_precision(iou, tau))
+            self.assertAlmostEqual(expected, ap)
+
+    def test_precision_recall(self):
+        iou = benchmark.iou(self.labels1, self.labels2)
+        precision, recall = benchmark.precision_recall(iou, [0.5, 0.9])
+        # Label pairs (0, 0) and (1, 1) have IOU > 0.5.
+        np.testing.assert_allclose([1, 0], precision)
+        np.testing.assert_allclose([2 / 3, 0], recall)
@@ -1,8 +1,10 @@
 from unittest import TestCase, mock
 
+import cv2
 import networkx as nx
 import numpy as np
 from scipy import sparse
+from sklearn import cluster
 
 import spateo.segmentation.density as density
 
@@ -14,6 +16,22 @@ class TestDensity(TestMixin, TestCase):
         adjacency = density._create_spatial_adjacency((7, 8))
         # networkx dimensions are flipped
         np.testing.assert_array_equal(nx.adjacency_matrix(nx.grid_graph((8, 7))).A, adjacency.A)
+        for shape in ((1, 5), (5, 1)):
+            adjacency = density._create_spatial_adjacency(shape)
+            np.testing.assert_array_equal(nx.adjacency_matrix(nx.path_graph(5)).A, adjacency.A)
+
+    def test_weighted_ward_tree(self):
+        rng = np.random.default_rng(2021)
+        X = rng.random((6, 7))
+        regions = np.arange(X.size).reshape(X.shape)
+        row, col = density._region_adjacency(regions)
+        children, n_leaves, distances = density._weighted_ward_tree(X.ravel(), np.ones(X.size), row, col)
+        _, _, expected_n_leaves, _, expected_distances = cluster.ward_tree(
+            X.ravel(), connectivity=density._create_spatial_adjacency(X.shape), return_distance=True
+        )
+        self.assertEqual(expected_n_leaves, n_leaves)
+        self.assertEqual((n_leaves - 1, 2), children.shape)
+        np.testing.assert_allclose(np.sort(expected_distances), np.sort(distances))
 
     def test_schc(self):
         X = np.zeros((10, 10))
@@ -25,6 +43,20 @@ class TestDensity(TestMixin, TestCase):
         expected[4:6, 4:6] = 2
         expected[7:, 7:] = 1
         np.testing.assert_array_equal(expected, density._schc(X))
+        result = density._schc(X, superpixel_size=2)
+        for region in (X == 0, X == 1 / 3, X == 2 / 3, X == 1):
+            self.assertEqual(1, len(np.unique(result[region])))
+        self.assertEqual(4, len(np.unique(result)))
+
+    def test_dilate_labels(self):
+        rng = np.random.default_rng(2021)
+        bins = cv2.resize(rng.integers(1, 6, (10, 10)).astype(np.int32), (40, 40), interpolation=cv2.INTER_NEAREST)
+        X = rng.random(bins.shape)
+        expected = np.zeros_like(bins)
+        for label in sorted(np.unique(bins), key=lambda label: X[bins == label].mean()):
+            dilate = cv2.dilate((bins == label).astype(np.uint8), density.utils.circle(5))
+            expected[density.utils.mclose_mopen(dilate, 5) > 0] = label
+        np.testing.assert_array_equal(expected, density._dilate_labels(X, bins, 5))
 
     def test_segment_densities(self):
         with mock.patch("spateo.segmentation.density.utils.conv2d") as conv2d, mock.patch(
@@ -35,7 +67,7 @@ class TestDensity(TestMixin, TestCase):
             np.testing.assert_array_equal(np.ones((3, 3), dtype=int), density._segment_densities(X, 5, 7))
             np.testing.assert_array_equal(conv2d.call_args[0][0], X.A / X.max())
             conv2d.assert_called_once_with(mock.ANY, 5, mode="gauss")
-            schc.assert_called_once_with(conv2d.return_value, distance_threshold=None)
+            schc.assert_called_once_with(conv2d.return_value, distance_threshold=None, superpixel_size=None)
 
     def test_segment_densities_adata(self):
         with mock.patch("spateo.segmentation.density._segment_densities") as _segment_densities, mock.patch(
@@ -49,6 +81,6 @@ class TestDensity(TestMixin, TestCase):
             dk = mock.MagicMock()
             density.segment_densities(adata, "X", 1, k, dk, distance_threshold)
             np.testing.assert_array_equal(adata.layers["X_bins"], _segment_densities.return_value)
-            _segment_densities.assert_called_once_with(mock.ANY, k, dk, distance_threshold)
+            _segment_densities.assert_called_once_with(mock.ANY, k, dk, distance_threshold, None)
             np.testing.assert_array_equal(adata.X, _segment_densities.call_args[0][0])
             bin_matrix.assert_not_called()
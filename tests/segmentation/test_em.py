@@ -17,6 +17,30 @@ class TestEM(TestMixin, TestCase):
         # np.testing.assert_allclose([53.75074877, 286.70262741], r)
         # np.testing.assert_allclose([0.33038823, 0.72543857], p)
 
+    def test_histogram_samples(self):
+        labels, groups, values, counts = em.histogram_samples({2: np.array([3, 1, 3, 3]), 1: np.array([1, 5])})
+        np.testing.assert_array_equal([2, 1], labels)
+        np.testing.assert_array_equal([0, 0, 1, 1], groups)
+        np.testing.assert_array_equal([1, 3, 1, 5], values)
+        np.testing.assert_array_equal([1, 3, 1, 1], counts)
+
+    def test_nbn_em_hist(self):
+        rng = np.random.default_rng(2021)
+        samples = {
+            1: rng.negative_binomial(5, 0.5, 200) + rng.negative_binomial(50, 0.3, 200) * (rng.random(200) < 0.3),
+            2: rng.negative_binomial(10, 0.5, 300) + rng.negative_binomial(100, 0.5, 300) * (rng.random(300) < 0.5),
+        }
+        params = dict(w=(0.5, 0.5), mu=(5.0, 100.0), var=(20.0, 400.0))
+        labels, groups, values, counts = em.histogram_samples(samples)
+        w, r, p = em.nbn_em_hist(values, counts, groups, max_iter=100, precision=1e-6, **params)
+        np.testing.assert_array_equal([1, 2], labels)
+        # Estimates of the per-sample EM loop on each group.
+        np.testing.assert_allclose(
+            [[0.7050000108674642, 0.2949999891325357], [0.5500000040708344, 0.4499999959291657]], w
+        )
+        np.testing.assert_allclose([[4.752129232268375, 40.491839903259084], [12.450652398582372, 61.9028891267371]], r)
+        np.testing.assert_allclose([[0.485525864040988, 0.2569780755898654], [0.5621640415981477, 0.36058177285529]], p)
+
     def test_confidence(self):
         np.testing.assert_allclose(
             [
@@ -1,6 +1,7 @@
 from unittest import TestCase, mock
 
 import numpy as np
+from scipy.sparse import csr_matrix
 
 import spateo.segmentation.icell as icell
 
@@ -175,3 +176,48 @@ class TestICell(TestMixin, TestCase):
             # apply_threshold.assert_called_once_with(mock.ANY, mk, threshold)
             np.testing.assert_array_equal(_score_pixels.return_value, apply_threshold.call_args[0][0])
             np.testing.assert_array_equal(adata.layers["unspliced_mask"], apply_threshold.return_value)
+
+
+class TestScorePixelsTiled(TestMixin, TestCase):
+    def test_score_pixels_tiled(self):
+        rng = np.random.default_rng(2021)
+        X = rng.poisson(0.5, (40, 50))
+        X[10:25, 15:30] += rng.poisson(5, (15, 15))
+        em_kwargs = dict(downsample=1.0, max_iter=20, seed=2021)
+        for method in ("gauss", "moran", "EM", "EM+gauss"):
+            with self.subTest(method=method):
+                expected = icell._score_pixels(
+                    X, 5, method, em_kwargs=None if method in ("gauss", "moran") else em_kwargs
+                )
+                result = icell._score_pixels_tiled(
+                    csr_matrix(X),
+                    5,
+                    method,
+                    em_kwargs=None if method in ("gauss", "moran") else em_kwargs,
+                    tile_size=16,
+                )
+                np.testing.assert_allclose(expected, result)
+
+    def test_score_pixels_tiled_small_tiles(self):
+        rng = np.random.default_rng(2021)
+        X = rng.poisson(0.5, (20, 25))
+        X[5:12, 8:15] += rng.poisson(5, (7, 7))
+        em_kwargs = dict(downsample=1.0, max_iter=20, seed=2021)
+        expected = icell._score_pixels(X, 5, "EM+gauss", em_kwargs=em_kwargs)
+        # The halo spans two tiles in each direction.
+        result = icell._score_pixels_tiled(csr_matrix(X), 5, "EM+gauss", em_kwargs=em_kwargs, tile_size=1)
+        np.testing.assert_allclose(expected, result)
+
+    def test_score_pixels_tiled_subsample(self):
+        rng = np.random.default_rng(2021)
+        X = rng.poisson(0.5, (40, 50))
+        X[10:25, 15:30] += rng.poisson(5, (15, 15))
+        em_kwargs = dict(downsample=0.5, max_iter=20, seed=2021)
+        expected = icell._score_pixels(X, 5, "EM", em_kwargs=em_kwargs)
+        with mock.patch.object(icell, "TILED_FIT_PIXELS", 1000), mock.patch.object(
+            icell, "_fit_nb_mixture", wraps=icell._fit_nb_mixture
+        ) as fit:
+            result = icell._score_pixels_tiled(csr_matrix(X), 5, "EM", em_kwargs=em_kwargs, tile_size=16)
+        self.assertEqual(fit.call_args.args[0].shape, (1000,))
+        self.assertEqual(fit.call_args.args[2]["downsample"], 1.0)
+        self.assertGreater(((expected > 0.5) == (result > 0.5)).mean(), 0.95)
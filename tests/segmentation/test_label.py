@@ -34,6 +34,31 @@ class TestLabel(TestMixin, TestCase):
         np.testing.assert_array_equal(expected, label._expand_labels(X, 3, 9))
     """
 
+    def test_expand_labels_edt(self):
+        X = np.zeros((6, 6), dtype=int)
+        X[:2, :2] = 1
+        X[5, 5] = 2
+        mask = np.ones(X.shape, dtype=bool)
+        mask[:, 2] = False
+        expected = np.array(
+            [
+                [1, 1, 0, 0, 0, 0],
+                [1, 1, 0, 0, 0, 0],
+                [1, 1, 0, 0, 0, 0],
+                [1, 1, 0, 0, 0, 2],
+                [0, 0, 0, 0, 2, 2],
+                [0, 0, 0, 2, 2, 2],
+            ]
+        )
+        # Pixels to the right of the masked column are closest to label 1, but
+        # are not connected to it.
+        np.testing.assert_array_equal(expected, label._expand_labels(X, 2, 100, mask=mask, mode="edt"))
+
+        # Labels stop expanding at max_area, claiming the closest pixels first.
+        result = label._expand_labels(X, 2, 6, mode="edt")
+        self.assertEqual(6, (result == 1).sum())
+        self.assertTrue((result[:2, :3] == 1).all())
+
     def test_find_peaks_with_erosion_with_scores(self):
         with mock.patch("spateo.segmentation.label.utils.safe_erode") as safe_erode:
             safe_erode.return_value = np.random.random((3, 3))
@@ -89,7 +114,7 @@ class TestLabel(TestMixin, TestCase):
             max_area = mock.MagicMock()
             label.expand_labels(adata, "nuclei", distance, max_area, mask_layer="mask")
             np.testing.assert_array_equal(adata.layers["nuclei_labels_expanded"], _expand_labels.return_value)
-            _expand_labels.assert_called_once_with(mock.ANY, distance, max_area, mask=mock.ANY)
+            _expand_labels.assert_called_once_with(mock.ANY, distance, max_area, mask=mock.ANY, mode="iterative")
             np.testing.assert_array_equal(adata.layers["nuclei_labels"], _expand_labels.call_args[0][0])
             np.testing.assert_array_equal(adata.layers["mask"], _expand_labels.call_args.kwargs["mask"])
 
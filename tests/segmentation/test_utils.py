@@ -1,13 +1,25 @@
 from unittest import TestCase, mock
 
 import numpy as np
+from scipy import signal
 
 import spateo.segmentation.utils as utils
+from spateo.errors import SegmentationError
 
 from ..mixins import TestMixin
 
 
 class TestSegmentationUtils(TestMixin, TestCase):
+    def test_label_overlap(self):
+        X = np.array([[0, 1, 1], [2, 2, 0]])
+        Y = np.array([[0, 1, 3], [1, 1, 0]])
+        np.testing.assert_array_equal(
+            [[2, 0, 0, 0], [0, 1, 0, 1], [0, 2, 0, 0]],
+            utils.label_overlap(X, Y).A,
+        )
+        with self.assertRaises(SegmentationError):
+            utils.label_overlap(X, Y[:1])
+
     def test_circle(self):
         circle = np.ones((3, 3), dtype=np.uint8)
         circle[0, 0] = 0
@@ -51,6 +63,16 @@ class TestSegmentationUtils(TestMixin, TestCase):
             utils.conv2d(X, 3, "square"),
         )
 
+    def test_convolve(self):
+        rng = np.random.default_rng(2021)
+        X = rng.poisson(2, (40, 50))
+        for k in (3, 13):
+            for kernel in (utils.circle(k), np.ones((k, k), dtype=np.uint8), rng.random((k, k))):
+                expected = signal.convolve2d(X, kernel, boundary="symm", mode="same")
+                result = utils.convolve(X, kernel)
+                self.assertEqual(expected.dtype, result.dtype)
+                np.testing.assert_allclose(expected, result)
+
     def test_conv2d_bins(self):
         X = np.array([[0, 1, 0, 1], [1, 0, 1, 0], [0, 1, 0, 1], [1, 0, 1, 0]])
         bins = np.zeros(X.shape, dtype=int)
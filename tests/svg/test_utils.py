@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+import numpy as np
+import ot
+from scipy import sparse
+
+from spateo.svg import utils
+
+from ..mixins import TestMixin
+
+
+class TestUtils(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        # Bins on a line, such that the distances are a tree metric.
+        self.M = np.abs(np.arange(30)[:, None] - np.arange(30)[None, :]).astype(float)
+        self.A = rng.random((30, 5)) * (rng.random((30, 5)) > 0.3)
+        self.A /= self.A.sum(axis=0)
+        self.b = rng.random(30)
+        self.b /= self.b.sum()
+
+    def test_get_wass_dis_solver(self):
+        expected = [ot.emd2(a, self.b, self.M) for a in self.A.T]
+        np.testing.assert_allclose(utils.get_wass_dis_solver(self.M, self.b, method="emd")(self.A), expected)
+        # On a line, the Wasserstein distance is the L1 distance of the cumulative distributions.
+        np.testing.assert_allclose(
+            utils.get_wass_dis_solver(self.M, self.b, method="tree")(self.A),
+            np.abs(np.cumsum(self.A - self.b[:, None], axis=0)).sum(axis=0),
+        )
+        expected = [
+            ot.sinkhorn2(a, self.b, self.M / 29, 0.02, method="sinkhorn_log", stopThr=1e-9) * 29 for a in self.A.T
+        ]
+        np.testing.assert_allclose(
+            utils.get_wass_dis_solver(self.M, self.b, method="sinkhorn", stopThr=1e-9)(self.A), expected, rtol=1e-5
+        )
+        with self.assertRaises(ValueError):
+            utils.get_wass_dis_solver(self.M, self.b, method="sinkhorn", reg=1e-3)
+
+    def test_cal_wass_dis_batch(self):
+        X = sparse.csc_matrix(np.hstack([self.A * 7, np.zeros((30, 1))]))
+        solver = utils.get_wass_dis_solver(self.M, self.b, method="tree")
+        perm = np.random.default_rng(0).permutation(30)
+        ws = utils.cal_wass_dis_batch(X, solver, perm=perm, block_size=2)
+        np.testing.assert_allclose(ws[:5], solver(self.A[perm]))
+        self.assertTrue(np.isnan(ws[5]))
@@ -0,0 +1,77 @@
+from unittest import TestCase, mock
+
+import numpy as np
+
+import spateo.tdr.morphometrics.morphofield_dg.GPVectorField as gp_vector_field
+from spateo.tdr.morphometrics.morphofield.gaussian_process import _gp_velocity
+
+from ..mixins import TestMixin
+
+
+class TestGPVectorField(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.X = rng.normal(size=(60, 3)) * 5 + 2
+        self.vf_dict = {
+            "X_ctrl": rng.normal(size=(25, 3)),
+            "C": rng.normal(size=(25, 3)),
+            "beta": 0.7,
+            "R": np.eye(3) + rng.normal(size=(3, 3)) * 0.1,
+            "t": rng.normal(size=3),
+            "kernel_dict": {"dist": "cdist"},
+            "norm_dict": {"mean_transformed": 2.0, "scale_transformed": 5.0, "mean_fixed": 1.0, "scale_fixed": 4.0},
+        }
+
+    def _jacobian(self, X):
+        # Displacements between all coordinates and control points, like in the original dense implementation.
+        x_norm = (np.atleast_2d(X) - 2.0) / 5.0
+        D = x_norm[:, None, :] - self.vf_dict["X_ctrl"][None]
+        K = np.exp(-self.vf_dict["beta"] * (D**2).sum(axis=2))
+        J = np.einsum("nm,mi,nmj->ijn", K, self.vf_dict["C"], D)
+        J = -2 * self.vf_dict["beta"] * J * 4.0 / 5.0
+        return J[:, :, 0] if X.ndim == 1 else J
+
+    def test_jacobian(self):
+        expected = self._jacobian(self.X)
+        np.testing.assert_allclose(gp_vector_field.Jacobian_GP_gaussian_kernel(self.X, self.vf_dict), expected)
+        np.testing.assert_allclose(
+            gp_vector_field.Jacobian_GP_gaussian_kernel(self.X[0], self.vf_dict), expected[:, :, 0]
+        )
+        with mock.patch.object(gp_vector_field, "CTRL_BLOCK", 4):
+            for cells, v, J in gp_vector_field._gp_jacobian_blocks(self.X, self.vf_dict, block_size=7):
+                np.testing.assert_allclose(J, expected[:, :, cells].transpose(2, 0, 1))
+                np.testing.assert_allclose(v, _gp_velocity(self.X[cells], self.vf_dict))
+
+    def test_compute_gp_geometry(self):
+        vf = lambda x: _gp_velocity(x, self.vf_dict)
+        res = gp_vector_field.compute_gp_geometry(
+            self.X,
+            self.vf_dict,
+            quantities=("velocity", "jacobian", "divergence", "curl", "acceleration", "curvature", "torsion"),
+            block_size=11,
+        )
+        np.testing.assert_allclose(res["velocity"], vf(self.X))
+        np.testing.assert_allclose(res["jacobian"], self._jacobian(self.X))
+        np.testing.assert_allclose(res["divergence"], gp_vector_field.compute_divergence(self._jacobian, self.X))
+        np.testing.assert_allclose(res["curl"], gp_vector_field.compute_curl(self._jacobian, self.X)[:, 0])
+        acce, acce_mat = gp_vector_field.compute_acceleration(vf, self._jacobian, self.X)
+        np.testing.assert_allclose(res["acceleration"], acce)
+        np.testing.assert_allclose(res["acceleration_vector"], acce_mat)
+        curv, cur_mat = gp_vector_field.compute_curvature(vf, self._jacobian, self.X)
+        np.testing.assert_allclose(res["curvature"], curv)
+        np.testing.assert_allclose(res["curvature_vector"], cur_mat)
+        np.testing.assert_allclose(res["torsion"], gp_vector_field.compute_torsion(vf, self._jacobian, self.X)[:, 0])
+
+        curv, _ = gp_vector_field.compute_curvature(vf, self._jacobian, self.X, formula=1)
+        res = gp_vector_field.compute_gp_geometry(self.X, self.vf_dict, quantities=("curvature",), formula=1)
+        np.testing.assert_allclose(res["curvature"], curv)
+        self.assertNotIn("curvature_vector", res)
+
+    def test_gp_vector_field(self):
+        vf = gp_vector_field.GPVectorField()
+        vf.vf_dict, vf.data["X"] = self.vf_dict, self.X
+        np.testing.assert_allclose(vf.compute_curl(block_size=7), gp_vector_field.compute_curl(self._jacobian, self.X))
+        divergence = gp_vector_field.compute_divergence(self._jacobian, self.X)
+        np.testing.assert_allclose(vf.compute_divergence(block_size=7), divergence)
+        np.testing.assert_allclose(vf.compute_divergence(vectorize_size=7), divergence)
@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+import numpy as np
+from anndata import AnnData
+from scipy import sparse
+from scipy.spatial import distance
+from scipy.stats import mannwhitneyu
+
+import spateo.tools.cluster_degs as cluster_degs
+from spateo.configuration import SKM
+
+from ..mixins import TestMixin
+
+
+class TestClusterDegs(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        X = rng.poisson(0.5, (300, 20)).astype(float)
+        X[:100, :5] += rng.poisson(3, (100, 5))
+        self.adata = AnnData(X=sparse.csr_matrix(X))
+        self.adata.obs["cluster"] = np.repeat(["a", "b", "c"], 100)
+        self.adata.var_names = [f"gene{i}" for i in range(20)]
+        SKM.init_adata_type(self.adata, SKM.ADATA_UMI_TYPE)
+
+    def test_mannwhitneyu_pvals(self):
+        rng = np.random.default_rng(2021)
+        # Ties, negative values and, with a small test group and no ties, the exact distribution.
+        X = np.round(rng.normal(size=(40, 10)), 1) * (rng.random((40, 10)) > 0.5)
+        X[:, 0] = rng.normal(size=40)
+        for n_test in (5, 15):
+            is_test = np.arange(40) < n_test
+            expected = [mannwhitneyu(X[is_test, i], X[~is_test, i])[1] for i in range(10)]
+            for data in (X, sparse.csc_matrix(X)):
+                np.testing.assert_allclose(cluster_degs._mannwhitneyu_pvals(data, is_test), expected)
+
+    def test_find_cluster_degs(self):
+        X = self.adata.X.toarray()
+        is_test = (self.adata.obs["cluster"] == "a").values
+        for method in ("multiple", "pairwise"):
+            de = cluster_degs.find_cluster_degs(
+                self.adata, "a", ["b", "c"], group="cluster", qval_thresh=1.1, log2fc_thresh=-np.inf, method=method
+            )
+            de = de[de["gene"] == "gene0"].iloc[0]
+            control = ~is_test if method == "multiple" else (self.adata.obs["cluster"] == de["control_group"]).values
+            self.assertAlmostEqual(de["pval"], mannwhitneyu(X[is_test, 0], X[control, 0])[1])
+            self.assertAlmostEqual(
+                de["log2fc"], np.log2((X[is_test, 0].mean() + 1e-9) / (X[control, 0].mean() + 1e-9) + 10e-5)
+            )
+            pearson_test = 1 - distance.correlation(X[:, 0], is_test)
+            pearson_control = 1 - distance.correlation(X[:, 0], control)
+            self.assertAlmostEqual(de["person_score"], pearson_test**3 / (pearson_control**2 + pearson_test**2))
+
+    def test_find_all_cluster_degs(self):
+        adata = cluster_degs.find_all_cluster_degs(self.adata, "cluster")
+        tables = adata.uns["cluster_markers"]["deg_tables"]
+        self.assertEqual(len(tables), 3)
+        self.assertEqual(set(tables[0]["gene"]), {f"gene{i}" for i in range(5)})
+        de = cluster_degs.find_cluster_degs(self.adata, "a", ["b", "c"], group="cluster")
+        np.testing.assert_allclose(
+            tables[0].set_index("gene")["pval"], de.set_index("gene").loc[tables[0]["gene"], "pval"]
+        )
@@ -0,0 +1,28 @@
+from unittest import TestCase, mock
+
+import numpy as np
+from anndata import AnnData
+
+import spateo.tools.cluster.find_clusters as find_clusters
+from spateo.configuration import SKM
+
+from ..mixins import TestMixin
+
+
+class TestFindClusters(TestMixin, TestCase):
+    def test_spagcn_pyg_refine_neighbors(self):
+        grid = np.stack(np.meshgrid(np.arange(12), np.arange(10)), axis=-1).reshape(-1, 2)
+        adata = AnnData(X=np.ones((len(grid), 3)))
+        adata.obsm["X_spatial"] = grid * 5.0
+        SKM.init_adata_type(adata, SKM.ADATA_UMI_TYPE)
+        pred = np.where(grid[:, 0] > 5, 0, 1)
+
+        # The training is mocked, only the adjacency used for the refinement is checked.
+        with mock.patch.object(find_clusters, "search_res"), mock.patch.object(
+            find_clusters, "SpaGCN"
+        ) as spagcn, mock.patch.object(find_clusters, "refine", return_value=pred) as refine:
+            spagcn.return_value.predict.return_value = (pred, None)
+            for shape, num_nbs in (("square", 4), ("hexagon", 6)):
+                find_clusters.spagcn_pyg(adata, n_clusters=2, refine_shape=shape, n_neighbors=2)
+                dis = refine.call_args.kwargs["dis"]
+                self.assertGreaterEqual(dis.getnnz(axis=1).min(), num_nbs)
@@ -0,0 +1,72 @@
+from unittest import TestCase
+
+import numpy as np
+from anndata import AnnData
+
+import spateo.tools.find_neighbors as find_neighbors
+from spateo.configuration import SKM
+
+from ..mixins import TestMixin
+
+
+class TestFindNeighbors(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.adata = AnnData(X=np.zeros((300, 2)))
+        self.adata.obsm["spatial"] = rng.random((300, 2)) * 100
+        SKM.init_adata_type(self.adata, SKM.ADATA_UMI_TYPE)
+
+    def test_construct_nn_graph_sparse(self):
+        for make_symmetrical in (False, True):
+            find_neighbors.construct_nn_graph(self.adata, make_symmetrical=make_symmetrical)
+            adj = self.adata.obsp["adj"].A
+            distance_matrix = self.adata.obsp["distance_matrix"]
+
+            find_neighbors.construct_nn_graph(self.adata, make_symmetrical=make_symmetrical, sparse=True)
+            np.testing.assert_array_equal(adj, self.adata.obsp["adj"].A)
+            rows, cols = self.adata.obsp["distance_matrix"].nonzero()
+            np.testing.assert_allclose(distance_matrix[rows, cols], self.adata.obsp["distance_matrix"][rows, cols].A1)
+
+    def test_find_bw_for_n_neighbors_spatial_index(self):
+        distances = find_neighbors.calculate_distance(self.adata.obsm["spatial"])
+        for use_spatial_index in (False, True):
+            bw = find_neighbors.find_bw_for_n_neighbors(
+                self.adata, target_n_neighbors=10, verbose=False, use_spatial_index=use_spatial_index
+            )
+            self.assertTrue(9 <= np.mean(np.sum(distances <= bw, axis=1)) <= 11)
+
+    def test_find_threshold_distance_spatial_index(self):
+        expected = find_neighbors.find_threshold_distance(self.adata, coords_key="spatial", chunk_size=100)
+        self.assertAlmostEqual(
+            find_neighbors.find_threshold_distance(self.adata, coords_key="spatial", use_spatial_index=True), expected
+        )
+
+    def test_compute_spatial_weights(self):
+        coords = self.adata.obsm["spatial"]
+        # Grid coordinates, such that there are ties between neighbor distances:
+        grid = np.stack(np.meshgrid(np.arange(20), np.arange(20)), axis=-1).reshape(-1, 2).astype(float)
+        for points in (coords, grid):
+            n_samples = points.shape[0]
+            for fixed_bw, bw in ((True, 10.0), (False, 8)):
+                for kernel in ("bisquare", "gaussian", "uniform"):
+                    expected = np.vstack(
+                        [
+                            find_neighbors.get_wi(
+                                i, n_samples, points, fixed_bw=fixed_bw, exclude_self=True, kernel=kernel, bw=bw
+                            )
+                            for i in range(n_samples)
+                        ]
+                    )
+                    w = find_neighbors.compute_spatial_weights(
+                        points, bw, fixed_bw=fixed_bw, exclude_self=True, kernel=kernel
+                    )
+                    np.testing.assert_allclose(expected, w.A)
+
+    def test_spatial_neighbors_smaller_bandwidth(self):
+        coords = self.adata.obsm["spatial"]
+        spatial_neighbors = find_neighbors.SpatialNeighbors(coords, 20, fixed=False)
+        self.assertFalse(spatial_neighbors.covers(21))
+        for bw in (5, 12, 20):
+            w = find_neighbors.compute_spatial_weights(coords, bw, fixed_bw=False, kernel="bisquare")
+            np.testing.assert_allclose(spatial_neighbors.weights(bw, kernel="bisquare").A, w.A)
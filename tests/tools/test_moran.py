@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+import numpy as np
+from anndata import AnnData
+from scipy import sparse
+
+import spateo.tools.moran as moran
+from spateo.configuration import SKM
+from spateo.tools.lisa import local_moran_i
+from spateo.tools.spatial_degs import moran_i
+
+from ..mixins import TestMixin
+
+
+class TestMoran(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.coords = rng.random((200, 2)) * 20
+        self.Y = rng.normal(size=(200, 3))
+        self.Y[:, 0] += self.coords[:, 0]
+        self.W = moran.spatial_weights(self.coords, k=5)
+
+    def test_spatial_weights(self):
+        self.assertEqual(self.W.nnz, 200 * 5)
+        np.testing.assert_allclose(self.W.sum(axis=1), 1)
+        self.assertEqual(self.W.diagonal().sum(), 0)
+
+        W = moran.spatial_weights(self.coords, k=2, kernel=True, row_standardize=False)
+        dist = np.linalg.norm(self.coords[:, None] - self.coords[None], axis=-1)
+        expected = np.where(dist <= 2, np.exp(-((dist / 2) ** 2) / 2) / np.sqrt(2 * np.pi), 0)
+        np.testing.assert_allclose(W.toarray(), expected)
+
+    def test_global_moran(self):
+        W = self.W.toarray()
+        Z = self.Y - self.Y.mean(axis=0)
+        expected = 200 / W.sum() * np.einsum("ig,ij,jg->g", Z, W, Z) / (Z * Z).sum(axis=0)
+        I, p_sim, z_sim = moran.global_moran(sparse.csr_matrix(self.Y), self.W, permutations=99, block_size=2, seed=0)
+        np.testing.assert_allclose(I, expected)
+        self.assertEqual(p_sim[0], 0.01)
+        self.assertGreater(z_sim[0], 10)
+
+    def test_local_moran(self):
+        permutations = 20
+        Is, q, p_sim, z_sim = moran.local_moran(self.Y, self.W, permutations=permutations, seed=0)
+
+        # Conditional randomization of each cell, with the same random cells as the shared permutations.
+        rng = np.random.default_rng(0)
+        ids = [rng.choice(199, size=5, replace=False) for _ in range(permutations)]
+        Z = (self.Y - self.Y.mean(axis=0)) / self.Y.std(axis=0)
+        lag = self.W @ Z
+        np.testing.assert_allclose(Is, 199 / 200 * Z * lag)
+        sims = np.zeros((permutations, 200, 3))
+        for i in range(200):
+            others = np.delete(Z, i, axis=0)
+            for j, cell_ids in enumerate(ids):
+                sims[j, i] = 199 / 200 * Z[i] * (self.W[i].data @ others[cell_ids])
+        larger = (sims >= Is).sum(axis=0)
+        np.testing.assert_allclose(p_sim, (np.minimum(larger, permutations - larger) + 1) / (permutations + 1))
+        np.testing.assert_allclose(z_sim, (Is - sims.mean(axis=0)) / sims.std(axis=0))
+        np.testing.assert_array_equal(q[(Z > 0) & (lag > 0)], 1)
+        np.testing.assert_array_equal(q[(Z <= 0) & (lag <= 0)], 3)
+
+    def test_moran_i_and_local_moran_i(self):
+        adata = AnnData(X=sparse.csr_matrix(np.maximum(self.Y, 0)))
+        adata.obsm["spatial"] = self.coords
+        adata.obs["group"] = np.where(self.coords[:, 0] > 10, "right", "left")
+        adata.var["use_for_pca"] = True
+        SKM.init_adata_type(adata, SKM.ADATA_UMI_TYPE)
+
+        res = moran_i(adata, permutations=99)
+        self.assertEqual(list(res.columns), ["moran_i", "moran_p_val", "moran_z", "moran_q_val"])
+        self.assertEqual(res["moran_i"].idxmax(), adata.var_names[0])
+
+        res = moran_i(adata, genes=adata.var_names[[2, 0]], permutations=9)
+        self.assertEqual(list(res.index), list(adata.var_names[[2, 0]]))
+        self.assertEqual(res["moran_i"].idxmax(), adata.var_names[0])
+        with self.assertRaises(ValueError):
+            moran_i(adata, genes=[adata.var_names[0], "unknown"])
+
+        res = local_moran_i(adata, "group")
+        self.assertEqual(res.loc[adata.var_names[0], "hotspot_num_group"], "right")
+        self.assertEqual(res.loc[adata.var_names[0], "coldspot_num_group"], "left")
@@ -0,0 +1,139 @@
+from unittest import TestCase, mock
+
+import numpy as np
+import scipy.sparse
+
+from spateo.tools.CCI_effects_modeling import regression_utils
+from spateo.tools.CCI_effects_modeling.distributions import Poisson
+
+from ..mixins import TestMixin
+
+
+class TestRegressionUtils(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.x = rng.random((200, 3))
+        self.y = rng.poisson(np.exp(self.x @ np.array([0.5, -0.3, 0.2]))).reshape(-1, 1).astype(float)
+        self.w = np.zeros((200, 1))
+        self.neighbors = np.sort(rng.choice(200, 40, replace=False))
+        self.w[self.neighbors, 0] = rng.random(40)
+        # Spatial weights of several local regressions, one per row:
+        w_batch = np.zeros((5, 200))
+        for row in w_batch:
+            row[rng.choice(200, 40, replace=False)] = rng.random(40)
+        self.w_batch = scipy.sparse.csr_matrix(w_batch)
+
+    def test_compute_betas_local_neighborhood(self):
+        betas, pseudoinverse, cov_inverse = regression_utils.compute_betas_local(self.y, self.x, self.w)
+        local_betas, local_pseudoinverse, local_cov_inverse = regression_utils.compute_betas_local(
+            self.y[self.neighbors], self.x[self.neighbors], self.w[self.neighbors]
+        )
+        np.testing.assert_allclose(betas, local_betas)
+        np.testing.assert_allclose(pseudoinverse[:, self.neighbors], local_pseudoinverse)
+        np.testing.assert_allclose(cov_inverse, local_cov_inverse)
+
+    def test_iwls_neighborhood(self):
+        betas, y_hat, _, irls_weights, _, _, pseudoinverse, fisher_inv = regression_utils.iwls(
+            self.y, self.x, distr="poisson", tol=1e-6, spatial_weights=self.w
+        )
+        local = regression_utils.iwls(
+            self.y[self.neighbors],
+            self.x[self.neighbors],
+            distr="poisson",
+            init_y_hat=Poisson().initial_predictions(self.y)[self.neighbors],
+            tol=1e-6,
+            spatial_weights=self.w[self.neighbors],
+            fisher_moments=regression_utils.get_fisher_moments(self.x),
+        )
+        np.testing.assert_allclose(betas, local[0])
+        np.testing.assert_allclose(y_hat[self.neighbors], local[1])
+        np.testing.assert_allclose(irls_weights[self.neighbors], local[3])
+        np.testing.assert_allclose(pseudoinverse[:, self.neighbors], local[6])
+        np.testing.assert_allclose(fisher_inv, local[7])
+
+    def test_compute_betas_local_batch(self):
+        betas, cov_inverse = regression_utils.compute_betas_local_batch(self.y, self.x, self.w_batch)
+        for i in range(self.w_batch.shape[0]):
+            expected_betas, _, expected_cov_inverse = regression_utils.compute_betas_local(
+                self.y, self.x, self.w_batch[i].A.T
+            )
+            np.testing.assert_allclose(betas[i], expected_betas.ravel())
+            np.testing.assert_allclose(cov_inverse[i], expected_cov_inverse)
+
+    def test_iwls_batch(self):
+        betas, y_hat, _, irls_weights, _, fisher_inv = regression_utils.iwls_batch(
+            self.y, self.x, self.w_batch, distr="poisson", tol=1e-6
+        )
+        for i in range(self.w_batch.shape[0]):
+            expected = regression_utils.iwls(
+                self.y, self.x, distr="poisson", tol=1e-6, spatial_weights=self.w_batch[i].A.T
+            )
+            entries = slice(self.w_batch.indptr[i], self.w_batch.indptr[i + 1])
+            neighbors = self.w_batch.indices[entries]
+            np.testing.assert_allclose(betas[i], expected[0].ravel(), rtol=1e-5)
+            np.testing.assert_allclose(y_hat[entries], expected[1][neighbors].ravel(), rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(irls_weights[entries], expected[3][neighbors].ravel(), rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(fisher_inv[i], expected[7], rtol=1e-5)
+
+    def test_batched_inverse(self):
+        xtx = np.stack([self.x.T @ self.x, np.diag([1.0, 2.0, 0.0])])
+        inverse = regression_utils.batched_inverse(xtx)
+        np.testing.assert_allclose(inverse[0], np.linalg.inv(xtx[0]))
+        np.testing.assert_allclose(inverse[1], np.linalg.pinv(xtx[1]))
+
+    def test_permutation_testing(self):
+        rng = np.random.default_rng(0)
+        data = scipy.sparse.random(300, 20, density=0.2, format="csr", random_state=0)
+        rows = rng.choice(300, 30, replace=False)
+        cols = rng.choice(20, 30)
+        # Subsets are chosen such that there are both duplicate and unique rows:
+        for subset_rows, subset_cols in ((rows, None), (rows, cols), (np.concatenate((rows, rows[:5])), None)):
+            if subset_cols is None:
+                observed = data.A[subset_rows, :].mean()
+                permuted = [data.A[rng.permutation(300)[subset_rows], :].mean() for _ in range(2000)]
+            else:
+                observed = data.A[subset_rows, subset_cols].mean()
+                permuted = [data.A[rng.permutation(300)[subset_rows], subset_cols].mean() for _ in range(2000)]
+            expected = (np.sum(np.array(permuted) > observed) + 1) / 2001
+            p_value = regression_utils.permutation_testing(
+                data, n_permutations=2000, subset_rows=subset_rows, subset_cols=subset_cols, random_state=0
+            )
+            self.assertAlmostEqual(p_value, expected, delta=0.05)
+            self.assertEqual(
+                regression_utils.permutation_testing(
+                    data.A, n_permutations=2000, subset_rows=subset_rows, subset_cols=subset_cols, random_state=0
+                ),
+                p_value,
+            )
+        self.assertEqual(regression_utils.permutation_testing(data, n_permutations=2000), 1 / 2001)
+        # Stops before all permutations are drawn, once the p-value is certain to be above the threshold:
+        p_value = regression_utils.permutation_testing(
+            data, n_permutations=2000, subset_rows=rows, significance_threshold=0.05, batch_size=100
+        )
+        self.assertGreater(p_value, 0.05)
+        n_drawn = [n for n in range(100, 2000, 100) if np.isclose(p_value * (n + 1), round(p_value * (n + 1)))]
+        self.assertTrue(len(n_drawn) > 0)
+
+    def test_permutation_testing_row_sums(self):
+        rng = np.random.default_rng(0)
+        rows = rng.choice(300, 30, replace=False)
+        counts = scipy.sparse.csr_matrix(rng.poisson(0.1, (300, 20)))
+        continuous = scipy.sparse.random(300, 20, density=0.2, format="csr", random_state=0)
+        # Row indices are only drawn when there are more distinct row sums than subset rows:
+        for data, draws_rows in ((counts, False), (continuous, True)):
+            with mock.patch.object(
+                regression_utils, "_permuted_row_images", wraps=regression_utils._permuted_row_images
+            ) as permuted_row_images:
+                p_value = regression_utils.permutation_testing(data, n_permutations=100, subset_rows=rows)
+            self.assertEqual(permuted_row_images.called, draws_rows)
+            self.assertTrue(0 < p_value <= 1)
+
+    def test_permuted_row_images(self):
+        # Both with few images, which are redrawn until distinct, and with many images, which are drawn with masks:
+        for n_images in (3, 5):
+            images = regression_utils._permuted_row_images(np.random.default_rng(0), 10, n_images, 20000)
+            self.assertTrue(np.all(np.sort(images, axis=1)[:, 1:] != np.sort(images, axis=1)[:, :-1]))
+            # Each row is equally likely to be the image of each of the rows:
+            for k in range(n_images):
+                np.testing.assert_allclose(np.bincount(images[:, k], minlength=10) / 20000, 0.1, atol=0.01)
@@ -0,0 +1,42 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from spateo.tools.CCI_effects_modeling import result_store
+
+from ..mixins import TestMixin
+
+
+class TestResultStore(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.df = pd.DataFrame(
+            rng.random((50, 4)),
+            index=pd.Index(np.arange(50, dtype=float), name="index"),
+            columns=["b_intercept", "b_Tgfb1", "se_intercept", "se_Tgfb1"],
+        )
+
+    def test_write_read_results(self):
+        named_df = self.df.set_axis([f"cell_{i}" for i in range(50)], axis=0)
+        for df in (self.df, named_df):
+            for ext in (".csv", ".h5"):
+                path = os.path.join(self.temp_dir, f"results_Ptn{ext}")
+                result_store.write_results(path, df)
+                self.assertTrue(result_store.is_result_file(path))
+                self.assertEqual(result_store.result_target(path), "Ptn")
+                self.assertEqual(result_store.read_result_columns(path), df.columns.tolist())
+                pd.testing.assert_frame_equal(result_store.read_results(path), df)
+                pd.testing.assert_frame_equal(
+                    result_store.read_results(path, columns=["se_Tgfb1", "b_Tgfb1"]), df[["se_Tgfb1", "b_Tgfb1"]]
+                )
+                self.assertEqual(result_store.read_results(path, columns=[]).shape, (50, 0))
+
+    def test_write_results_float32(self):
+        path = os.path.join(self.temp_dir, "results_Ptn.h5")
+        result_store.write_results(path, self.df, float32=True)
+        df = result_store.read_results(path)
+        self.assertTrue(all(dtype == np.float32 for dtype in df.dtypes))
+        np.testing.assert_allclose(df.values, self.df.values, rtol=1e-6)
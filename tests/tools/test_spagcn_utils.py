@@ -0,0 +1,69 @@
+from unittest import TestCase, mock
+
+import numpy as np
+import torch
+
+import spateo.tools.cluster.spagcn_utils as spagcn_utils
+
+from ..mixins import TestMixin
+
+
+class TestSpagcnUtils(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        grid = np.stack(np.meshgrid(np.arange(12), np.arange(10)), axis=-1).reshape(-1, 2)
+        self.x, self.y = grid[:, 0] * 5.0, grid[:, 1] * 5.0
+        self.image = rng.integers(0, 255, (70, 60, 3))
+        self.pred = np.where(self.x + rng.normal(0, 5, len(self.x)) > 30, "a", "b")
+
+    def test_calculate_adj_matrix(self):
+        kwargs = dict(x_pixel=self.x.astype(int), y_pixel=self.y.astype(int), image=self.image, beta=9)
+        adj = spagcn_utils.calculate_adj_matrix(self.x, self.y, **kwargs)
+
+        # Histology coordinate from the mean color of the window around each spot.
+        g = np.array(
+            [
+                self.image[max(0, i - 4) : i + 5, max(0, j - 4) : j + 5].mean(axis=(0, 1))
+                for i, j in zip(self.x.astype(int), self.y.astype(int))
+            ]
+        )
+        c3 = (g * g.var(axis=0)).sum(axis=1) / g.var(axis=0).sum()
+        z = (c3 - c3.mean()) / c3.std() * max(self.x.std(), self.y.std())
+        X = np.c_[self.x, self.y, z]
+        np.testing.assert_allclose(adj, np.linalg.norm(X[:, None] - X[None], axis=-1), rtol=1e-4, atol=1e-3)
+        self.assertEqual(adj.dtype, np.float32)
+        with mock.patch.object(spagcn_utils, "ADJ_BLOCK_SIZE", 1000):
+            np.testing.assert_array_equal(spagcn_utils.calculate_adj_matrix(self.x, self.y, **kwargs), adj)
+
+        # Sparse adjacency keeps the nearest neighbors, or all spots within a large radius.
+        sparse_adj = spagcn_utils.calculate_sparse_adj_matrix(self.x, self.y, n_neighbors=5, **kwargs)
+        self.assertGreaterEqual(sparse_adj.getnnz(axis=1).min(), 5)
+        rows, cols = sparse_adj.nonzero()
+        np.testing.assert_allclose(sparse_adj[rows, cols].A1, adj[rows, cols], rtol=1e-5)
+        sparse_adj = spagcn_utils.calculate_sparse_adj_matrix(self.x, self.y, radius=1e6, **kwargs)
+        for l in (1, 20):
+            self.assertAlmostEqual(spagcn_utils.calculate_p(sparse_adj, l), spagcn_utils.calculate_p(adj, l), places=4)
+        np.testing.assert_allclose(
+            spagcn_utils._exp_adj(sparse_adj, 20).toarray(), spagcn_utils._exp_adj(adj, 20), atol=1e-6
+        )
+
+    def test_refine(self):
+        sample_id = [str(i) for i in range(len(self.x))]
+        adj = spagcn_utils.calculate_adj_matrix(self.x, self.y, histology=False)
+        sparse_adj = spagcn_utils.calculate_sparse_adj_matrix(self.x, self.y, histology=False, n_neighbors=8)
+        self.assertEqual(
+            spagcn_utils.refine(sample_id, self.pred, sparse_adj, shape="square"),
+            spagcn_utils.refine(sample_id, self.pred, adj, shape="square"),
+        )
+
+    def test_graph_convolution(self):
+        torch.manual_seed(0)
+        features = torch.randn(len(self.x), 6)
+        adj = spagcn_utils.calculate_adj_matrix(self.x, self.y, histology=False)
+        sparse_adj = spagcn_utils.calculate_sparse_adj_matrix(self.x, self.y, histology=False, radius=1e6)
+        gc = spagcn_utils.GraphConvolution(6, 4)
+        dense = gc(features, spagcn_utils._torch_adj(spagcn_utils._exp_adj(adj, 10)))
+        sparse = gc(features, spagcn_utils._torch_adj(spagcn_utils._exp_adj(sparse_adj, 10)))
+        self.assertTrue(spagcn_utils._torch_adj(spagcn_utils._exp_adj(sparse_adj, 10)).is_sparse)
+        np.testing.assert_allclose(sparse.detach().numpy(), dense.detach().numpy(), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+import numpy as np
+from scipy import sparse
+
+import spateo.tools.spatial_smooth as spatial_smooth
+
+from ..mixins import TestMixin
+
+
+class TestSpatialSmooth(TestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(2021)
+        self.X = rng.poisson(0.7, (50, 8)).astype(float)
+        self.W = (rng.random((50, 50)) < 0.2) * rng.random((50, 50))
+        np.fill_diagonal(self.W, 0)
+        self.ct = rng.choice(["a", "b"], 50)
+        self.subset = rng.poisson(1, (50, 6))
+
+    def test_jaccard_similarity(self):
+        expected = spatial_smooth.compute_jaccard_similarity_matrix(self.subset, chunk_size=7)
+        np.testing.assert_allclose(
+            spatial_smooth.compute_jaccard_similarity_matrix(sparse.csr_matrix(self.subset), chunk_size=7).toarray(),
+            expected,
+        )
+        rows, cols = np.nonzero(self.W)
+        for data in (self.subset, sparse.csr_matrix(self.subset)):
+            np.testing.assert_allclose(
+                spatial_smooth.edge_jaccard_similarity(data, rows, cols, chunk_size=13), expected[rows, cols]
+            )
+
+    def test_smooth_normalized(self):
+        W = self.W * (self.ct[:, None] == self.ct)
+        expected = (W / W.sum(axis=1, keepdims=True)) @ self.X
+        x_new, d = spatial_smooth.smooth(sparse.csr_matrix(self.X), sparse.csr_matrix(self.W), ct=self.ct)
+        self.assertTrue(sparse.issparse(x_new))
+        np.testing.assert_allclose(x_new.toarray(), expected)
+        np.testing.assert_allclose(d, W.sum(axis=1))
+
+        x_new, _ = spatial_smooth.smooth(self.X, self.W, ct=self.ct)
+        np.testing.assert_allclose(x_new, expected)
+
+    def test_smooth_nonzero_average(self):
+        x_new = spatial_smooth.smooth(self.X, self.W, normalize_W=False, smoothing_threshold=1)
+        expressed = (self.X != 0).astype(float)
+        counts = (self.W != 0).astype(float) @ expressed
+        expected = np.where(
+            (expressed == 0) & (counts > 1), (self.W @ self.X) / np.maximum(self.W @ expressed, 1e-300), self.X
+        )
+        np.testing.assert_allclose(x_new, expected)
+
+        jaccard = spatial_smooth.compute_jaccard_similarity_matrix(self.subset, min_jaccard=0.05)
+        x_new, W = spatial_smooth.smooth(
+            sparse.csr_matrix(self.X), self.W, gene_expr_subset=self.subset, normalize_W=False, return_W=True
+        )
+        edges = jaccard[self.W != 0]
+        np.testing.assert_array_equal(W != 0, (self.W != 0) & (jaccard >= np.median(edges[edges != 0])))